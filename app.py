@@ -1,79 +1,548 @@
-from flask import Flask, jsonify, request, g
+from flask import Flask, Response, jsonify, request, g, has_request_context, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from concurrent.futures import ThreadPoolExecutor, wait
 from functools import wraps
 from jwt import ExpiredSignatureError, InvalidTokenError
+from db_pool import ConnectionPool, PoolExhaustedError
+from db_routing import READ_METHODS, create_read_router
+from bulk_ingest import BulkLoader, BulkRecordType, StockCheck, iter_csv_records, iter_ndjson_records
+from token_cache import TokenCache
+from response_cache import create_response_cache
+from events import create_event_broadcaster
+from export import EXPORT_FORMATS, ExportFormatError, check_format as check_export_format, iter_export
+from idempotency import create_idempotency_store
+from planning import RequirementsPlanner
+from search import CatalogSearchIndex, SearchIndexLoader
+from stock_ledger import StockLedgerFolder
+from db_instrument import InstrumentedConnection
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Registry, param_shape
+from urllib.parse import urlencode
+from serializer import UnsupportedFormatError
 import pyodbc
+import serializer
 import jwt
+import base64
+import binascii
 import datetime
+import hashlib
+import hmac
+import ipaddress
+import json
+import os
+import re
+import threading
+import time
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = '123456'  # 密钥
-CORS(app)
+# 签发 token 的密钥，生产环境必须通过环境变量 SECRET_KEY 设置（启动自检会拒绝默认值）
+DEFAULT_SECRET_KEY = '123456'
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', DEFAULT_SECRET_KEY)
+# 数据库连接串，可通过环境变量 CHEMICAL_FACTORY_DB 覆盖
+app.config['DB_CONNECTION_STRING'] = os.environ.get(
+    'CHEMICAL_FACTORY_DB',
+    'DRIVER={ODBC Driver 13 for SQL Server};'  # ODBC驱动版本
+    'SERVER=127.0.0.1;'
+    'DATABASE=chemical_factory;'
+    'Trusted_Connection=yes;'  # 使用Windows身份验证
+)
+# 连接池配置
+app.config['DB_POOL_MIN_SIZE'] = int(os.environ.get('DB_POOL_MIN_SIZE', 2))
+app.config['DB_POOL_MAX_SIZE'] = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 5))  # 取连接最长等待秒数
+app.config['DB_POOL_MAX_USES'] = int(os.environ.get('DB_POOL_MAX_USES', 1000))  # 连接借出多少次后重建
+app.config['DB_POOL_MAX_LIFETIME'] = float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800))  # 连接存活多少秒后重建
+app.config['DB_POOL_HEALTH_CHECK_INTERVAL'] = float(os.environ.get('DB_POOL_HEALTH_CHECK_INTERVAL', 30))  # 空闲多少秒后借出前检查
+app.config['DB_QUERY_TIMEOUT'] = int(os.environ.get('DB_QUERY_TIMEOUT', 0))  # 单条SQL最长执行秒数，0 表示不限制
+# 列表接口分页配置
+app.config['PAGE_SIZE_DEFAULT'] = int(os.environ.get('PAGE_SIZE_DEFAULT', 100))
+app.config['PAGE_SIZE_MAX'] = int(os.environ.get('PAGE_SIZE_MAX', 1000))
+app.config['STREAM_BATCH_SIZE'] = int(os.environ.get('STREAM_BATCH_SIZE', 500))  # 流式输出每批 fetchmany 的行数
+app.config['BULK_CHUNK_SIZE'] = int(os.environ.get('BULK_CHUNK_SIZE', 500))  # 批量导入每批提交的记录数
+app.config['BULK_CHUNK_SIZE_MAX'] = 5000
+# 记录历史导出（/export）：每批 fetchmany 的行数（即 Parquet 每个 row group 的行数）、Parquet 压缩算法
+app.config['EXPORT_BATCH_SIZE'] = int(os.environ.get('EXPORT_BATCH_SIZE', 50000))
+app.config['EXPORT_PARQUET_COMPRESSION'] = os.environ.get('EXPORT_PARQUET_COMPRESSION', 'snappy')
+# 已验证 token 缓存：最多缓存多少个 token、每个缓存多少秒（不会超过 token 自身的 exp）
+app.config['TOKEN_CACHE_SIZE'] = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))
+app.config['TOKEN_CACHE_TTL'] = float(os.environ.get('TOKEN_CACHE_TTL', 300))
+# 原料、产品目录的响应缓存：local 为进程内缓存，redis 为多进程共享缓存（需安装 redis 包）
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'local')
+app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL', 'redis://127.0.0.1:6379/0')
+app.config['CACHE_TTL'] = float(os.environ.get('CACHE_TTL', 300))
+app.config['CACHE_MAX_ENTRIES'] = int(os.environ.get('CACHE_MAX_ENTRIES', 1024))
+app.config['LOW_STOCK_USAGE_WINDOW_DAYS'] = int(os.environ.get('LOW_STOCK_USAGE_WINDOW_DAYS', 30))  # 估算可用天数时参考最近多少天的用量
+# 添加生产记录时是否拒绝会使原料库存变为负数的记录（默认允许，与之前的行为一致）
+app.config['PRODUCTION_REJECT_NEGATIVE_STOCK'] = os.environ.get('PRODUCTION_REJECT_NEGATIVE_STOCK', '').lower() in ('1', 'true', 'yes')
+# 新增记录接口的幂等键（Idempotency-Key）：存储后端（默认与响应缓存相同）、成功响应保存多少秒、进程内最多保存多少个键、
+# 相同键的并发请求最多等待多少秒、执行中的标记多少秒后自动释放（Redis 后端，防止进程中途退出后键一直被占用）
+app.config['IDEMPOTENCY_BACKEND'] = os.environ.get('IDEMPOTENCY_BACKEND', app.config['CACHE_BACKEND'])
+app.config['IDEMPOTENCY_TTL'] = float(os.environ.get('IDEMPOTENCY_TTL', 86400))
+app.config['IDEMPOTENCY_MAX_ENTRIES'] = int(os.environ.get('IDEMPOTENCY_MAX_ENTRIES', 10000))
+app.config['IDEMPOTENCY_WAIT_TIMEOUT'] = float(os.environ.get('IDEMPOTENCY_WAIT_TIMEOUT', 30))
+app.config['IDEMPOTENCY_LOCK_TTL'] = float(os.environ.get('IDEMPOTENCY_LOCK_TTL', 120))
+# 同时运行的工作进程数，由多进程启动器（serve.py）在工作进程 fork 之后设置，不从环境变量读取
+app.config['WORKER_PROCESSES'] = 1
+# 读写分离（db_routing.py）：只读副本的连接串（为空表示不使用副本，全部请求走主库）、副本连接池最大连接数、
+# 允许的最大复制延迟秒数（0 表示不检查延迟，如两个互不复制的本地测试库）、检查副本状态的间隔秒数、
+# 用户写入后多少秒内的读请求走主库（读你所写）及其存储后端（默认与响应缓存相同，多进程部署需用 redis）
+app.config['DB_REPLICA_CONNECTION_STRING'] = os.environ.get('CHEMICAL_FACTORY_DB_REPLICA', '')
+app.config['DB_REPLICA_POOL_MAX_SIZE'] = int(os.environ.get('DB_REPLICA_POOL_MAX_SIZE', 0)) or app.config['DB_POOL_MAX_SIZE']
+app.config['DB_REPLICA_MAX_LAG'] = float(os.environ.get('DB_REPLICA_MAX_LAG', 5))
+app.config['DB_REPLICA_CHECK_INTERVAL'] = float(os.environ.get('DB_REPLICA_CHECK_INTERVAL', 1))
+app.config['DB_READ_YOUR_WRITES_WINDOW'] = float(os.environ.get('DB_READ_YOUR_WRITES_WINDOW', 10))
+app.config['DB_STICKY_BACKEND'] = os.environ.get('DB_STICKY_BACKEND', app.config['CACHE_BACKEND'])
+# 库存流水（migrations/006_stock_ledger.sql）：后台合并流水的间隔秒数（0 表示不在本进程合并）、每批合并的流水行数
+app.config['STOCK_LEDGER_FOLD_INTERVAL'] = float(os.environ.get('STOCK_LEDGER_FOLD_INTERVAL', 0))
+app.config['STOCK_LEDGER_FOLD_BATCH'] = int(os.environ.get('STOCK_LEDGER_FOLD_BATCH', 50000))
+# 原料/产品搜索：定时全量重建索引的间隔秒数（0 表示只在启动时加载，多进程部署时设置）、默认和最大返回条数
+app.config['SEARCH_INDEX_REFRESH_INTERVAL'] = float(os.environ.get('SEARCH_INDEX_REFRESH_INTERVAL', 0))
+app.config['SEARCH_DEFAULT_LIMIT'] = int(os.environ.get('SEARCH_DEFAULT_LIMIT', 20))
+app.config['SEARCH_MAX_LIMIT'] = int(os.environ.get('SEARCH_MAX_LIMIT', 100))
+# 物料需求计划：消耗系数缓存的最长刷新间隔秒数（本进程写入生产记录后下次计划时立即刷新）
+app.config['PLANNING_REFRESH_INTERVAL'] = float(os.environ.get('PLANNING_REFRESH_INTERVAL', 30))
+# /healthz 检查数据库时的查询超时秒数
+app.config['HEALTHZ_DB_TIMEOUT'] = int(os.environ.get('HEALTHZ_DB_TIMEOUT', 2))
+# 响应压缩：是否启用、小于多少字节的响应不压缩、gzip 压缩级别、brotli 压缩质量（需安装 brotli）
+app.config['COMPRESSION_ENABLED'] = os.environ.get('COMPRESSION_ENABLED', '1').lower() in ('1', 'true', 'yes')
+app.config['COMPRESSION_MIN_SIZE'] = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+app.config['COMPRESSION_GZIP_LEVEL'] = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 5))
+app.config['COMPRESSION_BROTLI_QUALITY'] = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 4))
+# 变化事件推送（/events）：广播后端（local 只广播给本进程的连接，redis 通过发布/订阅转发给所有进程，默认与响应缓存相同）、
+# 每个连接最多缓存多少条未发送的事件、空闲时多少秒发一次心跳
+app.config['EVENTS_BACKEND'] = os.environ.get('EVENTS_BACKEND', app.config['CACHE_BACKEND'])
+app.config['EVENTS_QUEUE_SIZE'] = int(os.environ.get('EVENTS_QUEUE_SIZE', 100))
+app.config['EVENTS_HEARTBEAT_INTERVAL'] = float(os.environ.get('EVENTS_HEARTBEAT_INTERVAL', 15))
+# 在响应头 X-Query-Count / X-Query-Time 中返回本次请求执行的 SQL 条数和耗时（压测用，默认关闭）
+app.config['QUERY_COUNT_HEADER'] = os.environ.get('QUERY_COUNT_HEADER', '').lower() in ('1', 'true', 'yes')
+# 运行指标（/metrics）：是否启用、抓取时需要携带的 Bearer token、
+# 没有设置 token 时是否允许任何地址抓取（默认只允许本机直接访问）、慢查询日志阈值（秒）
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1').lower() in ('1', 'true', 'yes')
+app.config['METRICS_AUTH_TOKEN'] = os.environ.get('METRICS_AUTH_TOKEN', '')
+app.config['METRICS_PUBLIC'] = os.environ.get('METRICS_PUBLIC', '').lower() in ('1', 'true', 'yes')
+app.config['SLOW_QUERY_THRESHOLD'] = float(os.environ.get('SLOW_QUERY_THRESHOLD', 0.5))
+# ASGI 运行方式（asgi.py）：处理请求的线程数（默认与连接池最大连接数相同）、流式响应（NDJSON、/events）的线程数、
+# 单个请求的超时秒数（0 表示不限制）、最多同时排队的请求数、请求体大小上限（字节）
+app.config['ASGI_WORKERS'] = int(os.environ.get('ASGI_WORKERS', 0)) or app.config['DB_POOL_MAX_SIZE']
+app.config['ASGI_STREAM_WORKERS'] = int(os.environ.get('ASGI_STREAM_WORKERS', 64))
+app.config['ASGI_REQUEST_TIMEOUT'] = float(os.environ.get('ASGI_REQUEST_TIMEOUT', 60))
+app.config['ASGI_MAX_PENDING'] = int(os.environ.get('ASGI_MAX_PENDING', 2000))
+app.config['ASGI_MAX_BODY_SIZE'] = int(os.environ.get('ASGI_MAX_BODY_SIZE', 256 * 1024 * 1024))
+# 多进程运行方式（serve.py）：监听地址、工作进程数、工作方式（gthread 为每进程多线程的 WSGI，asgi 为每进程一个 uvicorn 事件循环）、
+# gthread 方式每进程的线程数（默认与连接池最大连接数相同）、keep-alive 秒数、请求超时秒数、
+# 优雅退出等待秒数、工作进程处理多少个请求后重启（0 表示不重启）
+app.config['SERVE_BIND'] = os.environ.get('SERVE_BIND', '0.0.0.0:5000')
+app.config['SERVE_WORKERS'] = int(os.environ.get('SERVE_WORKERS', 0)) or (os.cpu_count() or 1)
+app.config['SERVE_WORKER_CLASS'] = os.environ.get('SERVE_WORKER_CLASS', 'gthread')
+app.config['SERVE_THREADS'] = int(os.environ.get('SERVE_THREADS', 0)) or app.config['DB_POOL_MAX_SIZE']
+app.config['SERVE_KEEPALIVE'] = int(os.environ.get('SERVE_KEEPALIVE', 5))
+app.config['SERVE_TIMEOUT'] = int(os.environ.get('SERVE_TIMEOUT', 60))
+app.config['SERVE_GRACEFUL_TIMEOUT'] = int(os.environ.get('SERVE_GRACEFUL_TIMEOUT', 30))
+app.config['SERVE_MAX_REQUESTS'] = int(os.environ.get('SERVE_MAX_REQUESTS', 0))
+# 每个进程最多同时保持多少个 /events 连接（0 表示不限制），超过后返回 503。每个连接在推送期间一直占用一个线程
+# （gthread 方式占用处理请求的线程，ASGI 方式占用流式响应的线程），默认为这些线程数的一半，留下另一半处理其他请求
+_event_threads = (app.config['ASGI_STREAM_WORKERS'] if app.config['SERVE_WORKER_CLASS'] == 'asgi'
+                  else app.config['SERVE_THREADS'])
+app.config['EVENTS_MAX_SUBSCRIBERS'] = int(os.environ.get('EVENTS_MAX_SUBSCRIBERS', max(1, _event_threads // 2)))
+CORS(app, expose_headers=['X-Next-Cursor', 'Link', 'ETag', 'Idempotent-Replayed'])
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# ASGI 运行方式下放在 environ 中的取消句柄，请求超时或客户端断开时用来取消正在执行的 SQL
+CANCEL_SCOPE_ENVIRON_KEY = 'chemical_factory.cancel_scope'
 ROLE_PERMISSIONS = {
     'admin': {
         'materials': ['GET', 'POST', 'PUT', 'DELETE'],
         'products': ['GET', 'POST', 'PUT', 'DELETE'],
         'purchase_records': ['GET', 'POST', 'PUT', 'DELETE'],
         'sale_records': ['GET', 'POST', 'PUT', 'DELETE'],
-        'production_records': ['GET', 'POST']
+        'production_records': ['GET', 'POST'],
+        'events': ['GET'],
+        'analytics': ['GET', 'POST'],
+        'stock_snapshots': ['GET', 'POST'],
+        'planning': ['POST'],
+        'export': ['GET'],
+        'system': ['GET']
     },
     'buyer': {
         'materials': ['GET'],
         'products': ['GET'],
         'purchase_records': ['GET', 'POST'],
         'sale_records': [],
-        'production_records': []
+        'production_records': [],
+        'events': ['GET'],
+        'planning': ['POST'],
+        'export': ['GET']
     },
     'distributor': {
         'materials': ['GET'],
         'products': ['GET'],
         'purchase_records': [],
         'sale_records': ['GET', 'POST'],
-        'production_records': []
+        'production_records': [],
+        'events': ['GET'],
+        'export': ['GET']
     },
     'worker': {
         'materials': ['GET'],
         'products': ['GET'],
         'purchase_records': [],
         'sale_records': [],
-        'production_records': ['GET', 'POST']
+        'production_records': ['GET', 'POST'],
+        'events': ['GET'],
+        'analytics': ['GET'],
+        'planning': ['POST'],
+        'export': ['GET']
     }
 }
-# 数据库配置
+# 运行指标，由 /metrics 以 Prometheus 文本格式输出
+metrics = Registry()
+REQUEST_DURATION = metrics.histogram(
+    'http_request_duration_seconds', '请求处理耗时', ('endpoint', 'method', 'status'))
+REQUEST_QUERIES = metrics.histogram(
+    'db_queries_per_request', '每个请求执行的SQL条数', ('endpoint',),
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100))
+REQUEST_QUERY_TIME = metrics.histogram(
+    'db_query_seconds_per_request', '每个请求执行SQL的总耗时', ('endpoint',))
+QUERY_DURATION = metrics.histogram('db_query_duration_seconds', '单条SQL的执行耗时')
+SLOW_QUERIES = metrics.counter('db_slow_queries_total', '超过慢查询阈值的SQL条数', ('endpoint',))
+AUTH_DURATION = metrics.histogram('auth_duration_seconds', 'token_required 鉴权通过所用的时间')
+JSON_DURATION = metrics.histogram('json_serialize_duration_seconds', 'JSON序列化耗时')
+
+
+# 按格式编码响应数据并统计序列化耗时，返回 (bytes, 媒体类型)
+def serialize(obj, fmt='json'):
+    start = time.perf_counter()
+    try:
+        return serializer.encode(obj, fmt)
+    finally:
+        if app.config['METRICS_ENABLED']:
+            JSON_DURATION.observe(time.perf_counter() - start)
+
+
+# jsonify 和 flask.json.dumps 都经过这里，由 serializer 编码（安装了 orjson 时不经过标准库 json），
+# 类型转换与 Flask 默认的编码一致
+class FastJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        return serialize(obj)[0].decode('utf-8')
+
+    def response(self, *args, **kwargs):
+        body, mimetype = serialize(self._prepare_response_obj(args, kwargs))
+        return self._app.response_class(body + b'\n', mimetype=mimetype)
+
+
+app.json = FastJSONProvider(app)
+
+# 数据库连接池，每个进程第一次使用时创建；配置了只读副本时另有一个副本连接池
+_pool = None
+_replica_pool = None
+_pool_lock = threading.Lock()
+
+
+def create_pool(connection_string, max_size):
+    return ConnectionPool(
+        connection_string,
+        min_size=min(app.config['DB_POOL_MIN_SIZE'], max_size),
+        max_size=max_size,
+        timeout=app.config['DB_POOL_TIMEOUT'],
+        max_uses=app.config['DB_POOL_MAX_USES'],
+        max_lifetime=app.config['DB_POOL_MAX_LIFETIME'],
+        health_check_interval=app.config['DB_POOL_HEALTH_CHECK_INTERVAL'],
+    )
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = create_pool(app.config['DB_CONNECTION_STRING'], app.config['DB_POOL_MAX_SIZE'])
+    return _pool
+
+
+def get_replica_pool():
+    global _replica_pool
+    if _replica_pool is None:
+        with _pool_lock:
+            if _replica_pool is None:
+                _replica_pool = create_pool(app.config['DB_REPLICA_CONNECTION_STRING'],
+                                            app.config['DB_REPLICA_POOL_MAX_SIZE'])
+    return _replica_pool
+
+
+# 读写分离路由，没有配置只读副本时为 None（全部请求走主库）
+read_router = create_read_router(
+    get_pool, get_replica_pool,
+    sticky_backend=app.config['DB_STICKY_BACKEND'],
+    redis_url=app.config['CACHE_REDIS_URL'],
+    sticky_window=app.config['DB_READ_YOUR_WRITES_WINDOW'],
+    interval=app.config['DB_REPLICA_CHECK_INTERVAL'],
+    max_lag=app.config['DB_REPLICA_MAX_LAG'],
+    logger=app.logger,
+) if app.config['DB_REPLICA_CONNECTION_STRING'] else None
+
+
+# 不写数据库的 POST 接口（请求体只用来传参数）：与 GET 一样可以走副本，也不算作用户的写入
+READ_ONLY_ENDPOINTS = frozenset(['plan_requirements'])
+
+
+def is_read_request():
+    return request.method in READ_METHODS or request.endpoint in READ_ONLY_ENDPOINTS
+
+
+# 读你所写的记录只保存在本进程、而有多个工作进程时，用户的下一个请求可能落到其他进程而读到副本上的旧数据，
+# 此时读请求全部走主库（serve.py 启动时会拒绝这种配置，这里防止运行中增加的工作进程）
+def replica_reads_safe():
+    return read_router.sticky_backend.shared or app.config['WORKER_PROCESSES'] <= 1
+
+
+# 读请求在副本可用、且用户最近没有写入时借副本连接，其他请求借主库连接。
+# 连不上副本时标记副本不可用，本次改借主库连接
+def acquire_request_connection():
+    if read_router is not None and has_request_context() and read_router.use_replica(
+            is_read_request(), g.get('current_user'), g.get('read_primary', False) or not replica_reads_safe()):
+        pool = get_replica_pool()
+        try:
+            return pool, pool.acquire(), 'replica'
+        except pyodbc.Error as e:
+            read_router.replica_failed(e)
+    pool = get_pool()
+    return pool, pool.acquire(), 'primary'
+
+
+# 从连接池借出连接，同一个请求内复用
 def get_db():
     if 'db' not in g:
-        g.db = pyodbc.connect(
-            'DRIVER={ODBC Driver 13 for SQL Server};' # ODBC驱动版本
-            'SERVER=127.0.0.1;'
-            'DATABASE=chemical_factory;'
-            'Trusted_Connection=yes;'  # 使用Windows身份验证
-        )
-    return g.db
+        g.db_pool, g.db, g.db_route = acquire_request_connection()
+        if has_request_context() and not is_read_request():
+            g.db_wrote = True  # 请求成功后记下该用户的写入时间（见 record_user_write）
+        g.db.timeout = app.config['DB_QUERY_TIMEOUT']
+        cancel_scope = get_cancel_scope()
+        if cancel_scope is not None or app.config['METRICS_ENABLED'] or app.config['QUERY_COUNT_HEADER']:
+            g.db_instrumented = InstrumentedConnection(
+                g.db, record_query, cancel_scope.track if cancel_scope is not None else None)
+    return g.get('db_instrumented') or g.db
+
+
+def get_cancel_scope():
+    return request.environ.get(CANCEL_SCOPE_ENVIRON_KEY) if has_request_context() else None
+
+
+# 并发查询用的线程池，每个任务都占着一个借来的连接，线程数不会超过连接池大小
+_fanout_executor = ThreadPoolExecutor(app.config['DB_POOL_MAX_SIZE'], thread_name_prefix='db-fanout')
 
 
+# 并发执行互不依赖的只读查询，按顺序返回各个 task(cursor) 的结果。
+# 第一个任务在本请求的连接上执行，其余任务各自借一个空闲连接在线程池中执行；
+# 连接池没有空闲连接时不等待，剩下的任务在本请求的连接上依次执行
+def run_concurrently(*tasks):
+    conn = get_db()
+    pool = g.db_pool  # 与本请求的连接同在主库或同在副本
+    borrowed = []
+    for _ in tasks[1:]:
+        extra = pool.acquire(block=False)
+        if extra is None:
+            break
+        borrowed.append(extra)
+    if not borrowed:
+        return [task(conn.cursor()) for task in tasks]
+
+    cancel_scope = get_cancel_scope()
+    queries = []  # 其他线程执行的 SQL，回到本线程后再计入本请求的统计
+
+    def run_on(extra, task):
+        extra.timeout = app.config['DB_QUERY_TIMEOUT']
+        observed = InstrumentedConnection(extra, lambda *args: queries.append(args),
+                                          cancel_scope.track if cancel_scope is not None else None)
+        return task(observed.cursor())
+
+    futures = [_fanout_executor.submit(run_on, extra, task) for extra, task in zip(borrowed, tasks[1:])]
+    results = [None] * len(tasks)
+    try:
+        for i in [0] + list(range(len(borrowed) + 1, len(tasks))):
+            results[i] = tasks[i](conn.cursor())
+    finally:
+        wait(futures)
+        for extra, future in zip(borrowed, futures):
+            pool.release(extra, discard=isinstance(future.exception(), pyodbc.Error))
+        for args in queries:
+            record_query(*args)
+    for i, future in enumerate(futures, 1):
+        results[i] = future.result()
+    return results
+
+
+# 统计本次请求执行的 SQL 条数和耗时；超过阈值的语句记入慢查询日志（只记录参数的类型和长度，不记录值）
+def record_query(sql, params, seconds):
+    g.query_count = g.get('query_count', 0) + 1
+    g.query_time = g.get('query_time', 0.0) + seconds
+    QUERY_DURATION.observe(seconds)
+    if seconds >= app.config['SLOW_QUERY_THRESHOLD']:
+        endpoint = (request.endpoint if has_request_context() else None) or 'unmatched'
+        SLOW_QUERIES.inc(endpoint)
+        statement = ' '.join(sql.split())
+        if len(statement) > 1000:
+            statement = statement[:1000] + '...'
+        app.logger.warning(f"慢查询 {seconds * 1000:.1f} ms [{endpoint}] {statement} 参数: {param_shape(params)}")
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def add_query_count_header(response):
+    if app.config['QUERY_COUNT_HEADER']:
+        response.headers['X-Query-Count'] = str(g.get('query_count', 0))
+        response.headers['X-Query-Time'] = f"{g.get('query_time', 0.0) * 1000:.3f}"
+        if 'db_route' in g:
+            response.headers['X-Db-Route'] = g.db_route
+    return response
+
+
+# 读你所写：用户的写请求成功后，之后 DB_READ_YOUR_WRITES_WINDOW 秒内该用户的读请求走主库
+@app.after_request
+def record_user_write(response):
+    if read_router is not None and g.get('db_wrote') and response.status_code < 400:
+        read_router.record_write(g.get('current_user'))
+    return response
+
+
+# 按 Accept-Encoding 压缩响应（br 优先，其次 gzip）。流式响应和已经压缩的响应不处理；
+# 压缩后强 ETag 改为弱 ETag，客户端带回的 If-None-Match 仍按弱比较与未压缩的 ETag 匹配
+@app.after_request
+def compress_response(response):
+    if (not app.config['COMPRESSION_ENABLED'] or response.is_streamed or response.direct_passthrough
+            or 'Content-Encoding' in response.headers or response.status_code in (204, 206, 304)):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = serializer.negotiate_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    # 没有 Content-Length 头的非流式响应（如 Response 直接传入列表）按实际内容计算大小
+    size = response.content_length
+    if size is None:
+        size = len(response.get_data())
+    if size < app.config['COMPRESSION_MIN_SIZE']:
+        return response
+    response.set_data(serializer.compress(response.get_data(), encoding,
+                                          gzip_level=app.config['COMPRESSION_GZIP_LEVEL'],
+                                          brotli_quality=app.config['COMPRESSION_BROTLI_QUALITY']))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# 流式响应只统计到开始输出为止
+@app.after_request
+def record_request_metrics(response):
+    if app.config['METRICS_ENABLED'] and 'request_start' in g:
+        endpoint = request.endpoint or 'unmatched'
+        REQUEST_DURATION.observe(time.perf_counter() - g.request_start,
+                                 endpoint, request.method, response.status_code)
+        REQUEST_QUERIES.observe(g.get('query_count', 0), endpoint)
+        REQUEST_QUERY_TIME.observe(g.get('query_time', 0.0), endpoint)
+    return response
+
+
+# 请求结束时把连接还给连接池，出错的请求直接丢弃该连接
 @app.teardown_appcontext
 def close_db(error):
-    if 'db' in g:
-        g.db.close()
+    g.pop('db_instrumented', None)
+    db = g.pop('db', None)
+    pool = g.pop('db_pool', None)
+    if db is not None:
+        pool.release(db, discard=isinstance(error, pyodbc.Error))
+
+
+# 连接池耗尽时返回503，提示客户端稍后重试
+@app.errorhandler(PoolExhaustedError)
+def handle_pool_exhausted(error):
+    app.logger.warning(f"数据库连接池耗尽: {error}")
+    response = jsonify({'message': '服务器繁忙，请稍后重试', 'error': str(error)})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+# 已验证 token 的缓存，命中时跳过 jwt.decode
+token_cache = TokenCache(app.config['TOKEN_CACHE_SIZE'], app.config['TOKEN_CACHE_TTL'])
+
+# 库存流水的后台合并，STOCK_LEDGER_FOLD_INTERVAL 大于 0 时启动
+stock_ledger_folder = StockLedgerFolder(get_pool, app.config['STOCK_LEDGER_FOLD_INTERVAL'],
+                                        app.config['STOCK_LEDGER_FOLD_BATCH'], app.logger)
+
+# 原料/产品的内存搜索索引，启动时在后台加载，增删改接口提交后同步更新
+search_indexes = {
+    'materials': CatalogSearchIndex(
+        'materials',
+        "SELECT material_id, name, cas_number, category, unit, concentration FROM ChemicalMaterial",
+        'material_id', ['material_id', 'name', 'cas_number', 'category', 'unit', 'concentration'],
+        cas_field='cas_number', filter_fields=['category'],
+    ),
+    'products': CatalogSearchIndex(
+        'products',
+        "SELECT product_id, name, unit, hazard_rating FROM ChemicalProduct",
+        'product_id', ['product_id', 'name', 'unit', 'hazard_rating'],
+        filter_fields=['hazard_rating'],
+    ),
+}
+search_index_loader = SearchIndexLoader(get_pool, search_indexes, app.config['SEARCH_INDEX_REFRESH_INTERVAL'],
+                                        app.logger)
+
+# 物料需求计划的消耗系数缓存，第一次计划时从生产历史加载
+requirements_planner = RequirementsPlanner(app.config['PLANNING_REFRESH_INTERVAL'])
+
+# 路由权限表：(角色, endpoint) -> 允许的请求方法。
+# 第一次鉴权时根据 ROLE_PERMISSIONS 和已注册的路由编译，之后每个请求只做一次字典查找
+_route_permissions = None
+_route_permissions_lock = threading.Lock()
+
+
+def compile_route_permissions():
+    table = {}
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint == 'static':
+            continue
+        base_route = rule.rule.strip('/').split('/')[0]
+        for role, routes in ROLE_PERMISSIONS.items():
+            # 路由不在权限配置中时不加入表，查不到即拒绝访问
+            if base_route in routes:
+                table[(role, rule.endpoint)] = frozenset(routes[base_route])
+    return table
+
+
+def get_route_permissions():
+    global _route_permissions
+    if _route_permissions is None:
+        with _route_permissions_lock:
+            if _route_permissions is None:
+                _route_permissions = compile_route_permissions()
+    return _route_permissions
+
 
 # 权限控制装饰器
 def token_required(roles=None):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
+            auth_start = time.perf_counter()
             token = None
 
             # 1. 从请求头获取token
             auth_header = request.headers.get('Authorization')
             if auth_header and auth_header.startswith('Bearer '):
-                token = auth_header.split(" ")[1]
+                token = auth_header[7:]
 
             if not token:
                 return jsonify({'message': 'Token is missing!'}), 401
 
             try:
-                # 2. 解码和验证token
-                data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+                # 2. 解码和验证token，已验证过且未过期的token直接取缓存
+                data = token_cache.get(token)
+                if data is None:
+                    data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+                    token_cache.put(token, data)
                 current_user = data['username']
                 current_role = data['role']
 
@@ -82,22 +551,17 @@ def token_required(roles=None):
                     return jsonify({'message': '操作权限不足'}), 403
 
                 # 4. 检查路由权限
-                path_parts = [part for part in request.path.split('/') if part]
-                if path_parts:  # 确保路径不为空
-                    base_route = path_parts[0]
-
-                    # 检查路由是否在权限配置中
-                    if base_route in ROLE_PERMISSIONS.get(current_role, {}):
-                        allowed_methods = ROLE_PERMISSIONS[current_role][base_route]
-                        if request.method not in allowed_methods:
-                            return jsonify({'message': '操作权限不足'}), 403
-                    else:
-                        # 如果路由不在权限配置中，默认拒绝访问
-                        return jsonify({'message': 'No permission for this resource!'}), 403
+                allowed_methods = get_route_permissions().get((current_role, request.endpoint))
+                if allowed_methods is None:
+                    # 如果路由不在权限配置中，默认拒绝访问
+                    return jsonify({'message': 'No permission for this resource!'}), 403
+                if request.method not in allowed_methods:
+                    return jsonify({'message': '操作权限不足'}), 403
 
                 # 将用户信息存储在g对象中，供视图函数使用
                 g.current_user = current_user
                 g.current_role = current_role
+                AUTH_DURATION.observe(time.perf_counter() - auth_start)
 
                 return f(*args, **kwargs)
 
@@ -105,6 +569,8 @@ def token_required(roles=None):
                 return jsonify({'message': 'Token has expired!'}), 401
             except InvalidTokenError:
                 return jsonify({'message': 'Invalid token!'}), 401
+            except PoolExhaustedError:
+                raise
             except Exception as e:
                 app.logger.error(f"Authentication error: {str(e)}")
                 return jsonify({'message': 'Authentication failed!'}), 500
@@ -113,6 +579,617 @@ def token_required(roles=None):
 
     return decorator
 
+# 原料、产品目录的响应缓存。目录的增删改和任何会通过触发器改变库存的记录写入都会让对应的缓存失效
+response_cache = create_response_cache(
+    app.config['CACHE_BACKEND'],
+    redis_url=app.config['CACHE_REDIS_URL'],
+    ttl=app.config['CACHE_TTL'],
+    max_entries=app.config['CACHE_MAX_ENTRIES'],
+)
+CACHED_RESPONSE_HEADERS = ('X-Next-Cursor', 'Link', 'Vary')
+
+
+# 读缓存装饰器，放在 token_required 之后，先鉴权再查缓存。
+# 响应带强 ETag，客户端用 If-None-Match 重新验证时，缓存命中且未变化直接返回 304，不访问数据库
+def cached_response(namespace):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if wants_stream():
+                return f(*args, **kwargs)
+
+            # 列表接口按 ?format= / Accept 返回不同格式，缓存键带上格式
+            fmt, _ = response_format()
+            key = response_cache.key(namespace, f'{request.full_path}#{fmt or "json"}')
+            entry = response_cache.get(key)
+            if entry is None:
+                # 要写入缓存的结果从主库读取，副本上尚未同步的旧数据不会被缓存到下次失效
+                g.read_primary = True
+                response = app.make_response(f(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                body = response.get_data()
+                binary = response.mimetype == serializer.MSGPACK_MIMETYPE
+                entry = {
+                    'etag': hashlib.sha256(body).hexdigest()[:32],
+                    'body': base64.b64encode(body).decode('ascii') if binary else body.decode('utf-8'),
+                    'binary': binary,
+                    'mimetype': response.mimetype,
+                    'headers': {h: response.headers[h] for h in CACHED_RESPONSE_HEADERS if h in response.headers},
+                }
+                response_cache.set(key, entry)
+            else:
+                body = base64.b64decode(entry['body']) if entry.get('binary') else entry['body']
+                response = Response(body, mimetype=entry['mimetype'])
+                response.headers.update(entry['headers'])
+
+            response.set_etag(entry['etag'])
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response.make_conditional(request)
+
+        return decorated_function
+
+    return decorator
+
+
+# 新增记录的幂等键存储
+idempotency_store = create_idempotency_store(
+    app.config['IDEMPOTENCY_BACKEND'],
+    redis_url=app.config['CACHE_REDIS_URL'],
+    ttl=app.config['IDEMPOTENCY_TTL'],
+    max_entries=app.config['IDEMPOTENCY_MAX_ENTRIES'],
+    wait_timeout=app.config['IDEMPOTENCY_WAIT_TIMEOUT'],
+    pending_ttl=app.config['IDEMPOTENCY_LOCK_TTL'],
+)
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+
+# 幂等键装饰器，放在 token_required 之后。键按用户和接口区分，请求带 Idempotency-Key 时：
+# 重试直接返回第一次的成功响应（响应头 Idempotent-Replayed: true），相同键的并发请求等待第一次完成
+def idempotent(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is None:
+            return f(*args, **kwargs)
+        if not idempotency_key or len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return jsonify({'error': f'Idempotency-Key 长度应为 1-{IDEMPOTENCY_KEY_MAX_LENGTH} 个字符'}), 400
+
+        # 幂等键只保存在本进程、而有多个工作进程时，无法保证重试不重复创建记录，不执行请求
+        if not idempotency_store.shared and app.config['WORKER_PROCESSES'] > 1:
+            response = jsonify({'error': '服务端以多进程运行但幂等键只保存在进程内（IDEMPOTENCY_BACKEND=local），'
+                                         '无法保证不重复创建，请求未执行'})
+            response.status_code = 503
+            return response
+
+        key = idempotency_store.key(f'{g.current_user}:{request.endpoint}', idempotency_key)
+        outcome, saved = idempotency_store.begin(key, idempotency_store.fingerprint(request.get_data()))
+        if outcome == 'mismatch':
+            return jsonify({'error': '该 Idempotency-Key 已用于内容不同的请求'}), 422
+        if outcome == 'in_progress':
+            response = jsonify({'error': '相同 Idempotency-Key 的请求仍在处理中，请稍后重试'})
+            response.status_code = 409
+            response.headers['Retry-After'] = '1'
+            return response
+        if outcome == 'replay':
+            response = Response(saved['body'], status=saved['status'], mimetype=saved['mimetype'])
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = app.make_response(f(*args, **kwargs))
+        except BaseException:
+            idempotency_store.release(key)
+            raise
+        if 200 <= response.status_code < 300 and not response.is_streamed:
+            idempotency_store.complete(key, {
+                'status': response.status_code,
+                'body': response.get_data(as_text=True),
+                'mimetype': response.mimetype,
+            })
+        else:
+            idempotency_store.release(key)
+        return response
+
+    return decorated_function
+
+
+# 变化事件广播。写接口提交后发布事件，主题即 ROLE_PERMISSIONS 中的资源名，
+# 订阅者只收到其角色有 GET 权限的主题
+event_broadcaster = create_event_broadcaster(app.config['EVENTS_BACKEND'], app.config['CACHE_REDIS_URL'],
+                                             app.config['EVENTS_QUEUE_SIZE'], app.logger,
+                                             app.config['EVENTS_MAX_SUBSCRIBERS'])
+EVENT_TOPICS = ('materials', 'products', 'purchase_records', 'sale_records', 'production_records')
+# 有库存的目录：目录 -> (读取当前库存的视图, 主键列)
+STOCK_TABLES = {
+    'materials': ('vw_ChemicalMaterialCurrent', 'material_id'),
+    'products': ('vw_ChemicalProductCurrent', 'product_id'),
+}
+# 各类记录的明细表及其引用库存目录的列
+RECORD_STOCK_LINES = {
+    'purchase_records': ('PurchaseMaterial', 'material_id'),
+    'sale_records': ('SaleProduct', 'product_id'),
+    'production_records': ('UseMaterial', 'material_id'),
+}
+# IN 列表每次最多带多少个参数（SQL Server 单条语句参数上限为 2100）
+EVENT_QUERY_CHUNK = 1000
+
+
+def event_topics(role):
+    permissions = ROLE_PERMISSIONS.get(role, {})
+    return [topic for topic in EVENT_TOPICS if 'GET' in permissions.get(topic, [])]
+
+
+def publish_event(topic, payload):
+    event_broadcaster.publish(topic, serialize(payload)[0].decode('utf-8'))
+
+
+def query_stock(cursor, catalog, ids):
+    table, pk = STOCK_TABLES[catalog]
+    ids = sorted(set(ids))
+    items = []
+    for i in range(0, len(ids), EVENT_QUERY_CHUNK):
+        chunk = ids[i:i + EVENT_QUERY_CHUNK]
+        cursor.execute(f"SELECT {pk}, stock FROM {table} WHERE {pk} IN ({','.join('?' * len(chunk))})", chunk)
+        items.extend({pk: row[0], 'stock': row[1]} for row in cursor.fetchall())
+    return items
+
+
+# 查询记录明细涉及的原料/产品ID。删除记录时需要在删除之前调用
+def record_stock_ids(cursor, record_type, record_ids):
+    if not event_broadcaster.has_subscribers(RECORD_STOCK_CATALOGS[record_type]):
+        return []
+    line_table, column = RECORD_STOCK_LINES[record_type]
+    ids = set()
+    for i in range(0, len(record_ids), EVENT_QUERY_CHUNK):
+        chunk = record_ids[i:i + EVENT_QUERY_CHUNK]
+        cursor.execute(f"SELECT DISTINCT {column} FROM {line_table} "
+                       f"WHERE record_id IN ({','.join('?' * len(chunk))})", chunk)
+        ids.update(row[0] for row in cursor.fetchall())
+    return list(ids)
+
+
+# 目录变化事件：{"action": "created|updated|deleted|stock", "ids": [...], "items": [{主键, stock}]}
+# 事件在写入提交之后发布，查询失败只记录日志，不影响已经成功的写请求
+def publish_catalog_change(cursor, catalog, action, ids):
+    if not ids or not event_broadcaster.has_subscribers(catalog):
+        return
+    payload = {'action': action, 'ids': sorted(set(ids))}
+    try:
+        if action != 'deleted':
+            payload['items'] = query_stock(cursor, catalog, ids)
+    except pyodbc.Error as e:
+        app.logger.warning(f"变化事件查询库存失败: {e}")
+        return
+    publish_event(catalog, payload)
+
+
+# 记录变化事件：{"action": "created|deleted", "ids": [...]}，随后发布受影响原料/产品的库存事件
+def publish_record_change(cursor, record_type, action, record_ids, stock_ids):
+    if event_broadcaster.has_subscribers(record_type):
+        publish_event(record_type, {'action': action, 'ids': record_ids})
+    publish_catalog_change(cursor, RECORD_STOCK_CATALOGS[record_type], 'stock', stock_ids)
+
+
+# 列表接口的游标分页与流式输出
+# 按 (排序列, 主键) 做键集分页：每页都是一次带索引条件的 TOP 查询，
+# 不使用 OFFSET，所以翻到多深的位置代价都一样。
+# 响应体仍是 JSON 数组，下一页游标放在 X-Next-Cursor 响应头（以及 Link 头）中，没有下一页时不返回。
+def encode_cursor(sort_value, pk_value):
+    if isinstance(sort_value, (datetime.date, datetime.datetime)):
+        sort_value = sort_value.isoformat()
+    raw = json.dumps([sort_value, pk_value], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    raw = base64.urlsafe_b64decode((token + '=' * (-len(token) % 4)).encode('ascii'))
+    value = json.loads(raw.decode('utf-8'))
+    if not isinstance(value, list) or len(value) != 2 or not isinstance(value[1], int):
+        raise ValueError('invalid cursor')
+    return value
+
+
+def parse_date(raw):
+    return datetime.date.fromisoformat(raw)
+
+
+# 解析查询参数中的过滤条件
+# spec: {参数名: (SQL条件, 转换函数)}，条件中用一个 ? 占位
+def parse_filter_args(spec):
+    conditions, params = [], []
+    for name, (condition, convert) in spec.items():
+        raw = request.args.get(name)
+        if raw is None or raw == '':
+            continue
+        try:
+            value = convert(raw)
+        except ValueError:
+            return None, None, (jsonify({'error': f'参数 {name} 格式错误'}), 400)
+        conditions.append(condition)
+        params.append(value)
+    return conditions, params, None
+
+
+# 生成"排在游标之后"的条件。SQL Server 中 NULL 升序排最前、降序排最后
+def keyset_condition(sort_col, pk_col, sort_value, pk_value, descending):
+    op = '<' if descending else '>'
+    if sort_col == pk_col:
+        return f"{pk_col} {op} ?", [pk_value]
+    if sort_value is None:
+        if descending:
+            return f"{sort_col} IS NULL AND {pk_col} < ?", [pk_value]
+        return f"({sort_col} IS NULL AND {pk_col} > ?) OR {sort_col} IS NOT NULL", [pk_value]
+    if descending:
+        condition = f"{sort_col} < ? OR {sort_col} IS NULL OR ({sort_col} = ? AND {pk_col} < ?)"
+    else:
+        condition = f"{sort_col} > ? OR ({sort_col} = ? AND {pk_col} > ?)"
+    return condition, [sort_value, sort_value, pk_value]
+
+
+# 解析 limit 参数，default 为 None 时表示不限制条数
+def parse_limit(default, maximum=None):
+    raw = request.args.get('limit')
+    if raw is None or raw == '':
+        return default, None
+    try:
+        limit = int(raw)
+    except ValueError:
+        return None, (jsonify({'error': '参数 limit 必须是整数'}), 400)
+    if limit < 1:
+        return None, (jsonify({'error': '参数 limit 必须大于0'}), 400)
+    if maximum:
+        limit = min(limit, maximum)
+    return limit, None
+
+
+# 根据排序、过滤和游标参数拼出列表查询，返回 (SQL, 参数, 排序字段名, 错误响应)
+# columns/from_sql: SELECT 的列和 FROM 子句
+# pk: 结果中的主键列名；sortable: {可排序字段名: SQL列}，必须包含 pk
+# default_sort: 默认排序字段，前缀 - 表示降序；filters: 见 parse_filter_args
+# top: 最多取多少行，None 表示不限制
+def build_list_query(columns, from_sql, pk, sortable, default_sort, filters=None, top=None):
+    sort = request.args.get('sort') or default_sort
+    descending = sort.startswith('-')
+    sort_name = sort.lstrip('-')
+    if sort_name not in sortable:
+        return None, None, None, (jsonify({'error': f'不支持的排序字段: {sort_name}，可选 {", ".join(sortable)}'}), 400)
+    sort_col, pk_col = sortable[sort_name], sortable[pk]
+
+    conditions, params, error = parse_filter_args(filters or {})
+    if error:
+        return None, None, None, error
+
+    after = request.args.get('after')
+    if after:
+        try:
+            after_value, after_pk = decode_cursor(after)
+        except (ValueError, binascii.Error, UnicodeDecodeError):
+            return None, None, None, (jsonify({'error': '分页游标 after 无效'}), 400)
+        condition, condition_params = keyset_condition(sort_col, pk_col, after_value, after_pk, descending)
+        conditions.append(condition)
+        params.extend(condition_params)
+
+    direction = 'DESC' if descending else 'ASC'
+    where = ' WHERE ' + ' AND '.join(f'({c})' for c in conditions) if conditions else ''
+    order = f" ORDER BY {sort_col} {direction}"
+    if sort_col != pk_col:
+        order += f", {pk_col} {direction}"
+
+    if top is None:
+        return f"SELECT {columns} FROM {from_sql}{where}{order}", params, sort_name, None
+    return f"SELECT TOP (?) {columns} FROM {from_sql}{where}{order}", [top] + params, sort_name, None
+
+
+# 查询一页数据，返回 (列名, 行, 下一页游标, 错误响应)，参数同 build_list_query。
+# 既没有 limit 也没有 after 时与分页之前的接口一样返回全部数据，客户端传 limit 才开始分页；
+# 此时 expand 也会展开全部记录，展开函数需按 EVENT_QUERY_CHUNK 分批查询（见 attach_record_lines）
+def query_page(cursor, columns, from_sql, pk, sortable, default_sort, filters=None):
+    default_limit = app.config['PAGE_SIZE_DEFAULT'] if request.args.get('after') else None
+    limit, error = parse_limit(default_limit, app.config['PAGE_SIZE_MAX'])
+    if error:
+        return None, None, None, error
+    if limit is None:
+        sql, params, _, error = build_list_query(columns, from_sql, pk, sortable, default_sort, filters)
+        if error:
+            return None, None, None, error
+        cursor.execute(sql, params)
+        return [column[0] for column in cursor.description], cursor.fetchall(), None, None
+
+    # 多取一行用来判断是否还有下一页
+    sql, params, sort_name, error = build_list_query(columns, from_sql, pk, sortable, default_sort, filters, top=limit + 1)
+    if error:
+        return None, None, None, error
+    cursor.execute(sql, params)
+    names = [column[0] for column in cursor.description]
+    rows = cursor.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = dict(zip(names, rows[-1]))
+        next_cursor = encode_cursor(last[sort_name], last[pk])
+    return names, rows, next_cursor, None
+
+
+# 列表接口的响应格式：json（默认，每行一个对象）、columns（列名 + 行数组）、msgpack（columns 的 MessagePack 编码），
+# 由 ?format= 或 Accept 头选择。返回 (格式, 错误响应)
+def response_format():
+    try:
+        return serializer.negotiate_format(request.args.get('format'), request.accept_mimetypes), None
+    except UnsupportedFormatError as e:
+        return None, (jsonify({'error': str(e)}), 406)
+
+
+# 把一页数据包装成响应，附带下一页游标。fmt 不是 json 时 items 为 columns 格式
+def page_response(items, next_cursor, fmt='json'):
+    if fmt == 'json':
+        response = jsonify(items)
+    else:
+        body, mimetype = serialize(items, fmt)
+        response = Response(body, mimetype=mimetype)
+    response.vary.add('Accept')
+    if next_cursor:
+        args = [(k, v) for k, v in request.args.items(multi=True) if k != 'after']
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = f'<{request.base_url}?{urlencode(args + [("after", next_cursor)])}>; rel="next"'
+    return response
+
+
+# 客户端是否要求流式返回：Accept: application/x-ndjson 或 ?stream=1
+def wants_stream():
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+# 逐批 fetchmany 并编码为 NDJSON（每行一个 JSON 对象），内存占用与结果集大小无关
+def iter_ndjson(cursor, batch_size):
+    names = [column[0] for column in cursor.description]
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield b''.join(serializer.dumps_json(dict(zip(names, row))) + b'\n' for row in rows)
+
+
+def iter_cursor_output(cursor, chunks):
+    try:
+        yield from chunks
+    except pyodbc.Error as e:
+        # 响应头已经发出，只能记录日志并提前结束
+        app.logger.error(f"流式输出中断: {str(e)}")
+    finally:
+        cursor.close()
+
+
+# 流式返回已执行查询的结果，默认编码为 NDJSON。查询在调用前执行，出错时仍能返回普通的错误响应。
+# 数据库连接从 g 中取出，等响应真正发送完毕（或客户端断开）后才归还连接池
+def stream_response(cursor, chunks=None, mimetype=NDJSON_MIMETYPE):
+    g.pop('db_instrumented', None)
+    conn = g.pop('db', None)
+    pool = g.pop('db_pool', None)
+    if chunks is None:
+        chunks = iter_ndjson(cursor, app.config['STREAM_BATCH_SIZE'])
+    response = Response(stream_with_context(iter_cursor_output(cursor, chunks)), mimetype=mimetype)
+    response.headers['X-Accel-Buffering'] = 'no'  # 避免反向代理缓冲整个响应
+    if conn is not None:
+        response.call_on_close(lambda: pool.release(conn))
+    return response
+
+
+# 列表接口通用实现：分页、排序、过滤；流式模式下默认返回全部结果（可用 limit 限制）
+# expansions: {expand 参数中的名称: 函数(cursor, 本页数据)}，用于 ?expand= 批量附加关联数据
+def list_response(columns, from_sql, pk, sortable, default_sort, filters=None, expansions=None):
+    expand, error = parse_expand(expansions or {})
+    if error:
+        return error
+    cursor = get_db().cursor()
+    if wants_stream():
+        if expand:
+            return jsonify({'error': '流式模式不支持 expand 参数'}), 400
+        limit, error = parse_limit(None)
+        if error:
+            return error
+        sql, params, _, error = build_list_query(columns, from_sql, pk, sortable, default_sort, filters, top=limit)
+        if error:
+            return error
+        cursor.execute(sql, params)
+        return stream_response(cursor)
+
+    fmt, error = response_format()
+    if error:
+        return error
+    names, rows, next_cursor, error = query_page(cursor, columns, from_sql, pk, sortable, default_sort, filters)
+    if error:
+        return error
+    if fmt != 'json' and not expand:
+        # 查询结果按行元组直接编码，不构造每行的字典
+        return page_response(serializer.columns_payload(names, rows), next_cursor, fmt)
+    items = [dict(zip(names, row)) for row in rows]
+    for name in expand:
+        expansions[name](cursor, items)
+    return page_response(items if fmt == 'json' else serializer.items_to_columns(items), next_cursor, fmt)
+
+
+# 关联数据展开（?expand=）
+# 列表或详情需要的明细、名称等关联数据，按整页的记录ID批量查询后再分组挂到各条记录上，
+# 每 EVENT_QUERY_CHUNK 条记录一次查询（分页时一页只需一次），客户端也不必再逐条请求明细接口
+
+# 解析 expand 参数，返回 (要展开的名称集合, 错误响应)
+def parse_expand(allowed):
+    raw = request.args.get('expand', '')
+    names = {name.strip() for name in raw.split(',') if name.strip()}
+    unknown = names - set(allowed)
+    if unknown:
+        options = ', '.join(allowed) if allowed else '无'
+        return None, (jsonify({'error': f'不支持的 expand: {", ".join(sorted(unknown))}，可选 {options}'}), 400)
+    return names, None
+
+
+# 各类记录的明细查询：(明细在响应中的字段名, SQL)，字段与对应的明细接口一致
+RECORD_LINE_QUERIES = {
+    'purchase_records': ('materials', """
+        SELECT PM.record_id, CM.material_id, CM.name, PM.quantity, PM.unit_price, CM.unit
+        FROM PurchaseMaterial PM
+        JOIN ChemicalMaterial CM ON CM.material_id = PM.material_id
+        WHERE PM.record_id IN ({ids})
+    """),
+    'sale_records': ('products', """
+        SELECT SP.record_id, CP.product_id, CP.name, SP.quantity, SP.unit_price, CP.unit
+        FROM SaleProduct SP
+        JOIN ChemicalProduct CP ON CP.product_id = SP.product_id
+        WHERE SP.record_id IN ({ids})
+    """),
+    'production_records': ('materials', """
+        SELECT um.record_id, um.material_id, cm.name AS material_name, um.quantity_used, cm.unit
+        FROM UseMaterial um
+        JOIN ChemicalMaterial cm ON um.material_id = cm.material_id
+        WHERE um.record_id IN ({ids})
+    """),
+}
+
+
+# 按 record_id 批量取出多条记录的全部明细，挂到各条记录上。
+# 不分页的列表可能有任意多条记录，每 EVENT_QUERY_CHUNK 个ID一次查询，不超过单条语句的参数上限
+def attach_record_lines(cursor, record_type, items):
+    key, sql = RECORD_LINE_QUERIES[record_type]
+    lines = {item['record_id']: [] for item in items}
+    ids = list(lines)
+    for i in range(0, len(ids), EVENT_QUERY_CHUNK):
+        chunk = ids[i:i + EVENT_QUERY_CHUNK]
+        cursor.execute(sql.format(ids=','.join('?' * len(chunk))), chunk)
+        names = [column[0] for column in cursor.description]
+        for row in cursor.fetchall():
+            line = dict(zip(names, row))
+            lines[line.pop('record_id')].append(line)
+    for item in items:
+        item[key] = lines[item['record_id']]
+
+
+# 批量取出多条记录引用的名称（供应商、客户、员工），写入 name_field 字段，同样按 EVENT_QUERY_CHUNK 分批
+def attach_names(cursor, items, id_field, table, name_field):
+    ids = sorted({item[id_field] for item in items if item.get(id_field) is not None})
+    names = {}
+    for i in range(0, len(ids), EVENT_QUERY_CHUNK):
+        chunk = ids[i:i + EVENT_QUERY_CHUNK]
+        cursor.execute(f"SELECT {id_field}, name FROM {table} WHERE {id_field} IN ({','.join('?' * len(chunk))})",
+                       chunk)
+        names.update(cursor.fetchall())
+    for item in items:
+        item[name_field] = names.get(item.get(id_field))
+
+
+# 查询一条记录的主表信息，with_lines 时同时取出明细（两条查询并发执行），记录不存在返回 None
+def query_record_detail(sql, record_type, record_id, with_lines):
+    def fetch_record(cursor):
+        cursor.execute(sql, (record_id,))
+        columns = [column[0] for column in cursor.description]
+        row = cursor.fetchone()
+        return dict(zip(columns, row)) if row else None
+
+    if not with_lines:
+        return fetch_record(get_db().cursor())
+
+    def fetch_lines(cursor):
+        holder = {'record_id': record_id}
+        attach_record_lines(cursor, record_type, [holder])
+        return holder[RECORD_LINE_QUERIES[record_type][0]]
+
+    record, lines = run_concurrently(fetch_record, fetch_lines)
+    if record is not None:
+        record[RECORD_LINE_QUERIES[record_type][0]] = lines
+    return record
+
+
+def record_lines_expansion(record_type):
+    return lambda cursor, items: attach_record_lines(cursor, record_type, items)
+
+
+def names_expansion(id_field, table, name_field):
+    return lambda cursor, items: attach_names(cursor, items, id_field, table, name_field)
+
+
+PURCHASE_EXPANSIONS = {
+    'lines': record_lines_expansion('purchase_records'),
+    'supplier': names_expansion('supplier_id', 'Supplier', 'supplier_name'),
+    'employee': names_expansion('employee_id', 'Buyer', 'employee_name'),
+}
+SALE_EXPANSIONS = {
+    'lines': record_lines_expansion('sale_records'),
+    'customer': names_expansion('customer_id', 'Customer', 'customer_name'),
+    'employee': names_expansion('employee_id', 'Distributor', 'employee_name'),
+}
+PRODUCTION_EXPANSIONS = {
+    'lines': record_lines_expansion('production_records'),
+}
+
+
+# 历史时点库存（见 migrations/003_stock_snapshots.sql）：
+# 某日库存 = 不晚于该日的最近一次快照 + 快照日之后到该日的每日出入库汇总（索引视图）；
+# 该日之前还没有快照时，用当前库存减去该日之后的出入库：要汇总该日之后每一天每个原料/产品的变化量，
+# 代价随该日之后的天数线性增长，不再与历史长度无关，只在还没有补建快照（或查询早于第一次快照的日期）时出现。
+# 快照之后新建的原料/产品在该快照日没有快照行，按 0 计（新建时库存为 0）；补录到快照日之前的明细由触发器
+# 先补上快照行再修正（migrations/010_snapshot_rows_for_new_items.sql）
+# 目录 -> (快照类型, 当前库存视图, 主键, 返回的其他列, 每日变化量)
+STOCK_AT_CATALOGS = {
+    'materials': ('M', 'vw_ChemicalMaterialCurrent', 'material_id', ['name', 'unit'], """
+        SELECT material_id AS item_id, date, quantity FROM vw_PurchaseMaterialDaily WITH (NOEXPAND)
+        UNION ALL
+        SELECT material_id, date, -quantity FROM vw_UseMaterialDaily WITH (NOEXPAND)
+    """),
+    'products': ('P', 'vw_ChemicalProductCurrent', 'product_id', ['name', 'unit'], """
+        SELECT product_id AS item_id, date, -quantity AS quantity FROM vw_SaleProductDaily WITH (NOEXPAND)
+    """),
+}
+
+
+def stock_at_response(catalog):
+    raw = request.args.get('date')
+    if not raw:
+        return jsonify({'error': '缺少参数 date'}), 400
+    try:
+        day = parse_date(raw)
+    except ValueError:
+        return jsonify({'error': '参数 date 格式错误'}), 400
+
+    item_type, table, pk, fields, movements = STOCK_AT_CATALOGS[catalog]
+    select_sql = ', '.join(f'c.{f}' for f in [pk] + fields)
+    cursor = get_db().cursor()
+    cursor.execute("SELECT MAX(snapshot_date) FROM StockSnapshot WHERE item_type = ? AND snapshot_date <= ?",
+                   (item_type, day))
+    snapshot_date = cursor.fetchone()[0]
+
+    if snapshot_date is not None:
+        cursor.execute(f"""
+            SELECT {select_sql}, ISNULL(s.stock, 0) + ISNULL(d.quantity, 0) AS stock
+            FROM {table} c
+            LEFT JOIN StockSnapshot s ON s.item_type = ? AND s.snapshot_date = ? AND s.item_id = c.{pk}
+            LEFT JOIN (
+                SELECT item_id, SUM(quantity) AS quantity FROM ({movements}) m
+                WHERE date > ? AND date <= ?
+                GROUP BY item_id
+            ) d ON d.item_id = c.{pk}
+            ORDER BY c.{pk}
+        """, (item_type, snapshot_date, snapshot_date, day))
+    else:
+        cursor.execute(f"""
+            SELECT {select_sql}, ISNULL(c.stock, 0) - ISNULL(d.quantity, 0) AS stock
+            FROM {table} c
+            LEFT JOIN (
+                SELECT item_id, SUM(quantity) AS quantity FROM ({movements}) m
+                WHERE date > ?
+                GROUP BY item_id
+            ) d ON d.item_id = c.{pk}
+            ORDER BY c.{pk}
+        """, (day,))
+    columns = [column[0] for column in cursor.description]
+    response = jsonify([dict(zip(columns, row)) for row in cursor.fetchall()])
+    if snapshot_date is not None:
+        response.headers['X-Stock-Snapshot-Date'] = snapshot_date.isoformat()
+    return response
+
+
 # 登录接口
 @app.route('/login', methods=['POST'])
 def login():
@@ -144,6 +1221,12 @@ def login():
     })
 
 
+# 原料、产品接口返回的列（与原表的列一致，不含 001 增加的计算列 is_low_stock）
+MATERIAL_COLUMNS = ('material_id, name, cas_number, stock, unit, concentration, category, '
+                    'storage_condition, min_stock_threshold')
+PRODUCT_COLUMNS = 'product_id, name, unit, stock, hazard_rating'
+
+
 # 原料数据格式
 '''
 {
@@ -160,18 +1243,22 @@ def login():
 #  获取所有原料
 @app.route('/materials', methods=['GET'])
 @token_required()
+@cached_response('materials')
 def get_materials():
-    cursor = get_db().cursor()
-    cursor.execute("SELECT * FROM ChemicalMaterial")
-    columns = [column[0] for column in cursor.description]
-    return jsonify([dict(zip(columns, row)) for row in cursor.fetchall()])
+    return list_response(
+        MATERIAL_COLUMNS, 'vw_ChemicalMaterialCurrent', 'material_id',
+        sortable={'material_id': 'material_id', 'name': 'name'},
+        default_sort='material_id',
+        filters={'category': ('category = ?', str)},
+    )
 
 # 由id获取单个原料
 @app.route('/materials/<int:material_id>', methods=['GET'])
 @token_required()
+@cached_response('materials')
 def get_material(material_id):
     cursor = get_db().cursor()
-    cursor.execute("SELECT * FROM ChemicalMaterial WHERE material_id=?", (material_id,))
+    cursor.execute(f"SELECT {MATERIAL_COLUMNS} FROM vw_ChemicalMaterialCurrent WHERE material_id=?", (material_id,))
     columns = [column[0] for column in cursor.description]
     row = cursor.fetchone()
     if row:
@@ -179,7 +1266,89 @@ def get_material(material_id):
     else:
         return jsonify({'message': f'id为{material_id}的原料不存在'}), 404
 
-# 由原料名搜索原料（未完成）
+# 低库存原料列表（库存低于最低库存阈值），附带按最近用量估算的可用天数
+# 依赖 migrations/001_low_stock_watchlist.sql 中的 is_low_stock 计算列及其索引。
+# 启用库存流水后 stock 可能还没有合并，候选为 stock 已低于阈值的原料（索引查找）加上有未合并流水的原料，
+# 再按当前库存判断
+@app.route('/materials/low_stock', methods=['GET'])
+@token_required()
+@cached_response('materials')
+def get_low_stock_materials():
+    window_days = app.config['LOW_STOCK_USAGE_WINDOW_DAYS']
+    since = datetime.date.today() - datetime.timedelta(days=window_days)
+    cursor = get_db().cursor()
+    cursor.execute("""
+        SELECT
+            cm.material_id,
+            cm.name,
+            cm.cas_number,
+            cm.category,
+            cm.stock,
+            cm.unit,
+            cm.min_stock_threshold,
+            ISNULL(u.used, 0) AS recent_usage
+        FROM vw_ChemicalMaterialCurrent cm
+        OUTER APPLY (
+            SELECT SUM(um.quantity_used) AS used
+            FROM UseMaterial um
+            JOIN ProductionRecord pr ON pr.record_id = um.record_id
+            WHERE um.material_id = cm.material_id AND pr.date >= ?
+        ) u
+        WHERE cm.material_id IN (
+            SELECT material_id FROM ChemicalMaterial WHERE is_low_stock = 1
+            UNION
+            SELECT item_id FROM StockLedger WHERE item_type = 'M'
+        ) AND cm.is_low_stock = 1
+        ORDER BY cm.material_id
+    """, (since,))
+    columns = [column[0] for column in cursor.description]
+
+    materials = []
+    for row in cursor.fetchall():
+        material = dict(zip(columns, row))
+        # 可用天数 = 当前库存 / 日均用量；最近没有用量时无法估算，返回 null
+        daily_usage = float(material['recent_usage']) / window_days
+        stock = float(material['stock'] or 0)
+        material['avg_daily_usage'] = round(daily_usage, 4)
+        material['days_of_cover'] = round(max(stock, 0) / daily_usage, 1) if daily_usage > 0 else None
+        materials.append(material)
+    return jsonify(materials), 200
+
+# 查询某日结束时各原料的库存
+@app.route('/materials/stock_at', methods=['GET'])
+@token_required()
+@cached_response('materials')
+def get_materials_stock_at():
+    return stock_at_response('materials')
+
+# 搜索原料/产品：q 匹配名称（前缀、包含、拼音）和 CAS 号（完全相同、前缀），结果按匹配方式排序。
+# 可按 filter_fields 中的列过滤，多个值用逗号分隔
+def search_response(catalog):
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': '缺少参数 q'}), 400
+    try:
+        limit = int(request.args.get('limit', app.config['SEARCH_DEFAULT_LIMIT']))
+    except ValueError:
+        return jsonify({'error': '参数 limit 必须是整数'}), 400
+    if limit < 1 or limit > app.config['SEARCH_MAX_LIMIT']:
+        return jsonify({'error': f"参数 limit 必须在 1-{app.config['SEARCH_MAX_LIMIT']} 之间"}), 400
+
+    index = search_indexes[catalog]
+    filters = {}
+    for field in index.filter_fields:
+        raw = request.args.get(field)
+        if raw:
+            filters[field] = {value.strip() for value in raw.split(',')}
+    search_index_loader.ensure_loaded(index)
+    return jsonify(index.search(query, limit, filters)), 200
+
+
+# 搜索原料
+@app.route('/materials/search', methods=['GET'])
+@token_required()
+def search_materials():
+    return search_response('materials')
 
 # 添加原料
 @app.route('/materials', methods=['POST'])
@@ -207,9 +1376,13 @@ def add_material():
     # cursor.execute("INSERT INTO ChemicalMaterial (name, cas_number, stock, unit, concentration, category, storage_condition, min_stock_threshold) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
     #               (data['name'], data['cas_number'], 0.0, data['unit'], data['concentration'], data['category'], data['storage_condition'], data['min_stock_threshold']))
     try:
-        cursor.execute("INSERT INTO ChemicalMaterial (name, cas_number, stock, unit, concentration, category, storage_condition, min_stock_threshold) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        cursor.execute("INSERT INTO ChemicalMaterial (name, cas_number, stock, unit, concentration, category, storage_condition, min_stock_threshold) OUTPUT INSERTED.material_id VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
                       (data['name'], data['cas_number'], 0.0, data['unit'], data['concentration'], data['category'], data['storage_condition'], data['min_stock_threshold']))
+        new_material_id = cursor.fetchone()[0]
         get_db().commit()
+        response_cache.invalidate('materials')
+        search_indexes['materials'].upsert(dict(data, material_id=new_material_id))
+        publish_catalog_change(cursor, 'materials', 'created', [new_material_id])
         return jsonify({'message': '原料添加成功'}), 201
     except pyodbc.IntegrityError:
         return jsonify({'message': '原料存在重复名称或CAS编号，添加失败'}), 409
@@ -246,6 +1419,9 @@ def update_material(material_id):
         cursor.execute("UPDATE ChemicalMaterial SET name=?, cas_number=?, unit=?, concentration=?, category=?, storage_condition=?, min_stock_threshold=? WHERE material_id=?",
                       (data['name'], data['cas_number'], data['unit'], data['concentration'], data['category'], data['storage_condition'], data['min_stock_threshold'], material_id))
         get_db().commit()
+        response_cache.invalidate('materials')
+        search_indexes['materials'].upsert(dict(data, material_id=material_id))
+        publish_catalog_change(cursor, 'materials', 'updated', [material_id])
         return jsonify({'message': '原料更新成功'}), 200
     except pyodbc.IntegrityError:
         return jsonify({'message': '原料存在重复名称或CAS编号，更新失败'}), 409
@@ -269,6 +1445,9 @@ def delete_material(material_id):
 
     cursor.execute("DELETE FROM ChemicalMaterial WHERE material_id=?", (material_id,))
     get_db().commit()
+    response_cache.invalidate('materials')
+    search_indexes['materials'].remove(material_id)
+    publish_catalog_change(cursor, 'materials', 'deleted', [material_id])
     return jsonify({'message': '原料删除成功'}), 200
 
 # 产品增删改查
@@ -284,18 +1463,22 @@ def delete_material(material_id):
 # 获取所有产品
 @app.route('/products', methods=['GET'])
 @token_required()
+@cached_response('products')
 def get_products():
-    cursor = get_db().cursor()
-    cursor.execute("SELECT * FROM ChemicalProduct")
-    columns = [column[0] for column in cursor.description]
-    return jsonify([dict(zip(columns, row)) for row in cursor.fetchall()])
+    return list_response(
+        PRODUCT_COLUMNS, 'vw_ChemicalProductCurrent', 'product_id',
+        sortable={'product_id': 'product_id', 'name': 'name'},
+        default_sort='product_id',
+        filters={'hazard_rating': ('hazard_rating = ?', str)},
+    )
 
 # 由id获取单个产品
 @app.route('/products/<int:product_id>', methods=['GET'])
 @token_required()
+@cached_response('products')
 def get_product(product_id):
     cursor = get_db().cursor()
-    cursor.execute("SELECT * FROM ChemicalProduct WHERE product_id=?", (product_id,))
+    cursor.execute(f"SELECT {PRODUCT_COLUMNS} FROM vw_ChemicalProductCurrent WHERE product_id=?", (product_id,))
     columns = [column[0] for column in cursor.description]
     row = cursor.fetchone()
     if row:
@@ -304,6 +1487,21 @@ def get_product(product_id):
         return jsonify({'message': f'id为{product_id}的产品不存在'}), 404
 
 
+# 查询某日结束时各产品的库存
+@app.route('/products/stock_at', methods=['GET'])
+@token_required()
+@cached_response('products')
+def get_products_stock_at():
+    return stock_at_response('products')
+
+
+# 搜索产品
+@app.route('/products/search', methods=['GET'])
+@token_required()
+def search_products():
+    return search_response('products')
+
+
 # 添加产品
 @app.route('/products', methods=['POST'])
 @token_required(roles=['admin'])
@@ -323,10 +1521,14 @@ def add_product():
     cursor = get_db().cursor()
     try:
         cursor.execute(
-            "INSERT INTO ChemicalProduct (name, unit, hazard_rating, stock) VALUES (?, ?, ?, 0.0)",
+            "INSERT INTO ChemicalProduct (name, unit, hazard_rating, stock) OUTPUT INSERTED.product_id VALUES (?, ?, ?, 0.0)",
             (data['name'], data['unit'], data['hazard_rating'])
         )
+        new_product_id = cursor.fetchone()[0]
         get_db().commit()
+        response_cache.invalidate('products')
+        search_indexes['products'].upsert(dict(data, product_id=new_product_id))
+        publish_catalog_change(cursor, 'products', 'created', [new_product_id])
         return jsonify({'message': '产品添加成功'}), 201
     except pyodbc.IntegrityError:
         return jsonify({'message': '产品名称已存在'}), 409
@@ -362,6 +1564,9 @@ def update_product(product_id):
             (data['name'], data['unit'], data['hazard_rating'], product_id)
         )
         get_db().commit()
+        response_cache.invalidate('products')
+        search_indexes['products'].upsert(dict(data, product_id=product_id))
+        publish_catalog_change(cursor, 'products', 'updated', [product_id])
         return jsonify({'message': '产品更新成功'}), 200
     except pyodbc.IntegrityError:
         return jsonify({'message': '产品名称已存在'}), 409
@@ -390,6 +1595,9 @@ def delete_product(product_id):
 
     cursor.execute("DELETE FROM ChemicalProduct WHERE product_id=?", (product_id,))
     get_db().commit()
+    response_cache.invalidate('products')
+    search_indexes['products'].remove(product_id)
+    publish_catalog_change(cursor, 'products', 'deleted', [product_id])
     return jsonify({'message': '产品删除成功'})
 
 # 进货记录增删改查
@@ -412,21 +1620,32 @@ def delete_product(product_id):
 @app.route('/purchase_records', methods=['GET'])
 @token_required(roles=['admin',  'buyer'])
 def get_purchase_records():
-    cursor = get_db().cursor()
-    cursor.execute("SELECT * FROM PurchaseRecord")
-    columns = [column[0] for column in cursor.description]
-    return jsonify([dict(zip(columns, row)) for row in cursor.fetchall()])
+    return list_response(
+        '*', 'PurchaseRecord', 'record_id',
+        sortable={'record_id': 'record_id', 'date': 'date'},
+        default_sort='record_id',
+        filters={
+            'from': ('date >= ?', parse_date),
+            'to': ('date <= ?', parse_date),
+            'supplier_id': ('supplier_id = ?', int),
+            'employee_id': ('employee_id = ?', int),
+        },
+        expansions=PURCHASE_EXPANSIONS,
+    )
 
 
 # 根据id获取进货记录详情
 @app.route('/purchase_records/<int:record_id>', methods=['GET'])
 @token_required(roles=['admin', 'buyer'])
 def get_purchase_record_detail(record_id):
-    try:
-        cursor = get_db().cursor()
+    # 详情已包含名称字段，expand 中的名称类展开无需额外查询，lines 会附带明细
+    expand, error = parse_expand(PURCHASE_EXPANSIONS)
+    if error:
+        return error
 
-        # 查询进货记录详情
-        cursor.execute("""
+    try:
+        # 查询进货记录详情（需要明细时与明细查询并发执行）
+        record = query_record_detail("""
             SELECT 
                 pr.record_id,
                 pr.date,
@@ -438,15 +1657,11 @@ def get_purchase_record_detail(record_id):
             JOIN Supplier s ON pr.supplier_id = s.supplier_id
             JOIN Buyer e ON pr.employee_id = e.employee_id
             WHERE pr.record_id = ?
-        """, (record_id,))
-
-        columns = [column[0] for column in cursor.description]
-        row = cursor.fetchone()
+        """, 'purchase_records', record_id, 'lines' in expand)
 
-        if not row:
+        if not record:
             return jsonify({"error": f"进货记录ID {record_id} 不存在"}), 404
-
-        return jsonify(dict(zip(columns, row))), 200
+        return jsonify(record), 200
 
     except pyodbc.Error as e:
         error_msg = str(e).split('\n')[0]
@@ -464,30 +1679,40 @@ def get_purchase_materials(record_id):
 
 
 
-# 添加进货记录（直接处理，不使用存储过程）
-@app.route('/purchase_records', methods=['POST'])
-@token_required(roles=['admin', 'buyer'])
-def add_purchase_record():
-    data = request.get_json()
-
+# 校验进货记录数据，返回错误信息，校验通过返回 None（数量、单价会被转换为 float）
+def validate_purchase_record(data):
     # 基本参数校验
     required_fields = ['supplier_id', 'date', 'employee_id', 'materials']
     for field in required_fields:
         if field not in data:
-            return jsonify({'error': f'缺少必要字段: {field}'}), 400
+            return f'缺少必要字段: {field}'
 
     if not isinstance(data['materials'], list) or len(data['materials']) == 0:
-        return jsonify({'error': 'materials必须非空'}), 400
+        return 'materials必须非空'
 
     for idx, item in enumerate(data['materials']):
         for key in ['material_id', 'quantity', 'unit_price']:
             if key not in item:
-                return jsonify({'error': f'materials[{idx}] 缺少字段: {key}'}), 400
+                return f'materials[{idx}] 缺少字段: {key}'
             if key in ['quantity', 'unit_price']:
                 try:
                     item[key] = float(item[key])
-                except ValueError:
-                    return jsonify({'error': f'materials[{idx}].{key} 必须是数字'}), 400
+                except (TypeError, ValueError):
+                    return f'materials[{idx}].{key} 必须是数字'
+    return None
+
+
+# 添加进货记录（调用存储过程 sp_AddPurchaseRecord，原料明细以表值参数一次性传入）
+@app.route('/purchase_records', methods=['POST'])
+@token_required(roles=['admin', 'buyer'])
+@idempotent
+def add_purchase_record():
+    data = request.get_json()
+
+    # 参数校验
+    error = validate_purchase_record(data)
+    if error:
+        return jsonify({'error': error}), 400
 
     # 准备参数
     supplier_id = data['supplier_id']
@@ -501,10 +1726,12 @@ def add_purchase_record():
         # 开始事务
         conn.autocommit = False
 
-        # 1. 插入进货记录主表
+        # 主表和全部进货明细在一次调用中写入（PurchaseMaterialType 表值参数），
+        # 明细为一条 INSERT ... SELECT，库存触发器只触发一次
         cursor.execute(
-            "INSERT INTO PurchaseRecord (supplier_id, date, employee_id) OUTPUT INSERTED.record_id VALUES (?, ?, ?)",
-            (supplier_id, record_date, employee_id)
+            "{CALL sp_AddPurchaseRecord (?, ?, ?, ?)}",
+            (supplier_id, record_date, employee_id,
+             [(m['material_id'], m['quantity'], m['unit_price']) for m in materials])
         )
 
         # 获取新生成的record_id
@@ -515,14 +1742,11 @@ def add_purchase_record():
 
         new_record_id = result[0]
 
-        # 2. 插入进货联系集（PurchaseMaterial）
-        for material in materials:
-            cursor.execute(
-                "INSERT INTO PurchaseMaterial (material_id, record_id, quantity, unit_price) VALUES (?, ?, ?, ?)",
-                (material['material_id'], new_record_id, material['quantity'], material['unit_price'])
-            )
         # 提交事务
         conn.commit()
+        response_cache.invalidate('materials')
+        publish_record_change(cursor, 'purchase_records', 'created', [new_record_id],
+                              [m['material_id'] for m in materials])
 
         return jsonify({
             "message": "进货记录添加成功",
@@ -570,9 +1794,14 @@ def delete_purchase_record(record_id):
         if not cursor.fetchone():
             return jsonify({'message': f'进货记录ID {record_id} 不存在'}), 404
 
+        # 删除前记下受影响的原料，用于推送库存变化
+        stock_ids = record_stock_ids(cursor, 'purchase_records', [record_id])
+
         # 调用存储过程删除记录
         cursor.execute("EXEC sp_DeletePurchaseRecord @record_id = ?", (record_id,))
         conn.commit()
+        response_cache.invalidate('materials')
+        publish_record_change(cursor, 'purchase_records', 'deleted', [record_id], stock_ids)
 
         return jsonify({'message': f'进货记录ID {record_id} 删除成功'}), 200
 
@@ -581,6 +1810,9 @@ def delete_purchase_record(record_id):
         error_msg = str(e).split('\n')[0]  # 只取第一行错误信息
         return jsonify({"error": f"数据库错误: {error_msg}"}), 500
 
+    except PoolExhaustedError:
+        raise
+
     except Exception as e:
         return jsonify({"error": f"服务器错误: {str(e)}"}), 500
 
@@ -588,21 +1820,32 @@ def delete_purchase_record(record_id):
 @app.route('/sale_records', methods=['GET'])
 @token_required(roles=['admin', 'distributor'])
 def get_sale_records():
-    cursor = get_db().cursor()
-    cursor.execute("SELECT * FROM SalesRecord")
-    columns = [column[0] for column in cursor.description]
-    return jsonify([dict(zip(columns, row)) for row in cursor.fetchall()])
+    return list_response(
+        '*', 'SalesRecord', 'record_id',
+        sortable={'record_id': 'record_id', 'date': 'date'},
+        default_sort='record_id',
+        filters={
+            'from': ('date >= ?', parse_date),
+            'to': ('date <= ?', parse_date),
+            'customer_id': ('customer_id = ?', int),
+            'employee_id': ('employee_id = ?', int),
+        },
+        expansions=SALE_EXPANSIONS,
+    )
 
 
 # 获取销售记录详情
 @app.route('/sale_records/<int:record_id>', methods=['GET'])
 @token_required(roles=['admin', 'distributor'])
 def get_sale_record_detail(record_id):
-    try:
-        cursor = get_db().cursor()
+    # 详情已包含名称字段，expand 中的名称类展开无需额外查询，lines 会附带明细
+    expand, error = parse_expand(SALE_EXPANSIONS)
+    if error:
+        return error
 
-        # 查询销售记录详情
-        cursor.execute("""
+    try:
+        # 查询销售记录详情（需要明细时与明细查询并发执行）
+        record = query_record_detail("""
             SELECT 
                 sr.record_id,
                 sr.date,
@@ -615,15 +1858,11 @@ def get_sale_record_detail(record_id):
             JOIN Customer c ON sr.customer_id = c.customer_id
             JOIN Distributor e ON sr.employee_id = e.employee_id
             WHERE sr.record_id = ?
-        """, (record_id,))
+        """, 'sale_records', record_id, 'lines' in expand)
 
-        columns = [column[0] for column in cursor.description]
-        row = cursor.fetchone()
-
-        if not row:
+        if not record:
             return jsonify({"error": f"销售记录ID {record_id} 不存在"}), 404
-
-        return jsonify(dict(zip(columns, row))), 200
+        return jsonify(record), 200
 
     except pyodbc.Error as e:
         error_msg = str(e).split('\n')[0]
@@ -646,32 +1885,42 @@ def get_sale_products(record_id):
 
 
 
-# 添加销售记录
-@app.route('/sale_records', methods=['POST'])
-@token_required(roles=['admin', 'distributor'])
-def add_sale_record():
-    data = request.get_json()
-
+# 校验销售记录数据，返回错误信息，校验通过返回 None（数量、单价会被转换为 float）
+def validate_sale_record(data):
     # 基本参数校验
     required_fields = ['customer_id', 'date', 'employee_id', 'products']
     for field in required_fields:
         if field not in data:
-            return jsonify({'error': f'缺少必要字段: {field}'}), 400
+            return f'缺少必要字段: {field}'
 
     if not isinstance(data['products'], list) or len(data['products']) == 0:
-        return jsonify({'error': 'products必须是非空数组'}), 400
+        return 'products必须是非空数组'
 
     for idx, item in enumerate(data['products']):
         for key in ['product_id', 'quantity', 'unit_price']:
             if key not in item:
-                return jsonify({'error': f'products[{idx}] 缺少字段: {key}'}), 400
+                return f'products[{idx}] 缺少字段: {key}'
             if key in ['quantity', 'unit_price']:
                 try:
                     item[key] = float(item[key])
-                except ValueError:
-                    return jsonify({'error': f'products[{idx}].{key} 必须是数字'}), 400
+                except (TypeError, ValueError):
+                    return f'products[{idx}].{key} 必须是数字'
                 if item[key] <= 0:
-                    return jsonify({'error': f'products[{idx}].{key} 必须大于0'}), 400
+                    return f'products[{idx}].{key} 必须大于0'
+    return None
+
+
+# 添加销售记录
+@app.route('/sale_records', methods=['POST'])
+@token_required(roles=['admin', 'distributor'])
+@idempotent
+def add_sale_record():
+    data = request.get_json()
+
+    # 参数校验
+    error = validate_sale_record(data)
+    if error:
+        return jsonify({'error': error}), 400
 
     # 准备参数
     customer_id = data['customer_id']
@@ -684,10 +1933,11 @@ def add_sale_record():
         # 开始事务
         conn.autocommit = False
 
-        # 1. 插入销售记录主表
+        # 主表和全部销售明细在一次调用中写入（SaleProductType 表值参数）
         cursor.execute(
-            "INSERT INTO SalesRecord (customer_id, date, employee_id) OUTPUT INSERTED.record_id VALUES (?, ?, ?)",
-            (customer_id, record_date, employee_id)
+            "{CALL sp_AddSalesRecord (?, ?, ?, ?)}",
+            (customer_id, record_date, employee_id,
+             [(p['product_id'], p['quantity'], p['unit_price']) for p in products])
         )
 
         # 获取新生成的record_id
@@ -698,15 +1948,11 @@ def add_sale_record():
 
         new_record_id = result[0]
 
-        # 2. 插入销售产品联系集（SaleProduct）
-        for product in products:
-            cursor.execute(
-                "INSERT INTO SaleProduct (product_id, record_id, quantity, unit_price) VALUES (?, ?, ?, ?)",
-                (product['product_id'], new_record_id, product['quantity'], product['unit_price'])
-            )
-
         # 提交事务（库存更新由触发器自动处理）
         conn.commit()
+        response_cache.invalidate('products')
+        publish_record_change(cursor, 'sale_records', 'created', [new_record_id],
+                              [p['product_id'] for p in products])
 
         return jsonify({
             "message": "销售记录添加成功",
@@ -744,9 +1990,14 @@ def delete_sale_record(record_id):
         if not cursor.fetchone():
             return jsonify({'message': f'销售记录ID {record_id} 不存在'}), 404
 
+        # 删除前记下受影响的产品，用于推送库存变化
+        stock_ids = record_stock_ids(cursor, 'sale_records', [record_id])
+
         # 调用存储过程删除记录
         cursor.execute("EXEC sp_DeleteSalesRecord @record_id = ?", (record_id,))
         conn.commit()
+        response_cache.invalidate('products')
+        publish_record_change(cursor, 'sale_records', 'deleted', [record_id], stock_ids)
 
         return jsonify({'message': f'销售记录ID {record_id} 删除成功'}), 200
 
@@ -756,6 +2007,9 @@ def delete_sale_record(record_id):
 
         return jsonify({"error": f"数据库错误: {error_msg}"}), 500
 
+    except PoolExhaustedError:
+        raise
+
     except Exception as e:
         return jsonify({"error": f"操作失败: {str(e)}"}), 500
 
@@ -765,27 +2019,32 @@ def delete_sale_record(record_id):
 @token_required(roles=['admin', 'worker'])
 def get_production_records():
     try:
-        cursor = get_db().cursor()
-
-        # 查询生产记录主表信息
-        cursor.execute("""
-            SELECT 
+        # 查询生产记录主表信息，默认按日期倒序
+        return list_response(
+            """
                 pr.record_id,
                 pr.date,
                 pr.theoretical_output,
                 pr.actual_output,
                 cp.name AS product_name,
                 pl.name AS line_name
-            FROM ProductionRecord pr
+            """,
+            """
+            ProductionRecord pr
             JOIN ChemicalProduct cp ON pr.product_id = cp.product_id
             JOIN ProductionLine pl ON pr.line_id = pl.line_id
-            ORDER BY pr.date DESC, pr.record_id DESC
-        """)
-
-        columns = [column[0] for column in cursor.description]
-        records = [dict(zip(columns, row)) for row in cursor.fetchall()]
-
-        return jsonify(records), 200
+            """,
+            'record_id',
+            sortable={'record_id': 'pr.record_id', 'date': 'pr.date'},
+            default_sort='-date',
+            filters={
+                'from': ('pr.date >= ?', parse_date),
+                'to': ('pr.date <= ?', parse_date),
+                'product_id': ('pr.product_id = ?', int),
+                'line_id': ('pr.line_id = ?', int),
+            },
+            expansions=PRODUCTION_EXPANSIONS,
+        )
 
     except pyodbc.Error as e:
         error_msg = str(e).split('\n')[0]
@@ -796,11 +2055,14 @@ def get_production_records():
 @app.route('/production_records/<int:record_id>', methods=['GET'])
 @token_required(roles=['admin', 'worker'])
 def get_production_record_detail(record_id):
-    try:
-        cursor = get_db().cursor()
+    # 详情已包含名称字段，expand 中的名称类展开无需额外查询，lines 会附带明细
+    expand, error = parse_expand(PRODUCTION_EXPANSIONS)
+    if error:
+        return error
 
-        # 查询生产记录详情
-        cursor.execute("""
+    try:
+        # 查询生产记录详情（需要明细时与明细查询并发执行）
+        record = query_record_detail("""
             SELECT 
                 pr.record_id,
                 pr.date,
@@ -814,15 +2076,11 @@ def get_production_record_detail(record_id):
             JOIN ChemicalProduct cp ON pr.product_id = cp.product_id
             JOIN ProductionLine pl ON pr.line_id = pl.line_id
             WHERE pr.record_id = ?
-        """, (record_id,))
+        """, 'production_records', record_id, 'lines' in expand)
 
-        columns = [column[0] for column in cursor.description]
-        row = cursor.fetchone()
-
-        if not row:
+        if not record:
             return jsonify({"error": f"生产记录ID {record_id} 不存在"}), 404
-
-        return jsonify(dict(zip(columns, row))), 200
+        return jsonify(record), 200
 
     except pyodbc.Error as e:
         error_msg = str(e).split('\n')[0]
@@ -863,80 +2121,88 @@ def get_production_record_materials(record_id):
         return jsonify({"error": f"数据库错误: {error_msg}"}), 500
 
 
-# 添加生产记录
-@app.route('/production_records', methods=['POST'])
-@token_required(roles=['admin', 'worker'])
-def add_production_record():
-    data = request.get_json()
-
+# 校验生产记录数据，返回错误信息，校验通过返回 None（产量、原料数量会被转换为 float）
+def validate_production_record(data):
     # 基本参数校验
     required_fields = ['product_id', 'line_id', 'date', 'theoretical_output', 'actual_output', 'materials']
     for field in required_fields:
         if field not in data:
-            return jsonify({'error': f'缺少必要字段: {field}'}), 400
+            return f'缺少必要字段: {field}'
 
     # 校验产量值
     try:
-        theoretical_output = float(data['theoretical_output'])
-        actual_output = float(data['actual_output'])
-        if theoretical_output <= 0 or actual_output <= 0:
-            return jsonify({'error': '理论产量和实际产量必须大于0'}), 400
+        data['theoretical_output'] = float(data['theoretical_output'])
+        data['actual_output'] = float(data['actual_output'])
+        if data['theoretical_output'] <= 0 or data['actual_output'] <= 0:
+            return '理论产量和实际产量必须大于0'
     except (TypeError, ValueError):
-        return jsonify({'error': '产量值必须是有效数字'}), 400
+        return '产量值必须是有效数字'
 
     # 校验原料列表
     if not isinstance(data['materials'], list) or len(data['materials']) == 0:
-        return jsonify({'error': 'materials必须是非空数组'}), 400
+        return 'materials必须是非空数组'
 
     for idx, material in enumerate(data['materials']):
         for key in ['material_id', 'quantity']:
             if key not in material:
-                return jsonify({'error': f'materials[{idx}] 缺少字段: {key}'}), 400
+                return f'materials[{idx}] 缺少字段: {key}'
         try:
             material['quantity'] = float(material['quantity'])
             if material['quantity'] <= 0:
-                return jsonify({'error': f'materials[{idx}].quantity 必须大于0'}), 400
+                return f'materials[{idx}].quantity 必须大于0'
         except (TypeError, ValueError):
-            return jsonify({'error': f'materials[{idx}].quantity 必须是有效数字'}), 400
+            return f'materials[{idx}].quantity 必须是有效数字'
+    return None
+
+
+# sp_AddProductionRecordValidated 抛出的错误号 -> HTTP 状态码
+# 50101 产品不存在、50102 生产线不存在、50103 原料不存在、50104 原料库存不足
+PRODUCTION_RECORD_ERRORS = {50101: 400, 50102: 400, 50103: 400, 50104: 409}
+PROCEDURE_ERROR_PATTERN = re.compile(r'\[SQL Server\](.*?) \((5\d{4})\)')
+
+
+# 从 pyodbc 异常中取出存储过程 THROW 的错误号和消息，不是 THROW 的业务错误时返回 (None, None)
+def procedure_error(error):
+    match = PROCEDURE_ERROR_PATTERN.search(str(error))
+    if not match:
+        return None, None
+    return int(match.group(2)), match.group(1)
+
+
+# 添加生产记录
+@app.route('/production_records', methods=['POST'])
+@token_required(roles=['admin', 'worker'])
+@idempotent
+def add_production_record():
+    data = request.get_json()
+
+    # 参数校验
+    error = validate_production_record(data)
+    if error:
+        return jsonify({'error': error}), 400
 
     # 准备参数
+    theoretical_output = data['theoretical_output']
+    actual_output = data['actual_output']
     product_id = data['product_id']
     line_id = data['line_id']
     record_date = data['date']
     materials = data['materials']
 
-    # 检查产品是否存在
     conn = get_db()
     cursor = conn.cursor()
-    cursor.execute("SELECT product_id FROM ChemicalProduct WHERE product_id = ?", (product_id,))
-    if not cursor.fetchone():
-        return jsonify({'error': f'产品ID {product_id} 不存在'}), 400
-
-    # 检查生产线是否存在
-    cursor.execute("SELECT line_id FROM ProductionLine WHERE line_id = ?", (line_id,))
-    if not cursor.fetchone():
-        return jsonify({'error': f'生产线ID {line_id} 不存在'}), 400
-
-    # 检查所有原料是否存在
-    material_ids = [m['material_id'] for m in materials]
-    if material_ids:  # 确保列表不为空
-        placeholders = ','.join(['?'] * len(material_ids))
-        cursor.execute(f"SELECT material_id FROM ChemicalMaterial WHERE material_id IN ({placeholders})", material_ids)
-        existing_ids = [row[0] for row in cursor.fetchall()]
-
-        missing_ids = set(material_ids) - set(existing_ids)
-        if missing_ids:
-            return jsonify({'error': f'以下原料ID不存在: {", ".join(map(str, missing_ids))}'}), 400
 
     try:
         # 开始事务
         conn.autocommit = False
 
-        # 1. 插入生产记录主表
+        # 产品、生产线、原料是否存在（以及可选的库存检查）与主表、原料使用明细的写入在一次调用中完成，
+        # 校验和写入处于同一事务（ProductionMaterialUseType 表值参数）
         cursor.execute(
-            "INSERT INTO ProductionRecord (product_id, line_id, date, theoretical_output, actual_output) "
-            "OUTPUT INSERTED.record_id VALUES (?, ?, ?, ?, ?)",
-            (product_id, line_id, record_date, theoretical_output, actual_output)
+            "{CALL sp_AddProductionRecordValidated (?, ?, ?, ?, ?, ?, ?)}",
+            (product_id, line_id, record_date, theoretical_output, actual_output,
+             [(m['material_id'], m['quantity']) for m in materials],
+             app.config['PRODUCTION_REJECT_NEGATIVE_STOCK'])
         )
 
         # 获取新生成的record_id
@@ -947,15 +2213,12 @@ def add_production_record():
 
         new_record_id = result[0]
 
-        # 2. 插入原料使用联系集（UseMaterial）
-        for material in materials:
-            cursor.execute(
-                "INSERT INTO UseMaterial (material_id, record_id, quantity_used) VALUES (?, ?, ?)",
-                (material['material_id'], new_record_id, material['quantity'])
-            )
-
         # 提交事务
         conn.commit()
+        response_cache.invalidate('materials')
+        requirements_planner.mark_dirty()
+        publish_record_change(cursor, 'production_records', 'created', [new_record_id],
+                              [m['material_id'] for m in materials])
 
         return jsonify({
             "message": "生产记录添加成功",
@@ -963,12 +2226,17 @@ def add_production_record():
         }), 201
 
     except pyodbc.Error as e:
-        # 处理数据库错误
-        error_msg = str(e).split('\n')[0]
         try:
             conn.rollback()
         except:
             pass
+        # 存储过程的校验错误，消息由存储过程给出
+        code, message = procedure_error(e)
+        if code in PRODUCTION_RECORD_ERRORS:
+            return jsonify({'error': message}), PRODUCTION_RECORD_ERRORS[code]
+
+        # 处理数据库错误
+        error_msg = str(e).split('\n')[0]
         return jsonify({"error": f"数据库错误: {error_msg}"}), 500
 
     except Exception as e:
@@ -979,8 +2247,706 @@ def add_production_record():
         return jsonify({"error": f"操作失败: {str(e)}"}), 500
 
 
+# 各类记录写入后库存会变化的目录（由触发器更新 stock）
+RECORD_STOCK_CATALOGS = {
+    'purchase_records': 'materials',
+    'sale_records': 'products',
+    'production_records': 'materials',
+}
+
+# 批量导入支持的记录类型
+BULK_RECORD_TYPES = {
+    'purchase_records': BulkRecordType(
+        header_table='PurchaseRecord',
+        header_fields=[('supplier_id', 'INT', 'Supplier', '供应商ID'),
+                       ('date', 'DATE', None, '日期'),
+                       ('employee_id', 'INT', 'Buyer', '采购员工ID')],
+        lines_key='materials',
+        line_table='PurchaseMaterial',
+        line_fields=[('material_id', 'material_id', 'INT', 'ChemicalMaterial', '原料ID'),
+                     ('quantity', 'quantity', 'DECIMAL(10,2)', None, '数量'),
+                     ('unit_price', 'unit_price', 'DECIMAL(10,2)', None, '单价')],
+        validate=validate_purchase_record,
+    ),
+    'sale_records': BulkRecordType(
+        header_table='SalesRecord',
+        header_fields=[('customer_id', 'INT', 'Customer', '客户ID'),
+                       ('date', 'DATE', None, '日期'),
+                       ('employee_id', 'INT', 'Distributor', '经销员工ID')],
+        lines_key='products',
+        line_table='SaleProduct',
+        line_fields=[('product_id', 'product_id', 'INT', 'ChemicalProduct', '产品ID'),
+                     ('quantity', 'quantity', 'DECIMAL(10,2)', None, '数量'),
+                     ('unit_price', 'unit_price', 'DECIMAL(10,2)', None, '单价')],
+        validate=validate_sale_record,
+    ),
+    'production_records': BulkRecordType(
+        header_table='ProductionRecord',
+        header_fields=[('product_id', 'INT', 'ChemicalProduct', '产品ID'),
+                       ('line_id', 'INT', 'ProductionLine', '生产线ID'),
+                       ('date', 'DATE', None, '日期'),
+                       ('theoretical_output', 'DECIMAL(10,2)', None, '理论产量'),
+                       ('actual_output', 'DECIMAL(10,2)', None, '实际产量')],
+        lines_key='materials',
+        line_table='UseMaterial',
+        line_fields=[('material_id', 'material_id', 'INT', 'ChemicalMaterial', '原料ID'),
+                     ('quantity', 'quantity_used', 'DECIMAL(10,2)', None, '使用量')],
+        validate=validate_production_record,
+        stock_check=StockCheck('ChemicalMaterial', 'M', 'quantity', '原料'),
+    ),
+}
+
+
+# 批量导入记录，请求体为 NDJSON（每行一条记录，格式同单条添加接口）或 CSV（每行一条明细）
+# 每条记录单独返回结果，出错的记录不影响其他记录
+@app.route('/purchase_records/bulk', methods=['POST'], endpoint='bulk_add_purchase_records',
+           defaults={'record_type': 'purchase_records'})
+@app.route('/sale_records/bulk', methods=['POST'], endpoint='bulk_add_sale_records',
+           defaults={'record_type': 'sale_records'})
+@app.route('/production_records/bulk', methods=['POST'], endpoint='bulk_add_production_records',
+           defaults={'record_type': 'production_records'})
+@token_required()
+def bulk_add_records(record_type):
+    record_spec = BULK_RECORD_TYPES[record_type]
+
+    try:
+        chunk_size = int(request.args.get('chunk_size', app.config['BULK_CHUNK_SIZE']))
+    except ValueError:
+        return jsonify({'error': '参数 chunk_size 必须是整数'}), 400
+    if chunk_size < 1:
+        return jsonify({'error': '参数 chunk_size 必须大于0'}), 400
+    chunk_size = min(chunk_size, app.config['BULK_CHUNK_SIZE_MAX'])
+
+    if request.mimetype in ('text/csv', 'application/csv'):
+        records = iter_csv_records(request.stream, record_spec)
+    elif request.mimetype in (NDJSON_MIMETYPE, 'application/jsonl', 'application/json-seq'):
+        records = iter_ndjson_records(request.stream)
+    else:
+        return jsonify({'error': '请求体必须是 application/x-ndjson 或 text/csv'}), 415
+
+    try:
+        results = BulkLoader(get_db(), record_spec, chunk_size,
+                             app.config['PRODUCTION_REJECT_NEGATIVE_STOCK']).load(records)
+    except pyodbc.Error as e:
+        error_msg = str(e).split('\n')[0]
+        return jsonify({"error": f"数据库错误: {error_msg}"}), 500
+
+    succeeded = sum(1 for r in results if 'record_id' in r)
+    if succeeded:
+        response_cache.invalidate(RECORD_STOCK_CATALOGS[record_type])
+        if record_type == 'production_records':
+            requirements_planner.mark_dirty()
+        record_ids = [r['record_id'] for r in results if 'record_id' in r]
+        cursor = get_db().cursor()
+        try:
+            stock_ids = record_stock_ids(cursor, record_type, record_ids)
+        except pyodbc.Error as e:
+            app.logger.warning(f"变化事件查询明细失败: {e}")
+            stock_ids = []
+        publish_record_change(cursor, record_type, 'created', record_ids, stock_ids)
+    return jsonify({
+        'total': len(results),
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'results': results
+    }), 200
+
+
+# 记录历史导出：主表与明细展开为一行一条明细，并带上供应商/客户、员工、原料/产品、生产线的名称。
+# 没有明细的记录也输出一行，明细列为空。按 (date, record_id) 排序，可走 004 中的日期索引
+EXPORT_QUERIES = {
+    'purchase_records': ('pr', """
+        SELECT pr.record_id, pr.date, pr.supplier_id, s.name AS supplier_name, pr.employee_id, b.name AS employee_name,
+               pm.material_id, cm.name AS material_name, cm.unit, pm.quantity, pm.unit_price
+        FROM PurchaseRecord pr
+        LEFT JOIN Supplier s ON s.supplier_id = pr.supplier_id
+        LEFT JOIN Buyer b ON b.employee_id = pr.employee_id
+        LEFT JOIN PurchaseMaterial pm ON pm.record_id = pr.record_id
+        LEFT JOIN ChemicalMaterial cm ON cm.material_id = pm.material_id
+    """),
+    'sale_records': ('sr', """
+        SELECT sr.record_id, sr.date, sr.customer_id, c.name AS customer_name, sr.employee_id, d.name AS employee_name,
+               sp.product_id, cp.name AS product_name, cp.unit, sp.quantity, sp.unit_price
+        FROM SalesRecord sr
+        LEFT JOIN Customer c ON c.customer_id = sr.customer_id
+        LEFT JOIN Distributor d ON d.employee_id = sr.employee_id
+        LEFT JOIN SaleProduct sp ON sp.record_id = sr.record_id
+        LEFT JOIN ChemicalProduct cp ON cp.product_id = sp.product_id
+    """),
+    'production_records': ('pr', """
+        SELECT pr.record_id, pr.date, pr.product_id, p.name AS product_name, pr.line_id, pl.name AS line_name,
+               pr.theoretical_output, pr.actual_output,
+               um.material_id, cm.name AS material_name, cm.unit, um.quantity_used
+        FROM ProductionRecord pr
+        LEFT JOIN ChemicalProduct p ON p.product_id = pr.product_id
+        LEFT JOIN ProductionLine pl ON pl.line_id = pr.line_id
+        LEFT JOIN UseMaterial um ON um.record_id = pr.record_id
+        LEFT JOIN ChemicalMaterial cm ON cm.material_id = um.material_id
+    """),
+}
+
+
+# 导出记录历史，format 为 csv（默认）、arrow（Arrow IPC 流）或 parquet，from/to 为日期范围（含边界）。
+# 只能导出有 GET 权限的记录类型
+@app.route('/export/<record_type>', methods=['GET'])
+@token_required()
+def export_records(record_type):
+    if record_type not in EXPORT_QUERIES:
+        return jsonify({'error': f'不支持导出 {record_type}，可选 {", ".join(EXPORT_QUERIES)}'}), 404
+    if 'GET' not in ROLE_PERMISSIONS.get(g.current_role, {}).get(record_type, []):
+        return jsonify({'message': '操作权限不足'}), 403
+
+    fmt = request.args.get('format', 'csv')
+    try:
+        check_export_format(fmt)
+    except ExportFormatError as e:
+        return jsonify({'error': str(e)}), 406
+
+    alias, sql = EXPORT_QUERIES[record_type]
+    conditions, params = [], []
+    for name, condition in (('from', f'{alias}.date >= ?'), ('to', f'{alias}.date <= ?')):
+        raw = request.args.get(name)
+        if not raw:
+            continue
+        try:
+            params.append(parse_date(raw))
+        except ValueError:
+            return jsonify({'error': f'参数 {name} 格式错误'}), 400
+        conditions.append(condition)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    cursor = get_db().cursor()
+    cursor.execute(f"{sql} {where} ORDER BY {alias}.date, {alias}.record_id", params)
+    mimetype, extension, _ = EXPORT_FORMATS[fmt]
+    response = stream_response(
+        cursor,
+        iter_export(cursor, fmt, app.config['EXPORT_BATCH_SIZE'], app.config['EXPORT_PARQUET_COMPRESSION']),
+        mimetype=mimetype,
+    )
+    filename = '_'.join([record_type] + [request.args[n] for n in ('from', 'to') if request.args.get(n)])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}.{extension}"'
+    return response
+
+
+# 库存快照概况：快照日期范围和数量
+@app.route('/stock_snapshots', methods=['GET'])
+@token_required(roles=['admin'])
+def get_stock_snapshots():
+    cursor = get_db().cursor()
+    cursor.execute("""
+        SELECT item_type, COUNT(DISTINCT snapshot_date) AS snapshots,
+               MIN(snapshot_date) AS first_date, MAX(snapshot_date) AS last_date
+        FROM StockSnapshot
+        GROUP BY item_type
+    """)
+    result = {}
+    for item_type, snapshots, first_date, last_date in cursor.fetchall():
+        result['materials' if item_type == 'M' else 'products'] = {
+            'snapshots': snapshots,
+            'first_date': first_date.isoformat(),
+            'last_date': last_date.isoformat(),
+        }
+    return jsonify(result), 200
+
+
+# 按历史明细补建库存快照（调用 sp_BuildStockSnapshots），参数均可省略：
+# from、to 为快照日期范围，period_days 为间隔天数。默认补上最后一次快照之后到昨天的每日快照
+@app.route('/stock_snapshots', methods=['POST'])
+@token_required(roles=['admin'])
+def build_stock_snapshots():
+    data = request.get_json(silent=True) or {}
+    try:
+        date_from = parse_date(data['from']) if data.get('from') else None
+        date_to = parse_date(data['to']) if data.get('to') else None
+        period_days = int(data.get('period_days', 1))
+    except (TypeError, ValueError):
+        return jsonify({'error': '参数格式错误，日期格式为 YYYY-MM-DD，period_days 为正整数'}), 400
+    if period_days < 1:
+        return jsonify({'error': 'period_days 必须大于0'}), 400
+
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        # 存储过程按月分批，每批自行提交；在外层事务中调用时所有批次要等到最后才一起提交
+        conn.autocommit = True
+        cursor.execute("{CALL sp_BuildStockSnapshots (?, ?, ?)}", (date_from, date_to, period_days))
+        rows = cursor.fetchone()[0]
+    except pyodbc.Error as e:
+        error_msg = str(e).split('\n')[0]
+        return jsonify({"error": f"数据库错误: {error_msg}"}), 500
+    return jsonify({'message': '库存快照生成完成', 'rows': rows}), 200
+
+
+# 生产收率统计，只读 ProductionYieldDaily 汇总表（见 migrations/002_production_yield_rollup.sql），
+# 汇总表由触发器随生产记录的写入增量维护，查询量与原始记录数无关
+# group_by -> (分组表达式, 返回的分组列, 需要关联的表)
+YIELD_GROUPS = {
+    'day': ("y.date", "y.date AS day", ""),
+    'month': ("CONVERT(CHAR(7), y.date, 126)", "CONVERT(CHAR(7), y.date, 126) AS month", ""),
+    'product': ("y.product_id, p.name", "y.product_id, p.name AS product_name",
+                "JOIN ChemicalProduct p ON p.product_id = y.product_id"),
+    'line': ("y.line_id, l.name", "y.line_id, l.name AS line_name",
+             "JOIN ProductionLine l ON l.line_id = y.line_id"),
+}
+YIELD_FILTERS = {
+    'from': ('y.date >= ?', parse_date),
+    'to': ('y.date <= ?', parse_date),
+    'product_id': ('y.product_id = ?', int),
+    'line_id': ('y.line_id = ?', int),
+}
+
+
+# 按生产线、产品、日或月统计收率（实际产量 / 理论产量）
+@app.route('/analytics/yield', methods=['GET'])
+@token_required(roles=['admin', 'worker'])
+def get_yield_analytics():
+    group_by = request.args.get('group_by', 'day')
+    if group_by not in YIELD_GROUPS:
+        return jsonify({'error': f'参数 group_by 必须是 {", ".join(YIELD_GROUPS)} 之一'}), 400
+    group_sql, select_sql, join_sql = YIELD_GROUPS[group_by]
+
+    conditions, params, error = parse_filter_args(YIELD_FILTERS)
+    if error:
+        return error
+    where_sql = f"WHERE {' AND '.join(f'({c})' for c in conditions)}" if conditions else ""
+
+    cursor = get_db().cursor()
+    cursor.execute(f"""
+        SELECT
+            {select_sql},
+            SUM(y.record_count) AS record_count,
+            SUM(y.theoretical_output) AS theoretical_output,
+            SUM(y.actual_output) AS actual_output,
+            CAST(SUM(y.actual_output) / NULLIF(SUM(y.theoretical_output), 0) AS DECIMAL(9,4)) AS yield_rate
+        FROM ProductionYieldDaily y
+        {join_sql}
+        {where_sql}
+        GROUP BY {group_sql}
+        ORDER BY {group_sql}
+    """, params)
+    columns = [column[0] for column in cursor.description]
+    return jsonify([dict(zip(columns, row)) for row in cursor.fetchall()]), 200
+
+
+# 从原始生产记录重建收率汇总表（首次部署或数据修复后使用）
+@app.route('/analytics/yield/rebuild', methods=['POST'])
+@token_required(roles=['admin'])
+def rebuild_yield_analytics():
+    conn = get_db()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("{CALL sp_RebuildYieldRollup}")
+        rows = cursor.fetchone()[0]
+        conn.commit()
+    except pyodbc.Error as e:
+        error_msg = str(e).split('\n')[0]
+        return jsonify({"error": f"数据库错误: {error_msg}"}), 500
+    return jsonify({'message': '收率汇总重建完成', 'rows': rows}), 200
+
+
+# 物料需求计划：按计划产量和历史单位消耗估算原料需求，与当前库存、最低库存阈值比较。
+# 请求体 {"horizon_days": 30, "plan": [{"product_id": 1, "planned_output": 500}, ...]}
+@app.route('/planning/requirements', methods=['POST'])
+@token_required()
+def plan_requirements():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('plan'), list) or not data['plan']:
+        return jsonify({'error': '缺少参数 plan'}), 400
+    horizon_days = data.get('horizon_days')
+    if horizon_days is not None and (not isinstance(horizon_days, int) or horizon_days < 1):
+        return jsonify({'error': 'horizon_days 必须是正整数'}), 400
+
+    plan = {}
+    for index, item in enumerate(data['plan']):
+        product_id = item.get('product_id') if isinstance(item, dict) else None
+        planned_output = item.get('planned_output') if isinstance(item, dict) else None
+        if not isinstance(product_id, int):
+            return jsonify({'error': f'plan[{index}].product_id 必须是整数'}), 400
+        if not isinstance(planned_output, (int, float)) or planned_output < 0:
+            return jsonify({'error': f'plan[{index}].planned_output 必须是非负数'}), 400
+        # 同一产品出现多次时计划产量相加
+        plan[product_id] = plan.get(product_id, 0) + planned_output
+
+    cursor = get_db().cursor()
+    product_ids = sorted(plan)
+    products = {}
+    for i in range(0, len(product_ids), EVENT_QUERY_CHUNK):
+        chunk = product_ids[i:i + EVENT_QUERY_CHUNK]
+        cursor.execute(f"SELECT product_id, name, unit FROM ChemicalProduct "
+                       f"WHERE product_id IN ({','.join('?' * len(chunk))})", chunk)
+        products.update((row[0], row) for row in cursor.fetchall())
+    missing = [product_id for product_id in product_ids if product_id not in products]
+    if missing:
+        return jsonify({'error': f'以下产品ID不存在: {", ".join(map(str, missing))}'}), 400
+
+    requirements_planner.refresh(get_db())
+    history = requirements_planner.history(product_ids)
+    coefficients = requirements_planner.coefficients(product_ids)
+    demand = requirements_planner.demand(plan)
+
+    material_ids = sorted(demand)
+    materials = []
+    for i in range(0, len(material_ids), EVENT_QUERY_CHUNK):
+        chunk = material_ids[i:i + EVENT_QUERY_CHUNK]
+        cursor.execute(f"SELECT material_id, name, unit, stock, min_stock_threshold FROM vw_ChemicalMaterialCurrent "
+                       f"WHERE material_id IN ({','.join('?' * len(chunk))})", chunk)
+        for material_id, name, unit, stock, threshold in cursor.fetchall():
+            required = demand[material_id]
+            projected = float(stock or 0) - required
+            materials.append({
+                'material_id': material_id,
+                'name': name,
+                'unit': unit,
+                'demand': round(required, 4),
+                'daily_demand': round(required / horizon_days, 4) if horizon_days else None,
+                'stock': stock,
+                'min_stock_threshold': threshold,
+                'projected_stock': round(projected, 4),
+                'shortfall': round(max(-projected, 0.0), 4),
+                'below_threshold': projected < float(threshold or 0),
+                # 补足到最低库存阈值需要采购的数量
+                'reorder_quantity': round(max(float(threshold or 0) - projected, 0.0), 4),
+            })
+    # 缺口最大的排在前面
+    materials.sort(key=lambda m: (-m['shortfall'], not m['below_threshold'], m['material_id']))
+
+    return jsonify({
+        'horizon_days': horizon_days,
+        'products': [{
+            'product_id': product_id,
+            'name': products[product_id][1],
+            'unit': products[product_id][2],
+            'planned_output': plan[product_id],
+            'history_runs': history.get(product_id, (0, 0.0))[0],
+            'history_output': round(history.get(product_id, (0, 0.0))[1], 4),
+            'material_per_unit': [{'material_id': m, 'quantity': round(q, 6)}
+                                  for m, q in sorted(coefficients.get(product_id, {}).items())],
+        } for product_id in product_ids],
+        # 没有生产历史（或历史实际产量为 0）的产品无法估算，不计入需求
+        'products_without_history': [product_id for product_id in product_ids if not coefficients.get(product_id)],
+        'materials': materials,
+        'shortfall_count': sum(1 for m in materials if m['shortfall'] > 0),
+        'below_threshold_count': sum(1 for m in materials if m['below_threshold']),
+    }), 200
+
+
+# 变化事件推送（Server-Sent Events），代替轮询 /materials、/products 观察库存变化
+# 可用 topics 参数（逗号分隔）只订阅部分主题；不在角色权限内的主题会被忽略
+@app.route('/events', methods=['GET'])
+@token_required()
+def stream_events():
+    topics = event_topics(g.current_role)
+    requested = request.args.get('topics')
+    if requested:
+        topics = [t for t in topics if t in requested.split(',')]
+    subscription = event_broadcaster.subscribe(topics)
+    if subscription is None:
+        # 连接数已满：再接受会占满处理请求的线程，其他接口跟着不可用
+        response = jsonify({'message': '事件推送连接数已满，请稍后重试'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '5'
+        return response
+    heartbeat = app.config['EVENTS_HEARTBEAT_INTERVAL']
+
+    def generate():
+        try:
+            yield f'retry: 3000\n: subscribed {",".join(topics)}\n\n'
+            while True:
+                # 被丢弃后把队列里剩下的事件发完，再通知客户端重新加载
+                message = subscription.get(0 if subscription.dropped else heartbeat)
+                if message is not None:
+                    yield message
+                elif subscription.dropped:
+                    yield 'event: overflow\ndata: {}\n\n'
+                    return
+                else:
+                    yield ': keepalive\n\n'
+        finally:
+            event_broadcaster.unsubscribe(subscription)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # 反向代理（nginx）不要缓冲
+    return response
+
+
+# 运行状态统计（连接池使用情况等），用于容量规划
+@app.route('/system/stats', methods=['GET'])
+@token_required(roles=['admin'])
+def get_system_stats():
+    return jsonify({
+        'db_pool': get_pool().stats(),
+        'token_cache': token_cache.stats(),
+        'response_cache': response_cache.stats(),
+        'events': event_broadcaster.stats(),
+        'stock_ledger_folder': stock_ledger_folder.stats(),
+        'idempotency': idempotency_store.stats(),
+        'search': search_index_loader.stats(),
+        'planning': requirements_planner.stats(),
+        'db_replica_pool': _replica_pool.stats() if _replica_pool is not None else None,
+        'read_routing': read_router.stats() if read_router is not None else None
+    }), 200
+
+
+# 各组件已有的统计信息在抓取 /metrics 时取值
+def collect_component_metrics():
+    families = []
+    if _pool is not None:
+        pool = _pool.stats()
+        families += [
+            ('db_pool_connections', 'gauge', '连接池中的连接数',
+             {(('state', 'in_use'),): pool['in_use'], (('state', 'idle'),): pool['idle']}),
+            ('db_pool_max_size', 'gauge', '连接池最大连接数', {(): pool['max_size']}),
+            ('db_pool_waiting', 'gauge', '正在等待连接的请求数', {(): pool['waiting']}),
+            ('db_pool_acquired_total', 'counter', '借出连接的次数', {(): pool['acquired']}),
+            ('db_pool_timeouts_total', 'counter', '等待连接超时的次数', {(): pool['timeouts']}),
+            ('db_pool_wait_seconds_total', 'counter', '等待连接的总时间', {(): pool['total_wait_seconds']}),
+        ]
+    if read_router is not None:
+        routing = read_router.stats()
+        replica = routing['replica']
+        reads = {(('target', 'replica'), ('reason', 'routed')): routing['replica_reads']}
+        reads.update({(('target', 'primary'), ('reason', reason)): count
+                      for reason, count in routing['primary_reads'].items()})
+        families += [
+            ('db_read_requests_total', 'counter', '读请求使用的数据库（主库时按原因区分）', reads),
+            ('db_replica_available', 'gauge', '只读副本当前是否承担读请求', {(): int(read_router.monitor.available())}),
+            ('db_replica_lag_seconds', 'gauge', '最近一次测得的副本复制延迟', {(): replica['lag_seconds']}),
+            ('db_replica_check_failures_total', 'counter', '副本连接或查询失败的次数', {(): replica['failures']}),
+        ]
+    if _replica_pool is not None:
+        pool = _replica_pool.stats()
+        families += [
+            ('db_replica_pool_connections', 'gauge', '副本连接池中的连接数',
+             {(('state', 'in_use'),): pool['in_use'], (('state', 'idle'),): pool['idle']}),
+            ('db_replica_pool_timeouts_total', 'counter', '等待副本连接超时的次数', {(): pool['timeouts']}),
+        ]
+    token = token_cache.stats()
+    response = response_cache.stats()
+    events = event_broadcaster.stats()
+    folder = stock_ledger_folder.stats()
+    idempotency = idempotency_store.stats()
+    search = search_index_loader.stats()['indexes']
+    families += [
+        ('cache_entries', 'gauge', '缓存条目数',
+         {(('cache', 'token'),): token['size'], (('cache', 'response'),): response['entries']}),
+        ('cache_hits_total', 'counter', '缓存命中次数',
+         {(('cache', 'token'),): token['hits'], (('cache', 'response'),): response['hits']}),
+        ('cache_misses_total', 'counter', '缓存未命中次数',
+         {(('cache', 'token'),): token['misses'], (('cache', 'response'),): response['misses']}),
+        ('cache_invalidations_total', 'counter', '响应缓存失效次数', {(): response['invalidations']}),
+        ('events_subscribers', 'gauge', '/events 连接数', {(): events['subscribers']}),
+        ('events_published_total', 'counter', '发布的变化事件数', {(): events['published']}),
+        ('events_dropped_subscribers_total', 'counter', '因消费过慢被断开的连接数', {(): events['dropped_subscribers']}),
+        ('events_rejected_subscribers_total', 'counter', '连接数已满返回503的 /events 请求数', {(): events['rejected_subscribers']}),
+        ('stock_ledger_folds_total', 'counter', '库存流水合并次数', {(): folder['runs']}),
+        ('stock_ledger_fold_errors_total', 'counter', '库存流水合并失败次数', {(): folder['errors']}),
+        ('stock_ledger_folded_rows_total', 'counter', '已合并的库存流水行数', {(): folder['folded_rows']}),
+        ('stock_ledger_last_fold_seconds', 'gauge', '最近一次合并的耗时', {(): folder['last_duration_seconds']}),
+        ('idempotency_requests_total', 'counter', '带 Idempotency-Key 的新增记录请求数',
+         {(('outcome', 'executed'),): idempotency['executed'], (('outcome', 'replayed'),): idempotency['replayed'],
+          (('outcome', 'conflict'),): idempotency['conflicts']}),
+        ('idempotency_waits_total', 'counter', '等待相同键的请求完成的次数', {(): idempotency['waited']}),
+        ('idempotency_entries', 'gauge', '进程内保存的幂等键数', {(): idempotency['entries']}),
+        ('search_index_entries', 'gauge', '搜索索引中的条目数',
+         {(('catalog', name),): stats['entries'] for name, stats in search.items()}),
+        ('search_requests_total', 'counter', '搜索次数',
+         {(('catalog', name),): stats['searches'] for name, stats in search.items()}),
+        ('search_index_builds_total', 'counter', '搜索索引全量重建次数',
+         {(('catalog', name),): stats['builds'] for name, stats in search.items()}),
+    ]
+    return families
+
+
+metrics.register_collector(collect_component_metrics)
+
+
+# 请求直接来自本机（不是经反向代理转发的外部请求）
+def is_local_request():
+    if request.headers.get('X-Forwarded-For') or request.headers.get('Forwarded'):
+        return False
+    try:
+        return ipaddress.ip_address(request.remote_addr or '').is_loopback
+    except ValueError:
+        return False
+
+
+# 运行指标（Prometheus 文本格式）。抓取程序无法登录，配置了 METRICS_AUTH_TOKEN 时用固定的 Bearer token 校验；
+# 没有配置 token 时只允许本机抓取，除非显式设置 METRICS_PUBLIC=1（指标中有接口、SQL 语句形状等内部信息）
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not app.config['METRICS_ENABLED']:
+        return jsonify({'message': '运行指标未启用'}), 404
+    expected = app.config['METRICS_AUTH_TOKEN']
+    if expected:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {expected}'):
+            return jsonify({'message': 'Invalid token!'}), 401
+    elif not app.config['METRICS_PUBLIC'] and not is_local_request():
+        return jsonify({'message': '未设置 METRICS_AUTH_TOKEN 时只允许本机抓取运行指标'}), 403
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+
+# 健康检查，不需要登录。借一个空闲连接执行 SELECT 1（新建连接的登录和查询都以 HEALTHZ_DB_TIMEOUT 秒为限）；
+# 连接全部借出时不排队，说明数据库连接正常但进程繁忙，同样返回 200。
+# 只读副本不可用时读请求改走主库，不影响健康状态，只在 replica 字段中报告（取后台检查的结果，不查询副本）
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    pool = get_pool()
+    try:
+        conn = pool.acquire(block=False, connect_timeout=app.config['HEALTHZ_DB_TIMEOUT'])
+    except pyodbc.Error as e:
+        return jsonify({'status': 'error', 'db': str(e).split('\n')[0]}), 503
+    if conn is None:
+        return jsonify({'status': 'ok', 'db': 'busy'}), 200
+    discard = False
+    try:
+        conn.timeout = app.config['HEALTHZ_DB_TIMEOUT']
+        conn.cursor().execute("SELECT 1").fetchone()
+        conn.commit()
+    except pyodbc.Error as e:
+        discard = True
+        return jsonify({'status': 'error', 'db': str(e).split('\n')[0]}), 503
+    finally:
+        pool.release(conn, discard=discard)
+    result = {'status': 'ok', 'db': 'ok'}
+    if read_router is not None:
+        result['replica'] = 'ok' if read_router.monitor.available() else 'unavailable'
+    return jsonify(result), 200
+
+
+# 启动自检要求存在的数据库对象（表、视图、存储过程、索引）及其所在的迁移脚本
+REQUIRED_DB_OBJECTS = (
+    ('IX_ChemicalMaterial_is_low_stock', 'migrations/001_low_stock_watchlist.sql'),
+    ('ProductionYieldDaily', 'migrations/002_production_yield_rollup.sql'),
+    ('sp_BuildStockSnapshots', 'migrations/003_stock_snapshots.sql'),
+    ('IX_ProductionRecord_date', 'migrations/004_record_access_indexes.sql'),
+    ('sp_AddProductionRecordValidated', 'migrations/005_validated_production_record.sql'),
+    ('vw_ChemicalMaterialCurrent', 'migrations/006_stock_ledger.sql'),
+)
+
+
+# 配置了只读副本时另外要求的数据库对象（在主库执行，随复制到达副本）
+REPLICA_DB_OBJECTS = (
+    ('ReplicaHeartbeat', 'migrations/007_replica_heartbeat.sql'),
+)
+
+
+# 连接 connection_string 指定的数据库，检查 objects 中的对象是否存在，返回发现的问题列表
+def check_db_objects(connection_string, objects, label):
+    try:
+        conn = pyodbc.connect(connection_string, timeout=app.config['HEALTHZ_DB_TIMEOUT'] or 5)
+    except pyodbc.Error as e:
+        return [f"无法连接{label}: {str(e).splitlines()[0]}"]
+    try:
+        names = [name for name, _ in objects]
+        placeholders = ','.join('?' * len(names))
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT name FROM sys.objects WHERE name IN ({placeholders})
+            UNION
+            SELECT name FROM sys.indexes WHERE name IN ({placeholders})
+        """, names + names)
+        found = {row[0] for row in cursor.fetchall()}
+        return [f'{label}中缺少对象 {name}，请执行 {migration}'
+                for name, migration in objects if name not in found]
+    except pyodbc.Error as e:
+        return [f"检查{label}对象失败: {str(e).splitlines()[0]}"]
+    finally:
+        conn.close()
+
+
+# 多个工作进程时必须在进程之间共享的组件：(配置项, 设为 local 时的后果)
+SHARED_BACKENDS = [
+    ('CACHE_BACKEND', '目录修改后其他进程在 CACHE_TTL 秒内仍返回旧数据和旧 ETag'),
+    ('EVENTS_BACKEND', '/events 的连接收不到其他进程处理的写入'),
+    ('IDEMPOTENCY_BACKEND', '带 Idempotency-Key 的重试落到其他进程时不能识别，仍会重复创建记录'),
+]
+
+
+# workers 个进程同时运行时，仍使用进程内存储（local）的组件
+def shared_backend_problems(workers):
+    if workers <= 1:
+        return []
+    backends = list(SHARED_BACKENDS)
+    if read_router is not None:
+        backends.append(('DB_STICKY_BACKEND', '用户写入后的读请求落到其他进程时会读到副本上的旧数据'))
+    return [f'{name}=local 时每个进程各自保存状态（{consequence}），{workers} 个工作进程需要设置 {name}=redis'
+            for name, consequence in backends if app.config[name] == 'local']
+
+
+# 启动自检，返回发现的问题列表（为空表示通过）。在多进程启动器的主进程中 fork 之前执行，
+# 检查用的连接在返回前关闭，不会被子进程继承。workers 为将要启动的工作进程数
+def self_check(workers=1):
+    problems = []
+    if app.config['SECRET_KEY'] == DEFAULT_SECRET_KEY or len(app.config['SECRET_KEY']) < 16:
+        problems.append('SECRET_KEY 未设置或少于 16 个字符，请通过环境变量 SECRET_KEY 设置')
+    problems += shared_backend_problems(workers)
+    if not app.config['DB_REPLICA_CONNECTION_STRING']:
+        return problems + check_db_objects(app.config['DB_CONNECTION_STRING'], REQUIRED_DB_OBJECTS, '数据库')
+    objects = REQUIRED_DB_OBJECTS + REPLICA_DB_OBJECTS
+    problems += check_db_objects(app.config['DB_CONNECTION_STRING'], objects, '主库')
+    problems += check_db_objects(app.config['DB_REPLICA_CONNECTION_STRING'], objects, '只读副本')
+    return problems
+
+
+# 启动本进程的后台任务：库存流水合并、搜索索引加载、只读副本状态检查、接收其他进程的变化事件。
+# 多进程启动器在每个工作进程 fork 之后调用；重复调用时不再启动
+_background_started = False
+_background_lock = threading.Lock()
+
+
+def start_background_tasks():
+    global _background_started
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+    stock_ledger_folder.start()
+    search_index_loader.start()
+    event_broadcaster.start()
+    if read_router is not None:
+        read_router.monitor.start()
+
+
+def stop_background_tasks():
+    stock_ledger_folder.stop()
+    search_index_loader.stop()
+    event_broadcaster.stop()
+    if read_router is not None:
+        read_router.monitor.stop()
+
+
+# fork 之后在子进程中调用：丢弃从父进程继承的连接池和线程池（线程不会被 fork 复制，
+# 继承的 ODBC 连接与父进程共用同一个套接字，不能在子进程中使用），第一次使用时重新创建
+def reset_after_fork():
+    global _pool, _replica_pool, _pool_lock, _fanout_executor
+    _pool = None
+    _replica_pool = None
+    _pool_lock = threading.Lock()
+    _fanout_executor = ThreadPoolExecutor(app.config['DB_POOL_MAX_SIZE'], thread_name_prefix='db-fanout')
+
+
+# 关闭本进程的连接池（进程退出或 fork 之前调用）
+def close_pool():
+    global _pool, _replica_pool
+    with _pool_lock:
+        pools = [_pool, _replica_pool]
+        _pool = _replica_pool = None
+    for pool in pools:
+        if pool is not None:
+            pool.close()
+
+
+# 应用入口。路由在导入本模块时注册，配置来自环境变量，本函数不新建应用，总是返回模块级的 app；
+# 可以重复调用，后台线程只启动一次。
+# start_background=False 时不启动后台线程，由多进程启动器在各工作进程中启动（见 serve.py）
+def create_app(start_background=True):
+    if start_background:
+        start_background_tasks()
+    return app
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    # 开发服务器（单进程、调试模式），生产环境使用 serve.py
+    create_app().run(debug=True)
 
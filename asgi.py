@@ -0,0 +1,336 @@
+# ASGI 运行方式
+# 由 ASGI 服务器（如 uvicorn）负责连接：请求体读完、响应发出之前，慢速客户端只占用事件循环里的一个协程，不占线程。
+# Flask 路由仍是同步代码，读完请求体后放到线程池中执行，线程数默认与数据库连接池最大连接数相同，
+# 多出来的请求在事件循环中排队，不会出现大量线程同时阻塞在取连接上。
+# 单个请求超时或客户端提前断开时返回/放弃响应，并取消该请求正在执行的 SQL。
+#
+# 用法：
+#   pip install uvicorn
+#   uvicorn asgi:application --host 0.0.0.0 --port 5000
+import asyncio
+import json
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pyodbc
+
+from app import CANCEL_SCOPE_ENVIRON_KEY, app, create_app, metrics
+
+BODY_SPOOL_SIZE = 1024 * 1024  # 请求体超过该大小时写入临时文件
+
+
+# 请求已被取消后再创建游标时抛出，让仍在线程中执行的路由尽快结束
+class RequestCancelledError(Exception):
+    pass
+
+
+# 登记一个请求创建的游标，取消时对每个游标调用 cursor.cancel()（ODBC 的 SQLCancel，可在其他线程中调用）
+class CancelScope:
+    def __init__(self):
+        self.cancelled = False
+        self._cursors = []
+        self._lock = threading.Lock()
+
+    def track(self, cursor):
+        with self._lock:
+            if self.cancelled:
+                raise RequestCancelledError('请求已取消')
+            self._cursors.append(cursor)
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            cursors, self._cursors = self._cursors, []
+        for cursor in cursors:
+            try:
+                cursor.cancel()
+            except pyodbc.Error:
+                pass
+
+
+class _RequestTooLarge(Exception):
+    pass
+
+
+class _ClientDisconnected(Exception):
+    pass
+
+
+def _close(app_iter):
+    close = getattr(app_iter, 'close', None)
+    if close is not None:
+        close()
+
+
+# 已放弃（超时或客户端断开）的请求在线程结束后调用：关闭线程返回的流式响应。
+# 线程已结束时 add_done_callback 立即在事件循环线程中调用，否则在执行请求的线程中调用
+def _discard_response(task):
+    if task.cancelled() or task.exception() is not None:
+        return
+    result = task.result()
+    if result is not None and result[3] is not None:
+        _close(result[3])
+
+
+class AsgiAdapter:
+    def __init__(self, wsgi_app, workers, stream_workers, request_timeout, max_pending, max_body_size):
+        self.wsgi_app = wsgi_app
+        self.workers = workers
+        self.stream_workers = stream_workers
+        self.request_timeout = request_timeout
+        self.max_pending = max_pending
+        self.max_body_size = max_body_size
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='asgi-request')
+        self.stream_executor = ThreadPoolExecutor(stream_workers, thread_name_prefix='asgi-stream')
+
+        # 以下计数只在事件循环线程中修改
+        self._pending = 0  # 已交给线程池、线程还没有结束的请求（包括已超时或客户端已断开、但线程仍在执行的）
+        self._streams = 0  # 正在输出的流式响应
+        self._requests = 0
+        self._timeouts = 0
+        self._rejected = 0
+        self._disconnects = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http':
+            await self._handle_http(scope, receive, send)
+        elif scope['type'] == 'lifespan':
+            await self._handle_lifespan(receive, send)
+        else:
+            # 不支持 websocket，握手前关闭即返回 403
+            await send({'type': 'websocket.close'})
+
+    async def _handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                self.stream_executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _handle_http(self, scope, receive, send):
+        self._requests += 1
+        try:
+            body, size = await self._read_body(scope, receive)
+        except _RequestTooLarge:
+            await self._send_json(send, 413, {'message': f'请求体超过 {self.max_body_size} 字节'})
+            return
+        except _ClientDisconnected:
+            self._disconnects += 1
+            return
+
+        if self._pending >= self.max_pending:
+            self._rejected += 1
+            await self._send_json(send, 503, {'message': '服务器繁忙，请稍后重试'}, retry_after=True)
+            return
+
+        cancel_scope = CancelScope()
+        environ = self._build_environ(scope, body, size)
+        environ[CANCEL_SCOPE_ENVIRON_KEY] = cancel_scope
+        loop = asyncio.get_running_loop()
+        disconnected = asyncio.ensure_future(self._wait_disconnect(receive))
+        start = time.monotonic()
+        # 超时或断开后线程可能仍在执行，计数要等线程真正结束（或排队中被取消）时才减少，
+        # 否则 max_pending 限制不住仍占着线程池的请求
+        self._pending += 1
+        task = self.executor.submit(self._call_app, environ, cancel_scope)
+        task.add_done_callback(lambda _: loop.call_soon_threadsafe(self._request_finished))
+        future = asyncio.wrap_future(task)
+        done, _ = await asyncio.wait({future, disconnected}, timeout=self.request_timeout or None,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if future not in done:
+            # 还在排队的请求不会再执行；已在执行的请求取消其 SQL，线程结束后丢弃响应。
+            # 线程可能已越过 _call_app 中的取消检查、返回了流式响应，这里负责关闭它，归还连接、取消订阅
+            future.cancel()
+            cancel_scope.cancel()
+            task.add_done_callback(_discard_response)
+            body.close()
+            if disconnected in done:
+                self._disconnects += 1
+                return
+            self._timeouts += 1
+            app.logger.warning(f"请求超时 {time.monotonic() - start:.1f} 秒: {scope['method']} {scope['path']}")
+            await self._send_json(send, 504, {'message': '请求处理超时'})
+            return
+
+        try:
+            status, headers, chunks, app_iter = future.result()
+            try:
+                await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+                await send({'type': 'http.response.body', 'body': b''.join(chunks),
+                            'more_body': app_iter is not None})
+            except BaseException:
+                # 响应头发送失败时流式响应还没交给 _stream，在这里关闭
+                if app_iter is not None:
+                    await loop.run_in_executor(self.stream_executor, _close, app_iter)
+                raise
+            if app_iter is not None:
+                await self._stream(loop, app_iter, send, disconnected)
+        finally:
+            disconnected.cancel()
+            body.close()
+
+    def _request_finished(self):
+        self._pending -= 1
+
+    # 读完整个请求体再交给线程池，较大的请求体（批量导入）写入临时文件
+    async def _read_body(self, scope, receive):
+        body = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_SIZE)
+        size = 0
+        for name, value in scope['headers']:
+            if name == b'content-length' and value.isdigit() and int(value) > self.max_body_size:
+                raise _RequestTooLarge()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                raise _ClientDisconnected()
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.max_body_size:
+                body.close()
+                raise _RequestTooLarge()
+            body.write(chunk)
+            if not message.get('more_body', False):
+                body.seek(0)
+                return body, size
+
+    @staticmethod
+    async def _wait_disconnect(receive):
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+    def _build_environ(self, scope, body, size):
+        server = scope.get('server') or ('localhost', 80)
+        root_path = scope.get('root_path', '')
+        path = scope['path']
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+            'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': str(server[0]),
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.input_terminated': True,  # 请求体已完整读入，分块传输的请求也按实际长度读取
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+            environ['REMOTE_PORT'] = str(scope['client'][1])
+        for name, value in scope['headers']:
+            key = name.decode('latin-1').upper().replace('-', '_')
+            if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                key = 'HTTP_' + key
+            value = value.decode('latin-1')
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+        environ['CONTENT_LENGTH'] = str(size)
+        return environ
+
+    # 在线程池中执行 Flask。带 Content-Length 的普通响应在线程内整体取出；
+    # 没有 Content-Length 的流式响应只取响应头，之后逐块在流式线程池中读取
+    def _call_app(self, environ, cancel_scope):
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = headers
+
+        app_iter = self.wsgi_app(environ, start_response)
+        streaming = not any(name.lower() == 'content-length' for name, _ in started['headers'])
+        chunks = []
+        if not streaming:
+            try:
+                chunks = list(app_iter)
+            finally:
+                _close(app_iter)
+            app_iter = None
+        if cancel_scope.cancelled:
+            if app_iter is not None:
+                _close(app_iter)
+            return None
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in started['headers']]
+        return started['status'], headers, chunks, app_iter
+
+    async def _stream(self, loop, app_iter, send, disconnected):
+        iterator = iter(app_iter)
+        self._streams += 1
+        try:
+            while not disconnected.done():
+                chunk = await loop.run_in_executor(self.stream_executor, next, iterator, None)
+                if chunk is None:
+                    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+                    return
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            self._disconnects += 1
+        finally:
+            self._streams -= 1
+            # 关闭时会执行 Flask 的 teardown（归还连接、取消订阅），同样放到线程中
+            await loop.run_in_executor(self.stream_executor, _close, app_iter)
+
+    @staticmethod
+    async def _send_json(send, status, payload, retry_after=False):
+        body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        headers = [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode('latin-1'))]
+        if retry_after:
+            headers.append((b'retry-after', b'1'))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    def collect_metrics(self):
+        return [
+            ('asgi_workers', 'gauge', '处理请求的线程数', {(): self.workers}),
+            ('asgi_pending_requests', 'gauge', '线程池中排队或执行中的请求数（含已超时仍在执行的）', {(): self._pending}),
+            ('asgi_active_streams', 'gauge', '正在输出的流式响应数', {(): self._streams}),
+            ('asgi_requests_total', 'counter', '收到的请求数', {(): self._requests}),
+            ('asgi_request_timeouts_total', 'counter', '超时返回504的请求数', {(): self._timeouts}),
+            ('asgi_rejected_requests_total', 'counter', '排队过多返回503的请求数', {(): self._rejected}),
+            ('asgi_client_disconnects_total', 'counter', '响应完成前客户端断开的次数', {(): self._disconnects}),
+        ]
+
+
+_application = None
+
+
+# start_background=False 时不启动后台线程，由多进程启动器在各工作进程中启动（见 serve.py）。
+# 每个进程只有一个适配器（线程池和指标只创建、注册一次），重复调用返回同一个
+def create_application(start_background=True):
+    global _application
+    wsgi_app = create_app(start_background).wsgi_app
+    if _application is None:
+        _application = AsgiAdapter(
+            wsgi_app,
+            workers=app.config['ASGI_WORKERS'],
+            stream_workers=app.config['ASGI_STREAM_WORKERS'],
+            request_timeout=app.config['ASGI_REQUEST_TIMEOUT'],
+            max_pending=app.config['ASGI_MAX_PENDING'],
+            max_body_size=app.config['ASGI_MAX_BODY_SIZE'],
+        )
+        metrics.register_collector(_application.collect_metrics)
+    return _application
+
+
+# uvicorn asgi:application 第一次取 application 时才创建，导入本模块本身不启动任何线程
+def __getattr__(name):
+    if name != 'application':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if _application is None:
+        create_application()
+    return _application
@@ -0,0 +1,191 @@
+# 查询计划检查
+# 对接口的热点查询取预估执行计划（SET SHOWPLAN_XML ON，只编译不执行），
+# 如果记录表或明细表上出现整表扫描就以退出码 1 结束，可以和 run.py 一样放在部署前的检查中。
+# 带 TOP 的有序索引扫描（翻页时按索引顺序读前 N 行）不算整表扫描。
+#
+# 用法（数据库一般是 seed.py 生成的压测库，数据量太小时优化器可能会选择扫描）：
+#   python benchmark/plan_check.py --dsn "$BENCH_DB" --save-dir benchmark/results/plans
+#
+# 修改了 app.py 中对应的 SQL 时，需要同步修改 HOT_QUERIES。
+import argparse
+import datetime
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+from seed import DATABASE, ROOT, connect
+
+sys.path.insert(0, ROOT)
+
+from app import RECORD_LINE_QUERIES  # noqa: E402
+
+SHOWPLAN_NS = {'p': 'http://schemas.microsoft.com/sqlserver/2004/07/showplan'}
+RELOP = f"{{{SHOWPLAN_NS['p']}}}RelOp"
+SCAN_OPS = ('Table Scan', 'Clustered Index Scan', 'Index Scan')
+# 数据量随业务增长的表，这些表上不允许整表扫描
+WATCHED_TABLES = ('PurchaseRecord', 'SalesRecord', 'ProductionRecord', 'PurchaseMaterial', 'SaleProduct', 'UseMaterial')
+
+PRODUCTION_LIST_COLUMNS = """
+    pr.record_id, pr.date, pr.theoretical_output, pr.actual_output,
+    cp.name AS product_name, pl.name AS line_name
+    FROM ProductionRecord pr
+    JOIN ChemicalProduct cp ON pr.product_id = cp.product_id
+    JOIN ProductionLine pl ON pr.line_id = pl.line_id
+"""
+
+# (名称, SQL, 取参数的函数)。参数按示例数据取值，SQL 与 app.py 中的写法一致
+HOT_QUERIES = [
+    ('get_purchase_materials',
+     "SELECT CM.material_id, CM.name, PM.quantity, PM.unit_price, CM.unit FROM ChemicalMaterial CM, PurchaseMaterial PM, "
+     "PurchaseRecord PR WHERE CM.material_id = PM.material_id AND PM.record_id = PR.record_id AND PM.record_id = ?",
+     lambda s: [s['purchase_record']]),
+    ('get_sale_products',
+     "SELECT CP.product_id, CP.name, SP.quantity, SP.unit_price, CP.unit FROM ChemicalProduct CP, SaleProduct SP, "
+     "SalesRecord SR WHERE CP.product_id = SP.product_id AND SP.record_id = SR.record_id AND SP.record_id = ?",
+     lambda s: [s['sale_record']]),
+    ('get_production_record_materials',
+     "SELECT um.material_id, cm.name AS material_name, um.quantity_used, cm.unit FROM UseMaterial um "
+     "JOIN ChemicalMaterial cm ON um.material_id = cm.material_id WHERE um.record_id = ?",
+     lambda s: [s['production_record']]),
+    ('purchase_records expand=lines', RECORD_LINE_QUERIES['purchase_records'][1].format(ids='?'),
+     lambda s: [s['purchase_record']]),
+    ('sale_records expand=lines', RECORD_LINE_QUERIES['sale_records'][1].format(ids='?'),
+     lambda s: [s['sale_record']]),
+    ('production_records expand=lines', RECORD_LINE_QUERIES['production_records'][1].format(ids='?'),
+     lambda s: [s['production_record']]),
+    ('sp_DeletePurchaseRecord', "EXEC sp_DeletePurchaseRecord @record_id = ?", lambda s: [s['purchase_record']]),
+    ('sp_DeleteSalesRecord', "EXEC sp_DeleteSalesRecord @record_id = ?", lambda s: [s['sale_record']]),
+    ('production_records 第一页',
+     f"SELECT TOP (?) {PRODUCTION_LIST_COLUMNS} ORDER BY pr.date DESC, pr.record_id DESC",
+     lambda s: [101]),
+    ('production_records 翻页',
+     f"SELECT TOP (?) {PRODUCTION_LIST_COLUMNS} WHERE (pr.date < ? OR pr.date IS NULL OR (pr.date = ? AND pr.record_id < ?)) "
+     "ORDER BY pr.date DESC, pr.record_id DESC",
+     lambda s: [101, s['date'], s['date'], s['production_record']]),
+    ('production_records 按日期过滤',
+     f"SELECT TOP (?) {PRODUCTION_LIST_COLUMNS} WHERE (pr.date >= ?) AND (pr.date <= ?) ORDER BY pr.date DESC, pr.record_id DESC",
+     lambda s: [101, s['date'] - datetime.timedelta(days=7), s['date']]),
+    ('purchase_records 按日期过滤',
+     "SELECT TOP (?) * FROM PurchaseRecord WHERE (date >= ?) AND (date <= ?) ORDER BY date ASC, record_id ASC",
+     lambda s: [101, s['date'] - datetime.timedelta(days=7), s['date']]),
+    ('sale_records 按日期过滤',
+     "SELECT TOP (?) * FROM SalesRecord WHERE (date >= ?) AND (date <= ?) ORDER BY date ASC, record_id ASC",
+     lambda s: [101, s['date'] - datetime.timedelta(days=7), s['date']]),
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='检查热点查询的执行计划')
+    parser.add_argument('--dsn', default=os.environ.get('BENCH_DB'),
+                        help='ODBC 连接串（不含 DATABASE），默认取环境变量 BENCH_DB')
+    parser.add_argument('--save-dir', help='把每个查询的计划保存为 .sqlplan 文件（可用 SSMS 打开）')
+    return parser.parse_args()
+
+
+# 示例参数：取最新的记录和日期，保证查询的是真实存在的数据
+def sample_values(cursor):
+    samples = {}
+    for key, table in (('purchase_record', 'PurchaseRecord'), ('sale_record', 'SalesRecord'),
+                       ('production_record', 'ProductionRecord')):
+        cursor.execute(f"SELECT MAX(record_id) FROM {table}")
+        samples[key] = cursor.fetchone()[0] or 1
+    cursor.execute("SELECT MAX(date) FROM ProductionRecord")
+    samples['date'] = cursor.fetchone()[0] or datetime.date.today()
+    return samples
+
+
+# SHOWPLAN 下不能用参数化调用，把 ? 换成字面量（参数只有整数和日期）
+def inline_params(sql, params):
+    parts = sql.split('?')
+    if len(parts) != len(params) + 1:
+        raise ValueError(f'参数个数不匹配: {sql}')
+    literals = [f"'{p.isoformat()}'" if isinstance(p, datetime.date) else str(int(p)) for p in params]
+    return parts[0] + ''.join(literal + part for literal, part in zip(literals, parts[1:]))
+
+
+def fetch_plans(cursor, sql):
+    cursor.execute("SET SHOWPLAN_XML ON")
+    try:
+        cursor.execute(sql)
+        plans = []
+        while True:
+            plans.extend(row[0] for row in cursor.fetchall())
+            if not cursor.nextset():
+                break
+        return plans
+    finally:
+        cursor.execute("SET SHOWPLAN_XML OFF")
+
+
+def strip_brackets(name):
+    return (name or '').strip('[]')
+
+
+# 运算符下一层的 RelOp（中间隔着 NestedLoops、Hash 等运算符自身的元素）
+def child_relops(node):
+    for sub in node:
+        if sub.tag == RELOP:
+            yield sub
+        else:
+            yield from child_relops(sub)
+
+
+# 遍历计划中的扫描运算符，返回 [(运算符, 表, 索引, 是否整表扫描)]
+def scan_operators(plan_xml):
+    found = []
+
+    def visit(relop, under_top):
+        op = relop.get('PhysicalOp')
+        if op in SCAN_OPS:
+            scan = relop.find('p:IndexScan', SHOWPLAN_NS)
+            if scan is None:
+                scan = relop.find('p:TableScan', SHOWPLAN_NS)
+            obj = scan.find('p:Object', SHOWPLAN_NS) if scan is not None else None
+            table = strip_brackets(obj.get('Table')) if obj is not None else ''
+            index = strip_brackets(obj.get('Index')) if obj is not None else ''
+            ordered = scan is not None and scan.get('Ordered') == 'true'
+            found.append((op, table, index, table in WATCHED_TABLES and not (under_top and ordered)))
+        for child in child_relops(relop):
+            visit(child, under_top or op == 'Top')
+
+    for query_plan in ET.fromstring(plan_xml).iter(f"{{{SHOWPLAN_NS['p']}}}QueryPlan"):
+        for relop in child_relops(query_plan):
+            visit(relop, False)
+    return found
+
+
+def main():
+    args = parse_args()
+    conn = connect(args.dsn, DATABASE, autocommit=True)
+    cursor = conn.cursor()
+    samples = sample_values(cursor)
+    if args.save_dir:
+        os.makedirs(args.save_dir, exist_ok=True)
+
+    failures = []
+    for index, (name, sql, params) in enumerate(HOT_QUERIES, 1):
+        plans = fetch_plans(cursor, inline_params(sql, params(samples)))
+        operators = [op for plan in plans for op in scan_operators(plan)]
+        bad = [op for op in operators if op[3]]
+        status = '整表扫描' if bad else 'OK'
+        print(f'{name:36s} {status}')
+        for op, table, idx, full_scan in operators:
+            if table:
+                print(f'    {"!" if full_scan else " "} {op} {table}.{idx}')
+        if bad:
+            failures.append(name)
+        if args.save_dir:
+            for n, plan in enumerate(plans, 1):
+                path = os.path.join(args.save_dir, f'{index:02d}_{n}.sqlplan')
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(plan)
+    conn.close()
+
+    if failures:
+        print(f'\n{len(failures)} 个查询出现整表扫描: {", ".join(failures)}')
+        sys.exit(1)
+    print('\n全部查询都走索引查找')
+
+
+if __name__ == '__main__':
+    main()
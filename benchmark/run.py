@@ -0,0 +1,307 @@
+# HTTP 压测
+# 按权重混合发送目录查询、记录详情和进货/销售/生产写入请求，统计每个路由的 p50/p95/p99 延迟、每秒请求数，
+# 以及每个请求执行的 SQL 条数（需以 QUERY_COUNT_HEADER=1 启动服务，从 X-Query-Count 响应头读取）。
+# 结果保存为 JSON；指定 --baseline 时与上一次结果比较，超过允许的退化幅度时以退出码 1 结束。
+#
+# 用法：
+#   QUERY_COUNT_HEADER=1 python app.py
+#   python benchmark/run.py --duration 60 --concurrency 16 --mix mixed --output results/new.json \
+#       --baseline results/old.json --max-regression 0.1
+import argparse
+import datetime
+import http.client
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+# 压测使用 init.sql 中的示例账号
+USERS = {
+    'admin': ('admin', 'admin123'),
+    'buyer': ('buyer1', 'buyer123'),
+    'distributor': ('dist1', 'dist123'),
+    'worker': ('worker1', 'worker123'),
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='HTTP 压测')
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--manifest', default=os.path.join(os.path.dirname(__file__), 'manifest.json'),
+                        help='seed.py 生成的 ID 清单')
+    parser.add_argument('--mix', choices=sorted(MIXES), default='mixed', help='请求组合')
+    parser.add_argument('--duration', type=float, default=30, help='压测秒数（不含预热）')
+    parser.add_argument('--warmup', type=float, default=5, help='预热秒数，预热期间的请求不计入结果')
+    parser.add_argument('--concurrency', type=int, default=8, help='并发连接数')
+    parser.add_argument('--items', type=int, default=20, help='写入请求每条记录的明细数')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='结果 JSON 的保存路径')
+    parser.add_argument('--baseline', help='用于比较的历史结果 JSON')
+    parser.add_argument('--max-regression', type=float, default=0.1,
+                        help='允许的退化比例：p95 升高、吞吐下降或每请求 SQL 条数增加超过该比例即判为退化')
+    return parser.parse_args()
+
+
+def sample(rng, ids, count):
+    return rng.sample(ids, min(count, len(ids)))
+
+
+def purchase_body(rng, ids, args):
+    return {
+        'supplier_id': rng.choice(ids['suppliers']),
+        'date': datetime.date.today().isoformat(),
+        'employee_id': rng.choice(ids['buyers']),
+        'materials': [{'material_id': m, 'quantity': round(rng.uniform(1, 50), 2),
+                       'unit_price': round(rng.uniform(1, 500), 2)} for m in sample(rng, ids['materials'], args.items)],
+    }
+
+
+def sale_body(rng, ids, args):
+    return {
+        'customer_id': rng.choice(ids['customers']),
+        'date': datetime.date.today().isoformat(),
+        'employee_id': rng.choice(ids['distributors']),
+        'products': [{'product_id': p, 'quantity': round(rng.uniform(1, 5), 2),
+                      'unit_price': round(rng.uniform(10, 2000), 2)} for p in sample(rng, ids['products'], args.items)],
+    }
+
+
+def production_body(rng, ids, args):
+    theoretical = round(rng.uniform(100, 1000), 2)
+    return {
+        'product_id': rng.choice(ids['products']),
+        'line_id': rng.choice(ids['lines']),
+        'date': datetime.date.today().isoformat(),
+        'theoretical_output': theoretical,
+        'actual_output': round(theoretical * rng.uniform(0.85, 1.0), 2),
+        'materials': [{'material_id': m, 'quantity': round(rng.uniform(0.1, 2), 2)}
+                      for m in sample(rng, ids['materials'], args.items)],
+    }
+
+
+# 请求场景：名称 -> (角色, 函数(随机数, ID清单, 参数) -> (方法, 路径, 请求体))
+SCENARIOS = {
+    'GET /materials': ('worker', lambda rng, ids, args: ('GET', '/materials?limit=100', None)),
+    'GET /materials/<id>': ('worker', lambda rng, ids, args: (
+        'GET', f"/materials/{rng.choice(ids['materials'])}", None)),
+    'GET /products': ('distributor', lambda rng, ids, args: ('GET', '/products?limit=100', None)),
+    'GET /materials/low_stock': ('admin', lambda rng, ids, args: ('GET', '/materials/low_stock', None)),
+    'GET /purchase_records': ('buyer', lambda rng, ids, args: (
+        'GET', '/purchase_records?limit=50&sort=-date&expand=supplier,employee', None)),
+    'GET /purchase_records/<id>': ('buyer', lambda rng, ids, args: (
+        'GET', f"/purchase_records/{rng.choice(ids['purchase_records'])}?expand=lines", None)),
+    'GET /sale_records/<id>': ('distributor', lambda rng, ids, args: (
+        'GET', f"/sale_records/{rng.choice(ids['sale_records'])}?expand=lines", None)),
+    'GET /production_records/<id>': ('worker', lambda rng, ids, args: (
+        'GET', f"/production_records/{rng.choice(ids['production_records'])}?expand=lines", None)),
+    'GET /analytics/yield': ('admin', lambda rng, ids, args: (
+        'GET', f"/analytics/yield?group_by={rng.choice(['day', 'month', 'product', 'line'])}", None)),
+    'GET /materials/stock_at': ('admin', lambda rng, ids, args: (
+        'GET', f"/materials/stock_at?date="
+               f"{(datetime.date.today() - datetime.timedelta(days=rng.randrange(1, 365))).isoformat()}", None)),
+    'POST /purchase_records': ('buyer', lambda rng, ids, args: ('POST', '/purchase_records', purchase_body(rng, ids, args))),
+    'POST /sale_records': ('distributor', lambda rng, ids, args: ('POST', '/sale_records', sale_body(rng, ids, args))),
+    'POST /production_records': ('worker', lambda rng, ids, args: (
+        'POST', '/production_records', production_body(rng, ids, args))),
+}
+
+# 请求组合：场景名 -> 权重
+MIXES = {
+    'reads': {
+        'GET /materials': 20, 'GET /materials/<id>': 20, 'GET /products': 10, 'GET /materials/low_stock': 5,
+        'GET /purchase_records': 10, 'GET /purchase_records/<id>': 10, 'GET /sale_records/<id>': 10,
+        'GET /production_records/<id>': 10, 'GET /analytics/yield': 3, 'GET /materials/stock_at': 2,
+    },
+    'writes': {
+        'POST /purchase_records': 1, 'POST /sale_records': 1, 'POST /production_records': 1,
+    },
+    'mixed': {
+        'GET /materials': 20, 'GET /materials/<id>': 15, 'GET /products': 10, 'GET /materials/low_stock': 5,
+        'GET /purchase_records': 10, 'GET /purchase_records/<id>': 8, 'GET /sale_records/<id>': 8,
+        'GET /production_records/<id>': 8, 'GET /analytics/yield': 2, 'GET /materials/stock_at': 2,
+        'POST /purchase_records': 4, 'POST /sale_records': 4, 'POST /production_records': 4,
+    },
+}
+
+
+class Client:
+    def __init__(self, base_url):
+        parts = urlsplit(base_url)
+        connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.conn = connection_class(parts.hostname, parts.port, timeout=60)
+
+    def request(self, method, path, body=None, token=None):
+        headers = {'Accept': 'application/json'}
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        try:
+            self.conn.request(method, path, payload, headers)
+            response = self.conn.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            self.conn.close()  # 下次请求自动重连
+            raise
+        return response.status, response.getheader('X-Query-Count'), data
+
+
+def login(base_url):
+    tokens = {}
+    client = Client(base_url)
+    for role, (username, password) in USERS.items():
+        status, _, data = client.request('POST', '/login', {'username': username, 'password': password})
+        if status != 200:
+            sys.exit(f'{username} 登录失败（HTTP {status}），请确认数据库已由 seed.py 初始化')
+        tokens[role] = json.loads(data)['token']
+    return tokens
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))  # 最近秩法
+    return sorted_values[index]
+
+
+def worker(args, ids, tokens, mix, seed, measure_from, deadline, samples, lock):
+    rng = random.Random(seed)
+    client = Client(args.base_url)
+    names = list(mix)
+    weights = [mix[n] for n in names]
+    local = []
+    while True:
+        now = time.perf_counter()
+        if now >= deadline:
+            break
+        name = rng.choices(names, weights)[0]
+        role, build = SCENARIOS[name]
+        method, path, body = build(rng, ids, args)
+        start = time.perf_counter()
+        try:
+            status, query_count, _ = client.request(method, path, body, tokens[role])
+        except (http.client.HTTPException, OSError):
+            status, query_count = None, None
+        elapsed = time.perf_counter() - start
+        if start >= measure_from:
+            local.append((name, elapsed, status, query_count))
+    with lock:
+        samples.extend(local)
+
+
+def summarize(samples, duration):
+    routes = {}
+    for name in sorted({s[0] for s in samples}):
+        rows = [s for s in samples if s[0] == name]
+        latencies = sorted(s[1] * 1000 for s in rows)
+        errors = sum(1 for s in rows if s[2] is None or s[2] >= 400)
+        counts = [int(s[3]) for s in rows if s[3] is not None]
+        routes[name] = {
+            'requests': len(rows),
+            'errors': errors,
+            'rps': round(len(rows) / duration, 2),
+            'p50_ms': round(percentile(latencies, 50), 3),
+            'p95_ms': round(percentile(latencies, 95), 3),
+            'p99_ms': round(percentile(latencies, 99), 3),
+            'mean_ms': round(sum(latencies) / len(latencies), 3),
+            'queries_per_request': round(sum(counts) / len(counts), 2) if counts else None,
+        }
+    latencies = sorted(s[1] * 1000 for s in samples)
+    total = {
+        'requests': len(samples),
+        'errors': sum(r['errors'] for r in routes.values()),
+        'rps': round(len(samples) / duration, 2),
+        'p50_ms': round(percentile(latencies, 50), 3) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95), 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99), 3) if latencies else None,
+    }
+    return routes, total
+
+
+# 与基线比较，返回退化项列表
+def compare(result, baseline, tolerance):
+    regressions = []
+    for name, current in result['routes'].items():
+        base = baseline.get('routes', {}).get(name)
+        if not base:
+            continue
+        if base['p95_ms'] and current['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base['p95_ms']} -> {current['p95_ms']} ms")
+        if base['rps'] and current['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(f"{name}: rps {base['rps']} -> {current['rps']}")
+        if base.get('queries_per_request') is not None and current['queries_per_request'] is not None \
+                and current['queries_per_request'] > base['queries_per_request'] * (1 + tolerance):
+            regressions.append(f"{name}: queries/request {base['queries_per_request']} -> "
+                               f"{current['queries_per_request']}")
+        if current['errors'] > base['errors']:
+            regressions.append(f"{name}: errors {base['errors']} -> {current['errors']}")
+    return regressions
+
+
+def print_table(routes, total):
+    print(f"{'route':<32}{'req':>8}{'err':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'sql/req':>9}")
+    for name, r in list(routes.items()) + [('TOTAL', dict(total, queries_per_request=None))]:
+        qpr = '-' if r['queries_per_request'] is None else r['queries_per_request']
+        print(f"{name:<32}{r['requests']:>8}{r['errors']:>6}{r['rps']:>9}"
+              f"{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}{qpr:>9}")
+
+
+def main():
+    args = parse_args()
+    with open(args.manifest, encoding='utf-8') as f:
+        ids = json.load(f)['ids']
+    tokens = login(args.base_url)
+    mix = MIXES[args.mix]
+
+    samples, lock = [], threading.Lock()
+    measure_from = time.perf_counter() + args.warmup
+    deadline = measure_from + args.duration
+    threads = [threading.Thread(target=worker,
+                                args=(args, ids, tokens, mix, args.seed + i, measure_from, deadline, samples, lock))
+               for i in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    routes, total = summarize(samples, args.duration)
+    result = {
+        'meta': {
+            'finished_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'base_url': args.base_url,
+            'mix': args.mix,
+            'duration': args.duration,
+            'concurrency': args.concurrency,
+            'items': args.items,
+            'seed': args.seed,
+        },
+        'routes': routes,
+        'total': total,
+    }
+    print_table(routes, total)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f'结果已保存到 {args.output}')
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(result, json.load(f), args.max_regression)
+        if regressions:
+            print('性能退化：')
+            for line in regressions:
+                print(f'  {line}')
+            sys.exit(1)
+        print('与基线相比没有退化')
+
+
+if __name__ == '__main__':
+    main()
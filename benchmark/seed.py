@@ -0,0 +1,219 @@
+# 压测数据准备
+# 在本地 SQL Server（Docker 或 LocalDB）上执行 init.sql 和 migrations/，再按指定规模生成原料、产品和三类记录。
+# 记录通过批量导入（bulk_ingest.BulkLoader）写入，库存由库存触发器（init.sql，008 中改为按原料/产品汇总）维护，与线上行为一致。
+# 完成后写出 manifest（各类ID列表），供 run.py 构造请求。
+#
+# 用法：
+#   set BENCH_DB=DRIVER={ODBC Driver 18 for SQL Server};SERVER=127.0.0.1;UID=sa;PWD=...;TrustServerCertificate=yes
+#   python benchmark/seed.py --recreate --materials 2000 --records 50000
+#
+# 注意：--recreate 会删除并重建 chemical_factory 数据库，只能指向本地的压测实例。
+import argparse
+import datetime
+import glob
+import json
+import os
+import random
+import re
+import sys
+import time
+
+import pyodbc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bulk_ingest import BulkLoader  # noqa: E402
+from app import BULK_RECORD_TYPES  # noqa: E402
+
+DATABASE = 'chemical_factory'  # init.sql 中写死的库名
+GO_PATTERN = re.compile(r'^\s*GO\s*$', re.IGNORECASE | re.MULTILINE)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='生成压测数据')
+    parser.add_argument('--dsn', default=os.environ.get('BENCH_DB'),
+                        help='ODBC 连接串（不含 DATABASE），默认取环境变量 BENCH_DB')
+    parser.add_argument('--recreate', action='store_true', help='删除并重建数据库，执行 init.sql 和全部迁移脚本')
+    parser.add_argument('--materials', type=int, default=1000, help='生成的原料数')
+    parser.add_argument('--products', type=int, default=200, help='生成的产品数')
+    parser.add_argument('--suppliers', type=int, default=50)
+    parser.add_argument('--customers', type=int, default=100)
+    parser.add_argument('--records', type=int, default=10000, help='每类记录的条数')
+    parser.add_argument('--items', type=int, default=5, help='每条记录的明细数')
+    parser.add_argument('--days', type=int, default=365, help='记录日期分布在最近多少天内')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=42, help='随机种子，相同参数生成相同数据')
+    parser.add_argument('--manifest', default=os.path.join(os.path.dirname(__file__), 'manifest.json'))
+    return parser.parse_args()
+
+
+def connect(dsn, database=None, autocommit=False):
+    if not dsn:
+        sys.exit('请用 --dsn 或环境变量 BENCH_DB 指定压测数据库的连接串')
+    if database:
+        dsn = f'{dsn.rstrip(";")};DATABASE={database};'
+    return pyodbc.connect(dsn, autocommit=autocommit)
+
+
+# 按 GO 分批执行 SQL 脚本
+def run_script(conn, path):
+    with open(path, encoding='utf-8-sig') as f:
+        batches = [b.strip() for b in GO_PATTERN.split(f.read())]
+    cursor = conn.cursor()
+    for batch in batches:
+        if batch:
+            cursor.execute(batch)
+            while cursor.nextset():
+                pass
+
+
+def recreate_database(dsn):
+    conn = connect(dsn, 'master', autocommit=True)
+    cursor = conn.cursor()
+    cursor.execute(f"IF DB_ID('{DATABASE}') IS NOT NULL "
+                   f"ALTER DATABASE {DATABASE} SET SINGLE_USER WITH ROLLBACK IMMEDIATE")
+    cursor.execute(f"DROP DATABASE IF EXISTS {DATABASE}")
+    cursor.execute(f"CREATE DATABASE {DATABASE}")
+    conn.close()
+
+    conn = connect(dsn, DATABASE, autocommit=True)
+    print('执行 init.sql')
+    run_script(conn, os.path.join(ROOT, 'init.sql'))
+    for path in sorted(glob.glob(os.path.join(ROOT, 'migrations', '*.sql'))):
+        print(f'执行 {os.path.relpath(path, ROOT)}')
+        run_script(conn, path)
+    conn.close()
+
+
+def insert_rows(conn, sql, rows):
+    cursor = conn.cursor()
+    cursor.fast_executemany = True
+    if rows:
+        cursor.executemany(sql, rows)
+    conn.commit()
+
+
+def fetch_ids(conn, table, column):
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {column} FROM {table} ORDER BY {column}")
+    return [row[0] for row in cursor.fetchall()]
+
+
+# 生成目录数据。期初库存取得足够大，保证之后的销售和生产用量不会把库存扣成负数
+def seed_catalogs(conn, args, rng):
+    tag = datetime.datetime.now().strftime('%m%d%H%M%S')
+    insert_rows(conn, "INSERT INTO ChemicalMaterial (name, cas_number, stock, unit, concentration, category, "
+                      "storage_condition, min_stock_threshold) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(f'压测原料-{tag}-{i}', f'B{tag}-{i}', 1000000.0, rng.choice(['kg', 'L']),
+                  round(rng.uniform(10, 100), 2), rng.choice(['无机酸', '碱', '醇类', '酯类', '盐类']),
+                  '压测数据', round(rng.uniform(100, 2000000), 2))
+                 for i in range(args.materials)])
+    insert_rows(conn, "INSERT INTO ChemicalProduct (name, unit, stock, hazard_rating) VALUES (?, ?, ?, ?)",
+                [(f'压测产品-{tag}-{i}', rng.choice(['kg', 'L', '桶']), 10000000.0,
+                  rng.choice(['I', 'II', 'III', 'IV', 'V'])) for i in range(args.products)])
+    insert_rows(conn, "INSERT INTO Supplier (name, main_materials, credit_rating) VALUES (?, ?, ?)",
+                [(f'压测供应商-{tag}-{i}', '压测数据', rng.choice(['A', 'B', 'C'])) for i in range(args.suppliers)])
+    insert_rows(conn, "INSERT INTO Customer (name, main_product_requirements, credit_rating) VALUES (?, ?, ?)",
+                [(f'压测客户-{tag}-{i}', '压测数据', rng.choice(['A', 'B', 'C'])) for i in range(args.customers)])
+
+
+def manifest_ids(conn):
+    return {
+        'materials': fetch_ids(conn, 'ChemicalMaterial', 'material_id'),
+        'products': fetch_ids(conn, 'ChemicalProduct', 'product_id'),
+        'suppliers': fetch_ids(conn, 'Supplier', 'supplier_id'),
+        'customers': fetch_ids(conn, 'Customer', 'customer_id'),
+        'buyers': fetch_ids(conn, 'Buyer', 'employee_id'),
+        'distributors': fetch_ids(conn, 'Distributor', 'employee_id'),
+        'lines': fetch_ids(conn, 'ProductionLine', 'line_id'),
+    }
+
+
+def random_date(rng, days):
+    return (datetime.date.today() - datetime.timedelta(days=rng.randrange(days))).isoformat()
+
+
+def generate_records(record_type, ids, args, rng):
+    items = min(args.items, len(ids['materials']), len(ids['products']))
+    for _ in range(args.records):
+        if record_type == 'purchase_records':
+            yield {
+                'supplier_id': rng.choice(ids['suppliers']),
+                'date': random_date(rng, args.days),
+                'employee_id': rng.choice(ids['buyers']),
+                'materials': [{'material_id': m, 'quantity': round(rng.uniform(1, 50), 2),
+                               'unit_price': round(rng.uniform(1, 500), 2)}
+                              for m in rng.sample(ids['materials'], items)],
+            }
+        elif record_type == 'sale_records':
+            yield {
+                'customer_id': rng.choice(ids['customers']),
+                'date': random_date(rng, args.days),
+                'employee_id': rng.choice(ids['distributors']),
+                'products': [{'product_id': p, 'quantity': round(rng.uniform(1, 20), 2),
+                              'unit_price': round(rng.uniform(10, 2000), 2)}
+                             for p in rng.sample(ids['products'], items)],
+            }
+        else:
+            theoretical = round(rng.uniform(100, 1000), 2)
+            yield {
+                'product_id': rng.choice(ids['products']),
+                'line_id': rng.choice(ids['lines']),
+                'date': random_date(rng, args.days),
+                'theoretical_output': theoretical,
+                'actual_output': round(theoretical * rng.uniform(0.85, 1.0), 2),
+                'materials': [{'material_id': m, 'quantity': round(rng.uniform(0.1, 10), 2)}
+                              for m in rng.sample(ids['materials'], items)],
+            }
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+    if args.recreate:
+        recreate_database(args.dsn)
+
+    conn = connect(args.dsn, DATABASE)
+    print(f'生成目录数据：原料 {args.materials}，产品 {args.products}')
+    seed_catalogs(conn, args, rng)
+    ids = manifest_ids(conn)
+
+    for record_type, spec in BULK_RECORD_TYPES.items():
+        start = time.perf_counter()
+        records = ((record, None) for record in generate_records(record_type, ids, args, rng))
+        results = BulkLoader(conn, spec, args.chunk_size).load(records)
+        failed = [r for r in results if 'error' in r]
+        print(f'{record_type}: 写入 {len(results) - len(failed)} 条，失败 {len(failed)} 条，'
+              f'耗时 {time.perf_counter() - start:.1f} 秒')
+        if failed:
+            print(f'  首个错误: {failed[0]["error"]}')
+
+    # 收率汇总和库存快照按新数据重建（快照覆盖全部记录日期）
+    cursor = conn.cursor()
+    cursor.execute("{CALL sp_RebuildYieldRollup}")
+    cursor.fetchall()
+    conn.commit()
+    conn.autocommit = True  # 快照按月分批提交
+    cursor.execute("{CALL sp_BuildStockSnapshots (?, NULL, 1)}",
+                   (datetime.date.today() - datetime.timedelta(days=args.days),))
+    cursor.fetchall()
+    conn.autocommit = False
+
+    ids['purchase_records'] = fetch_ids(conn, 'PurchaseRecord', 'record_id')
+    ids['sale_records'] = fetch_ids(conn, 'SalesRecord', 'record_id')
+    ids['production_records'] = fetch_ids(conn, 'ProductionRecord', 'record_id')
+    conn.close()
+
+    manifest = {
+        'seeded_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'args': {k: v for k, v in vars(args).items() if k not in ('dsn', 'manifest')},
+        'ids': ids,
+    }
+    with open(args.manifest, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    print(f'manifest 已写入 {args.manifest}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+# 批量导入进货/销售/生产记录
+# 请求体逐条解析、校验（NDJSON 每行一条记录；CSV 每行一条明细，相同 ref 的相邻行属于同一条记录），
+# 通过校验的记录攒满一批后用 fast_executemany 写入临时表，再以集合操作一次性写入正式表并提交。
+# 单条记录出错只影响该记录，其余记录照常写入。
+import csv
+import datetime
+import decimal
+import io
+import json
+
+import pyodbc
+
+
+# 明细会扣减库存的记录类型（生产记录），写入前可检查库存是否足够。
+# 明细的第一项（主键）为 item_table 的主键，quantity_field 为扣减的数量；
+# 当前库存为 stock 加上未合并的库存流水（ledger_type 为 StockLedger.item_type，见 006）
+class StockCheck:
+    def __init__(self, item_table, ledger_type, quantity_field, label):
+        self.item_table = item_table
+        self.ledger_type = ledger_type
+        self.quantity_field = quantity_field
+        self.label = label
+
+
+class BulkRecordType:
+    # header_fields: [(字段名, SQL类型, 外键引用的表 或 None, 字段中文名)]
+    # line_fields:   [(JSON字段名, 明细表列名, SQL类型, 外键引用的表 或 None, 字段中文名)]，第一项为明细的主键
+    # 外键引用表中的主键列与字段同名
+    def __init__(self, header_table, header_fields, lines_key, line_table, line_fields, validate, stock_check=None):
+        self.header_table = header_table
+        self.header_fields = header_fields
+        self.lines_key = lines_key
+        self.line_table = line_table
+        self.line_fields = line_fields
+        self.validate = validate
+        self.stock_check = stock_check
+
+    @property
+    def csv_columns(self):
+        return ['ref'] + [f[0] for f in self.header_fields] + [f[0] for f in self.line_fields]
+
+
+# 逐行解析 NDJSON 请求体，产出 (记录, 解析错误)
+def iter_ndjson_records(stream):
+    for line_no, line in enumerate(io.TextIOWrapper(stream, encoding='utf-8-sig'), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield None, f'第{line_no}行不是有效的JSON'
+            continue
+        if not isinstance(record, dict):
+            yield None, f'第{line_no}行必须是JSON对象'
+            continue
+        yield record, None
+
+
+# 逐行解析 CSV 请求体，产出 (记录, 解析错误)
+# 每行是一条明细，ref 列相同的相邻行合并为一条记录（取第一行的表头字段）；没有 ref 时每行单独成一条记录
+def iter_csv_records(stream, record_type):
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    missing = [c for c in record_type.csv_columns[1:] if c not in (reader.fieldnames or [])]
+    if missing:
+        yield None, f'CSV缺少列: {", ".join(missing)}'
+        return
+
+    current, current_ref = None, None
+    for row in reader:
+        ref = row.get('ref') or None
+        line = {f[0]: row[f[0]] for f in record_type.line_fields}
+        if current is not None and ref is not None and ref == current_ref:
+            current[record_type.lines_key].append(line)
+            continue
+        if current is not None:
+            yield current, None
+        current = {f[0]: row[f[0]] for f in record_type.header_fields}
+        current[record_type.lines_key] = [line]
+        if ref is not None:
+            current['ref'] = ref
+        current_ref = ref
+    if current is not None:
+        yield current, None
+
+
+def _first_line(error):
+    return str(error).split('\n')[0]
+
+
+class BulkLoader:
+    HEADER_STAGE = '#bulk_header'
+    LINE_STAGE = '#bulk_line'
+    ID_STAGE = '#bulk_id'
+
+    # reject_negative_stock: 记录类型带 stock_check 时，拒绝会使库存变为负数的记录（同单条添加接口）
+    def __init__(self, conn, record_type, chunk_size=500, reject_negative_stock=False):
+        self.conn = conn
+        self.type = record_type
+        self.chunk_size = chunk_size
+        self.stock_check = record_type.stock_check if reject_negative_stock else None
+
+    # records: 可迭代的 (记录, 解析错误)；返回按顺序排列的逐条结果
+    def load(self, records):
+        results = []
+        chunk = []
+        self._create_staging()
+        try:
+            for index, (record, error) in enumerate(records):
+                ref = record.get('ref') if isinstance(record, dict) else None
+                row = None
+                if error is None:
+                    row, error = self._prepare(record)
+                if error:
+                    results.append({'index': index, 'ref': ref, 'error': error})
+                    continue
+                chunk.append((index, ref) + row)
+                if len(chunk) >= self.chunk_size:
+                    results.extend(self._flush(chunk))
+                    chunk = []
+            if chunk:
+                results.extend(self._flush(chunk))
+        finally:
+            self._drop_staging()
+        results.sort(key=lambda r: r['index'])
+        return results
+
+    # 校验并转换一条记录，返回 ((表头值, 明细值列表), 错误信息)
+    def _prepare(self, record):
+        error = self.type.validate(record)
+        if error:
+            return None, error
+        header = []
+        for name, sql_type, _, label in self.type.header_fields:
+            try:
+                header.append(self._convert(record[name], sql_type))
+            except (TypeError, ValueError):
+                return None, f'字段 {name} 格式错误'
+        lines, seen = [], set()
+        for idx, item in enumerate(record[self.type.lines_key]):
+            values = []
+            for name, _, sql_type, _, label in self.type.line_fields:
+                try:
+                    values.append(self._convert(item[name], sql_type))
+                except (TypeError, ValueError):
+                    return None, f'{self.type.lines_key}[{idx}].{name} 格式错误'
+            if values[0] in seen:
+                return None, f'{self.type.lines_key}[{idx}] 重复的{self.type.line_fields[0][4]}: {values[0]}'
+            seen.add(values[0])
+            lines.append(values)
+        return (header, lines), None
+
+    @staticmethod
+    def _convert(value, sql_type):
+        if sql_type == 'INT':
+            if isinstance(value, float) and not value.is_integer():
+                raise ValueError(value)
+            return int(value)
+        if sql_type == 'DATE':
+            if isinstance(value, datetime.date):
+                return value
+            return datetime.date.fromisoformat(str(value))
+        return float(value)
+
+    def _create_staging(self):
+        header_cols = ', '.join(f'{f[0]} {f[1]}' for f in self.type.header_fields)
+        line_cols = ', '.join(f'{f[1]} {f[2]}' for f in self.type.line_fields)
+        cursor = self.conn.cursor()
+        self._drop_staging(cursor)
+        cursor.execute(f"CREATE TABLE {self.HEADER_STAGE} (row_no INT PRIMARY KEY, {header_cols})")
+        cursor.execute(f"CREATE TABLE {self.LINE_STAGE} (row_no INT, {line_cols})")
+        cursor.execute(f"CREATE TABLE {self.ID_STAGE} (row_no INT PRIMARY KEY, record_id INT)")
+        self.conn.commit()
+
+    def _drop_staging(self, cursor=None):
+        cursor = cursor or self.conn.cursor()
+        for table in (self.HEADER_STAGE, self.LINE_STAGE, self.ID_STAGE):
+            cursor.execute(f"IF OBJECT_ID('tempdb..{table}') IS NOT NULL DROP TABLE {table}")
+        self.conn.commit()
+
+    # 查询并锁住 item_ids 的当前库存，提交前其他写入不能改变这些原料的库存。item_ids 为参数列表或子查询
+    def _stock_levels(self, cursor, item_ids):
+        check = self.stock_check
+        key = self.type.line_fields[0][1]
+        if isinstance(item_ids, str):
+            where, params = f"i.{key} IN ({item_ids})", ()
+        else:
+            where, params = f"i.{key} IN ({', '.join('?' * len(item_ids))})", tuple(item_ids)
+        cursor.execute(f"""
+            SELECT i.{key}, ISNULL(i.stock, 0) + ISNULL(l.quantity, 0)
+            FROM {check.item_table} i WITH (UPDLOCK, HOLDLOCK)
+            OUTER APPLY (
+                SELECT SUM(s.quantity) AS quantity FROM StockLedger s WITH (UPDLOCK, HOLDLOCK)
+                WHERE s.item_type = ? AND s.item_id = i.{key}
+            ) AS l
+            WHERE {where}
+        """, (check.ledger_type,) + params)
+        return {item_id: decimal.Decimal(stock) for item_id, stock in cursor.fetchall()}
+
+    # 按顺序扣减 levels 中的库存，不够时返回错误信息（格式同 sp_AddProductionRecordValidated），够时扣减并返回 None
+    def _consume_stock(self, levels, lines):
+        quantity_index = [f[0] for f in self.type.line_fields].index(self.stock_check.quantity_field)
+        needed = [(line[0], decimal.Decimal(str(line[quantity_index]))) for line in lines]
+        short = [(item_id, levels.get(item_id, decimal.Decimal(0)), quantity) for item_id, quantity in needed
+                 if levels.get(item_id, decimal.Decimal(0)) < quantity]
+        if short:
+            return f'{self.stock_check.label}库存不足: ' + '; '.join(
+                f'{item_id} (库存 {stock:.2f}, 需要 {quantity:.2f})' for item_id, stock, quantity in sorted(short))
+        for item_id, quantity in needed:
+            levels[item_id] -= quantity
+        return None
+
+    # 一批记录：载入临时表 -> 集合方式检查外键 -> 检查库存（可选） -> MERGE 写表头并取回新ID -> 一条 INSERT 写全部明细 -> 提交
+    def _flush(self, chunk):
+        header_names = [f[0] for f in self.type.header_fields]
+        line_columns = [f[1] for f in self.type.line_fields]
+        errors, ids = {}, {}
+        cursor = self.conn.cursor()
+        cursor.fast_executemany = True
+        try:
+            for table in (self.HEADER_STAGE, self.LINE_STAGE, self.ID_STAGE):
+                cursor.execute(f"TRUNCATE TABLE {table}")
+            cursor.executemany(
+                f"INSERT INTO {self.HEADER_STAGE} (row_no, {', '.join(header_names)}) "
+                f"VALUES (?, {', '.join('?' * len(header_names))})",
+                [[index] + header for index, _, header, _ in chunk])
+            cursor.executemany(
+                f"INSERT INTO {self.LINE_STAGE} (row_no, {', '.join(line_columns)}) "
+                f"VALUES (?, {', '.join('?' * len(line_columns))})",
+                [[index] + line for index, _, _, lines in chunk for line in lines])
+
+            # 外键检查，引用不存在的记录整条剔除
+            checks = [(self.HEADER_STAGE, f[0], f[2], f[3]) for f in self.type.header_fields if f[2]]
+            checks += [(self.LINE_STAGE, f[1], f[3], f[4]) for f in self.type.line_fields if f[3]]
+            for stage, column, parent, label in checks:
+                missing = f"NOT EXISTS (SELECT 1 FROM {parent} p WHERE p.{column} = s.{column})"
+                cursor.execute(f"SELECT DISTINCT s.row_no, s.{column} FROM {stage} s WHERE {missing}")
+                rows = cursor.fetchall()
+                for row_no, value in rows:
+                    errors.setdefault(row_no, f'{label} {value} 不存在')
+                if rows:
+                    cursor.execute(f"DELETE h FROM {self.HEADER_STAGE} h WHERE h.row_no IN "
+                                   f"(SELECT s.row_no FROM {stage} s WHERE {missing})")
+
+            # 库存检查：一次锁住本批涉及的全部原料，按记录顺序依次扣减，库存不够的记录整条剔除
+            if self.stock_check is not None:
+                levels = self._stock_levels(cursor, f"SELECT {line_columns[0]} FROM {self.LINE_STAGE}")
+                short = []
+                for index, _, _, lines in chunk:
+                    if index in errors:
+                        continue
+                    error = self._consume_stock(levels, lines)
+                    if error:
+                        errors[index] = error
+                        short.append([index])
+                if short:
+                    cursor.executemany(f"DELETE FROM {self.HEADER_STAGE} WHERE row_no = ?", short)
+            if errors:
+                cursor.execute(f"DELETE l FROM {self.LINE_STAGE} l WHERE NOT EXISTS "
+                               f"(SELECT 1 FROM {self.HEADER_STAGE} h WHERE h.row_no = l.row_no)")
+
+            cursor.execute(f"""
+                MERGE INTO {self.type.header_table} AS t
+                USING {self.HEADER_STAGE} AS s ON 1 = 0
+                WHEN NOT MATCHED THEN
+                    INSERT ({', '.join(header_names)}) VALUES ({', '.join('s.' + c for c in header_names)})
+                OUTPUT s.row_no, INSERTED.record_id INTO {self.ID_STAGE} (row_no, record_id);
+            """)
+            cursor.execute(f"""
+                INSERT INTO {self.type.line_table} ({', '.join(line_columns)}, record_id)
+                SELECT {', '.join('l.' + c for c in line_columns)}, m.record_id
+                FROM {self.LINE_STAGE} l
+                JOIN {self.ID_STAGE} m ON m.row_no = l.row_no
+            """)
+            cursor.execute(f"SELECT row_no, record_id FROM {self.ID_STAGE}")
+            ids = dict(cursor.fetchall())
+            self.conn.commit()
+        except pyodbc.Error:
+            # 批量写入失败（例如明细触发了约束），回滚后逐条写入以定位出错的记录
+            self.conn.rollback()
+            return self._flush_one_by_one(chunk)
+
+        results = []
+        for index, ref, _, _ in chunk:
+            if index in ids:
+                results.append({'index': index, 'ref': ref, 'record_id': ids[index]})
+            else:
+                results.append({'index': index, 'ref': ref, 'error': errors.get(index, '写入失败')})
+        return results
+
+    def _flush_one_by_one(self, chunk):
+        header_names = [f[0] for f in self.type.header_fields]
+        line_columns = [f[1] for f in self.type.line_fields]
+        results = []
+        cursor = self.conn.cursor()
+        cursor.fast_executemany = True
+        for index, ref, header, lines in chunk:
+            try:
+                if self.stock_check is not None:
+                    error = self._consume_stock(self._stock_levels(cursor, [line[0] for line in lines]), lines)
+                    if error:
+                        self.conn.rollback()
+                        results.append({'index': index, 'ref': ref, 'error': error})
+                        continue
+                # 表上有触发器时 OUTPUT 必须带 INTO，先写入表变量再取出
+                cursor.execute(
+                    f"SET NOCOUNT ON; DECLARE @ids TABLE (record_id INT); "
+                    f"INSERT INTO {self.type.header_table} ({', '.join(header_names)}) "
+                    f"OUTPUT INSERTED.record_id INTO @ids VALUES ({', '.join('?' * len(header_names))}); "
+                    f"SELECT record_id FROM @ids",
+                    header)
+                record_id = cursor.fetchone()[0]
+                cursor.executemany(
+                    f"INSERT INTO {self.type.line_table} ({', '.join(line_columns)}, record_id) "
+                    f"VALUES ({', '.join('?' * len(line_columns))}, ?)",
+                    [line + [record_id] for line in lines])
+                self.conn.commit()
+                results.append({'index': index, 'ref': ref, 'record_id': record_id})
+            except pyodbc.Error as e:
+                self.conn.rollback()
+                results.append({'index': index, 'ref': ref, 'error': f'数据库错误: {_first_line(e)}'})
+        return results
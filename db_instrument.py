@@ -0,0 +1,57 @@
+# 数据库调用统计
+# 用代理包装连接和游标，每次 execute/executemany 结束后回调 observer(sql, 参数, 耗时秒数)，
+# 其余属性和方法原样转发，调用方式与 pyodbc 完全相同。
+# on_cursor 在每次新建游标时以原始游标调用，用于登记游标以便请求超时时取消正在执行的 SQL
+import time
+
+
+class InstrumentedCursor:
+    def __init__(self, cursor, observer):
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, '_observer', observer)
+
+    def execute(self, sql, *params):
+        start = time.perf_counter()
+        try:
+            self._cursor.execute(sql, *params)
+        finally:
+            self._observer(sql, params, time.perf_counter() - start)
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        start = time.perf_counter()
+        try:
+            self._cursor.executemany(sql, seq_of_params)
+        finally:
+            self._observer(sql, seq_of_params, time.perf_counter() - start)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+
+class InstrumentedConnection:
+    def __init__(self, conn, observer, on_cursor=None):
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_observer', observer)
+        object.__setattr__(self, '_on_cursor', on_cursor)
+
+    def cursor(self):
+        cursor = self._conn.cursor()
+        if self._on_cursor is not None:
+            self._on_cursor(cursor)
+        return InstrumentedCursor(cursor, self._observer)
+
+    def execute(self, sql, *params):
+        return self.cursor().execute(sql, *params)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
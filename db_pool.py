@@ -0,0 +1,225 @@
+# 数据库连接池
+# 复用已登录的 ODBC 连接，避免每个请求都重新 pyodbc.connect
+import threading
+import time
+from collections import deque
+
+import pyodbc
+
+
+# 连接池耗尽：在等待时间内拿不到连接
+class PoolExhaustedError(Exception):
+    pass
+
+
+class _PooledEntry:
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+        self.uses = 0
+
+
+class ConnectionPool:
+    def __init__(self, connection_string, min_size=2, max_size=10, timeout=5.0,
+                 max_uses=1000, max_lifetime=1800.0, health_check_interval=30.0,
+                 connect=None):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError('连接池大小配置错误: 需要 0 <= min_size <= max_size 且 max_size >= 1')
+
+        self.connection_string = connection_string
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout  # 取连接的最长等待时间（秒）
+        self.max_uses = max_uses  # 单个连接最多被借出的次数，0 表示不限制
+        self.max_lifetime = max_lifetime  # 单个连接最长存活时间（秒），0 表示不限制
+        self.health_check_interval = health_check_interval  # 空闲超过该时间的连接借出前先检查，0 表示每次都检查
+        # connect(timeout) 建立一个新连接，timeout 为登录超时秒数，0 表示使用驱动的默认值
+        self._connect = connect or (lambda timeout=0: pyodbc.connect(self.connection_string, timeout=timeout))
+
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._in_use = {}  # id(conn) -> _PooledEntry
+        self._size = 0  # 已建立（含正在建立）的连接数
+
+        # 统计信息
+        self._acquired = 0
+        self._created = 0
+        self._recycled = 0
+        self._health_check_failures = 0
+        self._timeouts = 0
+        self._waiting = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+        self._fill()
+
+    # 预先建立 min_size 个连接；数据库暂时不可用时不影响启动，借出时再报错
+    def _fill(self):
+        while True:
+            with self._cond:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                entry = self._new_entry()
+            except pyodbc.Error:
+                with self._cond:
+                    self._size -= 1
+                return
+            with self._cond:
+                self._idle.append(entry)
+                self._cond.notify()
+
+    def _new_entry(self, connect_timeout=0):
+        entry = _PooledEntry(self._connect(connect_timeout))
+        with self._cond:
+            self._created += 1
+        return entry
+
+    def _expired(self, entry):
+        if self.max_uses and entry.uses >= self.max_uses:
+            return True
+        if self.max_lifetime and time.monotonic() - entry.created_at >= self.max_lifetime:
+            return True
+        return False
+
+    def _healthy(self, entry, query_timeout=0):
+        if time.monotonic() - entry.last_used_at < self.health_check_interval:
+            return True
+        previous = entry.conn.timeout
+        try:
+            entry.conn.timeout = query_timeout
+            cursor = entry.conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except pyodbc.Error:
+            return False
+        finally:
+            try:
+                entry.conn.timeout = previous
+            except pyodbc.Error:
+                pass
+
+    def _discard(self, entry):
+        try:
+            entry.conn.close()
+        except pyodbc.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    # 借出连接，超时抛出 PoolExhaustedError；block=False 时没有可用连接立即返回 None。
+    # connect_timeout 限制本次借出中新建连接的登录时间和空闲连接的检查时间（秒，0 表示不限制），
+    # 用于健康检查等需要在限定时间内返回的调用
+    def acquire(self, block=True, connect_timeout=0):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            entry = None
+            create = False
+            with self._cond:
+                while True:
+                    if self._idle:
+                        entry = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        create = True
+                        break
+                    if not block:
+                        return None
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolExhaustedError(
+                            f'{self.timeout:g} 秒内没有可用的数据库连接（最大连接数 {self.max_size}）')
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+
+            if create:
+                try:
+                    entry = self._new_entry(connect_timeout)
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif self._expired(entry):
+                with self._cond:
+                    self._recycled += 1
+                self._discard(entry)
+                continue
+            elif not self._healthy(entry, connect_timeout):
+                with self._cond:
+                    self._health_check_failures += 1
+                self._discard(entry)
+                continue
+
+            waited = time.monotonic() - start
+            with self._cond:
+                entry.uses += 1
+                self._in_use[id(entry.conn)] = entry
+                self._acquired += 1
+                self._total_wait += waited
+                self._max_wait = max(self._max_wait, waited)
+            return entry.conn
+
+    # 归还连接：回滚未提交的事务，到期的连接直接关闭
+    def release(self, conn, discard=False):
+        with self._cond:
+            entry = self._in_use.pop(id(conn), None)
+        if entry is None:
+            return
+
+        if not discard:
+            try:
+                conn.rollback()
+                conn.autocommit = False
+            except pyodbc.Error:
+                discard = True
+
+        if discard or self._expired(entry):
+            if not discard:
+                with self._cond:
+                    self._recycled += 1
+            self._discard(entry)
+            return
+
+        entry.last_used_at = time.monotonic()
+        with self._cond:
+            self._idle.append(entry)
+            self._cond.notify()
+
+    # 关闭所有空闲连接（进程退出或重新加载配置时使用）
+    def close(self):
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for entry in idle:
+            self._discard(entry)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size,
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+                'waiting': self._waiting,
+                'acquired': self._acquired,
+                'created': self._created,
+                'recycled': self._recycled,
+                'health_check_failures': self._health_check_failures,
+                'timeouts': self._timeouts,
+                'total_wait_seconds': round(self._total_wait, 6),
+                'avg_wait_seconds': round(self._total_wait / self._acquired, 6) if self._acquired else 0.0,
+                'max_wait_seconds': round(self._max_wait, 6),
+            }
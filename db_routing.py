@@ -0,0 +1,247 @@
+# 读写分离
+# 配置了只读副本（CHEMICAL_FACTORY_DB_REPLICA）时，读请求（GET/HEAD 及应用声明为只读的接口）的查询走副本连接池，其他请求走主库。
+# 以下情况读请求仍走主库：
+#   1. 读你所写：用户最近 sticky_window 秒内有过成功的写请求，之后的读请求能看到自己刚写入的数据
+#   2. 副本不可用，或复制延迟超过 max_lag 秒（由 ReplicaMonitor 后台线程定期检查，请求中连不上副本时也立即标记）
+# 复制延迟用心跳表测量（migrations/007_replica_heartbeat.sql）：监视线程先从副本读出心跳时间，
+# 再在主库更新心跳并取回更新前后的值。副本已经看到更新前的心跳时延迟记为 0，否则为主库当前时间减副本的心跳时间；
+# 两个时间都取自主库的时钟，不受两台服务器时钟差的影响。
+import threading
+import time
+from collections import OrderedDict
+
+import pyodbc
+
+from db_pool import PoolExhaustedError
+
+READ_METHODS = frozenset(['GET', 'HEAD'])
+
+
+class LocalStickyBackend:
+    shared = False  # 只记录本进程处理的写入
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._until = OrderedDict()  # 用户 -> 到期时间
+        self._lock = threading.Lock()
+
+    def stick(self, user, seconds):
+        with self._lock:
+            self._until[user] = time.monotonic() + seconds
+            self._until.move_to_end(user)
+            while len(self._until) > self.max_entries:
+                self._until.popitem(last=False)
+
+    def is_sticky(self, user):
+        with self._lock:
+            until = self._until.get(user)
+            if until is None:
+                return False
+            if until <= time.monotonic():
+                del self._until[user]
+                return False
+            return True
+
+    def size(self):
+        with self._lock:
+            return len(self._until)
+
+
+class RedisStickyBackend:
+    shared = True
+
+    def __init__(self, url, prefix='chemical_factory:read_primary:'):
+        import redis  # 可选依赖，只有使用 Redis 后端时才需要安装
+
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def stick(self, user, seconds):
+        self._client.set(self._prefix + user, 1, px=max(1, int(seconds * 1000)))
+
+    def is_sticky(self, user):
+        return bool(self._client.exists(self._prefix + user))
+
+    def size(self):
+        return None
+
+
+class ReplicaMonitor:
+    def __init__(self, get_primary_pool, get_replica_pool, interval=1.0, max_lag=5.0, logger=None):
+        self.get_primary_pool = get_primary_pool
+        self.get_replica_pool = get_replica_pool
+        self.interval = interval
+        self.max_lag = max_lag  # 0 表示不检查延迟，只检查能否连接
+        self.logger = logger
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._checked_at = None  # 最近一次检查成功的时间
+        self._reachable = False
+        self._lag = None
+        self._error = None
+        self._checks = 0
+        self._failures = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='replica-monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while True:
+            self.check()
+            if self._stop.wait(self.interval):
+                return
+
+    def _query(self, pool, sql):
+        conn = pool.acquire()
+        discard = False
+        try:
+            cursor = conn.cursor()
+            cursor.execute(sql)
+            row = cursor.fetchone()
+            conn.commit()
+            return row
+        except pyodbc.Error:
+            discard = True
+            raise
+        finally:
+            pool.release(conn, discard=discard)
+
+    def check(self):
+        try:
+            row = self._query(self.get_replica_pool(), "SELECT beat_at FROM ReplicaHeartbeat WHERE id = 1")
+        except (pyodbc.Error, PoolExhaustedError) as e:
+            self.mark_down(e)
+            return
+        replica_beat = row[0] if row else None
+        lag = None
+        error = None
+        try:
+            row = self._query(self.get_primary_pool(), """
+                UPDATE ReplicaHeartbeat SET beat_at = SYSUTCDATETIME()
+                OUTPUT deleted.beat_at, inserted.beat_at
+                WHERE id = 1
+            """)
+            if row is None or replica_beat is None:
+                error = '心跳表 ReplicaHeartbeat 为空，请执行 migrations/007_replica_heartbeat.sql'
+            elif replica_beat >= row[0]:
+                lag = 0.0
+            else:
+                lag = max((row[1] - replica_beat).total_seconds(), 0.0)
+        except (pyodbc.Error, PoolExhaustedError) as e:
+            error = f"更新主库心跳失败: {str(e).splitlines()[0]}"
+        with self._lock:
+            self._checks += 1
+            self._checked_at = time.monotonic()
+            self._reachable = True
+            self._lag = lag
+            self._error = error
+
+    # 副本连接或查询失败，在下次检查成功之前读请求都走主库
+    def mark_down(self, error):
+        with self._lock:
+            was_reachable = self._reachable
+            self._reachable = False
+            self._failures += 1
+            self._error = str(error).splitlines()[0]
+        if was_reachable and self.logger is not None:
+            self.logger.warning(f"只读副本不可用，读请求改走主库: {error}")
+
+    # 副本可以承担读请求：最近一次检查成功且不过期，延迟在 max_lag 以内
+    def available(self):
+        with self._lock:
+            if not self._reachable or self._checked_at is None:
+                return False
+            if time.monotonic() - self._checked_at > max(3 * self.interval, 5.0):
+                return False  # 监视线程没有按时检查，状态不可信
+            if self.max_lag <= 0:
+                return True
+            return self._lag is not None and self._lag <= self.max_lag
+
+    def stats(self):
+        with self._lock:
+            return {
+                'running': self._thread is not None and not self._stop.is_set(),
+                'reachable': self._reachable,
+                'lag_seconds': self._lag,
+                'max_lag': self.max_lag,
+                'error': self._error,
+                'checks': self._checks,
+                'failures': self._failures,
+                'last_check_age_seconds': (round(time.monotonic() - self._checked_at, 3)
+                                           if self._checked_at is not None else None),
+            }
+
+
+class ReadRouter:
+    def __init__(self, monitor, sticky_backend, sticky_window=10.0):
+        self.monitor = monitor
+        self.sticky_backend = sticky_backend
+        self.sticky_window = sticky_window
+        self._lock = threading.Lock()
+        self._replica_reads = 0
+        self._primary_reads = {'sticky': 0, 'unavailable': 0, 'forced': 0}
+
+    def _count(self, reason=None):
+        with self._lock:
+            if reason is None:
+                self._replica_reads += 1
+            else:
+                self._primary_reads[reason] += 1
+
+    # 返回本次请求是否使用副本。read 为本次请求是否只读；force_primary 为 True 时（如响应缓存未命中）读请求也走主库
+    def use_replica(self, read, user=None, force_primary=False):
+        if not read:
+            return False
+        if force_primary:
+            self._count('forced')
+            return False
+        if user and self.sticky_window > 0 and self.sticky_backend.is_sticky(user):
+            self._count('sticky')
+            return False
+        if not self.monitor.available():
+            self._count('unavailable')
+            return False
+        self._count()
+        return True
+
+    # use_replica 返回 True 但借副本连接失败，本次请求改走主库
+    def replica_failed(self, error):
+        with self._lock:
+            self._replica_reads -= 1
+            self._primary_reads['unavailable'] += 1
+        self.monitor.mark_down(error)
+
+    # 写请求成功后调用，之后 sticky_window 秒内该用户的读请求走主库
+    def record_write(self, user):
+        if user and self.sticky_window > 0:
+            self.sticky_backend.stick(user, self.sticky_window)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'replica_reads': self._replica_reads,
+                'primary_reads': dict(self._primary_reads),
+                'sticky_window': self.sticky_window,
+                'sticky_users': self.sticky_backend.size(),
+                'replica': self.monitor.stats(),
+            }
+
+
+# 根据配置创建读写分离路由，sticky_backend 为 local 或 redis
+def create_read_router(get_primary_pool, get_replica_pool, sticky_backend='local', redis_url=None,
+                       sticky_window=10.0, interval=1.0, max_lag=5.0, logger=None):
+    if sticky_backend == 'redis':
+        backend = RedisStickyBackend(redis_url)
+    elif sticky_backend == 'local':
+        backend = LocalStickyBackend()
+    else:
+        raise ValueError(f'未知的读你所写存储后端: {sticky_backend}')
+    monitor = ReplicaMonitor(get_primary_pool, get_replica_pool, interval, max_lag, logger)
+    return ReadRouter(monitor, backend, sticky_window)
@@ -0,0 +1,179 @@
+# 库存与记录变化的事件广播（Server-Sent Events）
+# 写接口提交后向广播器发布事件，每个 /events 连接对应一个有界队列。
+# 事件在发布时只序列化一次；订阅者只收到其角色有权读取的主题。
+# 队列写满的订阅者直接被丢弃（写接口从不阻塞），客户端重连后应重新拉取一次全量数据。
+# 每个订阅者在推送期间一直占用一个处理请求的线程，订阅者数量达到 max_subscribers 后拒绝新的订阅。
+# 默认只广播给本进程的订阅者；多进程部署时用 Redis 发布/订阅转发（RedisEventRelay），
+# 每个进程的后台线程接收其他进程发布的事件，再分发给本进程的订阅者。
+import itertools
+import json
+import queue
+import threading
+import uuid
+
+
+class Subscription:
+    def __init__(self, topics, queue_size):
+        self.topics = frozenset(topics)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = False
+
+    # 取下一条事件，超时返回 None
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class RedisEventRelay:
+    def __init__(self, url, channel='chemical_factory:events', logger=None):
+        import redis  # 可选依赖，只有使用 Redis 后端时才需要安装
+
+        self._client = redis.Redis.from_url(url)
+        self._channel = channel
+        self._origin = uuid.uuid4().hex  # 本进程发布的事件已在本地分发，转发回来时跳过
+        self.logger = logger
+        self._thread = None
+        self._stop = threading.Event()
+        self._errors = 0
+
+    def publish(self, topic, data):
+        self._client.publish(self._channel, json.dumps([self._origin, topic, data]))
+
+    def start(self, deliver):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, args=(deliver,), name='event-relay', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, deliver):
+        while not self._stop.is_set():
+            pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self._channel)
+                while not self._stop.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+                    origin, topic, data = json.loads(message['data'])
+                    if origin != self._origin:
+                        deliver(topic, data)
+            except Exception as e:
+                # 断线期间其他进程的事件会丢失，订阅者需要靠重连后的全量拉取补齐
+                self._errors += 1
+                if self.logger is not None:
+                    self.logger.warning(f"接收其他进程的变化事件失败，1 秒后重连: {e}")
+                self._stop.wait(1.0)
+            finally:
+                pubsub.close()
+
+    def stats(self):
+        return {
+            'running': self._thread is not None and not self._stop.is_set(),
+            'errors': self._errors,
+        }
+
+
+class EventBroadcaster:
+    def __init__(self, queue_size=100, relay=None, max_subscribers=0):
+        self.queue_size = queue_size
+        self.relay = relay
+        self.max_subscribers = max_subscribers  # 0 表示不限制
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._published = 0
+        self._delivered = 0
+        self._dropped = 0
+        self._rejected = 0
+
+    # 订阅者已满时返回 None
+    def subscribe(self, topics):
+        subscription = Subscription(topics, self.queue_size)
+        with self._lock:
+            if self.max_subscribers and len(self._subscribers) >= self.max_subscribers:
+                self._rejected += 1
+                return None
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    # 没有订阅者时写接口可以跳过为事件准备数据的查询。
+    # 使用 Redis 转发时不知道其他进程有没有订阅者，总是返回 True
+    def has_subscribers(self, topic=None):
+        if self.relay is not None:
+            return True
+        with self._lock:
+            if topic is None:
+                return bool(self._subscribers)
+            return any(topic in s.topics for s in self._subscribers)
+
+    # 发布一条事件。data 为已序列化的 JSON 字符串
+    def publish(self, topic, data):
+        if self.relay is not None:
+            try:
+                self.relay.publish(topic, data)
+            except Exception as e:
+                if self.relay.logger is not None:
+                    self.relay.logger.warning(f"向其他进程转发变化事件失败: {e}")
+        return self.deliver(topic, data)
+
+    # 分发给本进程的订阅者
+    def deliver(self, topic, data):
+        event_id = next(self._ids)
+        message = f'id: {event_id}\nevent: {topic}\ndata: {data}\n\n'
+        with self._lock:
+            self._published += 1
+            targets = [s for s in self._subscribers if topic in s.topics]
+        for subscription in targets:
+            try:
+                subscription.queue.put_nowait(message)
+            except queue.Full:
+                # 消费太慢的客户端直接断开，不阻塞写入方
+                subscription.dropped = True
+                self.unsubscribe(subscription)
+                with self._lock:
+                    self._dropped += 1
+                continue
+            with self._lock:
+                self._delivered += 1
+        return event_id
+
+    # 启动/停止接收其他进程事件的后台线程（只有使用 Redis 转发时才有）
+    def start(self):
+        if self.relay is not None:
+            self.relay.start(self.deliver)
+
+    def stop(self):
+        if self.relay is not None:
+            self.relay.stop()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'redis' if self.relay is not None else 'local',
+                'subscribers': len(self._subscribers),
+                'max_subscribers': self.max_subscribers,
+                'rejected_subscribers': self._rejected,
+                'queue_size': self.queue_size,
+                'published': self._published,
+                'delivered': self._delivered,
+                'dropped_subscribers': self._dropped,
+                'relay': self.relay.stats() if self.relay is not None else None,
+            }
+
+
+# 根据配置创建事件广播器，backend 为 local 或 redis
+def create_event_broadcaster(backend='local', redis_url=None, queue_size=100, logger=None, max_subscribers=0):
+    if backend == 'redis':
+        return EventBroadcaster(queue_size, RedisEventRelay(redis_url, logger=logger), max_subscribers)
+    if backend == 'local':
+        return EventBroadcaster(queue_size, max_subscribers=max_subscribers)
+    raise ValueError(f'未知的事件广播后端: {backend}')
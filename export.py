@@ -0,0 +1,136 @@
+# 记录历史导出（/export/<record_type>）
+# 查询结果按批 fetchmany，每批编码后立即输出：CSV 每批若干行，Arrow 每批一个 RecordBatch，Parquet 每批一个 row group。
+# 内存占用只与批大小有关，与导出的总行数无关。
+# Arrow、Parquet 需要安装 pyarrow；列类型按查询结果的列类型确定，DECIMAL 列导出为 decimal128，保留精度。
+import csv
+import datetime
+import decimal
+import io
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # 可选依赖
+    pyarrow = None
+
+# 格式 -> (媒体类型, 文件扩展名, 是否需要 pyarrow)
+EXPORT_FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv', False),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows', True),
+    'parquet': ('application/vnd.apache.parquet', 'parquet', True),
+}
+
+
+class ExportFormatError(Exception):
+    pass
+
+
+def check_format(fmt):
+    if fmt not in EXPORT_FORMATS:
+        raise ExportFormatError(f'不支持的 format: {fmt}，可选 {", ".join(EXPORT_FORMATS)}')
+    if EXPORT_FORMATS[fmt][2] and pyarrow is None:
+        raise ExportFormatError(f'服务器未安装 pyarrow，不支持 {fmt} 格式')
+
+
+# 只写的输出流，写入的数据暂存在内存中，每批编码完成后取出输出
+class _ChunkSink(io.RawIOBase):
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _batches(cursor, batch_size):
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield rows
+
+
+def iter_csv(cursor, batch_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column[0] for column in cursor.description])
+    for rows in _batches(cursor, batch_size):
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+# 由 cursor.description 确定 Arrow 列类型：(列名, Python 类型, 显示宽度, 内部长度, 精度, 小数位数, 可为空)
+def arrow_schema(description):
+    fields = []
+    for name, type_code, _, _, precision, scale, _ in description:
+        if type_code is bool:
+            arrow_type = pyarrow.bool_()
+        elif type_code is int:
+            arrow_type = pyarrow.int64()
+        elif type_code is float:
+            arrow_type = pyarrow.float64()
+        elif type_code is decimal.Decimal:
+            arrow_type = pyarrow.decimal128(precision or 38, scale or 0)
+        elif type_code is datetime.datetime:
+            arrow_type = pyarrow.timestamp('ms')
+        elif type_code is datetime.date:
+            arrow_type = pyarrow.date32()
+        elif type_code in (bytes, bytearray):
+            arrow_type = pyarrow.binary()
+        else:
+            arrow_type = pyarrow.string()
+        fields.append(pyarrow.field(name, arrow_type))
+    return pyarrow.schema(fields)
+
+
+def _record_batch(schema, rows):
+    columns = list(zip(*rows))
+    return pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema)
+
+
+def iter_arrow(cursor, batch_size):
+    schema = arrow_schema(cursor.description)
+    sink = _ChunkSink()
+    with pyarrow.ipc.new_stream(sink, schema) as writer:
+        yield sink.drain()
+        for rows in _batches(cursor, batch_size):
+            writer.write_batch(_record_batch(schema, rows))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def iter_parquet(cursor, batch_size, compression='snappy'):
+    schema = arrow_schema(cursor.description)
+    sink = _ChunkSink()
+    with pyarrow.parquet.ParquetWriter(sink, schema, compression=compression) as writer:
+        for rows in _batches(cursor, batch_size):
+            writer.write_table(pyarrow.Table.from_batches([_record_batch(schema, rows)]), row_group_size=len(rows))
+            yield sink.drain()
+    yield sink.drain()
+
+
+# 按格式逐块编码已执行查询的结果
+def iter_export(cursor, fmt, batch_size, parquet_compression='snappy'):
+    if fmt == 'parquet':
+        return iter_parquet(cursor, batch_size, parquet_compression)
+    if fmt == 'arrow':
+        return iter_arrow(cursor, batch_size)
+    return iter_csv(cursor, batch_size)
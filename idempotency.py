@@ -0,0 +1,219 @@
+# 写接口的幂等键（Idempotency-Key 请求头）
+# 客户端超时重试时带上同一个键：第一次请求执行期间，相同键的并发请求等待其完成；
+# 完成后在 ttl 秒内重试直接返回第一次的响应，不再访问数据库。请求体与第一次不同时视为误用。
+# 只保存成功（2xx）的响应，失败的请求释放键，客户端可以用同一个键重试。
+# 默认保存在进程内；多进程部署时可换成 Redis 后端，让所有进程共享。
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+PENDING = 'pending'
+DONE = 'done'
+
+
+class _LocalEntry:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.state = PENDING
+        self.response = None
+        self.expires = None
+        self.done = threading.Event()
+
+    def record(self):
+        return {'state': self.state, 'fingerprint': self.fingerprint, 'response': self.response}
+
+
+class LocalIdempotencyBackend:
+    shared = False  # 只对本进程收到的重试有效
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # 键 -> _LocalEntry
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry.state == DONE and entry.expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        return entry
+
+    # 超过容量时淘汰最早完成的条目，执行中的条目不淘汰
+    def _evict(self):
+        if len(self._entries) <= self.max_entries:
+            return
+        for key in [k for k, e in self._entries.items() if e.state == DONE]:
+            del self._entries[key]
+            if len(self._entries) <= self.max_entries:
+                return
+
+    # 占用键；已被占用时返回已有的记录
+    def claim(self, key, fingerprint, pending_ttl):
+        with self._lock:
+            entry = self._get(key)
+            if entry is not None:
+                return entry.record()
+            self._entries[key] = _LocalEntry(fingerprint)
+            self._evict()
+            return None
+
+    def complete(self, key, response, ttl):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.state = DONE
+            entry.response = response
+            entry.expires = time.monotonic() + ttl
+            self._entries.move_to_end(key)
+        entry.done.set()
+
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry.done.set()
+
+    # 等待执行中的请求结束，返回结束后的记录；键已被释放时返回 None，超时返回执行中的记录
+    def wait(self, key, timeout):
+        with self._lock:
+            entry = self._get(key)
+        if entry is None:
+            return None
+        entry.done.wait(timeout)
+        with self._lock:
+            return entry.record() if self._entries.get(key) is entry else None
+
+    def size(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class RedisIdempotencyBackend:
+    POLL_INTERVAL = 0.05
+    shared = True
+
+    def __init__(self, url, prefix='chemical_factory:idempotency:'):
+        import redis  # 可选依赖，只有使用 Redis 后端时才需要安装
+
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def _load(self, key):
+        raw = self._client.get(self._prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def claim(self, key, fingerprint, pending_ttl):
+        # 执行中的标记带过期时间，进程中途退出时键会自动释放
+        record = {'state': PENDING, 'fingerprint': fingerprint, 'response': None}
+        if self._client.set(self._prefix + key, json.dumps(record), nx=True, ex=max(1, int(pending_ttl))):
+            return None
+        return self._load(key) or self.claim(key, fingerprint, pending_ttl)
+
+    def complete(self, key, response, ttl):
+        record = self._load(key)
+        if record is None:
+            return
+        record.update(state=DONE, response=response)
+        self._client.set(self._prefix + key, json.dumps(record), ex=max(1, int(ttl)))
+
+    def release(self, key):
+        self._client.delete(self._prefix + key)
+
+    def wait(self, key, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            record = self._load(key)
+            if record is None or record['state'] == DONE or time.monotonic() >= deadline:
+                return record
+            time.sleep(self.POLL_INTERVAL)
+
+    def size(self):
+        return None
+
+
+class IdempotencyStore:
+    def __init__(self, backend, ttl=86400.0, wait_timeout=30.0, pending_ttl=120.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.pending_ttl = pending_ttl
+        self._lock = threading.Lock()
+        self._executed = 0
+        self._replayed = 0
+        self._waited = 0
+        self._conflicts = 0
+
+    # 键能否在进程之间共享；不能共享时，多进程运行下同一个键的重试可能落到其他进程而被重复执行
+    @property
+    def shared(self):
+        return self.backend.shared
+
+    @staticmethod
+    def key(scope, idempotency_key):
+        return hashlib.sha256(f'{scope}\n{idempotency_key}'.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def fingerprint(body):
+        return hashlib.sha256(body).hexdigest()
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    # 返回 (结果, 保存的响应)。结果为 execute（由本请求执行）、replay（返回保存的响应）、
+    # mismatch（同一个键的请求体不同）或 in_progress（等待超时，第一次请求仍在执行）
+    def begin(self, key, fingerprint):
+        deadline = time.monotonic() + self.wait_timeout
+        waited = False
+        while True:
+            record = self.backend.claim(key, fingerprint, self.pending_ttl)
+            if record is None:
+                self._count('_executed')
+                return 'execute', None
+            if record['fingerprint'] != fingerprint:
+                self._count('_conflicts')
+                return 'mismatch', None
+            if record['state'] == PENDING:
+                if not waited:
+                    waited = True
+                    self._count('_waited')
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    record = self.backend.wait(key, remaining)
+                if record is None:
+                    continue  # 第一次请求失败释放了键，由本请求重新执行
+                if record['state'] == PENDING:
+                    self._count('_conflicts')
+                    return 'in_progress', None
+            self._count('_replayed')
+            return 'replay', record['response']
+
+    def complete(self, key, response):
+        self.backend.complete(key, response, self.ttl)
+
+    def release(self, key):
+        self.backend.release(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': type(self.backend).__name__,
+                'entries': self.backend.size(),
+                'executed': self._executed,
+                'replayed': self._replayed,
+                'waited': self._waited,
+                'conflicts': self._conflicts,
+            }
+
+
+# 根据配置创建幂等键存储，backend 为 local 或 redis
+def create_idempotency_store(backend='local', redis_url=None, ttl=86400.0, max_entries=10000,
+                             wait_timeout=30.0, pending_ttl=120.0):
+    if backend == 'redis':
+        return IdempotencyStore(RedisIdempotencyBackend(redis_url), ttl, wait_timeout, pending_ttl)
+    if backend == 'local':
+        return IdempotencyStore(LocalIdempotencyBackend(max_entries), ttl, wait_timeout, pending_ttl)
+    raise ValueError(f'未知的幂等键存储后端: {backend}')
@@ -0,0 +1,16 @@
+-- 低库存监控
+-- 在原料表上增加持久化计算列 is_low_stock（库存低于最低库存阈值时为 1），并为其建立索引。
+-- 计算列随触发器对 stock 的每次更新自动维护，查询低库存原料只需在索引上做一次查找，与原料总数无关。
+-- 注：筛选索引的条件不能引用计算列，这里用普通索引，键的第一列即为 is_low_stock。
+
+USE chemical_factory;
+GO
+
+ALTER TABLE ChemicalMaterial ADD is_low_stock AS
+    CAST(CASE WHEN stock < min_stock_threshold THEN 1 ELSE 0 END AS BIT) PERSISTED;
+GO
+
+CREATE INDEX IX_ChemicalMaterial_is_low_stock
+    ON ChemicalMaterial (is_low_stock, material_id)
+    INCLUDE (name, cas_number, stock, unit, category, min_stock_threshold);
+GO
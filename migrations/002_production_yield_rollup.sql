@@ -0,0 +1,103 @@
+-- 生产收率汇总
+-- ProductionYieldDaily 按 (日期, 产品, 生产线) 汇总生产记录的条数、理论产量与实际产量。
+-- 由 ProductionRecord 上的触发器在同一事务内增量维护（单条添加、批量导入、修改、删除都会经过触发器），
+-- /analytics/yield 只读汇总表，不扫描原始记录。sp_RebuildYieldRollup 可一次性从原始记录重建汇总表。
+-- 注：product_id、line_id 或 date 为空的记录不计入汇总。
+
+USE chemical_factory;
+GO
+
+CREATE TABLE ProductionYieldDaily (
+    date DATE NOT NULL,
+    product_id INT NOT NULL,
+    line_id INT NOT NULL,
+    record_count INT NOT NULL,
+    theoretical_output DECIMAL(18,2) NOT NULL,
+    actual_output DECIMAL(18,2) NOT NULL,
+    CONSTRAINT PK_ProductionYieldDaily PRIMARY KEY (date, product_id, line_id)
+);
+GO
+
+-- 按产品、生产线分组时仍按日期范围筛选
+CREATE INDEX IX_ProductionYieldDaily_product ON ProductionYieldDaily (product_id, date)
+    INCLUDE (record_count, theoretical_output, actual_output);
+CREATE INDEX IX_ProductionYieldDaily_line ON ProductionYieldDaily (line_id, date)
+    INCLUDE (record_count, theoretical_output, actual_output);
+GO
+
+-- 生产记录变化时增量更新汇总表：新增行计正数、删除行计负数，合并后写入
+CREATE TRIGGER trg_ProductionYieldRollup
+ON ProductionRecord
+AFTER INSERT, UPDATE, DELETE
+AS
+BEGIN
+    SET NOCOUNT ON;
+
+    WITH delta AS (
+        SELECT date, product_id, line_id,
+               SUM(cnt) AS record_count,
+               SUM(theoretical_output) AS theoretical_output,
+               SUM(actual_output) AS actual_output
+        FROM (
+            SELECT date, product_id, line_id, 1 AS cnt,
+                   ISNULL(theoretical_output, 0) AS theoretical_output,
+                   ISNULL(actual_output, 0) AS actual_output
+            FROM INSERTED
+            UNION ALL
+            SELECT date, product_id, line_id, -1,
+                   -ISNULL(theoretical_output, 0),
+                   -ISNULL(actual_output, 0)
+            FROM DELETED
+        ) AS changes
+        WHERE date IS NOT NULL AND product_id IS NOT NULL AND line_id IS NOT NULL
+        GROUP BY date, product_id, line_id
+    )
+    MERGE ProductionYieldDaily WITH (HOLDLOCK) AS t
+    USING delta AS d
+        ON t.date = d.date AND t.product_id = d.product_id AND t.line_id = d.line_id
+    WHEN MATCHED AND t.record_count + d.record_count = 0 THEN
+        DELETE
+    WHEN MATCHED THEN
+        UPDATE SET record_count = t.record_count + d.record_count,
+                   theoretical_output = t.theoretical_output + d.theoretical_output,
+                   actual_output = t.actual_output + d.actual_output
+    WHEN NOT MATCHED BY TARGET AND d.record_count > 0 THEN
+        INSERT (date, product_id, line_id, record_count, theoretical_output, actual_output)
+        VALUES (d.date, d.product_id, d.line_id, d.record_count, d.theoretical_output, d.actual_output);
+END;
+GO
+
+-- 从原始记录重建汇总表（首次部署、数据修复时使用），返回重建后的汇总行数
+CREATE PROCEDURE sp_RebuildYieldRollup
+AS
+BEGIN
+    SET NOCOUNT ON;
+
+    BEGIN TRANSACTION;
+
+    BEGIN TRY
+        -- 重建期间锁住生产记录表，避免与触发器的增量更新交错
+        DELETE FROM ProductionYieldDaily WITH (TABLOCKX);
+
+        INSERT INTO ProductionYieldDaily (date, product_id, line_id, record_count, theoretical_output, actual_output)
+        SELECT date, product_id, line_id,
+               COUNT(*),
+               SUM(ISNULL(theoretical_output, 0)),
+               SUM(ISNULL(actual_output, 0))
+        FROM ProductionRecord WITH (TABLOCK, HOLDLOCK)
+        WHERE date IS NOT NULL AND product_id IS NOT NULL AND line_id IS NOT NULL
+        GROUP BY date, product_id, line_id;
+
+        DECLARE @rows INT = @@ROWCOUNT;
+        COMMIT TRANSACTION;
+        SELECT @rows AS RollupRows;
+    END TRY
+    BEGIN CATCH
+        ROLLBACK TRANSACTION;
+        THROW;
+    END CATCH
+END;
+GO
+
+EXEC sp_RebuildYieldRollup;
+GO
@@ -0,0 +1,310 @@
+-- 历史时点库存（月末结账等场景查询"某日库存"）
+-- 1. 三个索引视图按 (原料/产品, 日期) 汇总每日出入库量，由 SQL Server 随明细写入自动维护；
+-- 2. StockSnapshot 保存定期（默认每天）的库存快照，表示快照日当天结束时的库存；
+-- 3. 查询某日库存 = 不晚于该日的最近一次快照 + 快照日之后到该日的每日汇总。
+-- 初始库存是直接写入 stock 的，所以快照以当前库存为基准，减去之后的出入库倒推得到。
+-- 补录（日期早于已有快照）的明细由触发器直接修正之后的快照；记录日期被修改时删除受影响日期之后的快照，
+-- 查询会退回到更早的快照，之后再由 sp_BuildStockSnapshots 补建。
+
+USE chemical_factory;
+GO
+
+-- 每日原料进货量
+CREATE VIEW dbo.vw_PurchaseMaterialDaily
+WITH SCHEMABINDING
+AS
+SELECT pm.material_id, pr.date,
+       SUM(ISNULL(pm.quantity, 0)) AS quantity,
+       COUNT_BIG(*) AS line_count
+FROM dbo.PurchaseMaterial pm
+JOIN dbo.PurchaseRecord pr ON pr.record_id = pm.record_id
+GROUP BY pm.material_id, pr.date;
+GO
+CREATE UNIQUE CLUSTERED INDEX IX_vw_PurchaseMaterialDaily ON dbo.vw_PurchaseMaterialDaily (material_id, date);
+-- 查询某段日期内所有原料的变化量
+CREATE INDEX IX_vw_PurchaseMaterialDaily_date ON dbo.vw_PurchaseMaterialDaily (date, material_id) INCLUDE (quantity);
+GO
+
+-- 每日原料生产用量
+CREATE VIEW dbo.vw_UseMaterialDaily
+WITH SCHEMABINDING
+AS
+SELECT um.material_id, pr.date,
+       SUM(ISNULL(um.quantity_used, 0)) AS quantity,
+       COUNT_BIG(*) AS line_count
+FROM dbo.UseMaterial um
+JOIN dbo.ProductionRecord pr ON pr.record_id = um.record_id
+GROUP BY um.material_id, pr.date;
+GO
+CREATE UNIQUE CLUSTERED INDEX IX_vw_UseMaterialDaily ON dbo.vw_UseMaterialDaily (material_id, date);
+-- 查询某段日期内所有原料的变化量
+CREATE INDEX IX_vw_UseMaterialDaily_date ON dbo.vw_UseMaterialDaily (date, material_id) INCLUDE (quantity);
+GO
+
+-- 每日产品销售量
+CREATE VIEW dbo.vw_SaleProductDaily
+WITH SCHEMABINDING
+AS
+SELECT sp.product_id, sr.date,
+       SUM(ISNULL(sp.quantity, 0)) AS quantity,
+       COUNT_BIG(*) AS line_count
+FROM dbo.SaleProduct sp
+JOIN dbo.SalesRecord sr ON sr.record_id = sp.record_id
+GROUP BY sp.product_id, sr.date;
+GO
+CREATE UNIQUE CLUSTERED INDEX IX_vw_SaleProductDaily ON dbo.vw_SaleProductDaily (product_id, date);
+-- 查询某段日期内所有产品的变化量
+CREATE INDEX IX_vw_SaleProductDaily_date ON dbo.vw_SaleProductDaily (date, product_id) INCLUDE (quantity);
+GO
+
+-- 库存快照，item_type: M 原料，P 产品
+CREATE TABLE StockSnapshot (
+    item_type CHAR(1) NOT NULL,
+    snapshot_date DATE NOT NULL,
+    item_id INT NOT NULL,
+    stock DECIMAL(18,2) NOT NULL,
+    CONSTRAINT PK_StockSnapshot PRIMARY KEY (item_type, snapshot_date, item_id),
+    CONSTRAINT CK_StockSnapshot_item_type CHECK (item_type IN ('M', 'P'))
+);
+GO
+
+-- 补录的明细：修正日期不早于明细所属记录日期的快照
+CREATE TRIGGER trg_StockSnapshotPurchaseMaterial
+ON PurchaseMaterial
+AFTER INSERT, UPDATE, DELETE
+AS
+BEGIN
+    SET NOCOUNT ON;
+
+    DECLARE @delta TABLE (item_id INT, date DATE, quantity DECIMAL(18,2), PRIMARY KEY (item_id, date));
+    INSERT INTO @delta (item_id, date, quantity)
+    SELECT c.material_id, pr.date, SUM(c.quantity)
+    FROM (
+        SELECT record_id, material_id, ISNULL(quantity, 0) AS quantity FROM INSERTED
+        UNION ALL
+        SELECT record_id, material_id, -ISNULL(quantity, 0) FROM DELETED
+    ) AS c
+    JOIN PurchaseRecord pr ON pr.record_id = c.record_id
+    WHERE pr.date IS NOT NULL
+    GROUP BY c.material_id, pr.date;
+
+    UPDATE s
+    SET stock = s.stock + x.quantity
+    FROM StockSnapshot s
+    CROSS APPLY (SELECT SUM(d.quantity) AS quantity FROM @delta d
+                 WHERE d.item_id = s.item_id AND d.date <= s.snapshot_date) AS x
+    WHERE s.item_type = 'M'
+      AND s.snapshot_date >= (SELECT MIN(date) FROM @delta)
+      AND s.item_id IN (SELECT item_id FROM @delta)
+      AND x.quantity <> 0;
+END;
+GO
+
+CREATE TRIGGER trg_StockSnapshotUseMaterial
+ON UseMaterial
+AFTER INSERT, UPDATE, DELETE
+AS
+BEGIN
+    SET NOCOUNT ON;
+
+    DECLARE @delta TABLE (item_id INT, date DATE, quantity DECIMAL(18,2), PRIMARY KEY (item_id, date));
+    INSERT INTO @delta (item_id, date, quantity)
+    SELECT c.material_id, pr.date, SUM(c.quantity)
+    FROM (
+        SELECT record_id, material_id, -ISNULL(quantity_used, 0) AS quantity FROM INSERTED
+        UNION ALL
+        SELECT record_id, material_id, ISNULL(quantity_used, 0) FROM DELETED
+    ) AS c
+    JOIN ProductionRecord pr ON pr.record_id = c.record_id
+    WHERE pr.date IS NOT NULL
+    GROUP BY c.material_id, pr.date;
+
+    UPDATE s
+    SET stock = s.stock + x.quantity
+    FROM StockSnapshot s
+    CROSS APPLY (SELECT SUM(d.quantity) AS quantity FROM @delta d
+                 WHERE d.item_id = s.item_id AND d.date <= s.snapshot_date) AS x
+    WHERE s.item_type = 'M'
+      AND s.snapshot_date >= (SELECT MIN(date) FROM @delta)
+      AND s.item_id IN (SELECT item_id FROM @delta)
+      AND x.quantity <> 0;
+END;
+GO
+
+CREATE TRIGGER trg_StockSnapshotSaleProduct
+ON SaleProduct
+AFTER INSERT, UPDATE, DELETE
+AS
+BEGIN
+    SET NOCOUNT ON;
+
+    DECLARE @delta TABLE (item_id INT, date DATE, quantity DECIMAL(18,2), PRIMARY KEY (item_id, date));
+    INSERT INTO @delta (item_id, date, quantity)
+    SELECT c.product_id, sr.date, SUM(c.quantity)
+    FROM (
+        SELECT record_id, product_id, -ISNULL(quantity, 0) AS quantity FROM INSERTED
+        UNION ALL
+        SELECT record_id, product_id, ISNULL(quantity, 0) FROM DELETED
+    ) AS c
+    JOIN SalesRecord sr ON sr.record_id = c.record_id
+    WHERE sr.date IS NOT NULL
+    GROUP BY c.product_id, sr.date;
+
+    UPDATE s
+    SET stock = s.stock + x.quantity
+    FROM StockSnapshot s
+    CROSS APPLY (SELECT SUM(d.quantity) AS quantity FROM @delta d
+                 WHERE d.item_id = s.item_id AND d.date <= s.snapshot_date) AS x
+    WHERE s.item_type = 'P'
+      AND s.snapshot_date >= (SELECT MIN(date) FROM @delta)
+      AND s.item_id IN (SELECT item_id FROM @delta)
+      AND x.quantity <> 0;
+END;
+GO
+
+-- 记录日期被修改（很少发生）：删除从较早日期起的整日快照（原料和产品一起删，保持快照日期一致），
+-- 查询自动退回到更早的快照
+CREATE TRIGGER trg_StockSnapshotPurchaseDate
+ON PurchaseRecord
+AFTER UPDATE
+AS
+BEGIN
+    SET NOCOUNT ON;
+    IF NOT UPDATE(date) RETURN;
+
+    DECLARE @from DATE = (
+        SELECT MIN(CASE WHEN d.date IS NULL OR i.date < d.date THEN i.date ELSE d.date END)
+        FROM INSERTED i JOIN DELETED d ON d.record_id = i.record_id
+        WHERE EXISTS (SELECT i.date EXCEPT SELECT d.date)
+    );
+    IF @from IS NOT NULL
+        DELETE FROM StockSnapshot WHERE snapshot_date >= @from;
+END;
+GO
+
+CREATE TRIGGER trg_StockSnapshotProductionDate
+ON ProductionRecord
+AFTER UPDATE
+AS
+BEGIN
+    SET NOCOUNT ON;
+    IF NOT UPDATE(date) RETURN;
+
+    DECLARE @from DATE = (
+        SELECT MIN(CASE WHEN d.date IS NULL OR i.date < d.date THEN i.date ELSE d.date END)
+        FROM INSERTED i JOIN DELETED d ON d.record_id = i.record_id
+        WHERE EXISTS (SELECT i.date EXCEPT SELECT d.date)
+    );
+    IF @from IS NOT NULL
+        DELETE FROM StockSnapshot WHERE snapshot_date >= @from;
+END;
+GO
+
+CREATE TRIGGER trg_StockSnapshotSalesDate
+ON SalesRecord
+AFTER UPDATE
+AS
+BEGIN
+    SET NOCOUNT ON;
+    IF NOT UPDATE(date) RETURN;
+
+    DECLARE @from DATE = (
+        SELECT MIN(CASE WHEN d.date IS NULL OR i.date < d.date THEN i.date ELSE d.date END)
+        FROM INSERTED i JOIN DELETED d ON d.record_id = i.record_id
+        WHERE EXISTS (SELECT i.date EXCEPT SELECT d.date)
+    );
+    IF @from IS NOT NULL
+        DELETE FROM StockSnapshot WHERE snapshot_date >= @from;
+END;
+GO
+
+-- 按历史明细补建快照：从 @from 到 @to 每 @period_days 天一次，已存在的同日快照会被重建。返回写入的快照行数。
+-- 默认 @to 为昨天；@from 默认接在已有的最后一次快照之后，没有快照时从最早的出入库日期开始，
+-- 因此每天执行一次只会补上缺少的快照
+CREATE PROCEDURE sp_BuildStockSnapshots
+    @from DATE = NULL,
+    @to DATE = NULL,
+    @period_days INT = 1
+AS
+BEGIN
+    SET NOCOUNT ON;
+    -- 计算期间不允许新的出入库写入，保证倒推的基准（当前库存）与明细一致
+    SET TRANSACTION ISOLATION LEVEL SERIALIZABLE;
+
+    IF @period_days IS NULL OR @period_days < 1
+        THROW 50001, 'period_days 必须大于0', 1;
+    IF @to IS NULL
+        SET @to = DATEADD(DAY, -1, CAST(GETDATE() AS DATE));
+
+    BEGIN TRANSACTION;
+
+    BEGIN TRY
+        -- 每日净变化量
+        CREATE TABLE #net (item_type CHAR(1), item_id INT, date DATE, quantity DECIMAL(18,2),
+                           PRIMARY KEY (item_type, item_id, date));
+        INSERT INTO #net (item_type, item_id, date, quantity)
+        SELECT 'M', material_id, date, SUM(quantity)
+        FROM (
+            SELECT material_id, date, quantity FROM dbo.vw_PurchaseMaterialDaily WITH (NOEXPAND) WHERE date IS NOT NULL
+            UNION ALL
+            SELECT material_id, date, -quantity FROM dbo.vw_UseMaterialDaily WITH (NOEXPAND) WHERE date IS NOT NULL
+        ) AS m
+        GROUP BY material_id, date;
+        INSERT INTO #net (item_type, item_id, date, quantity)
+        SELECT 'P', product_id, date, -quantity
+        FROM dbo.vw_SaleProductDaily WITH (NOEXPAND)
+        WHERE date IS NOT NULL;
+
+        IF @from IS NULL
+            SET @from = ISNULL(DATEADD(DAY, @period_days, (SELECT MAX(snapshot_date) FROM StockSnapshot)),
+                               ISNULL((SELECT MIN(date) FROM #net), @to));
+
+        -- later: 该日及之后的净变化量合计
+        CREATE TABLE #later (item_type CHAR(1), item_id INT, date DATE, quantity DECIMAL(18,2),
+                             PRIMARY KEY (item_type, item_id, date));
+        INSERT INTO #later (item_type, item_id, date, quantity)
+        SELECT item_type, item_id, date,
+               SUM(quantity) OVER (PARTITION BY item_type, item_id ORDER BY date DESC ROWS UNBOUNDED PRECEDING)
+        FROM #net;
+
+        CREATE TABLE #dates (snapshot_date DATE PRIMARY KEY);
+        WITH d AS (
+            SELECT @from AS snapshot_date
+            UNION ALL
+            SELECT DATEADD(DAY, @period_days, snapshot_date) FROM d
+            WHERE DATEADD(DAY, @period_days, snapshot_date) <= @to
+        )
+        INSERT INTO #dates (snapshot_date)
+        SELECT snapshot_date FROM d WHERE snapshot_date <= @to
+        OPTION (MAXRECURSION 0);
+
+        DELETE s FROM StockSnapshot s JOIN #dates d ON d.snapshot_date = s.snapshot_date;
+
+        -- 快照日结束时的库存 = 当前库存 - 快照日之后的净变化量
+        INSERT INTO StockSnapshot (item_type, snapshot_date, item_id, stock)
+        SELECT c.item_type, d.snapshot_date, c.item_id, c.stock - ISNULL(l.quantity, 0)
+        FROM (
+            SELECT 'M' AS item_type, material_id AS item_id, ISNULL(stock, 0) AS stock FROM ChemicalMaterial
+            UNION ALL
+            SELECT 'P', product_id, ISNULL(stock, 0) FROM ChemicalProduct
+        ) AS c
+        CROSS JOIN #dates d
+        OUTER APPLY (
+            SELECT TOP 1 x.quantity FROM #later x
+            WHERE x.item_type = c.item_type AND x.item_id = c.item_id AND x.date > d.snapshot_date
+            ORDER BY x.date
+        ) AS l;
+
+        DECLARE @rows INT = @@ROWCOUNT;
+        COMMIT TRANSACTION;
+        SELECT @rows AS SnapshotRows;
+    END TRY
+    BEGIN CATCH
+        ROLLBACK TRANSACTION;
+        THROW;
+    END CATCH
+END;
+GO
+
+-- 首次部署时按历史补建每日快照在 009 中按月分批执行（这里的版本在一个 SERIALIZABLE 事务中扫描全部历史）；
+-- 之后每天执行一次 EXEC sp_BuildStockSnapshots（可由 SQL Server 代理作业调度，或调用 POST /stock_snapshots）
@@ -0,0 +1,19 @@
+-- 记录明细与记录列表的索引
+-- 三张联系集的主键以原料/产品ID开头，按 record_id 查明细（明细接口、expand=lines、删除存储过程、
+-- 索引视图维护时按记录关联）只能扫描整表。这里为 record_id 建立索引，并包含明细接口需要的列，查明细只需一次查找。
+-- 记录列表按日期排序、按日期范围过滤，日期索引包含列表返回的列，翻页时按索引顺序读取前 N 行即可。
+-- 查询计划是否命中这些索引可以用 benchmark/plan_check.py 检查。
+
+USE chemical_factory;
+GO
+
+CREATE INDEX IX_PurchaseMaterial_record ON PurchaseMaterial (record_id) INCLUDE (quantity, unit_price);
+CREATE INDEX IX_SaleProduct_record ON SaleProduct (record_id) INCLUDE (quantity, unit_price);
+CREATE INDEX IX_UseMaterial_record ON UseMaterial (record_id) INCLUDE (quantity_used);
+GO
+
+CREATE INDEX IX_PurchaseRecord_date ON PurchaseRecord (date, record_id) INCLUDE (supplier_id, employee_id);
+CREATE INDEX IX_SalesRecord_date ON SalesRecord (date, record_id) INCLUDE (customer_id, employee_id);
+CREATE INDEX IX_ProductionRecord_date ON ProductionRecord (date, record_id)
+    INCLUDE (product_id, line_id, theoretical_output, actual_output);
+GO
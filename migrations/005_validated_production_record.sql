@@ -0,0 +1,94 @@
+-- 带校验的生产记录写入
+-- 产品、生产线、原料是否存在，以及（可选）原料库存是否足够，与主表、明细的写入在同一个事务中完成，
+-- 应用只需调用一次存储过程。校验失败时用固定的错误号抛出，消息与原来接口返回的 400 错误信息一致：
+--   50101 产品不存在  50102 生产线不存在  50103 原料不存在  50104 原料库存不足（@reject_negative_stock = 1 时）
+-- 校验读取的行加 HOLDLOCK，库存检查加 UPDLOCK，提交前不会被删除或被并发的生产记录扣减。
+
+USE chemical_factory;
+GO
+
+CREATE PROCEDURE sp_AddProductionRecordValidated
+    @product_id INT,
+    @line_id INT,
+    @record_date DATE,
+    @theoretical_output DECIMAL(10,2),
+    @actual_output DECIMAL(10,2),
+    @materials_used ProductionMaterialUseType READONLY,
+    @reject_negative_stock BIT = 0
+AS
+BEGIN
+    SET NOCOUNT ON;
+    SET XACT_ABORT ON;
+
+    DECLARE @new_record_id INT;
+    DECLARE @message NVARCHAR(2048);
+
+    BEGIN TRANSACTION;
+
+    BEGIN TRY
+        -- 1. 检查产品、生产线
+        IF NOT EXISTS (SELECT 1 FROM ChemicalProduct WITH (HOLDLOCK) WHERE product_id = @product_id)
+        BEGIN
+            SET @message = CONCAT(N'产品ID ', @product_id, N' 不存在');
+            THROW 50101, @message, 1;
+        END
+
+        IF NOT EXISTS (SELECT 1 FROM ProductionLine WITH (HOLDLOCK) WHERE line_id = @line_id)
+        BEGIN
+            SET @message = CONCAT(N'生产线ID ', @line_id, N' 不存在');
+            THROW 50102, @message, 1;
+        END
+
+        -- 2. 检查原料，列出全部不存在的ID
+        SET @message = STUFF((
+            SELECT N', ' + CAST(u.material_id AS NVARCHAR(12))
+            FROM (SELECT DISTINCT material_id FROM @materials_used) u
+            WHERE NOT EXISTS (SELECT 1 FROM ChemicalMaterial cm WITH (HOLDLOCK) WHERE cm.material_id = u.material_id)
+            ORDER BY u.material_id
+            FOR XML PATH('')), 1, 2, N'');
+        IF @message IS NOT NULL
+        BEGIN
+            SET @message = N'以下原料ID不存在: ' + @message;
+            THROW 50103, @message, 1;
+        END
+
+        -- 3. 检查库存是否足够（可选）
+        IF @reject_negative_stock = 1
+        BEGIN
+            SET @message = STUFF((
+                SELECT N'; ' + CAST(cm.material_id AS NVARCHAR(12))
+                       + N' (库存 ' + CAST(ISNULL(cm.stock, 0) AS NVARCHAR(32))
+                       + N', 需要 ' + CAST(u.quantity_used AS NVARCHAR(32)) + N')'
+                FROM (SELECT material_id, SUM(quantity_used) AS quantity_used
+                      FROM @materials_used GROUP BY material_id) u
+                JOIN ChemicalMaterial cm WITH (UPDLOCK, HOLDLOCK) ON cm.material_id = u.material_id
+                WHERE ISNULL(cm.stock, 0) < u.quantity_used
+                ORDER BY cm.material_id
+                FOR XML PATH('')), 1, 2, N'');
+            IF @message IS NOT NULL
+            BEGIN
+                SET @message = N'原料库存不足: ' + @message;
+                THROW 50104, @message, 1;
+            END
+        END
+
+        -- 4. 写入主表和明细（库存由触发器扣减）
+        INSERT INTO ProductionRecord (product_id, line_id, date, theoretical_output, actual_output)
+        VALUES (@product_id, @line_id, @record_date, @theoretical_output, @actual_output);
+
+        SET @new_record_id = SCOPE_IDENTITY();
+
+        INSERT INTO UseMaterial (material_id, record_id, quantity_used)
+        SELECT material_id, @new_record_id, quantity_used
+        FROM @materials_used;
+
+        COMMIT TRANSACTION;
+        SELECT @new_record_id AS NewProductionRecordId;
+    END TRY
+    BEGIN CATCH
+        IF @@TRANCOUNT > 0
+            ROLLBACK TRANSACTION;
+        THROW;
+    END CATCH
+END;
+GO
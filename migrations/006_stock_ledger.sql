@@ -0,0 +1,476 @@
+-- 库存流水（可选）
+-- 进货、销售、生产的触发器原来直接 UPDATE 原料/产品行的 stock，同一原料（硫酸、氢氧化钠等常用原料）的并发写入
+-- 在这一行的锁上排队。启用库存流水后触发器只向 StockLedger 追加一行变化量，不再更新 stock：
+-- 1. StockLedger 按 @@SPID 分片，聚集索引以分片号开头，并发写入分散在多个插入点上；
+-- 2. sp_FoldStockLedger 定期把流水批量合并进 stock（应用的后台线程或 SQL Server 代理作业调用），每个原料每批只更新一次；
+-- 3. 读取库存通过视图 vw_ChemicalMaterialCurrent / vw_ChemicalProductCurrent：stock + 尚未合并的流水，结果始终是准确的当前库存。
+-- 合并在一个事务中删除流水并更新 stock，读取需要语句级一致性，所以启用前数据库必须打开 READ_COMMITTED_SNAPSHOT：
+--   ALTER DATABASE chemical_factory SET READ_COMMITTED_SNAPSHOT ON WITH ROLLBACK IMMEDIATE;
+--   EXEC sp_SetStockLedger @enabled = 1;
+-- 003 中按 (原料, 日期) 汇总的索引视图同样会在每次写入时锁住当天的一行，这里按 record_id 分桶重建，
+-- 同一原料当天的并发写入落在不同的行上；按日期汇总的查询本来就对视图行求和，不受影响。
+-- 未启用时流水表始终为空，视图的结果与原表一致，触发器直接更新 stock。
+-- 三个库存触发器都先按原料/产品汇总本语句的净变化量再写入，同一语句中同一原料的多行明细都会计入。
+
+USE chemical_factory;
+GO
+
+CREATE TABLE StockLedgerSetting (
+    id TINYINT PRIMARY KEY CHECK (id = 1),
+    enabled BIT NOT NULL DEFAULT 0,
+    shard_count TINYINT NOT NULL DEFAULT 16 CHECK (shard_count BETWEEN 1 AND 64)
+);
+INSERT INTO StockLedgerSetting (id) VALUES (1);
+GO
+
+-- 库存变化流水，item_type: M 原料，P 产品；quantity 为库存变化量（增加为正）
+CREATE TABLE StockLedger (
+    shard TINYINT NOT NULL,
+    movement_id BIGINT IDENTITY(1,1) NOT NULL,
+    item_type CHAR(1) NOT NULL,
+    item_id INT NOT NULL,
+    quantity DECIMAL(18,2) NOT NULL,
+    created_at DATETIME2(0) NOT NULL DEFAULT SYSUTCDATETIME(),
+    CONSTRAINT PK_StockLedger PRIMARY KEY (shard, movement_id)
+);
+-- 读取时按原料/产品汇总未合并的流水；键中带分片号，同一原料的插入同样分散
+CREATE INDEX IX_StockLedger_item ON StockLedger (item_type, item_id, shard) INCLUDE (quantity);
+GO
+
+-- 当前库存 = stock + 未合并的流水，列与原表一致（is_low_stock 按当前库存重新计算）
+CREATE VIEW dbo.vw_ChemicalMaterialCurrent
+AS
+SELECT cm.material_id, cm.name, cm.cas_number,
+       CAST(cm.stock + ISNULL(l.quantity, 0) AS DECIMAL(10,2)) AS stock,
+       cm.unit, cm.concentration, cm.category, cm.storage_condition, cm.min_stock_threshold,
+       CAST(CASE WHEN cm.stock + ISNULL(l.quantity, 0) < cm.min_stock_threshold THEN 1 ELSE 0 END AS BIT) AS is_low_stock
+FROM dbo.ChemicalMaterial cm
+OUTER APPLY (
+    SELECT SUM(s.quantity) AS quantity FROM dbo.StockLedger s
+    WHERE s.item_type = 'M' AND s.item_id = cm.material_id
+) AS l;
+GO
+
+CREATE VIEW dbo.vw_ChemicalProductCurrent
+AS
+SELECT cp.product_id, cp.name, cp.unit,
+       CAST(cp.stock + ISNULL(l.quantity, 0) AS DECIMAL(10,2)) AS stock,
+       cp.hazard_rating
+FROM dbo.ChemicalProduct cp
+OUTER APPLY (
+    SELECT SUM(s.quantity) AS quantity FROM dbo.StockLedger s
+    WHERE s.item_type = 'P' AND s.item_id = cp.product_id
+) AS l;
+GO
+
+-- 合并流水：删除一批流水并把各原料/产品的合计加到 stock 上。
+-- 同一时间只有一个合并在执行（应用锁），正在写入的事务持有的流水行被跳过（READPAST），下一次再合并
+CREATE PROCEDURE sp_FoldStockLedger
+    @batch_size INT = 50000
+AS
+BEGIN
+    SET NOCOUNT ON;
+    SET XACT_ABORT ON;
+
+    DECLARE @folded TABLE (item_type CHAR(1), item_id INT, quantity DECIMAL(18,2));
+    DECLARE @lock INT;
+
+    BEGIN TRANSACTION;
+
+    BEGIN TRY
+        EXEC @lock = sp_getapplock @Resource = 'StockLedgerFold', @LockMode = 'Exclusive',
+                                   @LockOwner = 'Transaction', @LockTimeout = 0;
+        IF @lock < 0
+        BEGIN
+            -- 其他进程正在合并，本次什么也没做，直接结束事务
+            COMMIT TRANSACTION;
+            SELECT 0 AS FoldedRows, 0 AS FoldedItems;
+            RETURN;
+        END
+
+        DELETE TOP (@batch_size) FROM StockLedger WITH (READPAST)
+        OUTPUT DELETED.item_type, DELETED.item_id, DELETED.quantity INTO @folded;
+
+        UPDATE cm
+        SET stock = cm.stock + f.quantity
+        FROM ChemicalMaterial cm
+        JOIN (SELECT item_id, SUM(quantity) AS quantity FROM @folded WHERE item_type = 'M' GROUP BY item_id) f
+            ON f.item_id = cm.material_id;
+
+        UPDATE cp
+        SET stock = cp.stock + f.quantity
+        FROM ChemicalProduct cp
+        JOIN (SELECT item_id, SUM(quantity) AS quantity FROM @folded WHERE item_type = 'P' GROUP BY item_id) f
+            ON f.item_id = cp.product_id;
+
+        COMMIT TRANSACTION;
+        SELECT COUNT(*) AS FoldedRows, COUNT(DISTINCT CONCAT(item_type, item_id)) AS FoldedItems FROM @folded;
+    END TRY
+    BEGIN CATCH
+        IF @@TRANCOUNT > 0
+            ROLLBACK TRANSACTION;
+        THROW;
+    END CATCH
+END;
+GO
+
+-- 启用/停用库存流水。停用后新的写入重新直接更新 stock，已有的流水仍由 sp_FoldStockLedger 合并
+CREATE PROCEDURE sp_SetStockLedger
+    @enabled BIT,
+    @shard_count TINYINT = NULL
+AS
+BEGIN
+    SET NOCOUNT ON;
+
+    IF @enabled = 1 AND NOT EXISTS (
+        SELECT 1 FROM sys.databases WHERE name = DB_NAME() AND is_read_committed_snapshot_on = 1)
+        THROW 50201, '启用库存流水前需要打开数据库的 READ_COMMITTED_SNAPSHOT', 1;
+
+    UPDATE StockLedgerSetting
+    SET enabled = @enabled, shard_count = ISNULL(@shard_count, shard_count)
+    WHERE id = 1;
+
+    IF @enabled = 0
+        EXEC sp_FoldStockLedger;
+END;
+GO
+
+-- 进货更新库存
+ALTER TRIGGER trg_UpdateMaterialStock
+ON PurchaseMaterial
+AFTER INSERT, UPDATE, DELETE -- 监听插入、更新、删除操作
+AS
+BEGIN
+    SET NOCOUNT ON;
+
+    -- 按原料汇总本语句的净变化量（新数量 - 旧数量）。一条语句可能写入同一原料的多行明细（批量导入），
+    -- 汇总后每个原料只追加一行流水或只更新一次 stock
+    DECLARE @delta TABLE (item_id INT PRIMARY KEY, quantity DECIMAL(18,2) NOT NULL);
+    INSERT INTO @delta (item_id, quantity)
+    SELECT material_id, SUM(quantity)
+    FROM (
+        SELECT material_id, ISNULL(quantity, 0) AS quantity FROM INSERTED
+        UNION ALL
+        SELECT material_id, -ISNULL(quantity, 0) FROM DELETED
+    ) AS c
+    WHERE material_id IS NOT NULL
+    GROUP BY material_id
+    HAVING SUM(quantity) <> 0;
+    IF @@ROWCOUNT = 0
+        RETURN;
+
+    -- 启用库存流水时只追加变化量，否则直接更新 stock
+    DECLARE @shard_count TINYINT;
+    SELECT @shard_count = shard_count FROM StockLedgerSetting WHERE id = 1 AND enabled = 1;
+    IF @shard_count IS NOT NULL
+        INSERT INTO StockLedger (shard, item_type, item_id, quantity)
+        SELECT @@SPID % @shard_count, 'M', item_id, quantity FROM @delta;
+    ELSE
+        UPDATE CM
+        SET stock = CM.stock + d.quantity
+        FROM ChemicalMaterial CM
+        INNER JOIN @delta d ON d.item_id = CM.material_id;
+END;
+GO
+
+-- 销售更新库存
+ALTER TRIGGER trg_UpdateProductStock
+ON SaleProduct
+AFTER INSERT, UPDATE, DELETE
+AS
+BEGIN
+    SET NOCOUNT ON;
+
+    -- 按产品汇总本语句的净变化量（旧数量 - 新数量）。一条语句可能写入同一产品的多行明细（批量导入），
+    -- 汇总后每个产品只追加一行流水或只更新一次 stock
+    DECLARE @delta TABLE (item_id INT PRIMARY KEY, quantity DECIMAL(18,2) NOT NULL);
+    INSERT INTO @delta (item_id, quantity)
+    SELECT product_id, SUM(quantity)
+    FROM (
+        SELECT product_id, -ISNULL(quantity, 0) AS quantity FROM INSERTED
+        UNION ALL
+        SELECT product_id, ISNULL(quantity, 0) FROM DELETED
+    ) AS c
+    WHERE product_id IS NOT NULL
+    GROUP BY product_id
+    HAVING SUM(quantity) <> 0;
+    IF @@ROWCOUNT = 0
+        RETURN;
+
+    -- 启用库存流水时只追加变化量，否则直接更新 stock
+    DECLARE @shard_count TINYINT;
+    SELECT @shard_count = shard_count FROM StockLedgerSetting WHERE id = 1 AND enabled = 1;
+    IF @shard_count IS NOT NULL
+        INSERT INTO StockLedger (shard, item_type, item_id, quantity)
+        SELECT @@SPID % @shard_count, 'P', item_id, quantity FROM @delta;
+    ELSE
+        UPDATE CP
+        SET stock = CP.stock + d.quantity
+        FROM ChemicalProduct CP
+        INNER JOIN @delta d ON d.item_id = CP.product_id;
+END;
+GO
+
+-- 生产使用原料触发器（处理库存变动）
+ALTER TRIGGER trg_UpdateMaterialStockOnProduction
+ON UseMaterial
+AFTER INSERT, UPDATE, DELETE
+AS
+BEGIN
+    SET NOCOUNT ON;
+
+    -- 按原料汇总本语句的净变化量（旧用量 - 新用量）。一条语句可能写入同一原料的多行明细（批量导入），
+    -- 汇总后每个原料只追加一行流水或只更新一次 stock
+    DECLARE @delta TABLE (item_id INT PRIMARY KEY, quantity DECIMAL(18,2) NOT NULL);
+    INSERT INTO @delta (item_id, quantity)
+    SELECT material_id, SUM(quantity)
+    FROM (
+        SELECT material_id, -ISNULL(quantity_used, 0) AS quantity FROM INSERTED
+        UNION ALL
+        SELECT material_id, ISNULL(quantity_used, 0) FROM DELETED
+    ) AS c
+    WHERE material_id IS NOT NULL
+    GROUP BY material_id
+    HAVING SUM(quantity) <> 0;
+    IF @@ROWCOUNT = 0
+        RETURN;
+
+    -- 启用库存流水时只追加变化量，否则直接更新 stock
+    DECLARE @shard_count TINYINT;
+    SELECT @shard_count = shard_count FROM StockLedgerSetting WHERE id = 1 AND enabled = 1;
+    IF @shard_count IS NOT NULL
+        INSERT INTO StockLedger (shard, item_type, item_id, quantity)
+        SELECT @@SPID % @shard_count, 'M', item_id, quantity FROM @delta;
+    ELSE
+        UPDATE CM
+        SET stock = CM.stock + d.quantity
+        FROM ChemicalMaterial CM
+        INNER JOIN @delta d ON d.item_id = CM.material_id;
+END;
+GO
+
+-- 每日汇总索引视图按 record_id 分 16 个桶，同一原料当天的并发写入维护的是不同的视图行
+DROP VIEW dbo.vw_PurchaseMaterialDaily;
+DROP VIEW dbo.vw_UseMaterialDaily;
+DROP VIEW dbo.vw_SaleProductDaily;
+GO
+
+CREATE VIEW dbo.vw_PurchaseMaterialDaily
+WITH SCHEMABINDING
+AS
+SELECT pm.material_id, pr.date, pm.record_id % 16 AS bucket,
+       SUM(ISNULL(pm.quantity, 0)) AS quantity,
+       COUNT_BIG(*) AS line_count
+FROM dbo.PurchaseMaterial pm
+JOIN dbo.PurchaseRecord pr ON pr.record_id = pm.record_id
+GROUP BY pm.material_id, pr.date, pm.record_id % 16;
+GO
+CREATE UNIQUE CLUSTERED INDEX IX_vw_PurchaseMaterialDaily ON dbo.vw_PurchaseMaterialDaily (material_id, date, bucket);
+CREATE INDEX IX_vw_PurchaseMaterialDaily_date ON dbo.vw_PurchaseMaterialDaily (date, material_id) INCLUDE (quantity);
+GO
+
+CREATE VIEW dbo.vw_UseMaterialDaily
+WITH SCHEMABINDING
+AS
+SELECT um.material_id, pr.date, um.record_id % 16 AS bucket,
+       SUM(ISNULL(um.quantity_used, 0)) AS quantity,
+       COUNT_BIG(*) AS line_count
+FROM dbo.UseMaterial um
+JOIN dbo.ProductionRecord pr ON pr.record_id = um.record_id
+GROUP BY um.material_id, pr.date, um.record_id % 16;
+GO
+CREATE UNIQUE CLUSTERED INDEX IX_vw_UseMaterialDaily ON dbo.vw_UseMaterialDaily (material_id, date, bucket);
+CREATE INDEX IX_vw_UseMaterialDaily_date ON dbo.vw_UseMaterialDaily (date, material_id) INCLUDE (quantity);
+GO
+
+CREATE VIEW dbo.vw_SaleProductDaily
+WITH SCHEMABINDING
+AS
+SELECT sp.product_id, sr.date, sp.record_id % 16 AS bucket,
+       SUM(ISNULL(sp.quantity, 0)) AS quantity,
+       COUNT_BIG(*) AS line_count
+FROM dbo.SaleProduct sp
+JOIN dbo.SalesRecord sr ON sr.record_id = sp.record_id
+GROUP BY sp.product_id, sr.date, sp.record_id % 16;
+GO
+CREATE UNIQUE CLUSTERED INDEX IX_vw_SaleProductDaily ON dbo.vw_SaleProductDaily (product_id, date, bucket);
+CREATE INDEX IX_vw_SaleProductDaily_date ON dbo.vw_SaleProductDaily (date, product_id) INCLUDE (quantity);
+GO
+
+-- 快照以准确的当前库存为基准；视图分桶后销售量同样需要先按日汇总
+ALTER PROCEDURE sp_BuildStockSnapshots
+    @from DATE = NULL,
+    @to DATE = NULL,
+    @period_days INT = 1
+AS
+BEGIN
+    SET NOCOUNT ON;
+    -- 计算期间不允许新的出入库写入，保证倒推的基准（当前库存）与明细一致
+    SET TRANSACTION ISOLATION LEVEL SERIALIZABLE;
+
+    IF @period_days IS NULL OR @period_days < 1
+        THROW 50001, 'period_days 必须大于0', 1;
+    IF @to IS NULL
+        SET @to = DATEADD(DAY, -1, CAST(GETDATE() AS DATE));
+
+    BEGIN TRANSACTION;
+
+    BEGIN TRY
+        -- 每日净变化量
+        CREATE TABLE #net (item_type CHAR(1), item_id INT, date DATE, quantity DECIMAL(18,2),
+                           PRIMARY KEY (item_type, item_id, date));
+        INSERT INTO #net (item_type, item_id, date, quantity)
+        SELECT 'M', material_id, date, SUM(quantity)
+        FROM (
+            SELECT material_id, date, quantity FROM dbo.vw_PurchaseMaterialDaily WITH (NOEXPAND) WHERE date IS NOT NULL
+            UNION ALL
+            SELECT material_id, date, -quantity FROM dbo.vw_UseMaterialDaily WITH (NOEXPAND) WHERE date IS NOT NULL
+        ) AS m
+        GROUP BY material_id, date;
+        INSERT INTO #net (item_type, item_id, date, quantity)
+        SELECT 'P', product_id, date, -SUM(quantity)
+        FROM dbo.vw_SaleProductDaily WITH (NOEXPAND)
+        WHERE date IS NOT NULL
+        GROUP BY product_id, date;
+
+        IF @from IS NULL
+            SET @from = ISNULL(DATEADD(DAY, @period_days, (SELECT MAX(snapshot_date) FROM StockSnapshot)),
+                               ISNULL((SELECT MIN(date) FROM #net), @to));
+
+        -- later: 该日及之后的净变化量合计
+        CREATE TABLE #later (item_type CHAR(1), item_id INT, date DATE, quantity DECIMAL(18,2),
+                             PRIMARY KEY (item_type, item_id, date));
+        INSERT INTO #later (item_type, item_id, date, quantity)
+        SELECT item_type, item_id, date,
+               SUM(quantity) OVER (PARTITION BY item_type, item_id ORDER BY date DESC ROWS UNBOUNDED PRECEDING)
+        FROM #net;
+
+        CREATE TABLE #dates (snapshot_date DATE PRIMARY KEY);
+        WITH d AS (
+            SELECT @from AS snapshot_date
+            UNION ALL
+            SELECT DATEADD(DAY, @period_days, snapshot_date) FROM d
+            WHERE DATEADD(DAY, @period_days, snapshot_date) <= @to
+        )
+        INSERT INTO #dates (snapshot_date)
+        SELECT snapshot_date FROM d WHERE snapshot_date <= @to
+        OPTION (MAXRECURSION 0);
+
+        DELETE s FROM StockSnapshot s JOIN #dates d ON d.snapshot_date = s.snapshot_date;
+
+        -- 快照日结束时的库存 = 当前库存 - 快照日之后的净变化量
+        INSERT INTO StockSnapshot (item_type, snapshot_date, item_id, stock)
+        SELECT c.item_type, d.snapshot_date, c.item_id, c.stock - ISNULL(l.quantity, 0)
+        FROM (
+            SELECT 'M' AS item_type, material_id AS item_id, ISNULL(stock, 0) AS stock FROM dbo.vw_ChemicalMaterialCurrent
+            UNION ALL
+            SELECT 'P', product_id, ISNULL(stock, 0) FROM dbo.vw_ChemicalProductCurrent
+        ) AS c
+        CROSS JOIN #dates d
+        OUTER APPLY (
+            SELECT TOP 1 x.quantity FROM #later x
+            WHERE x.item_type = c.item_type AND x.item_id = c.item_id AND x.date > d.snapshot_date
+            ORDER BY x.date
+        ) AS l;
+
+        DECLARE @rows INT = @@ROWCOUNT;
+        COMMIT TRANSACTION;
+        SELECT @rows AS SnapshotRows;
+    END TRY
+    BEGIN CATCH
+        ROLLBACK TRANSACTION;
+        THROW;
+    END CATCH
+END;
+GO
+
+-- 库存检查计入未合并的流水。检查时锁住该原料的流水范围，提交前其他写入不能改变这些原料的库存
+ALTER PROCEDURE sp_AddProductionRecordValidated
+    @product_id INT,
+    @line_id INT,
+    @record_date DATE,
+    @theoretical_output DECIMAL(10,2),
+    @actual_output DECIMAL(10,2),
+    @materials_used ProductionMaterialUseType READONLY,
+    @reject_negative_stock BIT = 0
+AS
+BEGIN
+    SET NOCOUNT ON;
+    SET XACT_ABORT ON;
+
+    DECLARE @new_record_id INT;
+    DECLARE @message NVARCHAR(2048);
+
+    BEGIN TRANSACTION;
+
+    BEGIN TRY
+        -- 1. 检查产品、生产线
+        IF NOT EXISTS (SELECT 1 FROM ChemicalProduct WITH (HOLDLOCK) WHERE product_id = @product_id)
+        BEGIN
+            SET @message = CONCAT(N'产品ID ', @product_id, N' 不存在');
+            THROW 50101, @message, 1;
+        END
+
+        IF NOT EXISTS (SELECT 1 FROM ProductionLine WITH (HOLDLOCK) WHERE line_id = @line_id)
+        BEGIN
+            SET @message = CONCAT(N'生产线ID ', @line_id, N' 不存在');
+            THROW 50102, @message, 1;
+        END
+
+        -- 2. 检查原料，列出全部不存在的ID
+        SET @message = STUFF((
+            SELECT N', ' + CAST(u.material_id AS NVARCHAR(12))
+            FROM (SELECT DISTINCT material_id FROM @materials_used) u
+            WHERE NOT EXISTS (SELECT 1 FROM ChemicalMaterial cm WITH (HOLDLOCK) WHERE cm.material_id = u.material_id)
+            ORDER BY u.material_id
+            FOR XML PATH('')), 1, 2, N'');
+        IF @message IS NOT NULL
+        BEGIN
+            SET @message = N'以下原料ID不存在: ' + @message;
+            THROW 50103, @message, 1;
+        END
+
+        -- 3. 检查库存是否足够（可选）
+        IF @reject_negative_stock = 1
+        BEGIN
+            SET @message = STUFF((
+                SELECT N'; ' + CAST(cm.material_id AS NVARCHAR(12))
+                       + N' (库存 ' + CAST(ISNULL(cm.stock, 0) + ISNULL(l.quantity, 0) AS NVARCHAR(32))
+                       + N', 需要 ' + CAST(u.quantity_used AS NVARCHAR(32)) + N')'
+                FROM (SELECT material_id, SUM(quantity_used) AS quantity_used
+                      FROM @materials_used GROUP BY material_id) u
+                JOIN ChemicalMaterial cm WITH (UPDLOCK, HOLDLOCK) ON cm.material_id = u.material_id
+                OUTER APPLY (
+                    SELECT SUM(s.quantity) AS quantity FROM StockLedger s WITH (UPDLOCK, HOLDLOCK)
+                    WHERE s.item_type = 'M' AND s.item_id = cm.material_id
+                ) AS l
+                WHERE ISNULL(cm.stock, 0) + ISNULL(l.quantity, 0) < u.quantity_used
+                ORDER BY cm.material_id
+                FOR XML PATH('')), 1, 2, N'');
+            IF @message IS NOT NULL
+            BEGIN
+                SET @message = N'原料库存不足: ' + @message;
+                THROW 50104, @message, 1;
+            END
+        END
+
+        -- 4. 写入主表和明细（库存由触发器扣减）
+        INSERT INTO ProductionRecord (product_id, line_id, date, theoretical_output, actual_output)
+        VALUES (@product_id, @line_id, @record_date, @theoretical_output, @actual_output);
+
+        SET @new_record_id = SCOPE_IDENTITY();
+
+        INSERT INTO UseMaterial (material_id, record_id, quantity_used)
+        SELECT material_id, @new_record_id, quantity_used
+        FROM @materials_used;
+
+        COMMIT TRANSACTION;
+        SELECT @new_record_id AS NewProductionRecordId;
+    END TRY
+    BEGIN CATCH
+        IF @@TRANCOUNT > 0
+            ROLLBACK TRANSACTION;
+        THROW;
+    END CATCH
+END;
+GO
@@ -0,0 +1,15 @@
+-- 只读副本的复制延迟检测（见 db_routing.py）
+-- 应用的监视线程每隔 DB_REPLICA_CHECK_INTERVAL 秒在主库更新这一行的 beat_at，再从副本读回，
+-- 比较两边的值得到副本落后的时间。只需在主库执行，表和数据随复制到达副本。
+
+USE chemical_factory;
+GO
+
+CREATE TABLE ReplicaHeartbeat (
+    id TINYINT NOT NULL PRIMARY KEY CHECK (id = 1),
+    beat_at DATETIME2(3) NOT NULL
+);
+GO
+
+INSERT INTO ReplicaHeartbeat (id, beat_at) VALUES (1, SYSUTCDATETIME());
+GO
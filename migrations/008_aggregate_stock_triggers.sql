@@ -0,0 +1,116 @@
+-- 库存触发器按原料/产品汇总变化量
+-- init.sql（及早先版本的 006）中的库存触发器用 UPDATE ... FROM ... JOIN INSERTED 直接更新 stock。一条语句写入多行明细、
+-- 其中有多行属于同一原料/产品时（如批量导入一批记录），UPDATE 连接到多行但每个目标行只更新一次，
+-- 只有其中一行的数量计入库存，库存悄悄偏离明细。
+-- 这里把三个触发器改为先按原料/产品汇总本语句的净变化量（新数量 - 旧数量，增加为正），再更新 stock 或追加库存流水；
+-- 插入、删除、修改（包括修改明细的原料/产品）统一按净变化量处理。
+-- 已经偏离的库存需要按明细重新核对后手工修正，本脚本不改动现有数据。
+
+USE chemical_factory;
+GO
+
+-- 进货更新库存（进货量计正数）
+ALTER TRIGGER trg_UpdateMaterialStock
+ON PurchaseMaterial
+AFTER INSERT, UPDATE, DELETE
+AS
+BEGIN
+    SET NOCOUNT ON;
+
+    DECLARE @delta TABLE (item_id INT PRIMARY KEY, quantity DECIMAL(18,2) NOT NULL);
+    INSERT INTO @delta (item_id, quantity)
+    SELECT material_id, SUM(quantity)
+    FROM (
+        SELECT material_id, ISNULL(quantity, 0) AS quantity FROM INSERTED
+        UNION ALL
+        SELECT material_id, -ISNULL(quantity, 0) FROM DELETED
+    ) AS m
+    WHERE material_id IS NOT NULL
+    GROUP BY material_id
+    HAVING SUM(quantity) <> 0;
+    IF @@ROWCOUNT = 0
+        RETURN;
+
+    -- 启用库存流水时只追加变化量（见 006）
+    DECLARE @shard_count TINYINT;
+    SELECT @shard_count = shard_count FROM StockLedgerSetting WHERE id = 1 AND enabled = 1;
+    IF @shard_count IS NOT NULL
+        INSERT INTO StockLedger (shard, item_type, item_id, quantity)
+        SELECT @@SPID % @shard_count, 'M', item_id, quantity FROM @delta;
+    ELSE
+        UPDATE CM
+        SET stock = CM.stock + d.quantity
+        FROM ChemicalMaterial CM
+        INNER JOIN @delta d ON d.item_id = CM.material_id;
+END;
+GO
+
+-- 销售更新库存（销售量计负数）
+ALTER TRIGGER trg_UpdateProductStock
+ON SaleProduct
+AFTER INSERT, UPDATE, DELETE
+AS
+BEGIN
+    SET NOCOUNT ON;
+
+    DECLARE @delta TABLE (item_id INT PRIMARY KEY, quantity DECIMAL(18,2) NOT NULL);
+    INSERT INTO @delta (item_id, quantity)
+    SELECT product_id, SUM(quantity)
+    FROM (
+        SELECT product_id, -ISNULL(quantity, 0) AS quantity FROM INSERTED
+        UNION ALL
+        SELECT product_id, ISNULL(quantity, 0) FROM DELETED
+    ) AS p
+    WHERE product_id IS NOT NULL
+    GROUP BY product_id
+    HAVING SUM(quantity) <> 0;
+    IF @@ROWCOUNT = 0
+        RETURN;
+
+    DECLARE @shard_count TINYINT;
+    SELECT @shard_count = shard_count FROM StockLedgerSetting WHERE id = 1 AND enabled = 1;
+    IF @shard_count IS NOT NULL
+        INSERT INTO StockLedger (shard, item_type, item_id, quantity)
+        SELECT @@SPID % @shard_count, 'P', item_id, quantity FROM @delta;
+    ELSE
+        UPDATE CP
+        SET stock = CP.stock + d.quantity
+        FROM ChemicalProduct CP
+        INNER JOIN @delta d ON d.item_id = CP.product_id;
+END;
+GO
+
+-- 生产使用原料更新库存（用量计负数）
+ALTER TRIGGER trg_UpdateMaterialStockOnProduction
+ON UseMaterial
+AFTER INSERT, UPDATE, DELETE
+AS
+BEGIN
+    SET NOCOUNT ON;
+
+    DECLARE @delta TABLE (item_id INT PRIMARY KEY, quantity DECIMAL(18,2) NOT NULL);
+    INSERT INTO @delta (item_id, quantity)
+    SELECT material_id, SUM(quantity)
+    FROM (
+        SELECT material_id, -ISNULL(quantity_used, 0) AS quantity FROM INSERTED
+        UNION ALL
+        SELECT material_id, ISNULL(quantity_used, 0) FROM DELETED
+    ) AS m
+    WHERE material_id IS NOT NULL
+    GROUP BY material_id
+    HAVING SUM(quantity) <> 0;
+    IF @@ROWCOUNT = 0
+        RETURN;
+
+    DECLARE @shard_count TINYINT;
+    SELECT @shard_count = shard_count FROM StockLedgerSetting WHERE id = 1 AND enabled = 1;
+    IF @shard_count IS NOT NULL
+        INSERT INTO StockLedger (shard, item_type, item_id, quantity)
+        SELECT @@SPID % @shard_count, 'M', item_id, quantity FROM @delta;
+    ELSE
+        UPDATE CM
+        SET stock = CM.stock + d.quantity
+        FROM ChemicalMaterial CM
+        INNER JOIN @delta d ON d.item_id = CM.material_id;
+END;
+GO
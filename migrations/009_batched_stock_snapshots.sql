@@ -0,0 +1,161 @@
+-- 分批补建库存快照
+-- 003/006 的 sp_BuildStockSnapshots 在一个 SERIALIZABLE 事务中扫描全部历史明细并写入所有快照：首次部署或长时间未执行时，
+-- 整个计算期间对全部历史范围持有范围锁，所有出入库写入都要等它结束。这里改为：
+-- 1. 按月分批，从最晚的月份往前，每批一个事务；已提交的批次不受后续批次失败的影响，用相同的 @from 再次执行即可补上其余月份；
+-- 2. 每批以紧接其后的快照为基准倒推（快照由触发器随补录的明细修正，始终准确），只读取两次快照之间的每日汇总；
+--    没有更晚的快照时（首次补建、每天补昨天的快照）以当前库存为基准，先减去基准日之后（当天）的变化量，
+--    只有这一步对当前库存和当天的明细加锁（HOLDLOCK），已结束的历史日期按默认的 READ COMMITTED 读取；
+-- 3. 基准快照行在批次内加 UPDLOCK：此时补录到更早日期的明细，其触发器要修正基准快照，会等到本批提交后再修正包括新快照在内的全部快照。
+--    读取明细时与这样的写入互相等待而死锁时，本批作为牺牲者回滚后重试（DEADLOCK_PRIORITY LOW，写入方不受影响）。
+
+USE chemical_factory;
+GO
+
+-- 参数与返回值同 003：从 @from 到 @to 每 @period_days 天一次，已存在的同日快照会被重建，返回写入的快照行数
+ALTER PROCEDURE sp_BuildStockSnapshots
+    @from DATE = NULL,
+    @to DATE = NULL,
+    @period_days INT = 1
+AS
+BEGIN
+    SET NOCOUNT ON;
+    SET TRANSACTION ISOLATION LEVEL READ COMMITTED;
+    SET DEADLOCK_PRIORITY LOW;
+
+    IF @period_days IS NULL OR @period_days < 1
+        THROW 50001, 'period_days 必须大于0', 1;
+    DECLARE @yesterday DATE = DATEADD(DAY, -1, CAST(GETDATE() AS DATE));
+    IF @to IS NULL
+        SET @to = @yesterday;
+    -- 以当前库存为基准时的基准日：之后的明细属于仍在写入的日期
+    DECLARE @anchor_date DATE = CASE WHEN @to > @yesterday THEN @to ELSE @yesterday END;
+
+    IF @from IS NULL
+        SET @from = ISNULL(DATEADD(DAY, @period_days, (SELECT MAX(snapshot_date) FROM StockSnapshot)),
+                           ISNULL((SELECT MIN(date) FROM (
+                                       SELECT MIN(date) AS date FROM dbo.vw_PurchaseMaterialDaily WITH (NOEXPAND)
+                                       UNION ALL
+                                       SELECT MIN(date) FROM dbo.vw_UseMaterialDaily WITH (NOEXPAND)
+                                       UNION ALL
+                                       SELECT MIN(date) FROM dbo.vw_SaleProductDaily WITH (NOEXPAND)
+                                   ) AS m), @to));
+
+    CREATE TABLE #dates (snapshot_date DATE PRIMARY KEY);
+    WITH d AS (
+        SELECT @from AS snapshot_date
+        UNION ALL
+        SELECT DATEADD(DAY, @period_days, snapshot_date) FROM d
+        WHERE DATEADD(DAY, @period_days, snapshot_date) <= @to
+    )
+    INSERT INTO #dates (snapshot_date)
+    SELECT snapshot_date FROM d WHERE snapshot_date <= @to
+    OPTION (MAXRECURSION 0);
+
+    -- 本批的基准：base_date 当天结束时的库存
+    CREATE TABLE #base (item_type CHAR(1), item_id INT, base_date DATE, stock DECIMAL(18,2),
+                        PRIMARY KEY (item_type, item_id));
+
+    DECLARE @rows INT = 0;
+    DECLARE @batch_from DATE, @batch_to DATE, @base_date DATE, @attempt INT;
+    SELECT @batch_to = MAX(snapshot_date) FROM #dates;
+
+    WHILE @batch_to IS NOT NULL
+    BEGIN
+        SET @batch_from = DATEFROMPARTS(YEAR(@batch_to), MONTH(@batch_to), 1);
+        SET @attempt = 1;
+
+        WHILE 1 = 1
+        BEGIN
+            BEGIN TRY
+                BEGIN TRANSACTION;
+                TRUNCATE TABLE #base;
+
+                -- 紧接本批之后的快照
+                SET @base_date = NULL;
+                SELECT @base_date = MIN(snapshot_date)
+                FROM StockSnapshot WITH (UPDLOCK, HOLDLOCK)
+                WHERE item_type IN ('M', 'P') AND snapshot_date > @batch_to;
+
+                IF @base_date IS NOT NULL
+                    INSERT INTO #base (item_type, item_id, base_date, stock)
+                    SELECT item_type, item_id, snapshot_date, stock
+                    FROM StockSnapshot WITH (UPDLOCK, HOLDLOCK)
+                    WHERE item_type IN ('M', 'P') AND snapshot_date = @base_date;
+
+                -- 没有更晚的快照，或基准快照之后新建的原料/产品：当前库存减去基准日之后的变化量
+                IF @base_date IS NULL
+                   OR EXISTS (SELECT 1 FROM ChemicalMaterial c WHERE NOT EXISTS (
+                                  SELECT 1 FROM #base b WHERE b.item_type = 'M' AND b.item_id = c.material_id))
+                   OR EXISTS (SELECT 1 FROM ChemicalProduct c WHERE NOT EXISTS (
+                                  SELECT 1 FROM #base b WHERE b.item_type = 'P' AND b.item_id = c.product_id))
+                    INSERT INTO #base (item_type, item_id, base_date, stock)
+                    SELECT c.item_type, c.item_id, @anchor_date, c.stock - ISNULL(n.quantity, 0)
+                    FROM (
+                        SELECT 'M' AS item_type, material_id AS item_id, ISNULL(stock, 0) AS stock
+                        FROM dbo.vw_ChemicalMaterialCurrent WITH (HOLDLOCK)
+                        UNION ALL
+                        SELECT 'P', product_id, ISNULL(stock, 0) FROM dbo.vw_ChemicalProductCurrent WITH (HOLDLOCK)
+                    ) AS c
+                    OUTER APPLY (
+                        SELECT SUM(x.quantity) AS quantity FROM (
+                            SELECT quantity FROM dbo.vw_PurchaseMaterialDaily WITH (NOEXPAND, HOLDLOCK)
+                            WHERE c.item_type = 'M' AND material_id = c.item_id AND date > @anchor_date
+                            UNION ALL
+                            SELECT -quantity FROM dbo.vw_UseMaterialDaily WITH (NOEXPAND, HOLDLOCK)
+                            WHERE c.item_type = 'M' AND material_id = c.item_id AND date > @anchor_date
+                            UNION ALL
+                            SELECT -quantity FROM dbo.vw_SaleProductDaily WITH (NOEXPAND, HOLDLOCK)
+                            WHERE c.item_type = 'P' AND product_id = c.item_id AND date > @anchor_date
+                        ) AS x
+                    ) AS n
+                    WHERE NOT EXISTS (SELECT 1 FROM #base b WHERE b.item_type = c.item_type AND b.item_id = c.item_id);
+
+                DELETE s FROM StockSnapshot s
+                JOIN #dates d ON d.snapshot_date = s.snapshot_date
+                WHERE d.snapshot_date BETWEEN @batch_from AND @batch_to;
+
+                -- 快照日结束时的库存 = 基准 - 快照日之后到基准日的净变化量（都是已结束的日期）
+                INSERT INTO StockSnapshot (item_type, snapshot_date, item_id, stock)
+                SELECT b.item_type, d.snapshot_date, b.item_id, b.stock - ISNULL(n.quantity, 0)
+                FROM #base b
+                JOIN #dates d ON d.snapshot_date BETWEEN @batch_from AND @batch_to
+                OUTER APPLY (
+                    SELECT SUM(x.quantity) AS quantity FROM (
+                        SELECT quantity FROM dbo.vw_PurchaseMaterialDaily WITH (NOEXPAND)
+                        WHERE b.item_type = 'M' AND material_id = b.item_id
+                          AND date > d.snapshot_date AND date <= b.base_date
+                        UNION ALL
+                        SELECT -quantity FROM dbo.vw_UseMaterialDaily WITH (NOEXPAND)
+                        WHERE b.item_type = 'M' AND material_id = b.item_id
+                          AND date > d.snapshot_date AND date <= b.base_date
+                        UNION ALL
+                        SELECT -quantity FROM dbo.vw_SaleProductDaily WITH (NOEXPAND)
+                        WHERE b.item_type = 'P' AND product_id = b.item_id
+                          AND date > d.snapshot_date AND date <= b.base_date
+                    ) AS x
+                ) AS n;
+
+                SET @rows += @@ROWCOUNT;
+                COMMIT TRANSACTION;
+                BREAK;
+            END TRY
+            BEGIN CATCH
+                IF XACT_STATE() <> 0
+                    ROLLBACK TRANSACTION;
+                -- 1205: 被选为死锁牺牲者
+                IF ERROR_NUMBER() <> 1205 OR @attempt >= 5
+                    THROW;
+                SET @attempt += 1;
+            END CATCH
+        END
+
+        SET @batch_to = (SELECT MAX(snapshot_date) FROM #dates WHERE snapshot_date < @batch_from);
+    END
+
+    SELECT @rows AS SnapshotRows;
+END;
+GO
+
+-- 003 首次部署时的补建改在这里执行：按月分批补建全部历史的每日快照
+EXEC sp_BuildStockSnapshots;
+GO
@@ -0,0 +1,153 @@
+-- 快照之后新建的原料/产品
+-- sp_BuildStockSnapshots 为建快照时已有的每个原料/产品写入一行，之后新建的原料/产品在已有的快照日没有快照行。
+-- 查询某日库存时缺少的行按 0 计（新建时库存为 0），本来是对的；但 003 的触发器只修正已有的快照行，
+-- 给新原料补录一笔日期早于最近快照的明细时，没有行可以修正，这笔明细在快照中丢失，查询结果少了这部分。
+-- 这里：
+-- 1. 三个明细触发器在修正快照之前，先为本语句涉及、但在受影响快照日缺少快照行的原料/产品补一行 0，再和已有的行一起修正；
+--    只有补录（明细日期不晚于已有快照）才会走到这一步，当天的正常写入没有受影响的快照日；
+-- 2. 已经缺少的快照行按当前库存减去快照日之后的变化量补齐（与没有快照时查询的算法相同），之前丢失的补录随之修正。
+
+USE chemical_factory;
+GO
+
+ALTER TRIGGER trg_StockSnapshotPurchaseMaterial
+ON PurchaseMaterial
+AFTER INSERT, UPDATE, DELETE
+AS
+BEGIN
+    SET NOCOUNT ON;
+
+    DECLARE @delta TABLE (item_id INT, date DATE, quantity DECIMAL(18,2), PRIMARY KEY (item_id, date));
+    INSERT INTO @delta (item_id, date, quantity)
+    SELECT c.material_id, pr.date, SUM(c.quantity)
+    FROM (
+        SELECT record_id, material_id, ISNULL(quantity, 0) AS quantity FROM INSERTED
+        UNION ALL
+        SELECT record_id, material_id, -ISNULL(quantity, 0) FROM DELETED
+    ) AS c
+    JOIN PurchaseRecord pr ON pr.record_id = c.record_id
+    WHERE pr.date IS NOT NULL
+    GROUP BY c.material_id, pr.date;
+
+    INSERT INTO StockSnapshot (item_type, snapshot_date, item_id, stock)
+    SELECT 'M', d.snapshot_date, i.item_id, 0
+    FROM (SELECT DISTINCT snapshot_date FROM StockSnapshot
+          WHERE item_type = 'M' AND snapshot_date >= (SELECT MIN(date) FROM @delta)) AS d
+    CROSS JOIN (SELECT DISTINCT item_id FROM @delta) AS i
+    WHERE NOT EXISTS (SELECT 1 FROM StockSnapshot s
+                      WHERE s.item_type = 'M' AND s.snapshot_date = d.snapshot_date AND s.item_id = i.item_id);
+
+    UPDATE s
+    SET stock = s.stock + x.quantity
+    FROM StockSnapshot s
+    CROSS APPLY (SELECT SUM(d.quantity) AS quantity FROM @delta d
+                 WHERE d.item_id = s.item_id AND d.date <= s.snapshot_date) AS x
+    WHERE s.item_type = 'M'
+      AND s.snapshot_date >= (SELECT MIN(date) FROM @delta)
+      AND s.item_id IN (SELECT item_id FROM @delta)
+      AND x.quantity <> 0;
+END;
+GO
+
+ALTER TRIGGER trg_StockSnapshotUseMaterial
+ON UseMaterial
+AFTER INSERT, UPDATE, DELETE
+AS
+BEGIN
+    SET NOCOUNT ON;
+
+    DECLARE @delta TABLE (item_id INT, date DATE, quantity DECIMAL(18,2), PRIMARY KEY (item_id, date));
+    INSERT INTO @delta (item_id, date, quantity)
+    SELECT c.material_id, pr.date, SUM(c.quantity)
+    FROM (
+        SELECT record_id, material_id, -ISNULL(quantity_used, 0) AS quantity FROM INSERTED
+        UNION ALL
+        SELECT record_id, material_id, ISNULL(quantity_used, 0) FROM DELETED
+    ) AS c
+    JOIN ProductionRecord pr ON pr.record_id = c.record_id
+    WHERE pr.date IS NOT NULL
+    GROUP BY c.material_id, pr.date;
+
+    INSERT INTO StockSnapshot (item_type, snapshot_date, item_id, stock)
+    SELECT 'M', d.snapshot_date, i.item_id, 0
+    FROM (SELECT DISTINCT snapshot_date FROM StockSnapshot
+          WHERE item_type = 'M' AND snapshot_date >= (SELECT MIN(date) FROM @delta)) AS d
+    CROSS JOIN (SELECT DISTINCT item_id FROM @delta) AS i
+    WHERE NOT EXISTS (SELECT 1 FROM StockSnapshot s
+                      WHERE s.item_type = 'M' AND s.snapshot_date = d.snapshot_date AND s.item_id = i.item_id);
+
+    UPDATE s
+    SET stock = s.stock + x.quantity
+    FROM StockSnapshot s
+    CROSS APPLY (SELECT SUM(d.quantity) AS quantity FROM @delta d
+                 WHERE d.item_id = s.item_id AND d.date <= s.snapshot_date) AS x
+    WHERE s.item_type = 'M'
+      AND s.snapshot_date >= (SELECT MIN(date) FROM @delta)
+      AND s.item_id IN (SELECT item_id FROM @delta)
+      AND x.quantity <> 0;
+END;
+GO
+
+ALTER TRIGGER trg_StockSnapshotSaleProduct
+ON SaleProduct
+AFTER INSERT, UPDATE, DELETE
+AS
+BEGIN
+    SET NOCOUNT ON;
+
+    DECLARE @delta TABLE (item_id INT, date DATE, quantity DECIMAL(18,2), PRIMARY KEY (item_id, date));
+    INSERT INTO @delta (item_id, date, quantity)
+    SELECT c.product_id, sr.date, SUM(c.quantity)
+    FROM (
+        SELECT record_id, product_id, -ISNULL(quantity, 0) AS quantity FROM INSERTED
+        UNION ALL
+        SELECT record_id, product_id, ISNULL(quantity, 0) FROM DELETED
+    ) AS c
+    JOIN SalesRecord sr ON sr.record_id = c.record_id
+    WHERE sr.date IS NOT NULL
+    GROUP BY c.product_id, sr.date;
+
+    INSERT INTO StockSnapshot (item_type, snapshot_date, item_id, stock)
+    SELECT 'P', d.snapshot_date, i.item_id, 0
+    FROM (SELECT DISTINCT snapshot_date FROM StockSnapshot
+          WHERE item_type = 'P' AND snapshot_date >= (SELECT MIN(date) FROM @delta)) AS d
+    CROSS JOIN (SELECT DISTINCT item_id FROM @delta) AS i
+    WHERE NOT EXISTS (SELECT 1 FROM StockSnapshot s
+                      WHERE s.item_type = 'P' AND s.snapshot_date = d.snapshot_date AND s.item_id = i.item_id);
+
+    UPDATE s
+    SET stock = s.stock + x.quantity
+    FROM StockSnapshot s
+    CROSS APPLY (SELECT SUM(d.quantity) AS quantity FROM @delta d
+                 WHERE d.item_id = s.item_id AND d.date <= s.snapshot_date) AS x
+    WHERE s.item_type = 'P'
+      AND s.snapshot_date >= (SELECT MIN(date) FROM @delta)
+      AND s.item_id IN (SELECT item_id FROM @delta)
+      AND x.quantity <> 0;
+END;
+GO
+
+-- 补齐已经缺少的快照行：快照日结束时的库存 = 当前库存 - 快照日之后的变化量
+INSERT INTO StockSnapshot (item_type, snapshot_date, item_id, stock)
+SELECT c.item_type, d.snapshot_date, c.item_id, c.stock - ISNULL(n.quantity, 0)
+FROM (
+    SELECT 'M' AS item_type, material_id AS item_id, ISNULL(stock, 0) AS stock FROM dbo.vw_ChemicalMaterialCurrent
+    UNION ALL
+    SELECT 'P', product_id, ISNULL(stock, 0) FROM dbo.vw_ChemicalProductCurrent
+) AS c
+JOIN (SELECT DISTINCT item_type, snapshot_date FROM StockSnapshot) AS d ON d.item_type = c.item_type
+OUTER APPLY (
+    SELECT SUM(x.quantity) AS quantity FROM (
+        SELECT quantity FROM dbo.vw_PurchaseMaterialDaily WITH (NOEXPAND)
+        WHERE c.item_type = 'M' AND material_id = c.item_id AND date > d.snapshot_date
+        UNION ALL
+        SELECT -quantity FROM dbo.vw_UseMaterialDaily WITH (NOEXPAND)
+        WHERE c.item_type = 'M' AND material_id = c.item_id AND date > d.snapshot_date
+        UNION ALL
+        SELECT -quantity FROM dbo.vw_SaleProductDaily WITH (NOEXPAND)
+        WHERE c.item_type = 'P' AND product_id = c.item_id AND date > d.snapshot_date
+    ) AS x
+) AS n
+WHERE NOT EXISTS (SELECT 1 FROM StockSnapshot s
+                  WHERE s.item_type = c.item_type AND s.snapshot_date = d.snapshot_date AND s.item_id = c.item_id);
+GO
@@ -0,0 +1,201 @@
+# 物料需求计划（/planning/requirements）
+# 由生产历史得到每种产品的单位产量原料消耗系数：系数 = 该产品历史上消耗的原料总量 / 实际产量总量。
+# 历史汇总在进程内缓存为 产品 × 原料 的消耗矩阵和产品产量向量，按 record_id 增量刷新：
+# 每次只汇总上次之后新增的生产记录（生产记录只增不改），汇总由数据库按 (产品, 原料) 分组完成，
+# 结果用 NumPy 一次性累加进矩阵。计划需求 = 计划产量向量 × 系数矩阵，整个计划一次矩阵运算，不按产品查询。
+# 没有安装 NumPy 时退回逐项累加的字典实现，结果相同。
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:  # 可选依赖
+    numpy = None
+
+
+class RequirementsPlanner:
+    def __init__(self, refresh_interval=30.0):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._reset()
+        self._dirty = True
+        self._refreshed_at = None
+        self._refreshes = 0
+        self._rebuilds = 0
+        self._last_refresh_duration = 0.0
+
+    def _reset(self):
+        self._watermark = 0  # 已汇总的最大 record_id
+        self._records = 0  # 已汇总的生产记录数
+        self._products = {}  # product_id -> 行号
+        self._materials = {}  # material_id -> 列号
+        self._material_ids = []
+        self._runs = {}  # product_id -> 生产次数
+        if numpy is not None:
+            self._consumed = numpy.zeros((0, 0))
+            self._output = numpy.zeros(0)
+        else:
+            self._consumed = {}  # product_id -> {material_id: 消耗量}
+            self._output = {}  # product_id -> 实际产量
+        self._coefficients = None
+
+    # 写入生产记录后调用，下次计划时立即增量刷新
+    def mark_dirty(self):
+        self._dirty = True
+
+    def _index(self, mapping, keys, ids=None):
+        for key in keys:
+            if key not in mapping:
+                mapping[key] = len(mapping)
+                if ids is not None:
+                    ids.append(key)
+        return numpy.fromiter((mapping[key] for key in keys), dtype=numpy.intp, count=len(keys))
+
+    def _grow(self):
+        rows, cols = len(self._products), len(self._materials)
+        if self._consumed.shape != (rows, cols):
+            consumed = numpy.zeros((rows, cols))
+            consumed[:self._consumed.shape[0], :self._consumed.shape[1]] = self._consumed
+            self._consumed = consumed
+        if self._output.shape[0] != rows:
+            self._output = numpy.concatenate([self._output, numpy.zeros(rows - self._output.shape[0])])
+
+    # outputs: [(product_id, 生产次数, 实际产量)]；usage: [(product_id, material_id, 消耗量)]
+    def _accumulate(self, outputs, usage):
+        for product_id, runs, _ in outputs:
+            self._runs[product_id] = self._runs.get(product_id, 0) + runs
+        if numpy is not None:
+            rows = self._index(self._products, [row[0] for row in outputs])
+            usage_rows = self._index(self._products, [row[0] for row in usage])
+            usage_cols = self._index(self._materials, [row[1] for row in usage], self._material_ids)
+            self._grow()
+            numpy.add.at(self._output, rows, numpy.array([float(row[2] or 0) for row in outputs]))
+            numpy.add.at(self._consumed, (usage_rows, usage_cols), numpy.array([float(row[2] or 0) for row in usage]))
+        else:
+            for product_id, _, output in outputs:
+                self._output[product_id] = self._output.get(product_id, 0.0) + float(output or 0)
+            for product_id, material_id, quantity in usage:
+                materials = self._consumed.setdefault(product_id, {})
+                materials[material_id] = materials.get(material_id, 0.0) + float(quantity or 0)
+                self._materials.setdefault(material_id, len(self._materials))
+            for product_id in self._output:
+                self._products.setdefault(product_id, len(self._products))
+        self._coefficients = None
+
+    def _load(self, cursor, low, high):
+        cursor.execute("""
+            SELECT product_id, COUNT(*), SUM(actual_output)
+            FROM ProductionRecord
+            WHERE record_id > ? AND record_id <= ?
+            GROUP BY product_id
+        """, (low, high))
+        outputs = cursor.fetchall()
+        cursor.execute("""
+            SELECT pr.product_id, um.material_id, SUM(um.quantity_used)
+            FROM ProductionRecord pr
+            JOIN UseMaterial um ON um.record_id = pr.record_id
+            WHERE pr.record_id > ? AND pr.record_id <= ?
+            GROUP BY pr.product_id, um.material_id
+        """, (low, high))
+        usage = cursor.fetchall()
+        self._accumulate(outputs, usage)
+        self._records += sum(row[1] for row in outputs)
+        self._watermark = high
+
+    # 汇总 record_id 在上次之后的生产记录。较小的 record_id 晚于较大的提交时（并发写入），
+    # 已汇总范围内的记录数会对不上，此时从头全量重建
+    def refresh(self, conn, force=False):
+        with self._lock:
+            if not (force or self._dirty or self._refreshed_at is None
+                    or time.monotonic() - self._refreshed_at >= self.refresh_interval):
+                return
+            start = time.monotonic()
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT COUNT_BIG(CASE WHEN record_id <= ? THEN 1 END), MAX(record_id)
+                FROM ProductionRecord
+            """, (self._watermark,))
+            summarized, high = cursor.fetchone()
+            high = high or 0
+            if summarized != self._records or high < self._watermark:
+                self._reset()
+                self._rebuilds += 1
+            if high > self._watermark:
+                self._load(cursor, self._watermark, high)
+            cursor.close()
+            self._dirty = False
+            self._refreshed_at = time.monotonic()
+            self._refreshes += 1
+            self._last_refresh_duration = time.monotonic() - start
+
+    def _coefficient_matrix(self):
+        if self._coefficients is None:
+            output = self._output[:, None]
+            self._coefficients = numpy.divide(self._consumed, output, out=numpy.zeros_like(self._consumed),
+                                              where=output > 0)
+        return self._coefficients
+
+    # 每种产品的单位产量原料消耗：{product_id: {material_id: 系数}}
+    def coefficients(self, product_ids):
+        with self._lock:
+            result = {}
+            for product_id in product_ids:
+                if numpy is not None:
+                    row = self._products.get(product_id)
+                    # 与字典实现一致：历史实际产量为 0 的产品没有系数
+                    if row is None or not self._output[row]:
+                        continue
+                    values = self._coefficient_matrix()[row]
+                    result[product_id] = {self._material_ids[i]: float(values[i]) for i in numpy.flatnonzero(values)}
+                elif self._output.get(product_id):
+                    output = self._output[product_id]
+                    result[product_id] = {m: q / output for m, q in self._consumed.get(product_id, {}).items() if q}
+            return result
+
+    # 历史产量：{product_id: (生产次数, 实际产量)}
+    def history(self, product_ids):
+        with self._lock:
+            result = {}
+            for product_id in product_ids:
+                if product_id not in self._products:
+                    continue
+                if numpy is not None:
+                    output = float(self._output[self._products[product_id]])
+                else:
+                    output = self._output[product_id]
+                result[product_id] = (self._runs.get(product_id, 0), output)
+            return result
+
+    # plan: {product_id: 计划产量}，返回 {material_id: 需求量}
+    def demand(self, plan):
+        with self._lock:
+            if numpy is not None:
+                product_ids = [p for p in plan if p in self._products]
+                if not product_ids:
+                    return {}
+                rows = numpy.fromiter((self._products[p] for p in product_ids), dtype=numpy.intp,
+                                      count=len(product_ids))
+                planned = numpy.fromiter((plan[p] for p in product_ids), dtype=float, count=len(product_ids))
+                totals = planned @ self._coefficient_matrix()[rows]
+                return {self._material_ids[i]: float(totals[i]) for i in numpy.flatnonzero(totals)}
+            totals = {}
+            for product_id, quantity in plan.items():
+                output = self._output.get(product_id)
+                if not output:
+                    continue
+                for material_id, consumed in self._consumed.get(product_id, {}).items():
+                    totals[material_id] = totals.get(material_id, 0.0) + quantity * consumed / output
+            return {m: q for m, q in totals.items() if q}
+
+    def stats(self):
+        with self._lock:
+            return {
+                'numpy': numpy is not None,
+                'products': len(self._products),
+                'materials': len(self._materials),
+                'records': self._records,
+                'watermark': self._watermark,
+                'refreshes': self._refreshes,
+                'rebuilds': self._rebuilds,
+                'last_refresh_duration_seconds': round(self._last_refresh_duration, 4),
+            }
@@ -0,0 +1,125 @@
+# 只读接口的响应缓存（原料、产品目录）
+# 每个命名空间有一个版本号，缓存键中带上版本号；数据变化时只需把版本号加一，旧条目自然失效。
+# 默认缓存在进程内；多进程部署时可换成 Redis 后端，让所有进程共享缓存和版本号。
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalCacheBackend:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # 键 -> (值, 过期时间戳)
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[1] <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def get_counter(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def size(self):
+        with self._lock:
+            return len(self._data)
+
+
+class RedisCacheBackend:
+    def __init__(self, url, prefix='chemical_factory:'):
+        import redis  # 可选依赖，只有使用 Redis 后端时才需要安装
+
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def get(self, key):
+        raw = self._client.get(self._prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        self._client.set(self._prefix + key, json.dumps(value), ex=max(1, int(ttl)))
+
+    def get_counter(self, key):
+        raw = self._client.get(self._prefix + key)
+        return int(raw) if raw is not None else 0
+
+    def incr(self, key):
+        return self._client.incr(self._prefix + key)
+
+    def size(self):
+        return None
+
+
+class ResponseCache:
+    def __init__(self, backend, ttl=300.0):
+        self.backend = backend
+        self.ttl = ttl  # 兜底过期时间，防止漏掉的失效通知让数据一直不更新
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    # 缓存键：命名空间 + 当前版本号 + 请求路径（含查询参数）
+    def key(self, namespace, path):
+        version = self.backend.get_counter(f'version:{namespace}')
+        return f'response:{namespace}:{version}:{path}'
+
+    def get(self, key):
+        entry = self.backend.get(key)
+        with self._lock:
+            if entry is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        return entry
+
+    def set(self, key, entry):
+        self.backend.set(key, entry, self.ttl)
+
+    def invalidate(self, *namespaces):
+        for namespace in namespaces:
+            self.backend.incr(f'version:{namespace}')
+        with self._lock:
+            self._invalidations += len(namespaces)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'backend': type(self.backend).__name__,
+                'entries': self.backend.size(),
+                'hits': self._hits,
+                'misses': self._misses,
+                'invalidations': self._invalidations,
+                'hit_rate': round(self._hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+# 根据配置创建缓存，backend 为 local 或 redis
+def create_response_cache(backend='local', redis_url=None, ttl=300.0, max_entries=1024):
+    if backend == 'redis':
+        return ResponseCache(RedisCacheBackend(redis_url), ttl)
+    if backend == 'local':
+        return ResponseCache(LocalCacheBackend(max_entries), ttl)
+    raise ValueError(f'未知的缓存后端: {backend}')
@@ -0,0 +1,377 @@
+# 原料/产品的内存搜索索引（/materials/search、/products/search）
+# 启动时从数据库全量加载，增删改接口提交后同步更新；多进程部署时可设置定时全量重建，让其他进程的修改也能生效。
+# 匹配方式按优先级排序：
+#   1. 名称或 CAS 号完全相同
+#   2. 名称前缀（按名称排序）
+#   3. CAS 号前缀
+#   4. 拼音全拼或首字母前缀（需要安装 pypinyin）
+#   5. 名称包含查询串（按名称长度排序）：由二元组倒排索引取候选，汉字另有单字索引，单个汉字也能查
+# 每一级都按最终顺序枚举候选，取够 limit 条即停止，查询代价与目录大小基本无关。
+import bisect
+import threading
+import time
+import unicodedata
+
+import pyodbc
+
+from db_pool import PoolExhaustedError
+
+try:
+    import pypinyin
+except ImportError:  # 可选依赖
+    pypinyin = None
+
+
+def normalize(text):
+    # 全角转半角、忽略大小写和空白
+    return ''.join(unicodedata.normalize('NFKC', text or '').casefold().split())
+
+
+def _is_cjk(char):
+    return '一' <= char <= '鿿' or '㐀' <= char <= '䶿'
+
+
+def _grams(name):
+    grams = {name[i:i + 2] for i in range(len(name) - 1)}
+    grams.update(char for char in name if _is_cjk(char))
+    return grams
+
+
+def _query_grams(query):
+    if len(query) == 1:
+        return [query] if _is_cjk(query) else []
+    return [query[i:i + 2] for i in range(len(query) - 1)]
+
+
+def pinyin_keys(name):
+    if pypinyin is None or not any(_is_cjk(char) for char in name):
+        return []
+    syllables = [s[0] for s in pypinyin.pinyin(name, style=pypinyin.Style.NORMAL, errors='default')]
+    full = normalize(''.join(syllables))
+    initials = normalize(''.join(s[:1] for s in syllables))
+    return list(dict.fromkeys(key for key in (full, initials) if key))
+
+
+# 有序的 (键, id) 列表，支持前缀枚举
+class _PrefixList:
+    def __init__(self, pairs=()):
+        self._items = sorted(pairs)
+
+    def add(self, key, doc_id):
+        bisect.insort(self._items, (key, doc_id))
+
+    def remove(self, key, doc_id):
+        i = bisect.bisect_left(self._items, (key, doc_id))
+        if i < len(self._items) and self._items[i] == (key, doc_id):
+            del self._items[i]
+
+    # 键恰好为 key 的最小 id，没有则返回 None
+    def first(self, key):
+        for found, doc_id in self.prefixed(key):
+            return doc_id if found == key else None
+        return None
+
+    def prefixed(self, prefix):
+        i = bisect.bisect_left(self._items, (prefix,))
+        while i < len(self._items):
+            key, doc_id = self._items[i]
+            if not key.startswith(prefix):
+                return
+            yield key, doc_id
+            i += 1
+
+
+class CatalogSearchIndex:
+    # key: 主键列；fields: 返回的列；cas_field: CAS 号列（没有则为 None）；filter_fields: 可按值过滤的列
+    def __init__(self, name, query, key, fields, cas_field=None, filter_fields=()):
+        self.name = name
+        self.query = query
+        self.key = key
+        self.fields = list(fields)
+        self.cas_field = cas_field
+        self.filter_fields = tuple(filter_fields)
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._rebuilding = False
+        self._pending = []  # 全量重建期间的增量修改，重建完成后重放
+        self._reset()
+        self._builds = 0
+        self._last_build = None
+        self._last_build_duration = 0.0
+        self._searches = 0
+        self._search_seconds = 0.0
+
+    def _reset(self):
+        self._docs = {}  # id -> 返回的字段
+        self._norm = {}  # id -> 规范化的名称
+        self._names = {}  # 规范化名称 -> id
+        self._cas = {}  # CAS 号 -> id
+        self._name_keys = _PrefixList()
+        self._cas_keys = _PrefixList()
+        self._pinyin_keys = _PrefixList()
+        self._postings = {}  # 二元组/汉字 -> 按 (名称长度, 名称, id) 排序的 id 列表
+
+    def _rank(self, doc_id):
+        name = self._norm[doc_id]
+        return len(name), name, doc_id
+
+    # 不检查是否已存在，调用方先 _remove
+    def _add(self, doc):
+        doc_id = doc[self.key]
+        name = normalize(doc['name'])
+        self._docs[doc_id] = doc
+        self._norm[doc_id] = name
+        self._names[name] = doc_id
+        self._name_keys.add(name, doc_id)
+        for key in pinyin_keys(doc['name']):
+            self._pinyin_keys.add(key, doc_id)
+        cas = normalize(doc.get(self.cas_field)) if self.cas_field else ''
+        if cas:
+            self._cas[cas] = doc_id
+            self._cas_keys.add(cas, doc_id)
+        rank = self._rank(doc_id)
+        for gram in _grams(name):
+            posting = self._postings.setdefault(gram, [])
+            posting.insert(bisect.bisect_left(posting, rank, key=self._rank), doc_id)
+
+    def _remove(self, doc_id):
+        doc = self._docs.get(doc_id)
+        if doc is None:
+            return
+        name = self._norm[doc_id]
+        rank = self._rank(doc_id)
+        for gram in _grams(name):
+            posting = self._postings[gram]
+            i = bisect.bisect_left(posting, rank, key=self._rank)
+            del posting[i]
+            if not posting:
+                del self._postings[gram]
+        cas = normalize(doc.get(self.cas_field)) if self.cas_field else ''
+        # 名称或 CAS 号相同的其他条目仍在时，完全匹配改指向其中之一
+        if cas:
+            self._cas_keys.remove(cas, doc_id)
+            if self._cas.get(cas) == doc_id:
+                other = self._cas_keys.first(cas)
+                if other is None:
+                    del self._cas[cas]
+                else:
+                    self._cas[cas] = other
+        for key in pinyin_keys(doc['name']):
+            self._pinyin_keys.remove(key, doc_id)
+        self._name_keys.remove(name, doc_id)
+        if self._names.get(name) == doc_id:
+            other = self._name_keys.first(name)
+            if other is None:
+                del self._names[name]
+            else:
+                self._names[name] = other
+        del self._norm[doc_id]
+        del self._docs[doc_id]
+
+    # 从数据库全量重建。新索引在锁外构建，构建期间的增量修改在替换后重放
+    def rebuild(self, conn):
+        start = time.monotonic()
+        with self._lock:
+            self._rebuilding = True
+            self._pending = []
+        try:
+            cursor = conn.cursor()
+            cursor.execute(self.query)
+            columns = [column[0] for column in cursor.description]
+            docs = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            cursor.close()
+            fresh = CatalogSearchIndex(self.name, self.query, self.key, self.fields, self.cas_field,
+                                       self.filter_fields)
+            fresh._bulk_load(docs)
+        except BaseException:
+            with self._lock:
+                self._rebuilding = False
+                self._pending = []
+            raise
+        with self._lock:
+            for attr in ('_docs', '_norm', '_names', '_cas', '_name_keys', '_cas_keys', '_pinyin_keys', '_postings'):
+                setattr(self, attr, getattr(fresh, attr))
+            for op, arg in self._pending:
+                getattr(self, op)(arg)
+            self._pending = []
+            self._rebuilding = False
+            self._loaded = True
+            self._builds += 1
+            self._last_build = time.time()
+            self._last_build_duration = time.monotonic() - start
+        return len(docs)
+
+    # 全量加载时先按 (名称长度, 名称, id) 排序，按此顺序追加的倒排列表天然有序，不逐条插入
+    def _bulk_load(self, docs):
+        names, cas, pinyins = [], [], []
+        postings = {}
+        for doc in docs:
+            doc_id = doc[self.key]
+            name = normalize(doc['name'])
+            self._docs[doc_id] = {field: doc.get(field) for field in self.fields}
+            self._norm[doc_id] = name
+            self._names[name] = doc_id
+            names.append((name, doc_id))
+        for doc_id in sorted(self._norm, key=self._rank):
+            doc = self._docs[doc_id]
+            name = self._norm[doc_id]
+            pinyins.extend((key, doc_id) for key in pinyin_keys(doc['name']))
+            cas_number = normalize(doc.get(self.cas_field)) if self.cas_field else ''
+            if cas_number:
+                self._cas[cas_number] = doc_id
+                cas.append((cas_number, doc_id))
+            for gram in _grams(name):
+                postings.setdefault(gram, []).append(doc_id)
+        self._name_keys = _PrefixList(names)
+        self._cas_keys = _PrefixList(cas)
+        self._pinyin_keys = _PrefixList(pinyins)
+        self._postings = postings
+
+    def _apply(self, op, arg):
+        with self._lock:
+            getattr(self, op)(arg)
+            if self._rebuilding:
+                self._pending.append((op, arg))
+
+    def _upsert(self, doc):
+        self._remove(doc[self.key])
+        self._add(doc)
+
+    # 增删改接口提交后调用；doc 至少包含 fields 中的列
+    def upsert(self, doc):
+        self._apply('_upsert', {field: doc.get(field) for field in self.fields})
+
+    def remove(self, doc_id):
+        self._apply('_remove', doc_id)
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def _candidates(self, query):
+        if query in self._names:
+            yield 'name', self._names[query]
+        if query in self._cas:
+            yield 'cas_number', self._cas[query]
+        for _, doc_id in self._name_keys.prefixed(query):
+            yield 'name_prefix', doc_id
+        for _, doc_id in self._cas_keys.prefixed(query):
+            yield 'cas_number_prefix', doc_id
+        for _, doc_id in self._pinyin_keys.prefixed(query):
+            yield 'pinyin', doc_id
+        grams = _query_grams(query)
+        if not grams:
+            return
+        postings = [self._postings.get(gram) for gram in grams]
+        if not all(postings):
+            return
+        # 从最短的倒排列表逐条验证，列表已按 (名称长度, 名称) 排序
+        for doc_id in min(postings, key=len):
+            if query in self._norm[doc_id]:
+                yield 'substring', doc_id
+
+    # filters: 列 -> 允许的值集合
+    def search(self, query, limit=20, filters=None):
+        start = time.perf_counter()
+        query = normalize(query)
+        results = []
+        seen = set()
+        with self._lock:
+            for match, doc_id in self._candidates(query):
+                if doc_id in seen:
+                    continue
+                doc = self._docs[doc_id]
+                if filters and any(doc.get(field) not in values for field, values in filters.items()):
+                    continue
+                seen.add(doc_id)
+                results.append(dict(doc, match=match))
+                if len(results) >= limit:
+                    break
+            self._searches += 1
+            self._search_seconds += time.perf_counter() - start
+        return results
+
+    def stats(self):
+        with self._lock:
+            return {
+                'loaded': self._loaded,
+                'entries': len(self._docs),
+                'grams': len(self._postings),
+                'pinyin': pypinyin is not None,
+                'builds': self._builds,
+                'last_build': self._last_build,
+                'last_build_duration_seconds': round(self._last_build_duration, 4),
+                'searches': self._searches,
+                'avg_search_seconds': round(self._search_seconds / self._searches, 6) if self._searches else 0.0,
+            }
+
+
+# 启动时在后台线程加载全部索引；interval > 0 时每隔 interval 秒全量重建一次
+class SearchIndexLoader:
+    def __init__(self, get_pool, indexes, interval=0, logger=None):
+        self.get_pool = get_pool
+        self.indexes = indexes
+        self.interval = interval
+        self.logger = logger
+        self._thread = None
+        self._stop = threading.Event()
+        self._load_lock = threading.Lock()
+        self._errors = 0
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='search-index-loader', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while True:
+            # 任何异常都只计数、记日志，线程继续运行；线程退出后定时重建停止，其他进程的修改不再生效
+            try:
+                self.rebuild()
+            except (pyodbc.Error, PoolExhaustedError) as e:
+                self._errors += 1
+                if self.logger is not None:
+                    self.logger.warning(f"重建搜索索引失败: {e}")
+            except Exception:
+                self._errors += 1
+                if self.logger is not None:
+                    self.logger.exception("重建搜索索引时发生未预期的错误")
+            if self.interval <= 0 or self._stop.wait(self.interval):
+                return
+
+    def rebuild(self, indexes=None):
+        with self._load_lock:
+            self._rebuild(indexes or self.indexes.values())
+
+    def _rebuild(self, indexes):
+        pool = self.get_pool()
+        conn = pool.acquire()
+        discard = False
+        try:
+            for index in indexes:
+                index.rebuild(conn)
+            conn.commit()
+        except pyodbc.Error:
+            discard = True
+            raise
+        finally:
+            pool.release(conn, discard=discard)
+
+    # 后台加载尚未完成时由请求线程同步加载，同一时间只有一个线程在加载
+    def ensure_loaded(self, index):
+        if index.loaded:
+            return
+        with self._load_lock:
+            if not index.loaded:
+                self._rebuild([index])
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'errors': self._errors,
+            'indexes': {name: index.stats() for name, index in self.indexes.items()},
+        }
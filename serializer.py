@@ -0,0 +1,124 @@
+# 响应序列化
+# 1. JSON：安装了 orjson 时用 orjson 直接编码为 bytes，没有安装时退回标准库 json。
+#    类型转换与 Flask 默认的 JSON 编码一致：Decimal 转为字符串（保留数据库中的精度），date/datetime 转为 HTTP 日期格式，
+#    键按字母排序；pyodbc 的 Row 按元组编码，查询结果可以不经过 dict 直接编码。
+#    与标准库不同的是非 ASCII 字符直接以 UTF-8 输出，不转义为 \uXXXX。
+# 2. 列表接口的可选格式：columns（{"columns": [...], "rows": [[...], ...]}，列名只出现一次）
+#    和 MessagePack（需要安装 msgpack）。
+# 3. 响应压缩：按 Accept-Encoding 选择 br（需要安装 brotli）或 gzip。
+import dataclasses
+import datetime
+import decimal
+import gzip
+import json
+import uuid
+
+import pyodbc
+from werkzeug.http import http_date
+
+try:
+    import orjson
+except ImportError:  # 可选依赖
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # 可选依赖
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:  # 可选依赖
+    brotli = None
+
+COLUMNS_MIMETYPE = 'application/vnd.chemical-factory.columns+json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+# 响应格式 -> 媒体类型
+FORMATS = {
+    'json': 'application/json',
+    'columns': COLUMNS_MIMETYPE,
+    'msgpack': MSGPACK_MIMETYPE,
+}
+# Accept 中可以使用的媒体类型 -> 响应格式
+ACCEPT_FORMATS = dict({mimetype: fmt for fmt, mimetype in FORMATS.items()}, **{'application/x-msgpack': 'msgpack'})
+
+
+class UnsupportedFormatError(Exception):
+    pass
+
+
+def _default(o):
+    if isinstance(o, datetime.date):
+        return http_date(o)
+    if isinstance(o, (decimal.Decimal, uuid.UUID)):
+        return str(o)
+    if isinstance(o, pyodbc.Row):
+        return tuple(o)
+    if dataclasses.is_dataclass(o):
+        return dataclasses.asdict(o)
+    if hasattr(o, '__html__'):
+        return str(o.__html__())
+    raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+
+    def dumps_json(obj):
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+else:
+    def dumps_json(obj):
+        return json.dumps(obj, default=_default, sort_keys=True, ensure_ascii=False,
+                          separators=(',', ':')).encode('utf-8')
+
+
+def dumps_msgpack(obj):
+    if msgpack is None:
+        raise UnsupportedFormatError('服务器未安装 msgpack，不支持 MessagePack 格式')
+    # 与 JSON 相同的类型转换；Decimal 仍转为字符串，避免二进制浮点数丢失精度
+    return msgpack.packb(obj, default=_default, use_bin_type=True, datetime=False)
+
+
+def columns_payload(names, rows):
+    return {'columns': list(names), 'rows': rows}
+
+
+# 一页字典形式的数据转为 columns 格式（已附加 expand 数据时使用），列顺序取第一条数据的键
+def items_to_columns(items):
+    names = list(items[0]) if items else []
+    return columns_payload(names, [[item.get(name) for name in names] for item in items])
+
+
+# 按格式编码，返回 (bytes, 媒体类型)
+def encode(obj, fmt='json'):
+    if fmt == 'msgpack':
+        return dumps_msgpack(obj), MSGPACK_MIMETYPE
+    return dumps_json(obj), FORMATS[fmt]
+
+
+# 根据 ?format= 或 Accept 头选择格式，format 参数优先
+def negotiate_format(format_arg, accept_mimetypes):
+    if format_arg:
+        if format_arg not in FORMATS:
+            raise UnsupportedFormatError(f'不支持的 format: {format_arg}，可选 {", ".join(FORMATS)}')
+        fmt = format_arg
+    else:
+        fmt = ACCEPT_FORMATS[accept_mimetypes.best_match(list(ACCEPT_FORMATS), default='application/json')]
+    if fmt == 'msgpack' and msgpack is None:
+        raise UnsupportedFormatError('服务器未安装 msgpack，不支持 MessagePack 格式')
+    return fmt
+
+
+# 根据 Accept-Encoding 选择压缩算法，优先 br，返回 None 表示不压缩
+def negotiate_encoding(accept_encodings):
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding, gzip_level=5, brotli_quality=4):
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_quality)
+    return gzip.compress(data, compresslevel=gzip_level, mtime=0)
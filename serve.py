@@ -0,0 +1,99 @@
+# 生产环境的多进程运行方式（gunicorn）
+# 主进程导入应用（preload）并执行启动自检，通过后 fork 出 SERVE_WORKERS 个工作进程。
+# 连接池、并发查询线程池和后台线程（库存流水合并、搜索索引加载、只读副本状态检查）都在工作进程 fork 之后各自创建，
+# 主进程自检用的数据库连接在 fork 之前关闭，不会被子进程共用。
+#
+# 用法：
+#   pip install gunicorn            # SERVE_WORKER_CLASS=asgi 时另需 pip install uvicorn
+#   SECRET_KEY=... CHEMICAL_FACTORY_DB=... python serve.py
+#   python serve.py --check         # 只执行启动自检
+#
+# 信号：HUP 平滑重启所有工作进程（重新读取配置，preload 下不重新加载代码）；
+#      TERM 优雅退出，工作进程处理完进行中的请求（最多 SERVE_GRACEFUL_TIMEOUT 秒）后退出；
+#      USR2 + 旧主进程 QUIT 用于不中断服务地升级代码。
+import sys
+
+from gunicorn.app.base import BaseApplication
+
+from app import (app, close_pool, create_app, reset_after_fork, self_check, start_background_tasks,
+                 stop_background_tasks)
+
+WORKER_CLASSES = {
+    'gthread': 'gthread',
+    'asgi': 'uvicorn.workers.UvicornWorker',
+}
+
+
+def on_starting(server):
+    problems = self_check(server.num_workers)
+    for problem in problems:
+        server.log.error(f"启动自检失败: {problem}")
+    if problems:
+        sys.exit(1)
+    server.log.info("启动自检通过")
+
+
+def pre_fork(server, worker):
+    close_pool()
+
+
+def post_fork(server, worker):
+    reset_after_fork()
+    app.config['WORKER_PROCESSES'] = server.num_workers
+
+
+def post_worker_init(worker):
+    start_background_tasks()
+
+
+def worker_exit(server, worker):
+    stop_background_tasks()
+    close_pool()
+
+
+class Server(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        if self.options['worker_class'] == WORKER_CLASSES['asgi']:
+            from asgi import create_application
+            return create_application(start_background=False)
+        return create_app(start_background=False)
+
+
+def options():
+    worker_class = app.config['SERVE_WORKER_CLASS']
+    if worker_class not in WORKER_CLASSES:
+        raise ValueError(f"SERVE_WORKER_CLASS 必须是 {', '.join(WORKER_CLASSES)} 之一")
+    return {
+        'bind': app.config['SERVE_BIND'],
+        'workers': app.config['SERVE_WORKERS'],
+        'worker_class': WORKER_CLASSES[worker_class],
+        'threads': app.config['SERVE_THREADS'],
+        'keepalive': app.config['SERVE_KEEPALIVE'],
+        'timeout': app.config['SERVE_TIMEOUT'],
+        'graceful_timeout': app.config['SERVE_GRACEFUL_TIMEOUT'],
+        'max_requests': app.config['SERVE_MAX_REQUESTS'],
+        'max_requests_jitter': app.config['SERVE_MAX_REQUESTS'] // 10,
+        'preload_app': True,
+        'on_starting': on_starting,
+        'pre_fork': pre_fork,
+        'post_fork': post_fork,
+        'post_worker_init': post_worker_init,
+        'worker_exit': worker_exit,
+    }
+
+
+if __name__ == '__main__':
+    if '--check' in sys.argv[1:]:
+        problems = self_check(app.config['SERVE_WORKERS'])
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        sys.exit(1 if problems else 0)
+    Server(options()).run()
@@ -15,7 +15,8 @@ export const setAuthToken = (token) => {
 
 export const getAuthToken = () => authToken;
 
-export const fetchAPI = async (endpoint, method = 'GET', data = null) => {
+// Returns both the parsed body and the response headers (used for pagination)
+const requestAPI = async (endpoint, method = 'GET', data = null) => {
     const url = `${BASE_URL}${endpoint}`;
     const headers = {
         'Content-Type': 'application/json',
@@ -44,7 +45,7 @@ export const fetchAPI = async (endpoint, method = 'GET', data = null) => {
             throw new Error(`Error ${response.status}: ${errorMessage}`);
         }
 
-        return responseData;
+        return { data: responseData, headers: response.headers };
 
     } catch (error) {
         console.error('API请求失败:', error);
@@ -52,42 +53,83 @@ export const fetchAPI = async (endpoint, method = 'GET', data = null) => {
     }
 };
 
+export const fetchAPI = async (endpoint, method = 'GET', data = null) => {
+    const { data: responseData } = await requestAPI(endpoint, method, data);
+    return responseData;
+};
+
+const withQuery = (endpoint, params) => {
+    const query = new URLSearchParams();
+    Object.entries(params || {}).forEach(([key, value]) => {
+        if (value !== null && value !== undefined && value !== '') {
+            query.append(key, value);
+        }
+    });
+    const queryString = query.toString();
+    if (!queryString) return endpoint;
+    return `${endpoint}${endpoint.includes('?') ? '&' : '?'}${queryString}`;
+};
+
+// 获取列表的一页，params 可包含 limit / after / sort 以及各接口支持的过滤参数
+// 返回 { items, nextCursor }，nextCursor 为 null 表示没有下一页
+export const fetchPage = async (endpoint, params = {}) => {
+    const { data, headers } = await requestAPI(withQuery(endpoint, params), 'GET');
+    return { items: data, nextCursor: headers.get('X-Next-Cursor') };
+};
+
+// 按游标逐页拉取列表的全部数据
+export const fetchAllPages = async (endpoint, params = {}, pageSize = 500) => {
+    let items = [];
+    let after = null;
+    do {
+        const page = await fetchPage(endpoint, { ...params, limit: pageSize, after });
+        items = items.concat(page.items);
+        after = page.nextCursor;
+    } while (after);
+    return items;
+};
+
 // Export all API endpoints for use in app.js
 export const API = {
     // Auth
     login: (username, password) => fetchAPI('/login', 'POST', { username, password }),
 
     // Materials
-    getMaterials: () => fetchAPI('/materials', 'GET'),
+    getMaterials: (params) => fetchAllPages('/materials', params),
     getMaterial: (id) => fetchAPI(`/materials/${id}`, 'GET'),
     addMaterial: (data) => fetchAPI('/materials', 'POST', data),
     updateMaterial: (id, data) => fetchAPI(`/materials/${id}`, 'PUT', data),
     deleteMaterial: (id) => fetchAPI(`/materials/${id}`, 'DELETE'),
 
     // Products
-    getProducts: () => fetchAPI('/products', 'GET'),
+    getProducts: (params) => fetchAllPages('/products', params),
     getProduct: (id) => fetchAPI(`/products/${id}`, 'GET'),
     addProduct: (data) => fetchAPI('/products', 'POST', data),
     updateProduct: (id, data) => fetchAPI(`/products/${id}`, 'PUT', data),
     deleteProduct: (id) => fetchAPI(`/products/${id}`, 'DELETE'),
 
     // Purchase Records
-    getPurchaseRecords: () => fetchAPI('/purchase_records', 'GET'),
-    getPurchaseRecordDetail: (id) => fetchAPI(`/purchase_records/${id}`, 'GET'),
+    getPurchaseRecords: (params) => fetchAllPages('/purchase_records', params),
+    // 一页进货记录及其明细、供应商和员工名称，一次请求完成
+    getPurchaseRecordsExpanded: (params = {}) => fetchPage('/purchase_records', { expand: 'lines,supplier,employee', ...params }),
+    // expand: 逗号分隔的展开项，如 'lines' 会在响应的 materials 字段中附带原料明细
+    getPurchaseRecordDetail: (id, expand) => fetchAPI(withQuery(`/purchase_records/${id}`, { expand }), 'GET'),
     getPurchaseMaterials: (id) => fetchAPI(`/purchase_records/${id}/materials`, 'GET'),
     addPurchaseRecord: (data) => fetchAPI('/purchase_records', 'POST', data),
     deletePurchaseRecord: (id) => fetchAPI(`/purchase_records/${id}`, 'DELETE'),
 
     // Sale Records
-    getSaleRecords: () => fetchAPI('/sale_records', 'GET'),
-    getSaleRecordDetail: (id) => fetchAPI(`/sale_records/${id}`, 'GET'),
+    getSaleRecords: (params) => fetchAllPages('/sale_records', params),
+    getSaleRecordsExpanded: (params = {}) => fetchPage('/sale_records', { expand: 'lines,customer,employee', ...params }),
+    getSaleRecordDetail: (id, expand) => fetchAPI(withQuery(`/sale_records/${id}`, { expand }), 'GET'),
     getSaleProducts: (id) => fetchAPI(`/sale_records/${id}/products`, 'GET'),
     addSaleRecord: (data) => fetchAPI('/sale_records', 'POST', data),
     deleteSaleRecord: (id) => fetchAPI(`/sale_records/${id}`, 'DELETE'),
 
     // Production Records
-    getProductionRecords: () => fetchAPI('/production_records', 'GET'),
-    getProductionRecordDetail: (id) => fetchAPI(`/production_records/${id}`, 'GET'),
+    getProductionRecords: (params) => fetchAllPages('/production_records', params),
+    getProductionRecordsExpanded: (params = {}) => fetchPage('/production_records', { expand: 'lines', ...params }),
+    getProductionRecordDetail: (id, expand) => fetchAPI(withQuery(`/production_records/${id}`, { expand }), 'GET'),
     getProductionMaterials: (id) => fetchAPI(`/production_records/${id}/materials`, 'GET'),
     addProductionRecord: (data) => fetchAPI('/production_records', 'POST', data),
     // Note: API doc doesn't have a DELETE for production records, so we won't implement it on frontend.
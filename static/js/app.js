@@ -456,7 +456,7 @@ const viewPurchaseRecordDetail = async (record) => {
     document.getElementById('purchaseRecordModalLabel').textContent = '进货记录详情';
 
     try {
-        const detail = await API.getPurchaseRecordDetail(record.record_id);
+        const detail = await API.getPurchaseRecordDetail(record.record_id, 'lines');
         document.getElementById('detailPurchaseRecordId').textContent = detail.record_id;
         document.getElementById('detailPurchaseDate').textContent = detail.date;
         document.getElementById('detailPurchaseSupplierName').textContent = detail.supplier_name;
@@ -464,7 +464,7 @@ const viewPurchaseRecordDetail = async (record) => {
         document.getElementById('detailPurchaseEmployeeName').textContent = detail.employee_name;
         document.getElementById('detailPurchaseEmployeeId').textContent = detail.employee_id;
 
-        const materials = await API.getPurchaseMaterials(record.record_id);
+        const materials = detail.materials;
         const materialsTableBody = document.getElementById('detailPurchaseMaterialsTableBody');
         materialsTableBody.innerHTML = '';
         if (materials.length === 0) {
@@ -574,7 +574,7 @@ const viewSaleRecordDetail = async (record) => {
     document.getElementById('saleRecordModalLabel').textContent = '销售记录详情';
 
     try {
-        const detail = await API.getSaleRecordDetail(record.record_id);
+        const detail = await API.getSaleRecordDetail(record.record_id, 'lines');
         document.getElementById('detailSaleRecordId').textContent = detail.record_id;
         document.getElementById('detailSaleDate').textContent = detail.date;
         document.getElementById('detailSaleCustomerName').textContent = detail.customer_name;
@@ -582,7 +582,7 @@ const viewSaleRecordDetail = async (record) => {
         document.getElementById('detailSaleEmployeeName').textContent = detail.employee_name;
         document.getElementById('detailSaleEmployeeId').textContent = detail.employee_id;
 
-        const products = await API.getSaleProducts(record.record_id);
+        const products = detail.products;
         const productsTableBody = document.getElementById('detailSaleProductsTableBody');
         productsTableBody.innerHTML = '';
         if (products.length === 0) {
@@ -690,7 +690,7 @@ const viewProductionRecordDetail = async (record) => {
     document.getElementById('productionRecordModalLabel').textContent = '生产记录详情';
 
     try {
-        const detail = await API.getProductionRecordDetail(record.record_id);
+        const detail = await API.getProductionRecordDetail(record.record_id, 'lines');
         document.getElementById('detailProductionRecordId').textContent = detail.record_id;
         document.getElementById('detailProductionDate').textContent = detail.date;
         document.getElementById('detailProductionProductName').textContent = detail.product_name;
@@ -700,7 +700,7 @@ const viewProductionRecordDetail = async (record) => {
         document.getElementById('detailProductionTheoreticalOutput').textContent = detail.theoretical_output;
         document.getElementById('detailProductionActualOutput').textContent = detail.actual_output;
 
-        const materials = await API.getProductionMaterials(record.record_id);
+        const materials = detail.materials;
         const materialsTableBody = document.getElementById('detailProductionMaterialsTableBody');
         materialsTableBody.innerHTML = '';
         if (materials.length === 0) {
@@ -0,0 +1,91 @@
+# 库存流水合并（见 migrations/006_stock_ledger.sql）
+# 后台线程每隔 interval 秒调用一次 sp_FoldStockLedger，把流水合并进 stock；一批合并满时立即继续下一批。
+# 多个进程同时运行时由存储过程中的应用锁保证只有一个在合并，其余的本轮直接跳过。
+# 合并不改变读到的库存（视图读取的是 stock + 未合并的流水），只是让流水表保持很小。
+import threading
+import time
+
+import pyodbc
+
+from db_pool import PoolExhaustedError
+
+
+class StockLedgerFolder:
+    def __init__(self, get_pool, interval, batch_size=50000, logger=None):
+        self.get_pool = get_pool
+        self.interval = interval
+        self.batch_size = batch_size
+        self.logger = logger
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._runs = 0
+        self._errors = 0
+        self._folded_rows = 0
+        self._last_run = None
+        self._last_duration = 0.0
+
+    def start(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='stock-ledger-folder', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            # 任何异常都只计数、记日志，线程继续运行；线程退出后流水不再合并，会无限增长
+            try:
+                self.fold()
+            except (pyodbc.Error, PoolExhaustedError) as e:
+                with self._lock:
+                    self._errors += 1
+                if self.logger is not None:
+                    self.logger.warning(f"合并库存流水失败: {e}")
+            except Exception:
+                with self._lock:
+                    self._errors += 1
+                if self.logger is not None:
+                    self.logger.exception("合并库存流水时发生未预期的错误")
+
+    # 合并到流水表没有可合并的行为止，返回本次合并的流水行数
+    def fold(self):
+        pool = self.get_pool()
+        conn = pool.acquire()
+        start = time.monotonic()
+        total = 0
+        discard = False
+        try:
+            cursor = conn.cursor()
+            while True:
+                cursor.execute("{CALL sp_FoldStockLedger (?)}", (self.batch_size,))
+                rows = cursor.fetchone()[0]
+                conn.commit()
+                total += rows
+                if rows < self.batch_size:
+                    break
+        except pyodbc.Error:
+            discard = True
+            raise
+        finally:
+            pool.release(conn, discard=discard)
+            with self._lock:
+                self._runs += 1
+                self._folded_rows += total
+                self._last_run = time.time()
+                self._last_duration = time.monotonic() - start
+        return total
+
+    def stats(self):
+        with self._lock:
+            return {
+                'interval': self.interval,
+                'running': self._thread is not None and not self._stop.is_set(),
+                'runs': self._runs,
+                'errors': self._errors,
+                'folded_rows': self._folded_rows,
+                'last_run': self._last_run,
+                'last_duration_seconds': round(self._last_duration, 4),
+            }
@@ -0,0 +1,100 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from asgi import AsgiAdapter, CancelScope, RequestCancelledError
+
+
+# 流式响应体：记录是否被关闭（关闭时 Flask 归还连接、取消订阅）
+class StreamBody:
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.closed = threading.Event()
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed.set()
+
+
+def streaming_app(body, delay=0.0):
+    def wsgi_app(environ, start_response):
+        time.sleep(delay)
+        start_response('200 OK', [('Content-Type', 'application/x-ndjson')])
+        return body
+    return wsgi_app
+
+
+def make_adapter(wsgi_app, request_timeout=1.0, adapter_class=AsgiAdapter):
+    return adapter_class(wsgi_app, workers=2, stream_workers=2, request_timeout=request_timeout,
+                         max_pending=10, max_body_size=1024)
+
+
+# 发送一个 GET 请求，返回发出的 ASGI 消息；客户端在请求过程中一直保持连接
+def request(adapter, path='/events'):
+    scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'', 'headers': []}
+    sent = []
+
+    async def run():
+        messages = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+        forever = asyncio.Event()
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await forever.wait()
+
+        async def send(message):
+            sent.append(message)
+
+        await adapter(scope, receive, send)
+
+    asyncio.run(run())
+    return sent
+
+
+def test_streaming_response_is_sent_and_closed():
+    body = StreamBody([b'{"a": 1}\n', b'{"a": 2}\n'])
+    sent = request(make_adapter(streaming_app(body)))
+
+    assert sent[0]['status'] == 200
+    assert b''.join(m.get('body', b'') for m in sent[1:]) == b'{"a": 1}\n{"a": 2}\n'
+    assert sent[-1]['more_body'] is False
+    assert body.closed.wait(1)
+
+
+def test_stream_returned_after_timeout_is_closed():
+    body = StreamBody([b'x'])
+    sent = request(make_adapter(streaming_app(body, delay=0.3), request_timeout=0.05))
+
+    assert sent[0]['status'] == 504
+    assert body.closed.wait(2)
+
+
+# 线程已越过 _call_app 中的取消检查、随后才超时：响应仍要被关闭
+class LateAdapter(AsgiAdapter):
+    def _call_app(self, environ, cancel_scope):
+        result = super()._call_app(environ, cancel_scope)
+        time.sleep(0.3)
+        return result
+
+
+def test_stream_that_passed_the_cancel_check_is_closed_after_timeout():
+    body = StreamBody([b'x'])
+    adapter = make_adapter(streaming_app(body), request_timeout=0.05, adapter_class=LateAdapter)
+    sent = request(adapter)
+
+    assert sent[0]['status'] == 504
+    assert body.closed.wait(2)
+    assert adapter._timeouts == 1
+
+
+def test_cancel_scope_rejects_new_cursors_after_cancel():
+    scope = CancelScope()
+    scope.cancel()
+
+    with pytest.raises(RequestCancelledError):
+        scope.track(object())
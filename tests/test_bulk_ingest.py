@@ -0,0 +1,210 @@
+import decimal
+import io
+import re
+
+import pyodbc
+import pytest
+
+from bulk_ingest import BulkLoader, BulkRecordType, StockCheck, iter_csv_records, iter_ndjson_records
+
+
+def validate(record):
+    if not record.get('materials'):
+        return '缺少 materials'
+    return None
+
+
+PRODUCTION = BulkRecordType(
+    header_table='ProductionRecord',
+    header_fields=[('product_id', 'INT', 'ChemicalProduct', '产品ID'),
+                   ('date', 'DATE', None, '日期')],
+    lines_key='materials',
+    line_table='UseMaterial',
+    line_fields=[('material_id', 'material_id', 'INT', 'ChemicalMaterial', '原料ID'),
+                 ('quantity', 'quantity_used', 'DECIMAL(10,2)', None, '使用量')],
+    validate=validate,
+    stock_check=StockCheck('ChemicalMaterial', 'M', 'quantity', '原料'),
+)
+
+
+# 按 BulkLoader 发出的 SQL 模拟临时表：记录写入的行、外键检查和库存查询的结果、MERGE 分配的ID
+class FakeConnection:
+    def __init__(self, existing=None, stock=None, fail_merge=False):
+        self.existing = existing or {}  # 外键表 -> 存在的主键集合，不在其中的表视为全部存在
+        self.stock = stock or {}
+        self.fail_merge = fail_merge
+        self.header, self.lines = {}, []
+        self.merges = []  # 每批 MERGE 时临时表中的 row_no
+        self.commits = self.rollbacks = 0
+        self.next_id = 1000
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def missing(self, parent, value):
+        return parent in self.existing and value not in self.existing[parent]
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.rows = []
+        self.fast_executemany = False
+
+    @staticmethod
+    def _columns(sql):
+        return [c.strip() for c in re.search(r'\(([^)]*)\)', sql).group(1).split(',')][1:]
+
+    def executemany(self, sql, rows):
+        conn = self.conn
+        rows = [list(row) for row in rows]
+        if sql.startswith('INSERT INTO #bulk_header'):
+            names = self._columns(sql)
+            conn.header = {row[0]: dict(zip(names, row[1:])) for row in rows}
+        elif sql.startswith('INSERT INTO #bulk_line'):
+            names = self._columns(sql)
+            conn.lines = [dict(zip(['row_no'] + names, row)) for row in rows]
+        elif sql.startswith('DELETE FROM #bulk_header'):
+            for (row_no,) in rows:
+                conn.header.pop(row_no, None)
+        elif sql.startswith('INSERT INTO UseMaterial'):
+            # 逐条写入时已提交的记录扣减库存，之后的记录能看到
+            for material_id, quantity, _ in rows:
+                conn.stock[material_id] -= decimal.Decimal(str(quantity))
+
+    def execute(self, sql, params=()):
+        conn = self.conn
+        self.rows = []
+        check = re.search(r'SELECT DISTINCT s\.row_no, s\.(\w+) FROM (#\w+) s WHERE NOT EXISTS '
+                          r'\(SELECT 1 FROM (\w+)', sql)
+        delete = re.search(r'DELETE h FROM #bulk_header h .* FROM (#\w+) s WHERE NOT EXISTS '
+                           r'\(SELECT 1 FROM (\w+) p WHERE p\.(\w+)', sql)
+        if check:
+            column, stage, parent = check.groups()
+            source = conn.header.items() if stage == '#bulk_header' else [(l['row_no'], l) for l in conn.lines]
+            self.rows = sorted({(row_no, row[column]) for row_no, row in source
+                                if conn.missing(parent, row[column])})
+        elif delete:
+            stage, parent, column = delete.groups()
+            source = conn.header.items() if stage == '#bulk_header' else [(l['row_no'], l) for l in conn.lines]
+            for row_no in {row_no for row_no, row in source if conn.missing(parent, row[column])}:
+                conn.header.pop(row_no, None)
+        elif 'WITH (UPDLOCK, HOLDLOCK)' in sql:
+            ids = params[1:] or [l['material_id'] for l in conn.lines]
+            self.rows = [(item_id, conn.stock.get(item_id, 0)) for item_id in set(ids)]
+        elif sql.lstrip().startswith('MERGE'):
+            if conn.fail_merge:
+                raise pyodbc.Error('23000', '违反约束')
+            conn.merges.append(sorted(conn.header))
+        elif sql.startswith('SELECT row_no, record_id FROM #bulk_id'):
+            self.rows = [(row_no, 1000 + row_no) for row_no in sorted(conn.header)]
+        elif sql.startswith('SET NOCOUNT ON; DECLARE @ids'):
+            self.rows = [(conn.next_id,)]
+            conn.next_id += 1
+        return self
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0]
+
+
+def record(material_id=1, quantity=10, product_id=1, ref=None, lines=None):
+    result = {'product_id': product_id, 'date': '2026-01-05',
+              'materials': lines or [{'material_id': material_id, 'quantity': quantity}]}
+    if ref is not None:
+        result['ref'] = ref
+    return result
+
+
+def load(conn, records, chunk_size=500, reject_negative_stock=False):
+    return BulkLoader(conn, PRODUCTION, chunk_size, reject_negative_stock).load((r, None) for r in records)
+
+
+def test_records_are_flushed_in_chunks_of_chunk_size():
+    conn = FakeConnection()
+    results = load(conn, [record() for _ in range(5)], chunk_size=2)
+
+    assert conn.merges == [[0, 1], [2, 3], [4]]
+    assert [r['record_id'] for r in results] == [1000, 1001, 1002, 1003, 1004]
+
+
+def test_invalid_records_are_reported_without_a_flush():
+    conn = FakeConnection()
+    results = load(conn, [{'product_id': 1, 'date': '2026-01-05', 'materials': []},
+                          record(quantity='abc'),
+                          record(lines=[{'material_id': 1, 'quantity': 1}, {'material_id': 1, 'quantity': 2}])])
+
+    assert conn.merges == []
+    assert results[0]['error'] == '缺少 materials'
+    assert results[1]['error'] == 'materials[0].quantity 格式错误'
+    assert results[2]['error'] == 'materials[1] 重复的原料ID: 1'
+
+
+def test_missing_foreign_keys_map_to_their_records():
+    conn = FakeConnection(existing={'ChemicalProduct': {1}, 'ChemicalMaterial': {1, 2}})
+    results = load(conn, [record(ref='a'), record(product_id=9, ref='b'), record(material_id=7, ref='c')])
+
+    assert conn.merges == [[0]]
+    assert results[0] == {'index': 0, 'ref': 'a', 'record_id': 1000}
+    assert results[1] == {'index': 1, 'ref': 'b', 'error': '产品ID 9 不存在'}
+    assert results[2] == {'index': 2, 'ref': 'c', 'error': '原料ID 7 不存在'}
+
+
+def test_stock_check_consumes_duplicate_items_across_a_chunk():
+    conn = FakeConnection(stock={1: decimal.Decimal('25'), 2: decimal.Decimal('100')})
+    results = load(conn, [record(material_id=1, quantity=10), record(material_id=1, quantity=10),
+                          record(material_id=1, quantity=10), record(material_id=2, quantity=10)],
+                   reject_negative_stock=True)
+
+    assert conn.merges == [[0, 1, 3]]
+    assert 'record_id' in results[0] and 'record_id' in results[1] and 'record_id' in results[3]
+    assert results[2]['error'] == '原料库存不足: 1 (库存 5.00, 需要 10.00)'
+
+
+def test_stock_check_is_off_unless_requested():
+    conn = FakeConnection(stock={1: decimal.Decimal('0')})
+    results = load(conn, [record(material_id=1, quantity=10)])
+
+    assert 'record_id' in results[0]
+
+
+def test_failed_chunk_falls_back_to_one_by_one_writes():
+    conn = FakeConnection(fail_merge=True, stock={1: decimal.Decimal('15')})
+    results = load(conn, [record(quantity=10), record(quantity=10)], reject_negative_stock=True)
+
+    assert conn.rollbacks >= 1
+    assert results[0]['record_id'] == 1000
+    assert results[1]['error'].startswith('原料库存不足: 1')
+
+
+def test_csv_rows_with_the_same_ref_form_one_record():
+    body = ('ref,product_id,date,material_id,quantity\n'
+            'a,1,2026-01-05,1,10\n'
+            'a,1,2026-01-05,2,5\n'
+            ',1,2026-01-06,3,1\n').encode('utf-8')
+    records = [r for r, _ in iter_csv_records(io.BytesIO(body), PRODUCTION)]
+
+    assert records[0]['ref'] == 'a'
+    assert [line['material_id'] for line in records[0]['materials']] == ['1', '2']
+    assert 'ref' not in records[1]
+
+
+def test_csv_missing_columns_is_a_single_error():
+    body = b'ref,product_id,material_id\n'
+    assert list(iter_csv_records(io.BytesIO(body), PRODUCTION)) == [(None, 'CSV缺少列: date, quantity')]
+
+
+@pytest.mark.parametrize('line, error', [
+    (b'not json', '第1行不是有效的JSON'),
+    (b'[1, 2]', '第1行必须是JSON对象'),
+])
+def test_ndjson_parse_errors(line, error):
+    assert list(iter_ndjson_records(io.BytesIO(line))) == [(None, error)]
@@ -0,0 +1,178 @@
+import threading
+
+import pyodbc
+import pytest
+
+from db_pool import ConnectionPool, PoolExhaustedError
+
+
+class FakeConnection:
+    def __init__(self, login_timeout):
+        self.login_timeout = login_timeout
+        self.timeout = 0
+        self.autocommit = False
+        self.healthy = True
+        self.closed = False
+        self.rollbacks = 0
+        self.checks = []  # 每次健康检查时的查询超时
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        self.checks.append(self.timeout)
+        if not self.healthy:
+            raise pyodbc.Error('08S01', '连接已断开')
+
+    def fetchone(self):
+        return (1,)
+
+    def close(self):
+        self.closed = True
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakeDriver:
+    def __init__(self):
+        self.connections = []
+        self.down = False
+
+    def __call__(self, timeout=0):
+        if self.down:
+            raise pyodbc.Error('08001', '无法连接')
+        conn = FakeConnection(timeout)
+        self.connections.append(conn)
+        return conn
+
+
+def make_pool(driver, **kwargs):
+    options = {'min_size': 0, 'max_size': 2, 'timeout': 0.05, 'health_check_interval': 60}
+    options.update(kwargs)
+    return ConnectionPool('DSN=test', connect=driver, **options)
+
+
+def test_min_size_connections_are_opened_up_front():
+    driver = FakeDriver()
+    pool = make_pool(driver, min_size=2)
+
+    assert len(driver.connections) == 2
+    assert pool.stats()['idle'] == 2
+
+
+def test_database_down_at_startup_does_not_fail_construction():
+    driver = FakeDriver()
+    driver.down = True
+    pool = make_pool(driver, min_size=2)
+
+    assert pool.stats()['size'] == 0
+    driver.down = False
+    assert pool.acquire() is driver.connections[0]
+
+
+def test_released_connection_is_reused():
+    driver = FakeDriver()
+    pool = make_pool(driver)
+    conn = pool.acquire()
+    pool.release(conn)
+
+    assert pool.acquire() is conn
+    assert len(driver.connections) == 1
+
+
+def test_full_pool_without_blocking_returns_none():
+    pool = make_pool(FakeDriver(), max_size=1)
+    pool.acquire()
+
+    assert pool.acquire(block=False) is None
+
+
+def test_full_pool_times_out():
+    pool = make_pool(FakeDriver(), max_size=1)
+    pool.acquire()
+
+    with pytest.raises(PoolExhaustedError):
+        pool.acquire()
+    assert pool.stats()['timeouts'] == 1
+
+
+def test_waiter_gets_the_released_connection():
+    pool = make_pool(FakeDriver(), max_size=1, timeout=5)
+    conn = pool.acquire()
+    threading.Timer(0.05, pool.release, (conn,)).start()
+
+    assert pool.acquire() is conn
+
+
+def test_connection_is_recycled_after_max_uses():
+    driver = FakeDriver()
+    pool = make_pool(driver, max_uses=2)
+    first = pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
+    pool.release(first)
+
+    assert first.closed
+    assert pool.acquire() is not first
+    assert pool.stats()['recycled'] == 1
+
+
+def test_unhealthy_idle_connection_is_replaced():
+    driver = FakeDriver()
+    pool = make_pool(driver, health_check_interval=0)
+    first = pool.acquire()
+    pool.release(first)
+    first.healthy = False
+
+    second = pool.acquire()
+    assert second is not first and first.closed
+    assert pool.stats()['health_check_failures'] == 1
+
+
+def test_connect_timeout_bounds_login_and_health_check():
+    driver = FakeDriver()
+    pool = make_pool(driver, health_check_interval=0)
+    conn = pool.acquire(connect_timeout=3)
+    assert conn.login_timeout == 3
+    pool.release(conn)
+
+    conn.timeout = 30
+    assert pool.acquire(connect_timeout=3) is conn
+    assert conn.checks == [3]
+    assert conn.timeout == 30
+
+
+def test_failed_connect_frees_the_slot():
+    driver = FakeDriver()
+    pool = make_pool(driver, max_size=1)
+    driver.down = True
+    with pytest.raises(pyodbc.Error):
+        pool.acquire()
+
+    driver.down = False
+    assert pool.acquire() is not None
+
+
+def test_release_rolls_back_and_resets_autocommit():
+    pool = make_pool(FakeDriver())
+    conn = pool.acquire()
+    conn.autocommit = True
+    pool.release(conn)
+
+    assert conn.rollbacks == 1 and conn.autocommit is False
+    assert pool.stats()['in_use'] == 0
+
+
+def test_discarded_connection_is_closed():
+    pool = make_pool(FakeDriver())
+    conn = pool.acquire()
+    pool.release(conn, discard=True)
+
+    assert conn.closed
+    assert pool.stats()['size'] == 0
+
+
+def test_invalid_sizes_are_rejected():
+    with pytest.raises(ValueError):
+        make_pool(FakeDriver(), min_size=3, max_size=2)
@@ -0,0 +1,165 @@
+import datetime
+import time
+
+import pyodbc
+import pytest
+
+from db_routing import LocalStickyBackend, ReadRouter, ReplicaMonitor, create_read_router
+
+
+class FakeMonitor:
+    def __init__(self, available=True):
+        self.is_available = available
+        self.errors = []
+
+    def available(self):
+        return self.is_available
+
+    def mark_down(self, error):
+        self.errors.append(error)
+        self.is_available = False
+
+    def stats(self):
+        return {}
+
+
+def make_router(available=True, sticky_window=10.0):
+    return ReadRouter(FakeMonitor(available), LocalStickyBackend(), sticky_window)
+
+
+def test_reads_use_replica_and_writes_use_primary():
+    router = make_router()
+
+    assert router.use_replica(True, 'alice') is True
+    assert router.use_replica(False, 'alice') is False
+    assert router.stats()['replica_reads'] == 1
+
+
+def test_user_reads_primary_after_own_write():
+    router = make_router()
+    router.record_write('alice')
+
+    assert router.use_replica(True, 'alice') is False
+    assert router.use_replica(True, 'bob') is True
+    assert router.stats()['primary_reads']['sticky'] == 1
+
+
+def test_sticky_window_expires():
+    router = make_router(sticky_window=0.01)
+    router.record_write('alice')
+    time.sleep(0.02)
+
+    assert router.use_replica(True, 'alice') is True
+    assert router.sticky_backend.size() == 0
+
+
+def test_zero_sticky_window_disables_read_your_writes():
+    router = make_router(sticky_window=0)
+    router.record_write('alice')
+
+    assert router.use_replica(True, 'alice') is True
+
+
+def test_unavailable_replica_and_forced_reads_go_to_primary():
+    router = make_router(available=False)
+    assert router.use_replica(True, 'alice') is False
+
+    router.monitor.is_available = True
+    assert router.use_replica(True, 'alice', force_primary=True) is False
+    assert router.stats()['primary_reads'] == {'sticky': 0, 'unavailable': 1, 'forced': 1}
+
+
+def test_replica_failure_moves_the_read_to_primary():
+    router = make_router()
+    assert router.use_replica(True)
+    router.replica_failed(pyodbc.Error('08001', '连接失败'))
+
+    assert router.stats()['replica_reads'] == 0
+    assert router.stats()['primary_reads']['unavailable'] == 1
+    assert router.use_replica(True) is False
+
+
+def test_local_sticky_backend_is_bounded():
+    backend = LocalStickyBackend(max_entries=2)
+    for user in ('a', 'b', 'c'):
+        backend.stick(user, 60)
+
+    assert backend.size() == 2
+    assert not backend.is_sticky('a') and backend.is_sticky('c')
+    assert LocalStickyBackend.shared is False
+
+
+def test_unknown_sticky_backend_is_rejected():
+    with pytest.raises(ValueError):
+        create_read_router(None, None, sticky_backend='memcached')
+
+
+class FakePool:
+    def __init__(self, row=None, error=None):
+        self.row = row
+        self.error = error
+        self.released = []
+
+    def acquire(self):
+        return self
+
+    def release(self, conn, discard=False):
+        self.released.append(discard)
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        if self.error:
+            raise self.error
+
+    def fetchone(self):
+        return self.row
+
+    def commit(self):
+        pass
+
+
+def test_monitor_measures_lag_on_primary_clock():
+    now = datetime.datetime(2026, 10, 18, 12, 0, 0)
+    replica = FakePool(row=(now - datetime.timedelta(seconds=3),))
+    primary = FakePool(row=(now - datetime.timedelta(seconds=1), now))
+    monitor = ReplicaMonitor(lambda: primary, lambda: replica, max_lag=5)
+    monitor.check()
+
+    assert monitor.stats()['lag_seconds'] == 3.0
+    assert monitor.available()
+
+    monitor.max_lag = 2
+    assert not monitor.available()
+
+
+def test_monitor_reports_zero_lag_when_replica_saw_last_beat():
+    now = datetime.datetime(2026, 10, 18, 12, 0, 0)
+    replica = FakePool(row=(now,))
+    primary = FakePool(row=(now, now + datetime.timedelta(seconds=1)))
+    monitor = ReplicaMonitor(lambda: primary, lambda: replica)
+    monitor.check()
+
+    assert monitor.stats()['lag_seconds'] == 0.0
+
+
+def test_monitor_marks_replica_down_when_unreachable():
+    replica = FakePool(error=pyodbc.Error('08001', '连接失败'))
+    monitor = ReplicaMonitor(lambda: FakePool(), lambda: replica)
+    monitor.check()
+
+    assert not monitor.available()
+    assert replica.released == [True]
+    assert monitor.stats()['failures'] == 1
+
+
+def test_read_only_post_endpoints_count_as_reads():
+    from app import app, is_read_request
+
+    with app.test_request_context('/planning/requirements', method='POST'):
+        assert is_read_request()
+    with app.test_request_context('/materials', method='POST'):
+        assert not is_read_request()
+    with app.test_request_context('/materials', method='GET'):
+        assert is_read_request()
@@ -0,0 +1,163 @@
+import json
+import sys
+import threading
+import types
+
+import pytest
+
+import app as app_module
+from app import app, stream_events
+from events import EventBroadcaster, RedisEventRelay, create_event_broadcaster
+
+
+def test_events_reach_only_subscribers_of_the_topic():
+    broadcaster = EventBroadcaster()
+    materials = broadcaster.subscribe(['materials'])
+    products = broadcaster.subscribe(['products'])
+    event_id = broadcaster.publish('materials', '{"ids": [1]}')
+
+    assert materials.get(0) == f'id: {event_id}\nevent: materials\ndata: {{"ids": [1]}}\n\n'
+    assert products.get(0) is None
+    assert broadcaster.has_subscribers('materials') and not broadcaster.has_subscribers('sale_records')
+
+
+def test_subscriber_cap_rejects_and_frees_slots():
+    broadcaster = EventBroadcaster(max_subscribers=1)
+    first = broadcaster.subscribe(['materials'])
+
+    assert broadcaster.subscribe(['materials']) is None
+    broadcaster.unsubscribe(first)
+    assert broadcaster.subscribe(['materials']) is not None
+    assert broadcaster.stats()['rejected_subscribers'] == 1
+
+
+def test_full_queue_drops_the_subscriber_without_blocking():
+    broadcaster = EventBroadcaster(queue_size=2)
+    slow = broadcaster.subscribe(['materials'])
+    for i in range(3):
+        broadcaster.publish('materials', str(i))
+
+    assert slow.dropped
+    assert [slow.get(0) is not None for _ in range(3)] == [True, True, False]
+    assert broadcaster.stats()['subscribers'] == 0 and broadcaster.stats()['dropped_subscribers'] == 1
+    assert broadcaster.stats()['delivered'] == 2
+
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError):
+        create_event_broadcaster('kafka')
+
+
+# 测试用的 redis 客户端：记录发布的消息，pubsub 依次返回 messages 中的消息
+class FakeRedis:
+    def __init__(self):
+        self.messages = []
+        self.published = []
+        self.fail_publish = False
+
+    def publish(self, channel, data):
+        if self.fail_publish:
+            raise ConnectionError('redis 不可用')
+        self.published.append((channel, data))
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+
+class FakePubSub:
+    def __init__(self, client):
+        self.client = client
+
+    def subscribe(self, channel):
+        self.channel = channel
+
+    def get_message(self, timeout):
+        if self.client.messages:
+            return {'data': self.client.messages.pop(0)}
+        threading.Event().wait(0.01)
+        return None
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    client = FakeRedis()
+    module = types.SimpleNamespace(Redis=types.SimpleNamespace(from_url=lambda url: client))
+    monkeypatch.setitem(sys.modules, 'redis', module)
+    return client
+
+
+def test_relay_forwards_events_and_skips_its_own(fake_redis):
+    broadcaster = create_event_broadcaster('redis', 'redis://localhost')
+    subscription = broadcaster.subscribe(['materials'])
+    broadcaster.publish('materials', '"local"')
+    origin, topic, data = json.loads(fake_redis.published[0][1])
+    assert (topic, data) == ('materials', '"local"')
+
+    # 转发回来的本进程事件跳过，其他进程的事件分发给本地订阅者
+    fake_redis.messages = [fake_redis.published[0][1], json.dumps(['other', 'materials', '"remote"'])]
+    broadcaster.start()
+    try:
+        assert subscription.get(1).endswith('data: "local"\n\n')
+        assert subscription.get(1).endswith('data: "remote"\n\n')
+        assert subscription.get(0.1) is None
+    finally:
+        broadcaster.stop()
+    assert broadcaster.has_subscribers('sale_records')  # 不知道其他进程的订阅者，总是准备事件数据
+
+
+def test_relay_failure_still_delivers_locally(fake_redis):
+    fake_redis.fail_publish = True
+    broadcaster = EventBroadcaster(relay=RedisEventRelay('redis://localhost'))
+    subscription = broadcaster.subscribe(['materials'])
+    broadcaster.publish('materials', '1')
+
+    assert subscription.get(0) is not None
+
+
+@pytest.fixture
+def broadcaster(monkeypatch):
+    broadcaster = EventBroadcaster(queue_size=2, max_subscribers=1)
+    monkeypatch.setattr(app_module, 'event_broadcaster', broadcaster)
+    return broadcaster
+
+
+# 只去掉登录装饰器，以 admin 角色订阅
+def open_stream():
+    with app.test_request_context('/events?topics=materials'):
+        app_module.g.current_role = 'admin'
+        return app.make_response(stream_events.__wrapped__())
+
+
+def test_events_endpoint_returns_503_when_full(broadcaster):
+    first = open_stream()
+    second = open_stream()
+
+    assert first.status_code == 200
+    assert second.status_code == 503 and second.headers['Retry-After'] == '5'
+    first.close()
+
+
+def test_closing_the_stream_unsubscribes(broadcaster):
+    response = open_stream()
+    chunks = iter(response.response)
+
+    assert next(chunks).startswith('retry: 3000\n: subscribed materials')
+    assert broadcaster.stats()['subscribers'] == 1
+    response.close()
+    assert broadcaster.stats()['subscribers'] == 0
+    assert open_stream().status_code == 200
+
+
+def test_overflowing_stream_sends_queued_events_then_overflow(broadcaster):
+    response = open_stream()
+    chunks = iter(response.response)
+    next(chunks)
+    for i in range(3):
+        broadcaster.publish('materials', str(i))
+
+    events = [line for chunk in chunks for line in chunk.split('\n') if line.startswith('event: ')]
+    assert events == ['event: materials', 'event: materials', 'event: overflow']
+    assert broadcaster.stats()['subscribers'] == 0
@@ -0,0 +1,66 @@
+import re
+
+from app import EVENT_QUERY_CHUNK, attach_names, attach_record_lines
+
+
+# 按 IN 列表中的ID返回明细行或名称，记录每次查询的参数个数
+class FakeCursor:
+    def __init__(self, columns):
+        self.description = [(name,) for name in columns]
+        self.param_counts = []
+        self.rows = []
+
+    def execute(self, sql, params):
+        assert len(re.search(r'IN \(([?,]*)\)', sql).group(1).split(',')) == len(params)
+        self.param_counts.append(len(params))
+        self.rows = [self.row(i) for i in params]
+
+    def fetchall(self):
+        return self.rows
+
+
+class LineCursor(FakeCursor):
+    def __init__(self):
+        super().__init__(['record_id', 'material_id', 'quantity'])
+
+    @staticmethod
+    def row(record_id):
+        return (record_id, record_id % 7, 1.5)
+
+
+class NameCursor(FakeCursor):
+    def __init__(self):
+        super().__init__(['supplier_id', 'name'])
+
+    @staticmethod
+    def row(supplier_id):
+        return (supplier_id, f'供应商{supplier_id}')
+
+
+def test_record_lines_are_queried_in_chunks():
+    items = [{'record_id': i} for i in range(1, 2 * EVENT_QUERY_CHUNK + 501)]
+    cursor = LineCursor()
+    attach_record_lines(cursor, 'purchase_records', items)
+
+    assert cursor.param_counts == [EVENT_QUERY_CHUNK, EVENT_QUERY_CHUNK, 500]
+    assert items[-1]['materials'] == [{'material_id': items[-1]['record_id'] % 7, 'quantity': 1.5}]
+    assert all(len(item['materials']) == 1 for item in items)
+
+
+def test_names_are_queried_in_chunks_of_distinct_ids():
+    items = [{'supplier_id': i % (EVENT_QUERY_CHUNK + 10)} for i in range(3000)] + [{'supplier_id': None}]
+    cursor = NameCursor()
+    attach_names(cursor, items, 'supplier_id', 'Supplier', 'supplier_name')
+
+    assert cursor.param_counts == [EVENT_QUERY_CHUNK, 10]
+    assert items[5]['supplier_name'] == '供应商5'
+    assert items[-1]['supplier_name'] is None
+
+
+def test_empty_page_runs_no_query():
+    cursor = LineCursor()
+    items = []
+    attach_record_lines(cursor, 'sale_records', items)
+    attach_names(cursor, items, 'supplier_id', 'Supplier', 'supplier_name')
+
+    assert cursor.param_counts == []
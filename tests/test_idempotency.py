@@ -0,0 +1,107 @@
+import threading
+import time
+
+import pytest
+
+from idempotency import IdempotencyStore, LocalIdempotencyBackend, create_idempotency_store
+
+
+def make_store(**kwargs):
+    return IdempotencyStore(LocalIdempotencyBackend(), **kwargs)
+
+
+def test_first_request_executes_and_retry_replays_saved_response():
+    store = make_store()
+    key = store.key('alice:add_purchase_record', 'k1')
+    fingerprint = store.fingerprint(b'{"supplier_id": 1}')
+
+    assert store.begin(key, fingerprint) == ('execute', None)
+    store.complete(key, {'status': 201, 'body': '{"record_id": 7}'})
+
+    assert store.begin(key, fingerprint) == ('replay', {'status': 201, 'body': '{"record_id": 7}'})
+    assert store.stats()['executed'] == 1 and store.stats()['replayed'] == 1
+
+
+def test_same_key_with_different_body_is_a_mismatch():
+    store = make_store()
+    key = store.key('alice:add_purchase_record', 'k1')
+    store.begin(key, store.fingerprint(b'a'))
+    store.complete(key, {'status': 201})
+
+    assert store.begin(key, store.fingerprint(b'b')) == ('mismatch', None)
+
+
+def test_keys_are_scoped_by_user_and_endpoint():
+    assert IdempotencyStore.key('alice:add_purchase_record', 'k1') != IdempotencyStore.key('bob:add_purchase_record', 'k1')
+    assert IdempotencyStore.key('alice:add_purchase_record', 'k1') != IdempotencyStore.key('alice:add_sale_record', 'k1')
+
+
+def test_released_key_can_be_executed_again():
+    store = make_store()
+    key = store.key('alice:add_purchase_record', 'k1')
+    store.begin(key, 'f')
+    store.release(key)
+
+    assert store.begin(key, 'f') == ('execute', None)
+
+
+def test_concurrent_retry_waits_for_the_first_request():
+    store = make_store(wait_timeout=5)
+    key = store.key('alice:add_purchase_record', 'k1')
+    store.begin(key, 'f')
+    outcome = []
+    waiter = threading.Thread(target=lambda: outcome.append(store.begin(key, 'f')))
+    waiter.start()
+    time.sleep(0.05)
+    store.complete(key, {'status': 201})
+    waiter.join(5)
+
+    assert outcome == [('replay', {'status': 201})]
+    assert store.stats()['waited'] == 1
+
+
+def test_retry_gives_up_while_first_request_is_still_running():
+    store = make_store(wait_timeout=0.05)
+    key = store.key('alice:add_purchase_record', 'k1')
+    store.begin(key, 'f')
+
+    assert store.begin(key, 'f') == ('in_progress', None)
+
+
+def test_retry_executes_when_first_request_fails_while_waiting():
+    store = make_store(wait_timeout=5)
+    key = store.key('alice:add_purchase_record', 'k1')
+    store.begin(key, 'f')
+    timer = threading.Timer(0.05, store.release, (key,))
+    timer.start()
+
+    assert store.begin(key, 'f') == ('execute', None)
+    timer.join()
+
+
+def test_completed_entries_expire_after_ttl():
+    store = make_store(ttl=0.01)
+    key = store.key('alice:add_purchase_record', 'k1')
+    store.begin(key, 'f')
+    store.complete(key, {'status': 201})
+    time.sleep(0.02)
+
+    assert store.begin(key, 'f') == ('execute', None)
+
+
+def test_local_backend_evicts_completed_entries_first():
+    backend = LocalIdempotencyBackend(max_entries=2)
+    backend.claim('done', 'f', 60)
+    backend.complete('done', {'status': 201}, 60)
+    backend.claim('pending-1', 'f', 60)
+    backend.claim('pending-2', 'f', 60)
+
+    assert backend.size() == 2
+    assert backend.claim('pending-1', 'f', 60)['state'] == 'pending'
+    assert backend.claim('done', 'f', 60) is None
+
+
+def test_only_shared_backends_are_safe_across_processes():
+    assert create_idempotency_store('local').shared is False
+    with pytest.raises(ValueError):
+        create_idempotency_store('memcached')
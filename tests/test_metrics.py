@@ -0,0 +1,98 @@
+import pytest
+
+from app import app
+from metrics import Registry, param_shape
+
+
+def test_counter_and_gauge_render_prometheus_text():
+    registry = Registry()
+    requests = registry.counter('requests_total', '请求数', ['method'])
+    requests.inc('GET')
+    requests.inc('GET', amount=2)
+    registry.gauge('pool_size', '连接数').set(3.0)
+
+    assert registry.render().splitlines() == [
+        '# HELP requests_total 请求数', '# TYPE requests_total counter', 'requests_total{method="GET"} 3',
+        '# HELP pool_size 连接数', '# TYPE pool_size gauge', 'pool_size 3',
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Registry().histogram('duration_seconds', '耗时', buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        histogram.observe(value)
+
+    assert histogram.render()[2:] == [
+        'duration_seconds_bucket{le="0.1"} 1', 'duration_seconds_bucket{le="1"} 3',
+        'duration_seconds_bucket{le="+Inf"} 4', 'duration_seconds_sum 4.25', 'duration_seconds_count 4',
+    ]
+
+
+def test_labels_are_escaped_and_checked():
+    counter = Registry().counter('errors_total', '错误数', ['message'])
+    counter.inc('say "hi"\n')
+
+    assert counter.render()[2] == 'errors_total{message="say \\"hi\\"\\n"} 1'
+    with pytest.raises(ValueError):
+        counter.inc()
+
+
+def test_collectors_skip_missing_values():
+    registry = Registry()
+    registry.register_collector(lambda: [('lag_seconds', 'gauge', '延迟', {(('replica', 'r1'),): 1.5,
+                                                                           (('replica', 'r2'),): None})])
+
+    assert registry.render().splitlines()[2:] == ['lag_seconds{replica="r1"} 1.5']
+
+
+def test_param_shape_hides_values():
+    assert param_shape(('secret', 42, [1, 2, 3, 4])) == 'tuple(str[6], int, list[4]<int>)'
+
+
+@pytest.fixture
+def metrics_config(monkeypatch):
+    monkeypatch.setitem(app.config, 'METRICS_ENABLED', True)
+    monkeypatch.setitem(app.config, 'METRICS_AUTH_TOKEN', '')
+    monkeypatch.setitem(app.config, 'METRICS_PUBLIC', False)
+    return app.config
+
+
+def scrape(remote_addr='127.0.0.1', headers=None):
+    client = app.test_client()
+    return client.get('/metrics', headers=headers or {}, environ_base={'REMOTE_ADDR': remote_addr})
+
+
+def test_local_scrape_is_allowed_without_token(metrics_config):
+    response = scrape()
+
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+
+
+@pytest.mark.parametrize('remote_addr, headers', [
+    ('10.0.0.5', {}),
+    ('127.0.0.1', {'X-Forwarded-For': '203.0.113.7'}),
+    ('127.0.0.1', {'Forwarded': 'for=203.0.113.7'}),
+])
+def test_remote_or_proxied_scrape_is_denied_without_token(metrics_config, remote_addr, headers):
+    assert scrape(remote_addr, headers).status_code == 403
+
+
+def test_token_is_required_when_configured(metrics_config):
+    metrics_config['METRICS_AUTH_TOKEN'] = 's3cret'
+
+    assert scrape('10.0.0.5').status_code == 401
+    assert scrape('127.0.0.1', {'Authorization': 'Bearer wrong'}).status_code == 401
+    assert scrape('10.0.0.5', {'Authorization': 'Bearer s3cret'}).status_code == 200
+
+
+def test_metrics_public_allows_remote_scrapes(metrics_config):
+    metrics_config['METRICS_PUBLIC'] = True
+
+    assert scrape('10.0.0.5').status_code == 200
+
+
+def test_disabled_metrics_return_404(metrics_config):
+    metrics_config['METRICS_ENABLED'] = False
+
+    assert scrape().status_code == 404
@@ -0,0 +1,164 @@
+import datetime
+
+import pytest
+
+import app as app_module
+from app import (MATERIAL_COLUMNS, PURCHASE_EXPANSIONS, app, build_list_query, decode_cursor, encode_cursor,
+                 keyset_condition, list_response, query_page)
+
+SORTABLE = {'material_id': 'material_id', 'name': 'name'}
+
+
+@pytest.mark.parametrize('sort_value, pk', [
+    ('硫酸', 3),
+    (None, 4),
+    (12.5, 5),
+    (datetime.date(2026, 1, 5), 6),
+])
+def test_cursor_round_trip(sort_value, pk):
+    token = encode_cursor(sort_value, pk)
+
+    assert '=' not in token
+    expected = sort_value.isoformat() if isinstance(sort_value, datetime.date) else sort_value
+    assert decode_cursor(token) == [expected, pk]
+
+
+@pytest.mark.parametrize('token', ['', 'bm90IGpzb24', 'WzFd', 'WyJhIiwgIngiXQ'])
+def test_invalid_cursor_is_rejected(token):
+    with pytest.raises(ValueError):
+        decode_cursor(token)
+
+
+def test_keyset_condition_on_primary_key():
+    assert keyset_condition('material_id', 'material_id', 7, 7, False) == ('material_id > ?', [7])
+    assert keyset_condition('material_id', 'material_id', 7, 7, True) == ('material_id < ?', [7])
+
+
+def test_keyset_condition_breaks_ties_on_primary_key():
+    condition, params = keyset_condition('name', 'material_id', 'b', 9, False)
+
+    assert condition == 'name > ? OR (name = ? AND material_id > ?)'
+    assert params == ['b', 'b', 9]
+
+
+def test_keyset_condition_places_nulls_like_sql_server():
+    assert keyset_condition('name', 'material_id', None, 9, True) == ('name IS NULL AND material_id < ?', [9])
+    condition, params = keyset_condition('name', 'material_id', None, 9, False)
+    assert condition == '(name IS NULL AND material_id > ?) OR name IS NOT NULL'
+
+
+def test_list_query_applies_sort_filters_and_cursor():
+    after = encode_cursor('b', 9)
+    with app.test_request_context(f'/materials?sort=-name&category=acid&after={after}'):
+        sql, params, sort_name, error = build_list_query(
+            'material_id, name', 'ChemicalMaterial', 'material_id', SORTABLE, 'material_id',
+            {'category': ('category = ?', str)}, top=11)
+
+    assert error is None and sort_name == 'name'
+    assert sql == ("SELECT TOP (?) material_id, name FROM ChemicalMaterial "
+                   "WHERE (category = ?) AND (name < ? OR name IS NULL OR (name = ? AND material_id < ?)) "
+                   "ORDER BY name DESC, material_id DESC")
+    assert params == [11, 'acid', 'b', 'b', 9]
+
+
+@pytest.mark.parametrize('query, message', [
+    ('sort=price', '不支持的排序字段: price，可选 material_id, name'),
+    ('after=!!', '分页游标 after 无效'),
+])
+def test_list_query_rejects_bad_arguments(query, message):
+    with app.test_request_context(f'/materials?{query}'):
+        error = build_list_query('*', 'ChemicalMaterial', 'material_id', SORTABLE, 'material_id')[3]
+        assert error[1] == 400 and error[0].get_json()['error'] == message
+
+
+class FakeCursor:
+    description = [('material_id',), ('name',)]
+
+    def __init__(self, count):
+        self.count = count
+
+    def execute(self, sql, params):
+        self.sql, self.params = sql, params
+
+    def fetchall(self):
+        limit = self.params[0] if self.sql.startswith('SELECT TOP') else self.count
+        return [(i, f'原料{i}') for i in range(1, min(limit, self.count) + 1)]
+
+
+def page(query, count):
+    cursor = FakeCursor(count)
+    with app.test_request_context(f'/materials?{query}'):
+        names, rows, next_cursor, error = query_page(cursor, MATERIAL_COLUMNS, 'vw_ChemicalMaterialCurrent',
+                                                     'material_id', SORTABLE, 'material_id')
+    assert error is None
+    return cursor, rows, next_cursor
+
+
+def test_without_limit_or_cursor_the_whole_list_is_returned():
+    cursor, rows, next_cursor = page('', 250)
+
+    assert not cursor.sql.startswith('SELECT TOP')
+    assert len(rows) == 250 and next_cursor is None
+
+
+def test_limit_returns_one_page_with_next_cursor():
+    cursor, rows, next_cursor = page('limit=2', 5)
+
+    assert cursor.params[0] == 3  # 多取一行判断是否还有下一页
+    assert len(rows) == 2
+    assert decode_cursor(next_cursor) == [2, 2]
+
+
+def test_last_page_has_no_next_cursor():
+    _, rows, next_cursor = page('limit=10', 5)
+
+    assert len(rows) == 5 and next_cursor is None
+
+
+def test_cursor_without_limit_uses_default_page_size():
+    cursor, _, _ = page(f'after={encode_cursor(1, 1)}', 500)
+
+    assert cursor.params[0] == app.config['PAGE_SIZE_DEFAULT'] + 1
+
+
+def test_catalog_columns_exclude_computed_low_stock_flag():
+    assert 'is_low_stock' not in MATERIAL_COLUMNS
+
+
+# 记录列表查询返回 count 条进货记录，明细、名称查询按 IN 列表中的ID各返回一行
+class RecordCursor:
+    def __init__(self, count):
+        self.count = count
+        self.param_counts = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params):
+        self.param_counts.append(len(params))
+        if 'FROM PurchaseRecord' in sql:
+            self.description = [('record_id',), ('supplier_id',)]
+            self.rows = [(i, i % 3) for i in range(1, self.count + 1)]
+        elif 'FROM Supplier' in sql:
+            self.description = [('supplier_id',), ('name',)]
+            self.rows = [(i, f'供应商{i}') for i in params]
+        else:
+            self.description = [('record_id',), ('material_id',)]
+            self.rows = [(i, 1) for i in params]
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_unpaged_list_with_expand_stays_under_parameter_limit(monkeypatch):
+    cursor = RecordCursor(2500)
+    monkeypatch.setattr(app_module, 'get_db', lambda: cursor)
+    with app.test_request_context('/purchase_records?expand=lines,supplier'):
+        response = list_response('*', 'PurchaseRecord', 'record_id', {'record_id': 'record_id'}, 'record_id',
+                                 expansions=PURCHASE_EXPANSIONS)
+        items = response.get_json()
+
+    assert len(items) == 2500 and 'X-Next-Cursor' not in response.headers
+    assert max(cursor.param_counts) <= 2100
+    assert items[-1]['materials'] == [{'material_id': 1}]
+    assert items[-1]['supplier_name'] == '供应商1'
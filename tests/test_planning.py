@@ -0,0 +1,134 @@
+import pytest
+
+import planning
+from planning import RequirementsPlanner
+
+# (record_id, product_id, 实际产量, [(material_id, 使用量)])
+HISTORY = [
+    (1, 1, 100, [(10, 50), (11, 20)]),
+    (2, 1, 100, [(10, 30), (12, 0)]),  # 原料 12 登记过但没有用量
+    (3, 2, 0, [(10, 5)]),  # 实际产量为 0 的记录
+    (4, 3, 40, [(11, 8)]),
+]
+
+
+# 按 RequirementsPlanner 发出的三条汇总查询从 records 计算结果
+class FakeConnection:
+    def __init__(self, records):
+        self.records = list(records)
+        self.loads = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params):
+        if 'COUNT_BIG' in sql:
+            (watermark,) = params
+            ids = [r[0] for r in self.records]
+            self.rows = [(sum(1 for i in ids if i <= watermark), max(ids, default=None))]
+            return
+        low, high = params
+        selected = [r for r in self.records if low < r[0] <= high]
+        groups = {}
+        if 'UseMaterial' in sql:
+            self.loads.append((low, high))
+            for _, product_id, _, lines in selected:
+                for material_id, quantity in lines:
+                    groups[(product_id, material_id)] = groups.get((product_id, material_id), 0) + quantity
+            self.rows = [key + (total,) for key, total in groups.items()]
+        else:
+            for _, product_id, output, _ in selected:
+                runs, total = groups.get(product_id, (0, 0))
+                groups[product_id] = (runs + 1, total + output)
+            self.rows = [(product_id,) + value for product_id, value in groups.items()]
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(params=['numpy', 'dict'])
+def planner(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(planning, 'numpy', None)
+    return RequirementsPlanner(refresh_interval=3600)
+
+
+def loaded(planner, records=HISTORY):
+    conn = FakeConnection(records)
+    planner.refresh(conn)
+    return conn
+
+
+def test_coefficients_are_consumption_per_unit_of_output(planner):
+    loaded(planner)
+
+    assert planner.coefficients([1, 3]) == {1: {10: pytest.approx(0.4), 11: pytest.approx(0.1)},
+                                             3: {11: pytest.approx(0.2)}}
+
+
+def test_zero_output_and_unknown_products_have_no_coefficients(planner):
+    loaded(planner)
+
+    assert planner.coefficients([2, 99]) == {}
+    assert planner.history([2, 99]) == {2: (1, 0.0)}
+
+
+def test_history_counts_runs_and_output(planner):
+    loaded(planner)
+
+    assert planner.history([1, 3]) == {1: (2, 200.0), 3: (1, 40.0)}
+
+
+def test_demand_sums_planned_output_times_coefficients(planner):
+    loaded(planner)
+    demand = planner.demand({1: 50, 2: 1000, 3: 10, 99: 5})
+
+    # 原料 12 没有用量，产品 2、99 无法估算，都不计入
+    assert demand == {10: pytest.approx(20.0), 11: pytest.approx(7.0)}
+    assert planner.demand({}) == {}
+
+
+def test_refresh_only_loads_new_records(planner):
+    conn = loaded(planner, HISTORY[:2])
+    conn.records = HISTORY
+    planner.mark_dirty()
+    planner.refresh(conn)
+
+    assert conn.loads == [(0, 2), (2, 4)]
+    assert planner.stats()['records'] == 4 and planner.stats()['rebuilds'] == 0
+    assert planner.coefficients([3]) == {3: {11: pytest.approx(0.2)}}
+
+
+def test_refresh_is_skipped_until_dirty_or_interval(planner):
+    conn = loaded(planner)
+    planner.refresh(conn)
+
+    assert planner.stats()['refreshes'] == 1
+    planner.refresh(conn, force=True)
+    assert planner.stats()['refreshes'] == 2
+
+
+def test_late_commit_below_the_watermark_triggers_rebuild(planner):
+    conn = loaded(planner, [HISTORY[0], HISTORY[3]])
+    conn.records = HISTORY  # record 2、3 在 record 4 之后才提交
+    planner.mark_dirty()
+    planner.refresh(conn)
+
+    assert planner.stats()['rebuilds'] == 1
+    assert conn.loads[-1] == (0, 4)
+    assert planner.history([1]) == {1: (2, 200.0)}
+    assert planner.coefficients([1]) == {1: {10: pytest.approx(0.4), 11: pytest.approx(0.1)}}
+
+
+def test_empty_history(planner):
+    loaded(planner, [])
+
+    assert planner.demand({1: 10}) == {} and planner.coefficients([1]) == {}
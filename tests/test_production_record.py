@@ -0,0 +1,81 @@
+import inspect
+
+import pyodbc
+import pytest
+
+import app as app_module
+from app import add_production_record, app, procedure_error
+
+# 去掉登录和幂等装饰器，直接调用视图函数
+view = inspect.unwrap(add_production_record)
+
+
+def sql_server_error(number, message):
+    return pyodbc.Error('42000', f'[42000] [Microsoft][ODBC Driver 18 for SQL Server][SQL Server]{message} '
+                                 f'({number}) (SQLExecDirectW)')
+
+
+class FakeConnection:
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = []
+        self.autocommit = True
+        self.rollbacks = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params):
+        if self.error is not None:
+            raise self.error
+        self.calls.append((sql, params))
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def test_procedure_error_extracts_thrown_number_and_message():
+    assert procedure_error(sql_server_error(50104, '原料库存不足: 3')) == (50104, '原料库存不足: 3')
+
+
+def test_other_database_errors_are_not_procedure_errors():
+    error = pyodbc.Error('08S01', '[08S01] [Microsoft][ODBC Driver 18 for SQL Server]通讯链接失败 (0)')
+    assert procedure_error(error) == (None, None)
+
+
+def post(monkeypatch, conn):
+    monkeypatch.setattr(app_module, 'get_db', lambda: conn)
+    body = {'product_id': 1, 'line_id': 2, 'date': '2026-01-05', 'theoretical_output': 100,
+            'actual_output': 95, 'materials': [{'material_id': 3, 'quantity': 10}]}
+    with app.test_request_context('/production_records', method='POST', json=body):
+        response, status = view()
+        return response.get_json(), status
+
+
+@pytest.mark.parametrize('number, message, status', [
+    (50101, '产品ID 1 不存在', 400),
+    (50102, '生产线ID 2 不存在', 400),
+    (50103, '以下原料ID不存在: 3', 400),
+    (50104, '原料库存不足: 3', 409),
+])
+def test_validation_errors_from_the_procedure_map_to_client_errors(monkeypatch, number, message, status):
+    conn = FakeConnection(error=sql_server_error(number, message))
+
+    assert post(monkeypatch, conn) == ({'error': message}, status)
+    assert conn.rollbacks == 1
+
+
+def test_unexpected_database_error_is_a_server_error(monkeypatch):
+    body, status = post(monkeypatch, FakeConnection(error=sql_server_error(547, '违反外键约束')))
+
+    assert status == 500 and body['error'].startswith('数据库错误: ')
+
+
+def test_invalid_body_is_rejected_before_calling_the_procedure(monkeypatch):
+    conn = FakeConnection()
+    monkeypatch.setattr(app_module, 'get_db', lambda: conn)
+    with app.test_request_context('/production_records', method='POST', json={'product_id': 1}):
+        response, status = view()
+
+    assert status == 400 and response.get_json()['error'] == '缺少必要字段: line_id'
+    assert conn.calls == []
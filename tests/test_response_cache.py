@@ -0,0 +1,128 @@
+import time
+
+import pytest
+
+import app as app_module
+from app import app, delete_material, get_materials_stock_at, response_cache
+from response_cache import LocalCacheBackend, ResponseCache, create_response_cache
+
+
+def make_cache(**kwargs):
+    return ResponseCache(LocalCacheBackend(kwargs.pop('max_entries', 16)), **kwargs)
+
+
+def test_invalidate_moves_namespace_to_a_new_key():
+    cache = make_cache()
+    key = cache.key('materials', '/materials?')
+    cache.set(key, {'etag': 'a'})
+
+    assert cache.get(cache.key('materials', '/materials?')) == {'etag': 'a'}
+    cache.invalidate('materials')
+    assert cache.key('materials', '/materials?') != key
+    assert cache.get(cache.key('materials', '/materials?')) is None
+
+
+def test_invalidation_is_per_namespace():
+    cache = make_cache()
+    key = cache.key('products', '/products?')
+    cache.set(key, {'etag': 'p'})
+    cache.invalidate('materials')
+
+    assert cache.get(cache.key('products', '/products?')) == {'etag': 'p'}
+    assert cache.stats()['invalidations'] == 1
+
+
+def test_entries_expire_after_ttl():
+    cache = make_cache(ttl=0.01)
+    key = cache.key('materials', '/materials?')
+    cache.set(key, {'etag': 'a'})
+    time.sleep(0.02)
+
+    assert cache.get(key) is None
+    assert cache.stats()['misses'] == 1
+
+
+def test_local_backend_evicts_least_recently_used():
+    backend = LocalCacheBackend(max_entries=2)
+    backend.set('a', 1, 60)
+    backend.set('b', 2, 60)
+    backend.get('a')
+    backend.set('c', 3, 60)
+
+    assert backend.get('b') is None and backend.get('a') == 1 and backend.size() == 2
+
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError):
+        create_response_cache('memcached')
+
+
+# 原料目录与删除接口共用的数据库：stock_at 返回 stock 列，删除时原料存在且没有关联记录
+class FakeDatabase:
+    def __init__(self):
+        self.stock = 40
+        self.queries = 0
+        self.description = [('material_id',), ('name',), ('unit',), ('stock',)]
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params=()):
+        self.queries += 1
+        self.sql = sql
+
+    def fetchone(self):
+        if 'snapshot_date' in self.sql:
+            return (None,)
+        return (1,) if 'FROM ChemicalMaterial' in self.sql else None
+
+    def fetchall(self):
+        return [(1, '硫酸', 'kg', self.stock)]
+
+    def commit(self):
+        pass
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(app_module, 'get_db', lambda: database)
+    response_cache.invalidate('materials')
+    return database
+
+
+# 只去掉登录装饰器，保留 cached_response
+def stock_at(if_none_match=None):
+    headers = {'If-None-Match': if_none_match} if if_none_match else {}
+    with app.test_request_context('/materials/stock_at?date=2026-01-05', headers=headers):
+        response = get_materials_stock_at.__wrapped__()
+        return response.status_code, response.headers.get('ETag'), response.get_data()
+
+
+def test_second_request_is_served_from_cache(db):
+    status, etag, body = stock_at()
+    queries = db.queries
+
+    assert status == 200 and etag.startswith('"') and not etag.startswith('W/')
+    assert stock_at() == (200, etag, body)
+    assert db.queries == queries
+
+
+def test_matching_etag_returns_304_without_querying(db):
+    _, etag, _ = stock_at()
+    queries = db.queries
+    status, _, _ = stock_at(if_none_match=etag)
+
+    assert status == 304
+    assert db.queries == queries
+
+
+def test_write_invalidates_cached_catalog(db):
+    _, etag, _ = stock_at()
+    db.stock = 30
+    with app.test_request_context('/materials/1', method='DELETE'):
+        assert delete_material.__wrapped__(1)[1] == 200
+
+    status, new_etag, body = stock_at(if_none_match=etag)
+    assert status == 200 and new_etag != etag
+    assert b'30' in body
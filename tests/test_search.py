@@ -0,0 +1,260 @@
+import time
+
+import pyodbc
+import pytest
+
+import search
+from db_pool import PoolExhaustedError
+from search import CatalogSearchIndex, SearchIndexLoader, _PrefixList, normalize
+
+FIELDS = ['material_id', 'name', 'cas_number', 'category']
+
+CATALOG = [
+    (1, '硫酸', '7664-93-9', 'acid'),
+    (2, '盐酸', '7647-01-0', 'acid'),
+    (3, '氢氧化钠', '1310-73-2', 'base'),
+    (4, '浓硫酸', '7664-93-9x', 'acid'),
+    (5, 'Sulfur', '7704-34-9', 'solid'),
+    (6, '硫酸铜', '7758-98-7', 'salt'),
+]
+
+
+class FakeConnection:
+    def __init__(self, rows, during_fetch=None):
+        self.rows = rows
+        self.during_fetch = during_fetch  # 模拟全量读取期间其他请求的修改
+        self.description = [(name,) for name in FIELDS]
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        pass
+
+    def fetchall(self):
+        if self.during_fetch is not None:
+            self.during_fetch()
+        return list(self.rows)
+
+    def close(self):
+        pass
+
+    def commit(self):
+        pass
+
+
+def make_index(rows=CATALOG):
+    index = CatalogSearchIndex('materials', 'SELECT ...', 'material_id', FIELDS, cas_field='cas_number',
+                               filter_fields=['category'])
+    index.rebuild(FakeConnection(rows))
+    return index
+
+
+def doc(material_id, name, cas_number=None, category='acid'):
+    return {'material_id': material_id, 'name': name, 'cas_number': cas_number, 'category': category}
+
+
+def ids(results):
+    return [r['material_id'] for r in results]
+
+
+# 倒排列表与逐条计算的结果一致，且按 (名称长度, 名称, id) 排序
+def assert_consistent(index):
+    expected = {}
+    for doc_id, name in index._norm.items():
+        for gram in search._grams(name):
+            expected.setdefault(gram, []).append(doc_id)
+    for posting in expected.values():
+        posting.sort(key=index._rank)
+    assert index._postings == expected
+    assert sorted(index._name_keys._items) == index._name_keys._items
+    assert {doc_id for _, doc_id in index._name_keys._items} == set(index._docs)
+
+
+def test_bulk_load_builds_sorted_postings():
+    assert_consistent(make_index())
+
+
+def test_ranking_order_across_tiers():
+    index = make_index()
+
+    results = index.search('硫酸')
+    assert [(r['material_id'], r['match']) for r in results] == [
+        (1, 'name'), (6, 'name_prefix'), (4, 'substring')]
+
+
+def test_cas_number_exact_and_prefix():
+    index = make_index()
+
+    assert [(r['material_id'], r['match']) for r in index.search('7664-93-9')] == [
+        (1, 'cas_number'), (4, 'cas_number_prefix')]
+
+
+def test_pinyin_tier_comes_after_prefixes(monkeypatch):
+    monkeypatch.setattr(search, 'pinyin_keys', lambda name: {'硫酸': ['liusuan', 'ls'], '盐酸': ['yansuan', 'ys']}
+                        .get(name, []))
+    index = make_index()
+
+    assert [(r['material_id'], r['match']) for r in index.search('ls')] == [(1, 'pinyin')]
+    index.upsert(doc(7, 'LS-100'))
+    assert [(r['material_id'], r['match']) for r in index.search('ls')] == [(7, 'name_prefix'), (1, 'pinyin')]
+
+
+def test_single_cjk_character_and_bigram_queries():
+    index = make_index()
+
+    # 按名称长度排序，长度相同时按名称
+    assert ids(index.search('酸')) == [2, 1, 4, 6]
+    assert ids(index.search('氧化')) == [3]
+    # 单个非汉字字符没有可用的倒排列表，只按前缀匹配
+    assert ids(index.search('s')) == [5]
+
+
+def test_query_is_normalized():
+    index = make_index()
+
+    assert normalize('ＳＵＬ fur') == 'sulfur'
+    assert [r['match'] for r in index.search('ＳＵＬ fur')] == ['name']
+
+
+def test_limit_and_filters():
+    index = make_index()
+
+    assert ids(index.search('酸', limit=2)) == [2, 1]
+    assert ids(index.search('酸', filters={'category': {'salt'}})) == [6]
+    assert index.search('酸', filters={'category': {'gas'}}) == []
+
+
+def test_upsert_rename_moves_the_item_between_postings():
+    index = make_index()
+    index.upsert(doc(2, '氯化钠', '7647-14-5', 'salt'))
+
+    assert_consistent(index)
+    assert ids(index.search('盐酸')) == []
+    assert ids(index.search('化钠')) == [2, 3]
+    assert ids(index.search('7647-01-0')) == []
+    assert ids(index.search('7647-14-5')) == [2]
+
+
+def test_upsert_new_item_keeps_substring_order():
+    index = make_index()
+    index.upsert(doc(8, '酸'))
+    index.upsert(doc(9, '稀硫酸溶液'))
+
+    assert_consistent(index)
+    assert ids(index.search('酸'))[:1] == [8]
+    assert ids(index.search('硫酸'))[-1] == 9
+
+
+def test_remove_clears_every_key():
+    index = make_index()
+    index.remove(1)
+    index.remove(99)  # 不存在的ID忽略
+
+    assert_consistent(index)
+    assert 1 not in ids(index.search('硫酸'))
+    assert ids(index.search('7664-93-9')) == [4]
+    assert index.stats()['entries'] == 5
+
+
+def test_removing_a_duplicate_keeps_exact_matches_for_the_other_item():
+    index = make_index()
+    index.upsert(doc(10, '硫酸', '7664-93-9'))
+    index.remove(10)
+
+    assert_consistent(index)
+    assert (index.search('硫酸')[0]['material_id'], index.search('硫酸')[0]['match']) == (1, 'name')
+    assert (index.search('7664-93-9')[0]['material_id'], index.search('7664-93-9')[0]['match']) == (1, 'cas_number')
+
+
+def test_changes_during_rebuild_are_replayed():
+    index = make_index()
+
+    def concurrent_writes():
+        index.upsert(doc(20, '硝酸'))
+        index.remove(2)
+
+    index.rebuild(FakeConnection(CATALOG, during_fetch=concurrent_writes))
+
+    assert_consistent(index)
+    assert ids(index.search('硝酸')) == [20]
+    assert ids(index.search('盐酸')) == []
+    assert index.stats()['builds'] == 2
+
+
+def test_failed_rebuild_keeps_the_old_index():
+    index = make_index()
+
+    def fail():
+        raise pyodbc.Error('08S01', '连接断开')
+
+    with pytest.raises(pyodbc.Error):
+        index.rebuild(FakeConnection(CATALOG, during_fetch=fail))
+    index.upsert(doc(21, '醋酸'))
+
+    assert ids(index.search('硫酸'))[0] == 1
+    assert index._pending == []
+
+
+def test_prefix_list():
+    keys = _PrefixList([('ab', 2), ('abc', 1), ('b', 3)])
+    keys.add('aa', 4)
+    keys.remove('abc', 1)
+    keys.remove('abc', 1)
+
+    assert list(keys.prefixed('a')) == [('aa', 4), ('ab', 2)]
+    assert list(keys.prefixed('c')) == []
+    assert keys.first('ab') == 2 and keys.first('a') is None
+
+
+class FakePool:
+    def __init__(self, error):
+        self.error = error
+
+    def acquire(self):
+        raise self.error
+
+
+class FakeLogger:
+    def __init__(self):
+        self.messages = []
+
+    def warning(self, message):
+        self.messages.append(message)
+
+    def exception(self, message):
+        self.messages.append(message)
+
+
+@pytest.mark.parametrize('error, message', [
+    (PoolExhaustedError('连接池耗尽'), '重建搜索索引失败: 连接池耗尽'),
+    (RuntimeError('bug'), '重建搜索索引时发生未预期的错误'),
+])
+def test_loader_thread_survives_errors(error, message):
+    logger = FakeLogger()
+    loader = SearchIndexLoader(lambda: FakePool(error), {}, interval=0.01, logger=logger)
+    loader.start()
+    deadline = time.monotonic() + 5
+    while loader.stats()['errors'] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    loader.stop()
+    loader._thread.join(5)
+
+    assert loader.stats()['errors'] >= 2
+    assert logger.messages[0] == message
+
+
+def test_loader_loads_indexes_on_demand():
+    index = CatalogSearchIndex('materials', 'SELECT ...', 'material_id', FIELDS, cas_field='cas_number')
+
+    class Pool:
+        def acquire(self):
+            return FakeConnection(CATALOG)
+
+        def release(self, conn, discard=False):
+            pass
+
+    loader = SearchIndexLoader(lambda: Pool(), {'materials': index})
+    loader.ensure_loaded(index)
+
+    assert index.loaded and ids(index.search('盐酸')) == [2]
@@ -0,0 +1,138 @@
+import datetime
+import decimal
+import gzip
+import json
+import types
+
+import pytest
+from flask import Response
+
+import serializer
+from app import app, compress_response, response_format
+from serializer import UnsupportedFormatError
+
+
+def test_json_matches_flask_conversions():
+    body = serializer.dumps_json({'b': decimal.Decimal('1.50'), 'a': datetime.date(2026, 1, 5), 'name': '硫酸'})
+
+    assert json.loads(body) == {'a': 'Mon, 05 Jan 2026 00:00:00 GMT', 'b': '1.50', 'name': '硫酸'}
+    assert body.index(b'"a"') < body.index(b'"b"')
+    assert '硫酸'.encode('utf-8') in body
+
+
+def test_items_to_columns_uses_the_first_items_keys():
+    items = [{'id': 1, 'name': 'a'}, {'name': 'b', 'id': 2, 'extra': True}, {'id': 3}]
+
+    assert serializer.items_to_columns(items) == {
+        'columns': ['id', 'name'], 'rows': [[1, 'a'], [2, 'b'], [3, None]]}
+    assert serializer.items_to_columns([]) == {'columns': [], 'rows': []}
+
+
+def accept(header):
+    with app.test_request_context('/', headers={'Accept': header} if header else {}) as ctx:
+        return ctx.request.accept_mimetypes
+
+
+@pytest.mark.parametrize('format_arg, header, expected', [
+    (None, None, 'json'),
+    (None, 'application/vnd.chemical-factory.columns+json', 'columns'),
+    ('columns', 'application/json', 'columns'),
+    (None, 'text/html', 'json'),
+])
+def test_negotiate_format(format_arg, header, expected):
+    assert serializer.negotiate_format(format_arg, accept(header)) == expected
+
+
+def test_msgpack_is_negotiated_only_when_installed(monkeypatch):
+    monkeypatch.setattr(serializer, 'msgpack', None)
+    with pytest.raises(UnsupportedFormatError):
+        serializer.negotiate_format('msgpack', accept(None))
+
+    monkeypatch.setattr(serializer, 'msgpack', types.SimpleNamespace())
+    assert serializer.negotiate_format(None, accept('application/x-msgpack')) == 'msgpack'
+
+
+def test_msgpack_round_trip():
+    msgpack = pytest.importorskip('msgpack')
+    body, mimetype = serializer.encode({'columns': ['stock'], 'rows': [[decimal.Decimal('2.50')]]}, 'msgpack')
+
+    assert mimetype == serializer.MSGPACK_MIMETYPE
+    assert msgpack.unpackb(body) == {'columns': ['stock'], 'rows': [['2.50']]}
+
+
+@pytest.mark.parametrize('query, status', [('format=xml', 406), ('format=columns', None)])
+def test_unknown_format_is_406(query, status):
+    with app.test_request_context(f'/materials?{query}'):
+        fmt, error = response_format()
+
+    if status is None:
+        assert fmt == 'columns' and error is None
+    else:
+        assert error[1] == 406 and 'xml' in error[0].get_json()['error']
+
+
+def accept_encoding(header):
+    with app.test_request_context('/', headers={'Accept-Encoding': header}) as ctx:
+        return ctx.request.accept_encodings
+
+
+def test_negotiate_encoding_prefers_brotli_when_installed(monkeypatch):
+    monkeypatch.setattr(serializer, 'brotli', None)
+    assert serializer.negotiate_encoding(accept_encoding('br, gzip')) == 'gzip'
+    assert serializer.negotiate_encoding(accept_encoding('br')) is None
+    assert serializer.negotiate_encoding(accept_encoding('identity')) is None
+
+    monkeypatch.setattr(serializer, 'brotli', types.SimpleNamespace())
+    assert serializer.negotiate_encoding(accept_encoding('gzip, br')) == 'br'
+
+
+def test_gzip_output_is_deterministic():
+    data = b'x' * 5000
+
+    assert serializer.compress(data, 'gzip') == serializer.compress(data, 'gzip')
+    assert gzip.decompress(serializer.compress(data, 'gzip')) == data
+
+
+def compressed(response, encoding='gzip'):
+    with app.test_request_context('/materials', headers={'Accept-Encoding': encoding}):
+        return compress_response(response)
+
+
+def test_large_response_is_compressed_and_etag_weakened():
+    body = json.dumps([{'name': '硫酸'}] * 500).encode('utf-8')
+    response = Response(body, mimetype='application/json')
+    response.set_etag('abc')
+    response = compressed(response)
+
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.get_data()) == body
+    assert response.headers['ETag'] == 'W/"abc"'
+    assert 'Accept-Encoding' in response.vary
+
+
+def test_response_without_content_length_is_compressed():
+    chunk = b'{"name": "sulfuric acid"}\n' * 100
+    response = Response([chunk, chunk])
+    assert response.content_length is None
+
+    response = compressed(response)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.get_data()) == chunk * 2
+
+
+@pytest.mark.parametrize('make_response', [
+    lambda: Response(b'small'),
+    lambda: Response([b'small']),
+    lambda: Response(iter([b'x' * 5000])),
+    lambda: Response(b'x' * 5000, status=304),
+])
+def test_small_streamed_and_bodyless_responses_are_not_compressed(make_response):
+    response = compressed(make_response())
+
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_client_without_gzip_gets_identity():
+    response = compressed(Response(b'x' * 5000), encoding='identity')
+
+    assert 'Content-Encoding' not in response.headers and 'Accept-Encoding' in response.vary
@@ -0,0 +1,167 @@
+import types
+
+import pyodbc
+import pytest
+
+import app as app_module
+import asgi
+from app import DEFAULT_SECRET_KEY, REQUIRED_DB_OBJECTS, app, create_app, self_check
+
+
+@pytest.fixture
+def starts(monkeypatch):
+    calls = []
+    monkeypatch.setattr(app_module, '_background_started', False)
+    for name in ('stock_ledger_folder', 'search_index_loader', 'event_broadcaster'):
+        monkeypatch.setattr(getattr(app_module, name), 'start', lambda name=name: calls.append(name))
+    monkeypatch.setattr(app_module, 'read_router', None)
+    return calls
+
+
+def test_create_app_starts_background_tasks_once(starts):
+    assert create_app(start_background=False) is app
+    assert starts == []
+
+    assert create_app() is create_app() is app
+    assert sorted(starts) == ['event_broadcaster', 'search_index_loader', 'stock_ledger_folder']
+
+
+def test_create_application_reuses_the_adapter(starts, monkeypatch):
+    collectors = []
+    monkeypatch.setattr(asgi, '_application', None)
+    monkeypatch.setattr(asgi, 'metrics', types.SimpleNamespace(register_collector=collectors.append))
+    adapter = asgi.create_application(start_background=False)
+
+    assert asgi.create_application() is adapter
+    assert asgi.application is adapter
+    assert collectors == [adapter.collect_metrics]
+    assert len(starts) == 3
+
+
+@pytest.fixture
+def config(monkeypatch):
+    monkeypatch.setitem(app.config, 'SECRET_KEY', 'x' * 32)
+    monkeypatch.setitem(app.config, 'DB_REPLICA_CONNECTION_STRING', '')
+    for name in ('CACHE_BACKEND', 'EVENTS_BACKEND', 'IDEMPOTENCY_BACKEND'):
+        monkeypatch.setitem(app.config, name, 'redis')
+    monkeypatch.setattr(app_module, 'read_router', None)
+    checked = []
+
+    def check_db_objects(connection_string, objects, label):
+        checked.append((label, objects))
+        return []
+    monkeypatch.setattr(app_module, 'check_db_objects', check_db_objects)
+    return checked
+
+
+def test_self_check_passes_with_a_complete_setup(config):
+    assert self_check(workers=4) == []
+    assert config == [('数据库', REQUIRED_DB_OBJECTS)]
+
+
+@pytest.mark.parametrize('secret_key', [DEFAULT_SECRET_KEY, 'short'])
+def test_self_check_rejects_a_weak_secret_key(config, secret_key):
+    app.config['SECRET_KEY'] = secret_key
+
+    assert [p for p in self_check() if 'SECRET_KEY' in p] != []
+
+
+def test_local_backends_are_reported_only_for_several_workers(config):
+    app.config['EVENTS_BACKEND'] = 'local'
+
+    assert self_check(workers=1) == []
+    problems = self_check(workers=2)
+    assert len(problems) == 1 and 'EVENTS_BACKEND=redis' in problems[0]
+
+
+def test_replica_is_checked_with_its_heartbeat_table(config):
+    app.config['DB_REPLICA_CONNECTION_STRING'] = 'DSN=replica'
+    self_check()
+
+    assert [label for label, _ in config] == ['主库', '只读副本']
+    assert all(objects[-1][0] == 'ReplicaHeartbeat' for _, objects in config)
+
+
+# /healthz 使用的连接池：acquire 返回 conn，或抛出 error；记录归还时是否丢弃连接
+class FakePool:
+    def __init__(self, conn=None, error=None):
+        self.conn = conn
+        self.error = error
+        self.released = []
+
+    def acquire(self, block=True, connect_timeout=None):
+        if self.error is not None:
+            raise self.error
+        return self.conn
+
+    def release(self, conn, discard=False):
+        self.released.append(discard)
+
+
+class FakeConnection:
+    def __init__(self, error=None):
+        self.error = error
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        if self.error is not None:
+            raise self.error
+        return self
+
+    def fetchone(self):
+        return (1,)
+
+    def commit(self):
+        pass
+
+
+def healthz(monkeypatch, pool):
+    monkeypatch.setattr(app_module, 'get_pool', lambda: pool)
+    monkeypatch.setattr(app_module, 'read_router', None)
+    response = app.test_client().get('/healthz')
+    return response.status_code, response.get_json()
+
+
+def test_healthz_ok(monkeypatch):
+    pool = FakePool(FakeConnection())
+
+    assert healthz(monkeypatch, pool) == (200, {'status': 'ok', 'db': 'ok'})
+    assert pool.released == [False]
+
+
+def test_healthz_busy_pool_is_still_healthy(monkeypatch):
+    assert healthz(monkeypatch, FakePool()) == (200, {'status': 'ok', 'db': 'busy'})
+
+
+def test_healthz_connect_failure_is_503(monkeypatch):
+    status, body = healthz(monkeypatch, FakePool(error=pyodbc.Error('登录超时\n详细信息')))
+
+    assert status == 503 and body == {'status': 'error', 'db': '登录超时'}
+
+
+def test_healthz_query_failure_discards_the_connection(monkeypatch):
+    pool = FakePool(FakeConnection(error=pyodbc.Error('连接已断开')))
+
+    assert healthz(monkeypatch, pool)[0] == 503
+    assert pool.released == [True]
+
+
+# gunicorn 主进程：记录日志的 server
+class FakeServer:
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.log = types.SimpleNamespace(errors=[], error=lambda msg: self.log.errors.append(msg),
+                                         info=lambda msg: None)
+
+
+def test_on_starting_exits_when_self_check_fails(config):
+    serve = pytest.importorskip('serve')
+    app.config['CACHE_BACKEND'] = 'local'
+    server = FakeServer(num_workers=2)
+
+    with pytest.raises(SystemExit):
+        serve.on_starting(server)
+    assert len(server.log.errors) == 1 and 'CACHE_BACKEND' in server.log.errors[0]
+    serve.on_starting(FakeServer(num_workers=1))
@@ -0,0 +1,71 @@
+import datetime
+import decimal
+
+import pytest
+
+import app as app_module
+from app import app, stock_at_response
+
+
+class FakeCursor:
+    description = [('material_id',), ('name',), ('unit',), ('stock',)]
+
+    def __init__(self, snapshot_date):
+        self.snapshot_date = snapshot_date
+        self.queries = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params):
+        self.queries.append((' '.join(sql.split()), params))
+
+    def fetchone(self):
+        return (self.snapshot_date,)
+
+    def fetchall(self):
+        return [(1, '硫酸', 'kg', decimal.Decimal('40.00'))]
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    def install(snapshot_date):
+        cursor = FakeCursor(snapshot_date)
+        monkeypatch.setattr(app_module, 'get_db', lambda: cursor)
+        return cursor
+    return install
+
+
+def test_latest_snapshot_plus_later_movements(fake_db):
+    cursor = fake_db(datetime.date(2026, 1, 4))
+    with app.test_request_context('/materials/stock_at?date=2026-01-05'):
+        response = stock_at_response('materials')
+
+    assert cursor.queries[0][1] == ('M', datetime.date(2026, 1, 5))
+    sql, params = cursor.queries[1]
+    assert 'ISNULL(s.stock, 0) + ISNULL(d.quantity, 0)' in sql
+    assert params == ('M', datetime.date(2026, 1, 4), datetime.date(2026, 1, 4), datetime.date(2026, 1, 5))
+    assert response.headers['X-Stock-Snapshot-Date'] == '2026-01-04'
+    assert response.get_json() == [{'material_id': 1, 'name': '硫酸', 'unit': 'kg', 'stock': '40.00'}]
+
+
+def test_without_snapshot_current_stock_minus_later_movements(fake_db):
+    cursor = fake_db(None)
+    with app.test_request_context('/materials/stock_at?date=2026-01-05'):
+        response = stock_at_response('materials')
+
+    sql, params = cursor.queries[1]
+    assert 'ISNULL(c.stock, 0) - ISNULL(d.quantity, 0)' in sql
+    assert params == (datetime.date(2026, 1, 5),)
+    assert 'X-Stock-Snapshot-Date' not in response.headers
+
+
+@pytest.mark.parametrize('query, message', [
+    ('', '缺少参数 date'),
+    ('date=2026-13-40', '参数 date 格式错误'),
+])
+def test_date_is_required(fake_db, query, message):
+    with app.test_request_context(f'/materials/stock_at?{query}'):
+        response, status = stock_at_response('materials')
+
+    assert status == 400 and response.get_json()['error'] == message
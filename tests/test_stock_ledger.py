@@ -0,0 +1,103 @@
+import time
+
+import pyodbc
+import pytest
+
+from db_pool import PoolExhaustedError
+from stock_ledger import StockLedgerFolder
+
+
+class FakePool:
+    def __init__(self, batches=(), error=None):
+        self.batches = list(batches)  # 每次调用 sp_FoldStockLedger 合并的行数
+        self.error = error
+        self.calls = []
+        self.commits = 0
+        self.released = []
+
+    def acquire(self):
+        if isinstance(self.error, PoolExhaustedError):
+            raise self.error
+        return self
+
+    def release(self, conn, discard=False):
+        self.released.append(discard)
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params):
+        if self.error is not None:
+            raise self.error
+        self.calls.append(params)
+
+    def fetchone(self):
+        return (self.batches.pop(0),)
+
+    def commit(self):
+        self.commits += 1
+
+
+class FakeLogger:
+    def __init__(self):
+        self.messages = []
+
+    def warning(self, message):
+        self.messages.append(message)
+
+    def exception(self, message):
+        self.messages.append(message)
+
+
+def test_fold_continues_while_batches_are_full():
+    pool = FakePool(batches=[10, 10, 3])
+    folder = StockLedgerFolder(lambda: pool, interval=0, batch_size=10)
+
+    assert folder.fold() == 23
+    assert pool.calls == [(10,), (10,), (10,)]
+    assert pool.commits == 3 and pool.released == [False]
+    assert folder.stats()['folded_rows'] == 23
+
+
+def test_database_error_discards_the_connection():
+    pool = FakePool(error=pyodbc.Error('40001', '死锁'))
+    folder = StockLedgerFolder(lambda: pool, interval=0)
+
+    with pytest.raises(pyodbc.Error):
+        folder.fold()
+    assert pool.released == [True]
+    assert folder.stats()['runs'] == 1
+
+
+def run_until_errors(folder, count):
+    folder.start()
+    deadline = time.monotonic() + 5
+    while folder.stats()['errors'] < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    folder.stop()
+    folder._thread.join(5)
+
+
+def test_background_thread_survives_exhausted_pool():
+    logger = FakeLogger()
+    folder = StockLedgerFolder(lambda: FakePool(error=PoolExhaustedError('连接池耗尽')), interval=0.01, logger=logger)
+    run_until_errors(folder, 2)
+
+    assert folder.stats()['errors'] >= 2
+    assert logger.messages[0] == '合并库存流水失败: 连接池耗尽'
+
+
+def test_background_thread_survives_unexpected_errors():
+    logger = FakeLogger()
+    folder = StockLedgerFolder(lambda: FakePool(error=RuntimeError('bug')), interval=0.01, logger=logger)
+    run_until_errors(folder, 2)
+
+    assert folder.stats()['errors'] >= 2
+    assert logger.messages[0] == '合并库存流水时发生未预期的错误'
+
+
+def test_zero_interval_does_not_start_a_thread():
+    folder = StockLedgerFolder(lambda: FakePool(), interval=0)
+    folder.start()
+
+    assert folder.stats()['running'] is False
@@ -0,0 +1,69 @@
+import time
+
+import jwt
+
+from app import app, token_required
+from token_cache import TokenCache
+
+
+def test_cached_payload_is_returned_until_ttl():
+    cache = TokenCache(ttl=0.05)
+    cache.put('t1', {'username': 'alice', 'role': 'admin'})
+
+    assert cache.get('t1') == {'username': 'alice', 'role': 'admin'}
+    time.sleep(0.06)
+    assert cache.get('t1') is None
+    assert cache.stats()['size'] == 0
+
+
+def test_entry_never_outlives_token_exp():
+    cache = TokenCache(ttl=300)
+    cache.put('expired', {'username': 'alice', 'exp': time.time() - 1})
+    cache.put('valid', {'username': 'bob', 'exp': time.time() + 60})
+
+    assert cache.get('expired') is None
+    assert cache.get('valid')['username'] == 'bob'
+
+
+def test_least_recently_used_token_is_evicted():
+    cache = TokenCache(max_size=2)
+    cache.put('a', {})
+    cache.put('b', {})
+    cache.get('a')
+    cache.put('c', {})
+
+    assert cache.get('b') is None and cache.get('a') == {}
+    assert cache.stats()['evictions'] == 1
+
+
+def test_zero_size_disables_caching():
+    cache = TokenCache(max_size=0)
+    cache.put('a', {})
+
+    assert cache.get('a') is None
+
+
+@token_required()
+def whoami():
+    return {'user': 'ok'}, 200
+
+
+def call(token):
+    with app.test_request_context('/materials', headers={'Authorization': f'Bearer {token}'}):
+        response = app.make_response(whoami())
+        return response.status_code, response.get_json()
+
+
+def test_expired_token_is_not_served_from_cache():
+    exp = int(time.time()) + 1
+    token = jwt.encode({'username': 'alice', 'role': 'admin', 'exp': exp}, app.config['SECRET_KEY'])
+
+    assert call(token)[0] == 200
+    time.sleep(max(exp - time.time(), 0) + 0.05)
+    assert call(token) == (401, {'message': 'Token has expired!'})
+
+
+def test_tampered_token_is_rejected():
+    token = jwt.encode({'username': 'alice', 'role': 'admin'}, 'another-secret-that-is-long-enough-for-hs256')
+
+    assert call(token) == (401, {'message': 'Invalid token!'})